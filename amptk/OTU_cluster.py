@@ -36,6 +36,7 @@ def main(args):
     parser.add_argument('--map_filtered', action='store_true', help='map quality filtered reads back to OTUs')
     parser.add_argument('--unoise', action='store_true', help='Run De-noising (UNOISE)')
     parser.add_argument('--debug', action='store_true', help='Remove Intermediate Files')
+    parser.add_argument('--tmp_codec', default=amptklib.TMP_CODEC, choices=list(amptklib.CODEC_EXT), help='Compress intermediate files in tmp folder')
     parser.add_argument('--cpus', type=int, help="Number of CPUs. Default: auto")
     args=parser.parse_args(args)
 
@@ -73,7 +74,8 @@ def main(args):
     else:
         cpus = amptklib.getCPUS()
 
-    #make tmp folder
+    #make tmp folder, large intermediate files are compressed with --tmp_codec
+    amptklib.set_tmp_codec(args.tmp_codec)
     tmp = base + '_tmp'
     if not os.path.exists(tmp):
         os.makedirs(tmp)
@@ -81,46 +83,55 @@ def main(args):
     #Count FASTQ records
     amptklib.log.info("Loading FASTQ Records")
     #convert to FASTA for mapping
-    orig_fasta = os.path.join(tmp, base+'.orig.fa')
+    orig_fasta = amptklib.tmpname(os.path.join(tmp, base+'.orig.fa'))
     cmd = ['vsearch', '--fastq_filter', args.FASTQ, '--fastaout', orig_fasta, '--fastq_qmax', '55', '--threads', str(1)]
-    amptklib.runSubprocess(cmd, amptklib.log)
+    amptklib.runSubprocessCodec(cmd, amptklib.log, inputs=[args.FASTQ], outputs=[orig_fasta])
     orig_total = amptklib.countfasta(orig_fasta)
     size = amptklib.checkfastqsize(args.FASTQ)
     readablesize = amptklib.convertSize(size)
     amptklib.log.info('{0:,}'.format(orig_total) + ' reads (' + readablesize + ')')
 
-    #Expected Errors filtering step
-    filter_out = os.path.join(tmp, base + '.EE' + args.maxee + '.filter.fq')
-    filter_fasta = os.path.join(tmp, base + '.EE' + args.maxee + '.filter.fa')
-    amptklib.log.info("Quality Filtering, expected errors < %s" % args.maxee)
+    #Expected Errors filtering step, dereplication, optional UNOISE, and sort by size run
+    #at the same time with the files in between passed through named pipes unless --debug
+    filter_out = amptklib.tmpname(os.path.join(tmp, base + '.EE' + args.maxee + '.filter.fq'))
+    filter_fasta = amptklib.tmpname(os.path.join(tmp, base + '.EE' + args.maxee + '.filter.fa'))
     cmd = ['vsearch', '--fastq_filter', args.FASTQ, '--fastq_maxee', str(args.maxee), '--fastqout', filter_out, '--fastaout', filter_fasta, '--fastq_qmax', '55', '--threads', str(1)]
-    amptklib.runSubprocess(cmd, amptklib.log)
-    total = amptklib.countfastq(filter_out)
-    amptklib.log.info('{0:,}'.format(total) + ' reads passed')
+    stages = [(cmd, [args.FASTQ], [filter_out, filter_fasta])]
 
     #now run full length dereplication
-    derep_out = os.path.join(tmp, base + '.EE' + args.maxee + '.derep.fa')
-    amptklib.log.info("De-replication (remove duplicate reads)")
+    derep_out = amptklib.tmpname(os.path.join(tmp, base + '.EE' + args.maxee + '.derep.fa'))
     cmd = ['vsearch', '--derep_fulllength', filter_fasta, '--sizeout', '--output', derep_out, '--threads', str(1)]
-    amptklib.runSubprocess(cmd, amptklib.log)
-    total = amptklib.countfasta(derep_out)
-    amptklib.log.info('{0:,}'.format(total) + ' reads passed')
+    stages.append((cmd, [filter_fasta], [derep_out]))
 
     #optional run UNOISE
     if args.unoise:
         unoise_out = unoise_out = os.path.join(tmp, base + '.EE' + args.maxee + '.denoised.fa')
-        amptklib.log.info("Denoising Data with UNOISE")
         cmd = ['vsearch', '--cluster_fast', derep_out, '--centroids', unoise_out, '--id', '0.9', '--maxdiffs', '5', '--sizein', '--sizeout', '--threads', str(cpus)]
-        amptklib.runSubprocess(cmd, amptklib.log)
-        total = amptklib.countfasta(unoise_out)
-        amptklib.log.info('{0:,}'.format(total) + ' reads passed')
+        stages.append((cmd, [derep_out], [unoise_out]))
     else:
         unoise_out = derep_out
 
     #now sort by size remove singletons
-    sort_out = os.path.join(tmp, base + '.EE' + args.maxee + '.sort.fa')
+    sort_out = amptklib.tmpname(os.path.join(tmp, base + '.EE' + args.maxee + '.sort.fa'))
     cmd = ['vsearch', '--sortbysize', unoise_out, '--minsize', args.minsize, '--output', sort_out, '--threads', str(1)]
-    amptklib.runSubprocess(cmd, amptklib.log)
+    stages.append((cmd, [unoise_out], [sort_out]))
+
+    amptklib.log.info("Quality Filtering, expected errors < %s" % args.maxee)
+    amptklib.log.info("De-replication (remove duplicate reads)")
+    if args.unoise:
+        amptklib.log.info("Denoising Data with UNOISE")
+    #filtered reads are mapped to the OTUs later with --map_filtered
+    if args.debug:
+        keep = True
+    elif args.map_filtered:
+        keep = [filter_fasta]
+    else:
+        keep = []
+    totals = amptklib.runPipeline(stages, amptklib.log, keep=keep, counts=[filter_out, derep_out, unoise_out])
+    amptklib.log.info('{0:,}'.format(totals[filter_out]) + ' reads passed quality filtering')
+    amptklib.log.info('{0:,}'.format(totals[derep_out]) + ' unique sequences')
+    if args.unoise:
+        amptklib.log.info('{0:,}'.format(totals[unoise_out]) + ' reads passed')
 
     #now run clustering algorithm
     radius = str(100 - int(args.pct_otu))
@@ -128,13 +139,13 @@ def main(args):
     if args.cluster_method == 'usearch':
         amptklib.log.info("Clustering OTUs (UPARSE)")
         cmd = [usearch, '-cluster_otus', sort_out, '-relabel', 'OTU', '-otu_radius_pct', radius, '-otus', otu_out, '-threads', str(cpus)]
-        amptklib.runSubprocess(cmd, amptklib.log)
+        amptklib.runSubprocessCodec(cmd, amptklib.log, inputs=[sort_out])
     else: #run vsearch cluster smallmem and then run uchime de novo
         amptklib.log.info('Clustering OTUs (VSEARCH --cluster_smallmem)')
         smallMem = os.path.join(tmp, base + '.EE' + args.maxee + '.smallmem.otus.fa')
         smallMemSort = os.path.join(tmp, base + '.EE' + args.maxee + '.smallmem.min2.otus.fa')
         cmd = ['vsearch', '--cluster_smallmem', sort_out, '--relabel', 'OTU', '--usersort', '--sizeout', '--id', str(float(args.pct_otu)*.01), '--centroids', smallMem, '--threads', str(cpus)]
-        amptklib.runSubprocess(cmd, amptklib.log)
+        amptklib.runSubprocessCodec(cmd, amptklib.log, inputs=[sort_out])
         #cmd = ['vsearch', '--sortbysize', smallMem, '--minsize', args.minsize, '--output', smallMemSort, '--threads', str(1)]
         #amptklib.runSubprocess(cmd, amptklib.log)
         amptklib.log.info('De novo Chimera detection (VSEARCH --uchime_denovo)')
@@ -191,7 +202,7 @@ def main(args):
     amptklib.log.info('{:,} OTUs validated ({:,} dropped)'.format(numKept, numDropped))
 
     #now map reads back to OTUs and build OTU table
-    uc_out = os.path.join(tmp, base + '.EE' + args.maxee + '.mapping.uc')
+    uc_out = amptklib.tmpname(os.path.join(tmp, base + '.EE' + args.maxee + '.mapping.uc'))
     otu_table = os.path.join(tmp, base + '.EE' + args.maxee + '.otu_table.txt')
     #setup reads to map
     if args.map_filtered:
@@ -200,7 +211,7 @@ def main(args):
         reads = orig_fasta
     amptklib.log.info("Mapping Reads to OTUs and Building OTU table")
     cmd = ['vsearch', '--usearch_global', reads, '--strand', 'plus', '--id', '0.97', '--db', passingOTUs, '--uc', uc_out, '--otutabout', otu_table, '--threads', str(cpus)]
-    amptklib.runSubprocess(cmd, amptklib.log)
+    amptklib.runSubprocessCodec(cmd, amptklib.log, inputs=[reads], outputs=[uc_out])
 
     #count reads mapped
     total = amptklib.line_count2(uc_out)
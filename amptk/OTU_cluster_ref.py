@@ -51,6 +51,7 @@ def main(args):
     parser.add_argument('--utax_level', default='k', choices=['k','p','c','o','f','g','s'], help='UTAX classification level to retain')
     parser.add_argument('--mock', default='synmock', help='Spike-in mock community (fasta)')
     parser.add_argument('--debug', action='store_true', help='Remove Intermediate Files')
+    parser.add_argument('--tmp_codec', default=amptklib.TMP_CODEC, choices=list(amptklib.CODEC_EXT), help='Compress intermediate files in tmp folder')
     parser.add_argument('--closed_ref_only', action='store_true', help='Only run closed reference clustering')
     parser.add_argument('--cpus', type=int, help="Number of CPUs. Default: auto")
     args=parser.parse_args(args)
@@ -92,7 +93,8 @@ def main(args):
     else:
         cpus = amptklib.getCPUS()
 
-    #make tmp folder
+    #make tmp folder, large intermediate files are compressed with --tmp_codec
+    amptklib.set_tmp_codec(args.tmp_codec)
     tmp = base + '_tmp'
     if not os.path.exists(tmp):
         os.makedirs(tmp)
@@ -153,36 +155,36 @@ def main(args):
     #Count FASTQ records
     amptklib.log.info("Loading FASTQ Records")
     #convert to FASTA for mapping
-    orig_fasta = os.path.join(tmp, base+'.orig.fa')
+    orig_fasta = amptklib.tmpname(os.path.join(tmp, base+'.orig.fa'))
     cmd = ['vsearch', '--fastq_filter', args.FASTQ, '--fastaout', orig_fasta, '--fastq_qmax', '55', '--threads', str(cpus)]
-    amptklib.runSubprocess(cmd, amptklib.log)
+    amptklib.runSubprocessCodec(cmd, amptklib.log, inputs=[args.FASTQ], outputs=[orig_fasta])
     orig_total = amptklib.countfasta(orig_fasta)
     size = amptklib.checkfastqsize(args.FASTQ)
     readablesize = amptklib.convertSize(size)
     amptklib.log.info('{0:,}'.format(orig_total) + ' reads (' + readablesize + ')')
 
     #Expected Errors filtering step
-    filter_out = os.path.join(tmp, base + '.EE' + args.maxee + '.filter.fq')
-    filter_fasta = os.path.join(tmp, base + '.EE' + args.maxee + '.filter.fa')
+    filter_out = amptklib.tmpname(os.path.join(tmp, base + '.EE' + args.maxee + '.filter.fq'))
+    filter_fasta = amptklib.tmpname(os.path.join(tmp, base + '.EE' + args.maxee + '.filter.fa'))
     amptklib.log.info("Quality Filtering, expected errors < %s" % args.maxee)
     cmd = ['vsearch', '--fastq_filter', args.FASTQ, '--fastq_maxee', str(args.maxee), '--fastqout', filter_out, '--fastaout', filter_fasta, '--fastq_qmax', '55', '--threads', str(cpus)]
-    amptklib.runSubprocess(cmd, amptklib.log)
+    amptklib.runSubprocessCodec(cmd, amptklib.log, inputs=[args.FASTQ], outputs=[filter_out, filter_fasta])
     qtrimtotal = amptklib.countfastq(filter_out)
     amptklib.log.info('{0:,}'.format(qtrimtotal) + ' reads passed')
 
     #now run full length dereplication
-    derep_out = os.path.join(tmp, base + '.EE' + args.maxee + '.derep.fa')
+    derep_out = amptklib.tmpname(os.path.join(tmp, base + '.EE' + args.maxee + '.derep.fa'))
     amptklib.log.info("De-replication (remove duplicate reads)")
     cmd = ['vsearch', '--derep_fulllength', filter_fasta, '--sizeout', '--output', derep_out, '--threads', str(cpus), '--threads', str(cpus)]
-    amptklib.runSubprocess(cmd, amptklib.log)
+    amptklib.runSubprocessCodec(cmd, amptklib.log, inputs=[filter_fasta], outputs=[derep_out])
     total = amptklib.countfasta(derep_out)
     amptklib.log.info('{0:,}'.format(total) + ' reads passed')
 
     #now run sort by size
-    sort_out = os.path.join(tmp, base + '.EE' + args.maxee + '.sort.fa')
+    sort_out = amptklib.tmpname(os.path.join(tmp, base + '.EE' + args.maxee + '.sort.fa'))
     amptklib.log.info("Sorting reads by size: removing reads seen less than %s times" % args.minsize)
     cmd = ['vsearch', '--sortbysize', derep_out, '--minsize', args.minsize, '--output', sort_out, '--threads', str(cpus)]
-    amptklib.runSubprocess(cmd, amptklib.log)
+    amptklib.runSubprocessCodec(cmd, amptklib.log, inputs=[derep_out], outputs=[sort_out])
     total = amptklib.countfasta(sort_out)
     amptklib.log.info('{0:,}'.format(total) + ' reads passed')
 
@@ -191,7 +193,7 @@ def main(args):
     amptklib.log.info("De novo chimera detection (VSEARCH)")
     chimera_out = os.path.join(tmp, base + '.EE' + args.maxee + '.chimera_check.fa')
     cmd = ['vsearch', '--uchime_denovo', sort_out, '--relabel', 'Seq', '--sizeout', '--nonchimeras', chimera_out, '--threads', str(cpus)]
-    amptklib.runSubprocess(cmd, amptklib.log)
+    amptklib.runSubprocessCodec(cmd, amptklib.log, inputs=[sort_out])
     total = amptklib.countfasta(chimera_out)
     amptklib.log.info('{0:,}'.format(total) + ' reads passed')
 
@@ -314,7 +316,7 @@ def main(args):
     amptklib.log.info('{0:,}'.format(total) + ' total OTUs')
 
     #now map reads back to OTUs
-    uc_out = os.path.join(tmp, base + '.EE' + args.maxee + '.mapping.uc')
+    uc_out = amptklib.tmpname(os.path.join(tmp, base + '.EE' + args.maxee + '.mapping.uc'))
     otu_table = os.path.join(tmp, base + '.EE' + args.maxee + '.otu_table.txt')
     #setup reads to map
     if args.map_filtered:
@@ -323,7 +325,7 @@ def main(args):
         reads = orig_fasta
     amptklib.log.info("Mapping Reads to OTUs and Building OTU table")
     cmd = ['vsearch', '--usearch_global', reads, '--strand', 'plus', '--id', '0.97', '--db', otu_clean, '--uc', uc_out, '--otutabout', otu_table, '--threads', str(cpus)]
-    amptklib.runSubprocess(cmd, amptklib.log)
+    amptklib.runSubprocessCodec(cmd, amptklib.log, inputs=[reads], outputs=[uc_out])
 
     #count reads mapped
     total = amptklib.line_count2(uc_out)
@@ -89,6 +89,8 @@ Arguments:   -i, --fastq,--bam   Input BAM or FASTQ file (Required)
              --barcode_mismatch   Number of mismatches in barcode to allow. Default: 0
              --primer_mismatch   Number of mismatches in primers to allow. Default: 2
              --cpus              Number of CPUs to use. Default: all
+             --sort_samples      Group demux output by sample, write per-sample index.
+             --prefix_cache      Cache barcode/primer results for N read prefixes. Default: 0 (off)
              --mult_samples      Combine multiple chip runs, name prefix for chip
         """.format(getVersion())
 
@@ -117,8 +119,10 @@ Arguments:   -i, --fastq         Input folder of FASTQ files (Required)
              --primer_mismatch   Number of mismatches in primers to allow. Default: 2
              --barcode_mismatch   Number of mismatches in barcode to allow. Default: 1
              --cpus              Number of CPUs to use. Default: all
+             --sort_samples      Group demux output by sample, write per-sample index.
              --cleanup           Remove intermediate files.
              --merge_method      Software to use for PE merging. Default: usearch [usearch,vsearch]
+             --phix_hits         PhiX k-mers to remove a read, 0 keeps PhiX. Default: 10
              -u, --usearch       USEARCH executable. Default: usearch9
         """.format(getVersion())
 
@@ -150,7 +154,9 @@ Arguments:   -i, --fastq            Illumina R1 (PE forward) reads (Required)
              --full_length          Keep only full length sequences.
              --primer_mismatch      Number of mismatches in primers to allow. Default: 2
              --merge_method         Software to use for PE merging. Default: usearch [usearch,vsearch]
+             --phix_hits            PhiX k-mers to remove a read, 0 keeps PhiX. Default: 10
              --cpus                 Number of CPUs to use. Default: all
+             --sort_samples         Group demux output by sample, write per-sample index.
              -u, --usearch          USEARCH executable. Default: usearch9
         """.format(getVersion())
 
@@ -180,7 +186,9 @@ Arguments:   -f, --forward       FASTQ R1 (forward) file (Required)
              --barcode_mismatch  Number of mismatches in index (barcodes) to allow. Default: 2
              --barcode_rev_comp  Reverse complement barcode sequences in mapping file.
              --merge_method      Software to use for PE merging. Default: usearch [usearch,vsearch]
+             --phix_hits         PhiX k-mers to remove a read, 0 keeps PhiX. Default: 10
              --cpus              Number of CPUs to use. Default: all
+             --sort_samples      Group demux output by sample, write per-sample index.
              --cleanup           Remove intermediate files.
              -u, --usearch       USEARCH executable. Default: usearch9
         """.format(getVersion())
@@ -209,6 +217,7 @@ Arguments:   -i, --sff, --fasta  Input file (SFF, FASTA, or FASTQ) (Required)
              --barcode_mismatch  Number of mismatches in barcode to allow. Default: 0
              --primer_mismatch   Number of mismatches in primers to allow. Default: 2
              --cpus              Number of CPUs to use. Default: all
+             --sort_samples      Group demux output by sample, write per-sample index.
         """.format(getVersion())
 
 sraHelp = """
@@ -254,6 +263,7 @@ Arguments:   -i, --fastq         Input FASTQ file (Required)
              --map_filtered      Map quality filtered reads back to OTUs. Default: off
              --unoise            Run De-noising pre-clustering (UNOISE). Default: off
              --debug             Keep intermediate files.
+             --tmp_codec         Compress intermediate files. Default: none [gzip, zstd, lz4]
              --cpus              Number of CPUs to use. Default: all
              -u, --usearch       USEARCH executable. Default: usearch9
         """.format(getVersion())
@@ -281,6 +291,7 @@ Arguments:   -i, --fastq         Input FASTQ file (Required)
              --closed_ref_only   Run only closed reference clustering.
              --map_filtered      Map quality filtered reads back to OTUs. Default: off
              --debug             Keep intermediate files.
+             --tmp_codec         Compress intermediate files. Default: none [gzip, zstd, lz4]
              --cpus              Number of CPUs to use. Default: all
              -u, --usearch       USEARCH executable. Default: usearch9
         """.format(getVersion())
@@ -308,6 +319,7 @@ Arguments:   -i, --fastq         Input FASTQ file (Required)
              --uchime_ref        Run Ref Chimera filtering. Default: off [ITS, LSU, COI, 16S, custom path]
              --cpus              Number of CPUs to use. Default: all
              --debug             Keep intermediate files.
+             --tmp_codec         Compress intermediate files. Default: none [gzip, zstd, lz4]
         """.format(getVersion())
 
 unoise2Help = """
@@ -347,6 +359,7 @@ Arguments:   -i, --fastq         Input FASTQ file (Required)
              --uchime_ref        Run Ref Chimera filtering. Default: off [ITS, LSU, COI, 16S, custom path]
              --cpus              Number of CPUs to use. Default: all
              --debug             Keep intermediate files.
+             --tmp_codec         Compress intermediate files. Default: none [gzip, zstd, lz4]
         """.format(getVersion())
 
 luluHelp = """
@@ -690,6 +703,7 @@ Arguments:   -i, --bam           Directory/Folder contained 1 BAM file per sampl
              --min_len           Minimum length read to keep. Default: 800
              --primer_mismatch   Number of mismatches in primers to allow. Default: 3
              --cpus              Number of CPUs to use. Default: all
+             --sort_samples      Group demux output by sample, write per-sample index.
         """.format(getVersion())
 
 pbdada2Help = """
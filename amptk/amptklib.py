@@ -1,6 +1,7 @@
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 import sys
+import errno
 import logging
 import csv
 import os
@@ -9,7 +10,25 @@ import multiprocessing
 import time
 import shutil
 import gzip
+import io
+import zlib
+import struct
+import bisect
+import functools
+import re
+import collections
+import operator
+import tempfile
+import threading
+import itertools
+import mmap
+import heapq
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import edlib
+import numpy as np
 import pandas as pd
 import json
 import platform
@@ -202,7 +221,7 @@ def SafeRemove(input):
     if os.path.isdir(input):
         shutil.rmtree(input)
     elif os.path.isfile(input):
-        os.remove(input)
+        removefile(input)
     else:
         return
 
@@ -345,51 +364,14 @@ def mod_versions():
     log.debug("Python Modules: %s" % ', '.join(results))
 
 
-class gzopen(object):
-    def __init__(self, fname):
-        f = open(fname)
-        # Read magic number (the first 2 bytes) and rewind.
-        magic_number = f.read(2)
-        f.seek(0)
-        # Encapsulated 'self.f' is a file or a GzipFile.
-        if magic_number == '\x1f\x8b':
-            self.f = gzip.GzipFile(fileobj=f)
-        else:
-            self.f = f
-    # Define '__enter__' and '__exit__' to use in
-    # 'with' blocks. Always close the file and the
-    # GzipFile if applicable.
-    def __enter__(self):
-        return self
-    def __exit__(self, type, value, traceback):
-        try:
-            self.f.fileobj.close()
-        except AttributeError:
-            pass
-        finally:
-            self.f.close()
-    # Reproduce the interface of an open file
-    # by encapsulation.
-    def __getattr__(self, name):
-        return getattr(self.f, name)
-    def __iter__(self):
-        return iter(self.f)
-    def __next__(self):
-        return next(self.f)
-
 def Funzip(input, output, cpus):
     '''
-    function to unzip as fast as it can, pigz -> bgzip -> gzip
+    function to unzip as fast as it can, pigz -> igzip -> in-process,
+    format is sniffed so BGZF, zstd, and plain input work as well
     '''
-    if which('pigz'):
-        cmd = ['pigz', '--decompress', '-c', '-p', str(cpus), input]
-    else:
-        cmd = ['gzip', '--decompress', '-c', input]
-    try:
-        runSubprocess2(cmd, log, output)
-    except NameError:
-        with open(output, 'w') as outfile:
-            subprocess.call(cmd, stdout=outfile)
+    with open_fastx(input, mode='rb', threads=cpus) as infile:
+        with open(output, 'wb') as outfile:
+            shutil.copyfileobj(infile, outfile, 1048576)
 
 def Fzip(input, output, cpus):
     '''
@@ -421,7 +403,7 @@ def Fzip_inplace(input):
 
 def fastalen2dict(input):
     Lengths = {}
-    with open(input, 'r') as infile:
+    with open_fastx(input) as infile:
         for rec in SeqIO.parse(infile, 'fasta'):
             if not rec.id in Lengths:
                 Lengths[rec.id] = len(rec.seq)
@@ -433,7 +415,7 @@ def myround(x, base=10):
 def GuessRL(input):
     #read first 50 records, get length then exit
     lengths = []
-    for title, seq, qual in FastqGeneralIterator(gzopen(input)):
+    for title, seq, qual in FastqGeneralIterator(open_fastx(input)):
         if len(lengths) < 50:
             lengths.append(len(seq))
         else:
@@ -441,20 +423,13 @@ def GuessRL(input):
     return myround(max(set(lengths)))
 
 def countfasta(input):
-    count = 0
-    with open(input, 'r') as f:
-        for line in f:
-            if line.startswith(">"):
-                count += 1
-    return count
+    return fastx_stats(input)['records']
 
 def countfastq(input):
-    lines = sum(1 for line in gzopen(input))
-    count = int(lines) // 4
-    return count
+    return fastx_stats(input)['records']
 
 def line_count(fname):
-    with open(fname) as f:
+    with open_fastx(fname) as f:
         i = -1
         for i, l in enumerate(f):
             pass
@@ -468,14 +443,14 @@ def softwrap(string, every=80):
 
 def line_count2(fname):
     count = 0
-    with open(fname, 'r') as f:
+    with open_fastx(fname) as f:
         for line in f:
             if not '*' in line:
                 count += 1
     return count
 
 def getreadlength(input):
-    with gzopen(input) as fp:
+    with open_fastx(input) as fp:
         for i, line in enumerate(fp):
             if i == 1:
                 read_length = len(line) - 1 #offset to switch to 1 based counts
@@ -553,7 +528,7 @@ def scan_linepos(path):
     """return a list of seek offsets of the beginning of each line"""
     linepos = []
     offset = 0
-    with gzopen(path) as inf:
+    with open(path, 'r') as inf:
         # WARNING: CPython 2.7 file.tell() is not accurate on file.next()
         for line in inf:
             linepos.append(offset)
@@ -564,105 +539,1600 @@ def return_lines(path, linepos, nstart, nstop):
     """return nsamp lines from path where line offsets are in linepos"""
     offsets = linepos[int(nstart):int(nstop)]
     lines = []
-    with gzopen(path) as inf:
+    with open(path, 'r') as inf:
         for offset in offsets:
             inf.seek(offset)
             lines.append(inf.readline())
     return lines
 
+#BGZF blocks are gzip members with FEXTRA set and a 'BC' subfield holding the block size
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+#zstd frame magic number 0xFD2FB528, little endian
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+#lz4 frame magic number 0x184D2204, little endian
+LZ4_MAGIC = b'\x04\x22\x4d\x18'
+
+def fastx_format(input):
+    '''
+    sniff the compression of a FASTA/FASTQ file from its magic bytes,
+    returns 'bgzf', 'gzip', 'zstd', 'lz4', or 'plain'
+    '''
+    with open(input, 'rb') as infile:
+        header = infile.read(18)
+    if header[:4] == BGZF_MAGIC and header[12:14] == b'BC':
+        return 'bgzf'
+    elif header[:2] == b'\x1f\x8b':
+        return 'gzip'
+    elif header[:4] == ZSTD_MAGIC:
+        return 'zstd'
+    elif header[:4] == LZ4_MAGIC:
+        return 'lz4'
+    else:
+        return 'plain'
+
+def fastx_splittable(input):
+    #only plain and BGZF files can be read from an arbitrary (start, end) byte range
+    return fastx_format(input) in ['plain', 'bgzf']
+
+def read_bgzf_block(infile):
+    '''
+    read next BGZF block from open binary file, returns uncompressed bytes
+    or None at end of file. Expects htslib layout, i.e. single BC subfield
+    '''
+    header = infile.read(18)
+    if len(header) < 18:
+        return None
+    if header[:4] != BGZF_MAGIC or header[12:14] != b'BC':
+        raise ValueError('Invalid BGZF block at offset {:}'.format(infile.tell()-len(header)))
+    bsize = struct.unpack('<H', header[16:18])[0]
+    data = infile.read(bsize - 17)
+    return zlib.decompress(data[:-8], -15)
+
+def bgzf_next_block(input, offset):
+    '''
+    return compressed offset of the first BGZF block starting at or after offset
+    '''
+    size = getSize(input)
+    with open(input, 'rb') as infile:
+        while offset < size:
+            infile.seek(offset)
+            buf = infile.read(1048576 + 17)
+            i = 0
+            while True:
+                i = buf.find(BGZF_MAGIC, i)
+                if i < 0 or i + 18 > len(buf):
+                    break
+                if buf[12+i:14+i] == b'BC' and buf[10+i:12+i] == b'\x06\x00':
+                    return offset + i
+                i += 1
+            offset += 1048576
+    return size
+
+def iter_fastx_blocks(input, start=0, end=None, format=None, blocksize=1048576):
+    '''
+    yield (offset, data) blocks of uncompressed data between start and end, the
+    offset of data[i] is always offset+i. For plain files offsets are bytes, for
+    BGZF they are virtual offsets (coffset << 16 | uoffset). gzip, zstd and lz4
+    streams are decompressed from the start, their start and end count FASTQ
+    records (4 lines each) and the records before start are skipped
+    '''
+    if not format:
+        format = fastx_format(input)
+    if format == 'bgzf':
+        if end is None:
+            end = getSize(input) << 16
+        with open(input, 'rb') as infile:
+            infile.seek(start >> 16)
+            skip = start & 0xFFFF
+            while True:
+                coffset = infile.tell()
+                if (coffset << 16) >= end:
+                    break
+                data = read_bgzf_block(infile)
+                if data is None:
+                    break
+                if coffset == end >> 16:
+                    data = data[:end & 0xFFFF]
+                if skip:
+                    data = data[skip:]
+                if data:
+                    yield (coffset << 16) | skip, data
+                skip = 0
+    elif format in ['gzip', 'zstd', 'lz4']:
+        skip = start * 4
+        keep = None if end is None else (end - start) * 4
+        with fastx_decompress(input, format) as infile:
+            offset = 0
+            for data in iter(lambda: infile.read(blocksize), b''):
+                if skip:
+                    lines = data.count(b'\n')
+                    if lines < skip:
+                        skip -= lines
+                        offset += len(data)
+                        continue
+                    pos = line_end(data, skip)
+                    offset += pos
+                    data = data[pos:]
+                    skip = 0
+                if keep is not None:
+                    lines = data.count(b'\n')
+                    if lines >= keep:
+                        data = data[:line_end(data, keep)]
+                        if data:
+                            yield offset, data
+                        break
+                    keep -= lines
+                if data:
+                    yield offset, data
+                offset += len(data)
+    else:
+        with open(input, 'rb') as infile:
+            infile.seek(start)
+            offset = start
+            while end is None or offset < end:
+                if end is None:
+                    data = infile.read(blocksize)
+                else:
+                    data = infile.read(min(blocksize, end - offset))
+                if not data:
+                    break
+                yield offset, data
+                offset += len(data)
+
+def line_end(data, n):
+    #offset just past the n-th newline in data
+    pos = 0
+    for i in range(n):
+        pos = data.index(b'\n', pos) + 1
+    return pos
+
+def fastx_eof(input, format=None):
+    #offset used as end of file in the (start, end) ranges, the record count for streams
+    if not format:
+        format = fastx_format(input)
+    if format == 'bgzf':
+        return getSize(input) << 16
+    elif format in ['gzip', 'zstd', 'lz4']:
+        return fastx_stats(input)['records']
+    return getSize(input)
+
+def fastq_sync(input, offset, format, skip=True):
+    '''
+    return offset of first FASTQ record starting after the line containing offset,
+    a header is an @ line that has the + separator two lines further down
+    '''
+    buf = bytearray()
+    pieces = []
+    bases = []
+    for base, data in iter_fastx_blocks(input, start=offset, format=format, blocksize=65536):
+        pieces.append(len(buf))
+        bases.append(base)
+        buf += data
+        if buf.count(b'\n') > 12:
+            break
+    pos = 0
+    if skip:
+        pos = buf.find(b'\n') + 1
+        if pos == 0:
+            return fastx_eof(input, format)
+    starts = []
+    while pos < len(buf):
+        starts.append(pos)
+        pos = buf.find(b'\n', pos) + 1
+        if pos == 0:
+            break
+    for i in range(len(starts) - 2):
+        if buf[starts[i]:starts[i]+1] == b'@' and buf[starts[i+2]:starts[i+2]+1] == b'+':
+            x = bisect.bisect_right(pieces, starts[i]) - 1
+            return bases[x] + starts[i] - pieces[x]
+    return fastx_eof(input, format)
+
+def fastq_chunks(input, chunks):
+    '''
+    split FASTQ into roughly equal (start, end) ranges that begin on a record,
+    samples one offset per chunk and resyncs it rather than indexing every line.
+    gzip/zstd/lz4 streams are split into record ranges from the record count
+    '''
+    format = fastx_format(input)
+    if format in ['gzip', 'zstd', 'lz4'] and chunks < 2:
+        return [(0, None)]
+    size = getSize(input)
+    eof = fastx_eof(input, format)
+    bounds = [0, eof]
+    if format in ['gzip', 'zstd', 'lz4']:
+        bounds += [eof * i // chunks for i in range(1, chunks)]
+    else:
+        for i in range(1, chunks):
+            target = size * i // chunks
+            if format == 'bgzf':
+                block = bgzf_next_block(input, target)
+                if block >= size:
+                    continue
+                bounds.append(fastq_sync(input, block << 16, format))
+            else:
+                bounds.append(fastq_sync(input, max(target - 1, 0), format))
+    bounds = sorted(set(bounds))
+    return [(bounds[i], bounds[i+1]) for i in range(len(bounds)-1)]
+
+def fastq_line_offsets(input, lines, format=None):
+    '''
+    return offset at which each line number (sorted) starts, counting newlines
+    block by block so memory stays O(len(lines))
+    '''
+    if not format:
+        format = fastx_format(input)
+    offsets = []
+    seen = 0
+    for base, data in iter_fastx_blocks(input, format=format):
+        newlines = data.count(b'\n')
+        pos = 0
+        #a line starts inside this block unless it follows a newline ending the block
+        last = seen + newlines
+        while len(offsets) < len(lines) and (lines[len(offsets)] < last or
+                (lines[len(offsets)] == last and not data.endswith(b'\n'))):
+            target = lines[len(offsets)]
+            while seen < target:
+                pos = data.find(b'\n', pos) + 1
+                seen += 1
+                newlines -= 1
+            offsets.append(base + pos)
+        if len(offsets) == len(lines):
+            return offsets
+        seen += newlines
+    eof = fastx_eof(input, format)
+    return offsets + [eof] * (len(lines) - len(offsets))
+
+def fastq_count_lines(input, offsets, format=None):
+    '''
+    return number of lines before each offset (sorted, on line starts)
+    '''
+    if not format:
+        format = fastx_format(input)
+    counts = []
+    seen = 0
+    for base, data in iter_fastx_blocks(input, format=format):
+        while len(counts) < len(offsets) and offsets[len(counts)] < base + len(data):
+            counts.append(seen + data.count(b'\n', 0, offsets[len(counts)] - base))
+        if len(counts) == len(offsets):
+            return counts
+        seen += data.count(b'\n')
+    return counts + [seen] * (len(offsets) - len(counts))
+
+def fastq_read_name(title):
+    #name shared by the mates of a pair, first word of the title without a /1 /2 /3 suffix
+    name = title.split(None, 1)[0] if title.strip() else b''
+    if name[-2:] in [b'/1', b'/2', b'/3']:
+        name = name[:-2]
+    return name
+
+def fastq_titles(input, start, end, format):
+    '''
+    yield (offset, title) of the records of a plain or BGZF FASTQ from the record at
+    start up to the first one at or after end, titles without the @
+    '''
+    buf = b''
+    pieces = []
+    line = 0
+    for base, data in iter_fastx_blocks(input, start=start, format=format, blocksize=65536):
+        pieces.append((len(buf), base))
+        buf += data
+        pos = 0
+        while True:
+            nl = buf.find(b'\n', pos)
+            if nl < 0:
+                break
+            if line % 4 == 0:
+                x = bisect.bisect_right(pieces, (pos, float('inf'))) - 1
+                offset = pieces[x][1] + pos - pieces[x][0]
+                if end is not None and offset >= end:
+                    return
+                yield offset, buf[pos+1:nl]
+            line += 1
+            pos = nl + 1
+        #keep the partial last line and the pieces it starts in
+        x = bisect.bisect_right(pieces, (pos, float('inf'))) - 1
+        pieces = [(max(p - pos, 0), b + max(pos - p, 0)) for p, b in pieces[x:]]
+        buf = buf[pos:]
+
+def fastq_names_at(input, starts, format):
+    #read names of the records at starts (sorted offsets, record numbers for streams)
+    if format in ['plain', 'bgzf']:
+        return [fastq_read_name(next(fastq_titles(input, x, None, format))[1]) for x in starts]
+    names = []
+    if starts:
+        for n, rec in enumerate(iter_fastq(input)):
+            if n == starts[len(names)]:
+                names.append(fastq_read_name(rec[0]))
+                if len(names) == len(starts):
+                    break
+    return names
+
+def fastq_find_mate(input, name, fraction, format, window=1048576):
+    '''
+    offset of the record named name in a plain or BGZF FASTQ, searched around the same
+    fraction of the file in a window that grows until it is found, None if it is not
+    '''
+    size = getSize(input)
+    target = int(size * fraction)
+    while True:
+        lo, hi = max(target - window, 0), min(target + window, size)
+        if format == 'bgzf':
+            start = fastq_sync(input, bgzf_next_block(input, lo) << 16, format) if lo else 0
+            end = bgzf_next_block(input, hi) << 16
+        else:
+            start = fastq_sync(input, lo - 1, format) if lo else 0
+            end = hi
+        for offset, title in fastq_titles(input, start, end, format):
+            if fastq_read_name(title) == name:
+                return offset
+        if lo == 0 and hi == size:
+            return None
+        window *= 4
+
+def fastq_find_records(input, names, format):
+    #record numbers of the reads named names (in file order) in a gzip/zstd/lz4 stream
+    records = []
+    if names:
+        for n, rec in enumerate(iter_fastq(input)):
+            if fastq_read_name(rec[0]) == names[len(records)]:
+                records.append(n)
+                if len(records) == len(names):
+                    break
+    return records + [None] * (len(names) - len(records))
+
+def fastq_chunksPE(inputs, chunks):
+    '''
+    split paired FASTQ files (R1, R2, and optional I1) into chunks holding the same
+    records, returns list of (first read number, [(start, end), ...]) with one range per
+    input file, so mates stay in lockstep.  R1 is split at sampled offsets (fastq_chunks)
+    and the mates at the same read names, searched near the same fraction of the file.
+    The first read number is the R1 start of the chunk, the record index for streams and
+    else the offset: a record is more than one byte, so the reads of a chunk numbered
+    from it never reach the next chunk's numbers
+    '''
+    ranges = fastq_chunks(inputs[0], chunks)
+    format = fastx_format(inputs[0])
+    stream = format not in ['plain', 'bgzf']
+    starts = [r[0] for r in ranges]
+    inner = starts[1:]
+    if stream:
+        fractions = [x / float(ranges[-1][1]) for x in inner]
+    else:
+        size = getSize(inputs[0])
+        fractions = [(x >> 16 if format == 'bgzf' else x) / float(size) for x in inner]
+    names = fastq_names_at(inputs[0], inner, format)
+    first = fastq_names_at(inputs[0], [0], format) if inner else []
+    records = None
+    bounds = [starts + [ranges[-1][1]]]
+    for x in inputs[1:]:
+        xformat = fastx_format(x)
+        if stream and xformat not in ['plain', 'bgzf']:
+            #stream ranges are the record numbers, the last one runs to the end
+            bounds.append(starts + [None])
+            continue
+        offsets = [None] * len(inner)
+        if not inner or fastq_names_at(x, [0], xformat) == first:
+            if xformat in ['plain', 'bgzf']:
+                offsets = [fastq_find_mate(x, n, f, xformat) for n, f in zip(names, fractions)]
+            else:
+                offsets = fastq_find_records(x, names, xformat)
+        if None in offsets:
+            #mates named differently, count R1 records up to the chunk starts instead
+            log.debug('{:}: read names do not match {:}, counting records'.format(x, inputs[0]))
+            if records is None:
+                records = inner if stream else [y // 4 for y in fastq_count_lines(inputs[0], inner, format)]
+            if xformat in ['plain', 'bgzf']:
+                offsets = fastq_line_offsets(x, [r * 4 for r in records], xformat)
+            else:
+                offsets = records
+        bounds.append([0] + offsets + [fastx_eof(x, xformat) if xformat in ['plain', 'bgzf'] else None])
+    return [(rec, [(b[i], b[i+1]) for b in bounds]) for i, rec in enumerate(starts)]
+
+class BlockStream(io.RawIOBase):
+    '''
+    read-only raw stream over the (offset, data) blocks from iter_fastx_blocks
+    '''
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.buf = memoryview(b'')
+    def readable(self):
+        return True
+    def readinto(self, b):
+        while not len(self.buf):
+            try:
+                self.buf = memoryview(next(self.blocks)[1])
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+    def close(self):
+        self.blocks.close()
+        super(BlockStream, self).close()
+
+class PipeStream(io.RawIOBase):
+    '''
+    read-only raw stream over STDOUT of a decompression command, raises
+    IOError if the command fails rather than returning truncated data
+    '''
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    def readable(self):
+        return True
+    def readinto(self, b):
+        n = self.proc.stdout.readinto(b)
+        if not n and self.proc.wait() != 0:
+            raise IOError('{:} failed: {:}'.format(' '.join(self.cmd),
+                          self.proc.stderr.read().decode('utf-8').strip()))
+        return n
+    def close(self):
+        if not self.closed:
+            #closing early sends SIGPIPE to the command, that is fine
+            self.proc.stdout.close()
+            self.proc.stderr.close()
+            self.proc.wait()
+        super(PipeStream, self).close()
+
+#blocks/record batches a reader thread keeps queued ahead of the per-read loops, 2 is
+#double buffering, 0 reads in the calling thread. Set with AMPTK_READAHEAD
+READAHEAD = int(os.environ.get('AMPTK_READAHEAD', 4))
+
+def iter_readahead(items, depth=None):
+    '''
+    iterate over items on a background thread that keeps up to depth of them queued, so
+    file reads and decompression (zlib/zstd release the GIL) overlap with the work of
+    the consumer. Exceptions are raised in the consumer, depth=0 iterates in place
+    '''
+    if depth is None:
+        depth = READAHEAD
+    if depth < 1:
+        for item in items:
+            yield item
+        return
+    buffer = queue.Queue(depth)
+    stop = threading.Event()
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def fill():
+        try:
+            for item in items:
+                if not put((True, item)):
+                    break
+            else:
+                put((False, None))
+        except Exception as e:
+            put((False, e))
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+    thread = threading.Thread(target=fill)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            more, item = buffer.get()
+            if not more:
+                if item is not None:
+                    raise item
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def readahead_records(records, depth=None, batchsize=1024):
+    #iter_readahead for parsers that yield one record at a time, queued in batches
+    records = iter(records)
+    batches = iter(lambda: list(itertools.islice(records, batchsize)), [])
+    for batch in iter_readahead(batches, depth):
+        for rec in batch:
+            yield rec
+
+class ThreadStream(io.RawIOBase):
+    '''
+    read-only raw stream filled from a data iterator by a background thread,
+    zlib releases the GIL so decompression overlaps with parsing the records
+    '''
+    def __init__(self, blocks, depth=None):
+        self.blocks = iter_readahead(blocks, depth)
+        self.buf = memoryview(b'')
+    def readable(self):
+        return True
+    def readinto(self, b):
+        while not len(self.buf):
+            try:
+                self.buf = memoryview(next(self.blocks))
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+    def close(self):
+        if not self.closed:
+            self.blocks.close()
+        super(ThreadStream, self).close()
+
+def which_path(name):
+    #full path of executable or None, unlike which() this does not run it
+    try:
+        from shutil import which as find_executable
+    except ImportError:
+        from distutils.spawn import find_executable
+    return find_executable(name)
+
+def decompress_command(input, format, threads=1):
+    '''
+    command that writes the decompressed input to STDOUT, or None if none of
+    the tools are installed. BGZF is multi-member gzip, so pigz reads it too
+    '''
+    if format == 'zstd':
+        if which_path('zstd'):
+            return ['zstd', '--decompress', '--stdout', '--quiet', input]
+    elif format == 'lz4':
+        if which_path('lz4'):
+            return ['lz4', '--decompress', '--stdout', '--quiet', input]
+    elif which_path('pigz'):
+        return ['pigz', '--decompress', '-c', '-p', str(threads), input]
+    elif which_path('igzip'):
+        return ['igzip', '--decompress', '-c', input]
+    return None
+
+def iter_decompress(input, format, blocksize=1048576):
+    #in-process fallback, python-isal if installed is ~2X faster than gzip
+    if format == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise IOError('{:} is zstd compressed, install zstd or the zstandard python module'.format(input))
+        with open(input, 'rb') as fh:
+            reader = zstandard.ZstdDecompressor().stream_reader(fh, read_across_frames=True)
+            for data in iter(lambda: reader.read(blocksize), b''):
+                yield data
+    elif format == 'lz4':
+        try:
+            import lz4.frame
+        except ImportError:
+            raise IOError('{:} is lz4 compressed, install lz4 or the lz4 python module'.format(input))
+        with lz4.frame.open(input, 'rb') as infile:
+            for data in iter(lambda: infile.read(blocksize), b''):
+                yield data
+    else:
+        try:
+            from isal import igzip as gzipmod
+        except ImportError:
+            gzipmod = gzip
+        with gzipmod.open(input, 'rb') as infile:
+            for data in iter(lambda: infile.read(blocksize), b''):
+                yield data
+
+def fastx_decompress(input, format, threads=1):
+    '''
+    binary stream of a whole gzip/BGZF/zstd/lz4 file, decompressed through a pipe
+    from pigz/igzip/zstd/lz4 or else in-process on a background thread
+    '''
+    cmd = decompress_command(input, format, threads)
+    if cmd:
+        raw = PipeStream(cmd)
+    else:
+        raw = ThreadStream(iter_decompress(input, format))
+    return io.BufferedReader(raw, buffer_size=1048576)
+
+def open_fastx(input, mode='rt', start=0, end=None, threads=1):
+    '''
+    open a FASTA/FASTQ file for reading, compression (plain, gzip, BGZF, zstd, or lz4)
+    is sniffed from the magic bytes so the file extension does not matter and
+    compressed input is streamed, never unzipped to a temporary copy. input is
+    a filename or a (filename, start, end) range from fastq_chunks, see
+    iter_fastx_blocks for the range units. mode is 'rt' or 'rb'
+    '''
+    if isinstance(input, tuple):
+        input, start, end = input
+    format = fastx_format(input)
+    if end is not None and format in ['plain', 'bgzf'] and end >= fastx_eof(input, format):
+        end = None
+    if not start and end is None:
+        if format == 'plain':
+            stream = io.open(input, 'rb', buffering=1048576)
+        else:
+            stream = fastx_decompress(input, format, threads)
+    else:
+        stream = io.BufferedReader(BlockStream(iter_fastx_blocks(input, start=start, end=end, format=format)),
+                                   buffer_size=1048576)
+    if mode == 'rb':
+        return stream
+    return io.TextIOWrapper(stream)
+
+#htslib fills BGZF blocks with at most 0xff00 bytes of uncompressed data
+BGZF_BLOCKSIZE = 65280
+#empty block that marks the end of a BGZF file
+BGZF_EOF = (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00'
+            b'\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+def bgzf_block(data, level=6):
+    #compress up to BGZF_BLOCKSIZE bytes into a single BGZF block
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    return header + cdata + struct.pack('<2I', zlib.crc32(data) & 0xffffffff, len(data))
+
+class BgzfWriter(io.RawIOBase):
+    '''
+    raw binary writer that cuts data into BGZF blocks and compresses batches of them
+    on a thread pool while the caller keeps writing (zlib releases the GIL), so output
+    is compressed in the same pass. tell() returns the virtual offset of the next byte
+    '''
+    def __init__(self, output, threads=1, level=6, append=False):
+        self.handle = open(output, 'ab' if append else 'wb')
+        self.level = level
+        self.buf = bytearray()
+        self.blocks = []
+        self.coffset = self.handle.tell()
+        self.inflight = None
+        self.pool = None
+        self.batch = 1
+        if threads > 1:
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(threads)
+            self.batch = 4 * threads
+    def writable(self):
+        return True
+    def write(self, b):
+        self.buf += b
+        n = len(self.buf) // BGZF_BLOCKSIZE * BGZF_BLOCKSIZE
+        if n:
+            for i in range(0, n, BGZF_BLOCKSIZE):
+                self.blocks.append(bytes(self.buf[i:i+BGZF_BLOCKSIZE]))
+            del self.buf[:n]
+            if len(self.blocks) >= self.batch:
+                self._compress()
+        return len(b)
+    def _drain(self):
+        #wait for the batch on the thread pool and write it out
+        if self.inflight is not None:
+            for block in self.inflight.get():
+                self.handle.write(block)
+                self.coffset += len(block)
+            self.inflight = None
+    def _compress(self):
+        self._drain()
+        if self.pool:
+            self.inflight = self.pool.map_async(functools.partial(bgzf_block, level=self.level), self.blocks)
+        else:
+            for data in self.blocks:
+                block = bgzf_block(data, level=self.level)
+                self.handle.write(block)
+                self.coffset += len(block)
+        self.blocks = []
+    def tell(self):
+        #block offset is only known once everything before it is compressed
+        self._compress()
+        self._drain()
+        return (self.coffset << 16) | len(self.buf)
+    def close(self):
+        if not self.closed:
+            if self.buf:
+                self.blocks.append(bytes(self.buf))
+                self.buf = bytearray()
+            self._compress()
+            self._drain()
+            self.handle.write(BGZF_EOF)
+            self.handle.close()
+            if self.pool:
+                self.pool.close()
+                self.pool.join()
+        super(BgzfWriter, self).close()
+
+def compress_command(format, threads=1):
+    '''
+    command that compresses STDIN to STDOUT with a fast zstd/lz4 preset, or None
+    if the tool is not installed
+    '''
+    if format == 'zstd':
+        if which_path('zstd'):
+            return ['zstd', '-3', '--stdout', '--quiet', '-T{:}'.format(threads)]
+    elif format == 'lz4':
+        if which_path('lz4'):
+            return ['lz4', '-1', '--stdout', '--quiet']
+    return None
+
+class PipeWriter(io.RawIOBase):
+    '''
+    write-only raw stream into STDIN of a compression command that writes output,
+    raises IOError on close if the command fails rather than leaving a truncated file
+    '''
+    def __init__(self, cmd, output, append=False):
+        self.cmd = cmd
+        self.offset = 0
+        with open(output, 'ab' if append else 'wb') as handle:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=handle, stderr=subprocess.PIPE)
+    def writable(self):
+        return True
+    def write(self, b):
+        self.proc.stdin.write(b)
+        self.offset += len(b)
+        return len(b)
+    def tell(self):
+        return self.offset
+    def close(self):
+        if not self.closed:
+            try:
+                self.proc.stdin.close()
+                stderr = self.proc.stderr.read()
+                if self.proc.wait() != 0:
+                    raise IOError('{:} failed: {:}'.format(' '.join(self.cmd), stderr.decode('utf-8').strip()))
+            finally:
+                super(PipeWriter, self).close()
+
+class StreamWriter(io.RawIOBase):
+    '''
+    raw writer over the zstandard/lz4 python modules, used when the zstd/lz4
+    command line tools are not installed
+    '''
+    def __init__(self, output, format, threads=1, append=False):
+        self.offset = 0
+        mode = 'ab' if append else 'wb'
+        if format == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise IOError('writing {:} needs zstd or the zstandard python module'.format(output))
+            self.stream = zstandard.ZstdCompressor(level=3, threads=threads if threads > 1 else 0).stream_writer(open(output, mode))
+        else:
+            try:
+                import lz4.frame
+            except ImportError:
+                raise IOError('writing {:} needs lz4 or the lz4 python module'.format(output))
+            self.stream = lz4.frame.open(output, mode)
+    def writable(self):
+        return True
+    def write(self, b):
+        self.stream.write(b)
+        self.offset += len(b)
+        return len(b)
+    def tell(self):
+        return self.offset
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+        super(StreamWriter, self).close()
+
+#file extension of each codec open_fastx_writer can write, gzip is written as BGZF
+CODEC_EXT = collections.OrderedDict([('none', ''), ('gzip', '.gz'), ('zstd', '.zst'), ('lz4', '.lz4')])
+
+def fastx_codec(output):
+    #codec of an output file from its extension
+    for codec, ext in CODEC_EXT.items():
+        if ext and output.endswith(ext):
+            return codec
+    return 'none'
+
+def open_fastx_writer(output, mode='wt', threads=1, compress=None, append=False):
+    '''
+    open FASTA/FASTQ output for writing. If output ends with .gz (or compress=True) it is
+    written as BGZF on the fly, so there is no separate gzip pass and no uncompressed
+    copy on disk. BGZF is plain gzip to other tools and open_fastx can read it by range.
+    Likewise .zst/.lz4 (or compress='zstd'/'lz4') are written through zstd/lz4.
+    append=True adds to the end of output (a new gzip/zstd/lz4 member if compressed)
+    '''
+    if compress is None:
+        compress = fastx_codec(output)
+    elif compress is True:
+        compress = 'gzip'
+    if compress in ['gzip', 'bgzf']:
+        raw = BgzfWriter(output, threads=threads, append=append)
+    elif compress in ['zstd', 'lz4']:
+        cmd = compress_command(compress, threads)
+        if cmd:
+            raw = PipeWriter(cmd, output, append=append)
+        else:
+            raw = StreamWriter(output, compress, threads, append=append)
+    else:
+        raw = io.FileIO(output, 'ab' if append else 'wb')
+    #keep the buffer small as per-sample writers can be many
+    stream = io.BufferedWriter(raw, buffer_size=65536)
+    if mode == 'wb':
+        return stream
+    return io.TextIOWrapper(stream)
+
+def cat_fastx(inputs, output, threads=1):
+    #concatenate files into output, compressing on the fly if output ends with .gz
+    with open_fastx_writer(output, mode='wb', threads=threads) as outfile:
+        for file in inputs:
+            with open_fastx(file, mode='rb') as infile:
+                shutil.copyfileobj(infile, outfile, 1048576)
+
+#codec of the intermediate files in the tmp folders, set with --tmp_codec
+TMP_CODEC = os.environ.get('AMPTK_TMP_CODEC', 'none')
+
+def codec_available(codec):
+    #gzip is BGZF written in-process, zstd/lz4 need the command or the python module
+    if codec in ['zstd', 'lz4']:
+        if which_path(codec):
+            return True
+        try:
+            if codec == 'zstd':
+                import zstandard
+            else:
+                import lz4.frame
+        except ImportError:
+            return False
+    return True
+
+def set_tmp_codec(codec):
+    '''
+    set TMP_CODEC, a codec that cannot be written here falls back to uncompressed
+    intermediate files with a warning instead of failing part way through a run
+    '''
+    global TMP_CODEC
+    if not codec_available(codec):
+        log.info('Warning: --tmp_codec {:} needs the {:} command or python module, intermediate files are not compressed'.format(codec, codec))
+        codec = 'none'
+    TMP_CODEC = codec
+    return codec
+
+def tmpname(filename):
+    '''
+    name of an intermediate file in a tmp folder, the TMP_CODEC extension makes
+    open_fastx_writer and runSubprocessCodec write it compressed, open_fastx and
+    the counting functions read it transparently
+    '''
+    return filename + CODEC_EXT[TMP_CODEC]
+
+def _fifo_feed(input, fifo, errors):
+    #decompress input into the named pipe
+    try:
+        with open(fifo, 'wb') as outfile:
+            with open_fastx(input, mode='rb') as infile:
+                shutil.copyfileobj(infile, outfile, 1048576)
+    except (IOError, OSError) as e:
+        #broken pipe if the command stopped reading, or never opened the pipe
+        if e.errno != errno.EPIPE:
+            errors.append(e)
+
+def _fifo_drain(fifo, output, codec, errors):
+    #compress whatever is written to the named pipe into output
+    try:
+        with open(fifo, 'rb') as infile:
+            with open_fastx_writer(output, mode='wb', compress=codec) as outfile:
+                shutil.copyfileobj(infile, outfile, 1048576)
+    except (IOError, OSError) as e:
+        errors.append(e)
+
+def _fifo_release(fifo, thread, flags):
+    #open the other end of a pipe the command never opened so the thread can finish
+    while thread.is_alive():
+        try:
+            fd = os.open(fifo, flags | os.O_NONBLOCK)
+        except OSError as e:
+            #ENXIO is a write end without a reader yet, try again
+            if e.errno != errno.ENXIO:
+                raise
+        else:
+            thread.join(0.01)
+            os.close(fd)
+        thread.join(0.01)
+
+def _codec_fifos(cmd, inputs, outputs, fifodir, errors):
+    '''
+    replace compressed inputs and outputs with a codec extension in cmd by named pipes
+    in fifodir that are fed/drained by threads, returns the new cmd and the threads
+    as (fifo, thread, flags) for _fifo_release. vsearch reads gzip itself, so gzip
+    inputs are only piped for other tools
+    '''
+    native = ['plain']
+    if os.path.basename(cmd[0]) == 'vsearch':
+        native += ['gzip', 'bgzf']
+    feed = [x for x in inputs if fastx_format(x) not in native]
+    drain = [x for x in outputs if fastx_codec(x) != 'none']
+    cmd = list(cmd)
+    threads = []
+    for file in feed + drain:
+        fifo = os.path.join(fifodir, '{:}_{:}'.format(len(os.listdir(fifodir)), os.path.basename(file)))
+        if file in feed:
+            if cmd.count(file) > 1:
+                #a pipe can only be read once
+                Funzip(file, fifo, 1)
+                cmd = [fifo if x == file else x for x in cmd]
+                continue
+            os.mkfifo(fifo)
+            thread = threading.Thread(target=_fifo_feed, args=(file, fifo, errors))
+            flags = os.O_RDONLY
+        else:
+            os.mkfifo(fifo)
+            thread = threading.Thread(target=_fifo_drain, args=(fifo, file, fastx_codec(file), errors))
+            flags = os.O_WRONLY
+        thread.daemon = True
+        thread.start()
+        threads.append((fifo, thread, flags))
+        cmd = [fifo if x == file else x for x in cmd]
+    return cmd, threads
+
+def runSubprocessCodec(cmd, logfile, inputs=[], outputs=[]):
+    '''
+    runSubprocess for tools that need plain files, compressed inputs are decompressed
+    into named pipes and outputs with a codec extension (see tmpname) are compressed
+    from named pipes, so no uncompressed copy of either is written to disk
+    '''
+    fifodir = tempfile.mkdtemp(prefix='amptk_fifo_')
+    errors = []
+    threads = []
+    try:
+        cmd, threads = _codec_fifos(cmd, inputs, outputs, fifodir, errors)
+        runSubprocess(cmd, logfile)
+    finally:
+        for fifo, thread, flags in threads:
+            _fifo_release(fifo, thread, flags)
+        shutil.rmtree(fifodir)
+    if errors:
+        logfile.error('{:} failed: {:}'.format(os.path.basename(cmd[0]), errors[0]))
+        sys.exit(1)
+
+def _fifo_tee(counts, key, input, *outputs):
+    #copy data from one pipe to the next ones, counting FASTA/FASTQ records on the way
+    n = 0
+    marker = None
+    with open(input, 'rb') as infile:
+        outfiles = [open(x, 'wb') for x in outputs]
+        try:
+            for data in iter(lambda: infile.read(1048576), b''):
+                if marker is None:
+                    #'>' cannot be in a FASTA sequence, but '@' can be a FASTQ quality
+                    marker = b'>' if data.startswith(b'>') else b'\n'
+                n += data.count(marker)
+                for outfile in outfiles:
+                    outfile.write(data)
+        finally:
+            for outfile in outfiles:
+                outfile.close()
+    counts[key] = n if marker == b'>' else n // 4
+
+def _stage_call(func, args, errors):
+    try:
+        func(*args)
+    except (IOError, OSError) as e:
+        #broken pipe if the stage reading from it failed, that stage is reported
+        if e.errno != errno.EPIPE:
+            errors.append(e)
+    except Exception as e:
+        errors.append(e)
+
+def _stage_release(fifo, mode, other):
+    '''
+    stand in for a finished stage on its end of a pipe until the stage on the other end
+    is finished too, so that one is not blocked forever in open() or write() if this
+    stage failed before it opened the pipe
+    '''
+    if mode == 'wb':
+        while not other.is_set():
+            try:
+                os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+                break
+            except OSError as e:
+                #ENXIO is no reader yet
+                if e.errno != errno.ENXIO:
+                    raise
+            other.wait(0.01)
+    else:
+        fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            while not other.is_set():
+                try:
+                    if os.read(fd, 1048576):
+                        continue
+                except OSError as e:
+                    #EAGAIN is a writer that has nothing to send yet
+                    if e.errno != errno.EAGAIN:
+                        raise
+                other.wait(0.01)
+        finally:
+            os.close(fd)
+
+def _pipeline_fifos(stages, keep, counts, fifodir):
+    '''
+    named pipes for the files written by one stage and only read by later commands,
+    python functions sniff and reopen their input so they only read regular files.
+    Returns (stages, piped, branches, tallies), a relay stage is added for each file
+    with several readers or in counts that copies its pipe to branches[file] and
+    counts the records in tallies
+    '''
+    piped = {}
+    branches = {}
+    tallies = {}
+    stages = list(stages)
+    for i, (cmd, inputs, outputs) in enumerate(list(stages)):
+        for file in outputs:
+            readers = [x for x in stages[i+1:] if file in x[1]]
+            if file in keep or not readers or any(callable(x[0]) for x in readers):
+                continue
+            #without the codec extension, pipes always carry plain data
+            name = os.path.basename(file)[:len(os.path.basename(file))-len(CODEC_EXT[fastx_codec(file)])]
+            piped[file] = os.path.join(fifodir, '{:}_{:}'.format(len(piped), name))
+            os.mkfifo(piped[file])
+            if len(readers) > 1 or file in counts:
+                branches[file] = ['{:}.{:}'.format(piped[file], x) for x in range(len(readers))]
+                for fifo in branches[file]:
+                    os.mkfifo(fifo)
+                stages.append((functools.partial(_fifo_tee, tallies, file), [piped[file]], branches[file]))
+    return stages, piped, branches, tallies
+
+def _pipeline_start(stages, piped, branches, pipes, fifodir, logfile, errors, running):
+    '''
+    start every stage, python functions in a thread and commands in a subprocess, and
+    add them to running as (cmd, proc, output, codec threads, pipes read, pipes written).
+    If one cannot be started the started ones are killed, the rest are added with proc
+    None so the pipes they would have opened are released too
+    '''
+    #each reader of a relayed file gets the next branch
+    branched = dict((x, iter(y)) for x, y in branches.items())
+    failed = False
+    for cmd, inputs, outputs in stages:
+        ins = [next(branched[x]) if x in branched else piped.get(x, x) for x in inputs]
+        outs = [piped.get(x, x) for x in outputs]
+        fifo_in = [x for x in ins if x in pipes]
+        fifo_out = [x for x in outs if x in pipes]
+        if failed:
+            running.append((cmd, None, None, [], fifo_in, fifo_out))
+            continue
+        codec = []
+        out = None
+        try:
+            if callable(cmd):
+                proc = threading.Thread(target=_stage_call, args=(cmd, ins + outs, errors))
+                proc.daemon = True
+                proc.start()
+            else:
+                names = dict(zip(inputs + outputs, ins + outs))
+                cmd = [names.get(x, x) for x in cmd]
+                cmd, codec = _codec_fifos(cmd, [x for x in ins if x not in pipes],
+                                          [x for x in outs if x not in pipes], fifodir, errors)
+                logfile.debug(' '.join(cmd))
+                out = tempfile.TemporaryFile()
+                proc = subprocess.Popen(cmd, stdout=out, stderr=out)
+        except (IOError, OSError) as e:
+            errors.append(e)
+            failed = True
+            proc = None
+            for stage in running:
+                if isinstance(stage[1], subprocess.Popen):
+                    stage[1].kill()
+        running.append((cmd, proc, out, codec, fifo_in, fifo_out))
+
+def _pipeline_wait(running, pipes, logfile, errors):
+    '''
+    wait for the stages, as each one finishes its output is logged and the pipes it
+    did not open are released (_stage_release), so no stage is left blocked on them
+    '''
+    #set when the stage on the 'rb'/'wb' end of a pipe is finished
+    finished = dict((x, {'rb': threading.Event(), 'wb': threading.Event()}) for x in pipes)
+    releases = []
+    while running:
+        for stage in list(running):
+            cmd, proc, out, codec, fifo_in, fifo_out = stage
+            if isinstance(proc, threading.Thread):
+                if proc.is_alive():
+                    continue
+            elif proc is not None:
+                if proc.poll() is None:
+                    continue
+                out.seek(0)
+                output = out.read()
+                out.close()
+                if output:
+                    logfile.debug(output.decode('utf-8'))
+                if proc.returncode != 0:
+                    errors.append(IOError('{:} exited with {:}'.format(' '.join(cmd), proc.returncode)))
+            elif out is not None:
+                out.close()
+            for fifo, thread, flags in codec:
+                _fifo_release(fifo, thread, flags)
+            for fifo, mode, other in [(x, 'rb', 'wb') for x in fifo_in] + [(x, 'wb', 'rb') for x in fifo_out]:
+                finished[fifo][mode].set()
+                thread = threading.Thread(target=_stage_release, args=(fifo, mode, finished[fifo][other]))
+                thread.daemon = True
+                thread.start()
+                releases.append(thread)
+            running.remove(stage)
+        time.sleep(0.01)
+    for thread in releases:
+        thread.join()
+
+def runPipeline(stages, logfile, keep=[], counts=[]):
+    '''
+    run a chain of stages at the same time, stages are (cmd, inputs, outputs) where cmd
+    is a command or a python function called with the inputs and outputs. A file that
+    one stage writes and a single later command reads is passed through a named pipe
+    instead of being written to disk, unless it is in keep. keep=True (--debug) runs
+    the stages one after another and keeps every file. Other files are handled as in
+    runSubprocessCodec. Returns the number of records in each file of counts
+    '''
+    if keep is True:
+        for cmd, inputs, outputs in stages:
+            if callable(cmd):
+                cmd(*(inputs + outputs))
+            else:
+                runSubprocessCodec(cmd, logfile, inputs=inputs, outputs=outputs)
+        return dict((x, fastx_stats(x)['records']) for x in counts)
+    fifodir = tempfile.mkdtemp(prefix='amptk_fifo_')
+    errors = []
+    running = []
+    try:
+        stages, piped, branches, tallies = _pipeline_fifos(stages, keep, counts, fifodir)
+        pipes = set(piped.values()) | set(x for y in branches.values() for x in y)
+        _pipeline_start(stages, piped, branches, pipes, fifodir, logfile, errors, running)
+        _pipeline_wait(running, pipes, logfile, errors)
+    finally:
+        shutil.rmtree(fifodir)
+    if errors:
+        logfile.error('Pipeline failed: {:}'.format(errors[0]))
+        sys.exit(1)
+    return dict((x, tallies[x] if x in branches else fastx_stats(x)['records']) for x in counts)
+
+def sample_label(header):
+    '''
+    sample label of a bytes read header, i.e. R_1;barcodelabel=BC.5; parsed like the
+    filter_sample of keep_samples/remove_samples: after label= (barcodelabel=), else
+    sample=, else the first =, None if there is no = in the read name
+    '''
+    fields = header.split(None, 1)
+    name = fields[0] if fields else b''
+    for tag in (b'label=', b'sample='):
+        if tag in name:
+            return name.split(tag, 1)[1].split(b';')[0]
+    if b'=' in name:
+        return name.split(b'=', 1)[1].split(b';')[0]
+    return None
+
+#added to the pre-merge header of pairs with both primers found and cut, merging keeps
+#the R1 header so losslessTrim can skip the primer search, it is dropped from the output
+PRIMERS_TRIMMED = 'primers=trimmed;'
+PRIMERS_TRIMMED_B = PRIMERS_TRIMMED.encode('ascii')
+
+class FastxStats(object):
+    '''
+    record count, total bases, length histogram and per-sample label counts of FASTA or
+    FASTQ data, updated with raw blocks of bytes as the file is read
+    '''
+    def __init__(self):
+        self.format = None
+        self.records = 0
+        self.bases = 0
+        self.lengths = collections.Counter()
+        self.samples = collections.Counter()
+        self.pending = b''
+        self.seqlen = None
+    def update(self, data):
+        data = self.pending + data
+        lines = data.split(b'\n')
+        self.pending = lines.pop()
+        if self.format is None:
+            first = [x for x in lines if x]
+            if not first:
+                self.pending = data
+                return
+            self.format = 'fasta' if first[0].startswith(b'>') else 'fastq'
+        if self.format == 'fastq':
+            #keep lines of a partial record for the next block
+            n = len(lines) // 4 * 4
+            if n < len(lines):
+                self.pending = b'\n'.join(lines[n:] + [self.pending])
+            seqlens = [len(x) for x in lines[1:n:4]]
+            self.records += len(seqlens)
+            self.bases += sum(seqlens)
+            self.lengths.update(seqlens)
+            self._labels(lines[0:n:4])
+        else:
+            headers = []
+            for line in lines:
+                if line.startswith(b'>'):
+                    self._endrecord()
+                    self.seqlen = 0
+                    headers.append(line)
+                elif self.seqlen is not None:
+                    self.seqlen += len(line.rstrip())
+            self._labels(headers)
+    def _labels(self, headers):
+        for header in headers:
+            label = sample_label(header)
+            if label is not None:
+                self.samples[label.decode('utf-8')] += 1
+    def _endrecord(self):
+        if self.seqlen is not None:
+            self.records += 1
+            self.bases += self.seqlen
+            self.lengths[self.seqlen] += 1
+            self.seqlen = None
+    def finish(self):
+        if self.pending.strip():
+            self.update(b'\n')
+        self.pending = b''
+        self._endrecord()
+
+#in-memory stats of the files counted by this process
+FASTX_STATS = {}
+
+#save the stats next to each file counted so later amptk commands do not count it again,
+#off by default as the sidecars would end up next to user files and outputs
+STATS_SIDECAR = os.environ.get('AMPTK_STATS_SIDECAR', '') not in ['', '0']
+
+def fastx_stats_file(input):
+    #hidden sidecar next to the file, so folder listings and globs skip it
+    return os.path.join(os.path.dirname(input), '.'+os.path.basename(input)+'.amptkstats')
+
+def fastx_stats_key(input):
+    st = os.stat(input)
+    return [os.path.abspath(input), st.st_size, st.st_mtime]
+
+def load_fastx_stats(input, key):
+    try:
+        with open(fastx_stats_file(input), 'r') as infile:
+            result = json.load(infile)
+        if result.get('key') == key:
+            result['lengths'] = dict((int(k), v) for k, v in result['lengths'].items())
+            return result
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return None
+
+def save_fastx_stats(input, result):
+    try:
+        with open(fastx_stats_file(input), 'w') as outfile:
+            json.dump(result, outfile)
+    except (IOError, OSError):
+        pass #read-only folder, keep it in memory only
+
+def fastx_stats(input):
+    '''
+    return dict of record count (records), total bases, length histogram (lengths) and
+    per-sample label counts (samples) for a FASTA/FASTQ file. The file is scanned block-wise
+    on the first request and the result kept in memory keyed by path, size, and mtime.
+    With AMPTK_STATS_SIDECAR=1 it is also saved in a sidecar next to the file
+    '''
+    key = fastx_stats_key(input)
+    if tuple(key) in FASTX_STATS:
+        return FASTX_STATS[tuple(key)]
+    result = load_fastx_stats(input, key) if STATS_SIDECAR else None
+    if result is None:
+        stats = FastxStats()
+        for offset, data in iter_fastx_blocks(input):
+            stats.update(data)
+        stats.finish()
+        result = {'key': key, 'format': stats.format,
+                  'records': stats.records, 'bases': stats.bases,
+                  'lengths': dict(stats.lengths), 'samples': dict(stats.samples)}
+        if STATS_SIDECAR:
+            save_fastx_stats(input, result)
+    FASTX_STATS[tuple(key)] = result
+    return result
+
+def iter_fastq_batches(input, start=0, end=None, blocksize=1048576, threads=1, depth=None):
+    '''
+    fast FASTQ parser for the per-read loops, reads large binary blocks and yields
+    lists of (title, seq, qual) bytes tuples, one list per block. Reads must be
+    4 lines per record (as written by Illumina/Ion/amptk), title is without the @.
+    Blocks are read, decompressed and split on a reader thread, see iter_readahead
+    '''
+    return iter_readahead(fastq_blocks(input, start, end, blocksize, threads), depth)
+
+def fastq_blocks(input, start, end, blocksize, threads):
+    pending = b''
+    with open_fastx(input, mode='rb', start=start, end=end, threads=threads) as infile:
+        while True:
+            block = infile.read(blocksize)
+            if not block:
+                break
+            lines = (pending + block).split(b'\n')
+            n = ((len(lines) - 1) // 4) * 4
+            pending = b'\n'.join(lines[n:])
+            if n:
+                yield fastq_batch(lines, n)
+    if pending.strip():
+        lines = pending.rstrip(b'\r\n').split(b'\n')
+        if len(lines) % 4:
+            raise ValueError('%s: truncated FASTQ record at end of file' % input)
+        yield fastq_batch(lines, len(lines))
+
+FIRST_BYTE = operator.itemgetter(0)
+
+def fastq_batch(lines, n):
+    #lines[:n] are complete records, check the structure once per batch
+    titles = lines[0:n:4]
+    seqs = lines[1:n:4]
+    comments = lines[2:n:4]
+    quals = lines[3:n:4]
+    try:
+        valid = set(map(FIRST_BYTE, titles)) == {64} and set(map(FIRST_BYTE, comments)) == {43}
+    except IndexError: #empty line
+        valid = False
+    if not valid:
+        raise ValueError('FASTQ records must start with @ and have + separator lines')
+    if b'\r' in seqs[0] or b'\r' in quals[-1]:
+        titles = [x.rstrip(b'\r') for x in titles]
+        seqs = [x.rstrip(b'\r') for x in seqs]
+        quals = [x.rstrip(b'\r') for x in quals]
+    return list(zip([x[1:] for x in titles], seqs, quals))
+
+def iter_fastq(input, start=0, end=None, threads=1, depth=None):
+    #one (title, seq, qual) bytes tuple at a time, for zipping paired files
+    for batch in iter_fastq_batches(input, start=start, end=end, threads=threads, depth=depth):
+        for rec in batch:
+            yield rec
+
+class FastqWriter(object):
+    '''
+    batched writer for the bytes records from iter_fastq_batches, records are joined and
+    written every batchsize reads. Output goes through open_fastx_writer, so .gz output
+    is BGZF
+    '''
+    def __init__(self, output, threads=1, batchsize=4096, append=False):
+        self.handle = open_fastx_writer(output, mode='wb', threads=threads, append=append)
+        self.batchsize = batchsize
+        self.batch = []
+    def write(self, title, seq, qual):
+        self.batch.append(b'@%s\n%s\n+\n%s\n' % (title, seq, qual))
+        if len(self.batch) >= self.batchsize:
+            self.flush()
+    def writebatch(self, records):
+        self.flush()
+        self.handle.write(b''.join([b'@%s\n%s\n+\n%s\n' % x for x in records]))
+    def flush(self):
+        if self.batch:
+            self.handle.write(b''.join(self.batch))
+            self.batch = []
+    def tell(self):
+        self.flush()
+        self.handle.flush()
+        return self.handle.tell()
+    def close(self):
+        self.flush()
+        self.handle.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+
+#per-sample writers kept open at once, well below the usual limit of 1024 open files
+MAX_OPEN_WRITERS = 128
+
+class WriterCache(object):
+    '''
+    per-sample output writers, at most maxopen are open at once. The least recently used
+    is closed when another is needed and opener(output, append=True) reopens it to add
+    to the end, so any number of samples can be written without running out of handles
+    '''
+    def __init__(self, opener, maxopen=MAX_OPEN_WRITERS):
+        self.opener = opener
+        self.maxopen = max(1, int(maxopen))
+        self.handles = collections.OrderedDict()
+        self.opened = set()
+
+    def get(self, output):
+        handle = self.handles.get(output)
+        if handle is not None:
+            self.handles.move_to_end(output)
+            return handle
+        if len(self.handles) >= self.maxopen:
+            self.handles.popitem(last=False)[1].close()
+        handle = self.opener(output, append=output in self.opened)
+        self.opened.add(output)
+        self.handles[output] = handle
+        return handle
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
+def fastx_index_file(input):
+    #per-sample index of a sample sorted BGZF file, lives next to it like a .fai
+    return input+'.idx'
+
+def save_fastx_index(input, index):
+    #index is list of [sample, start, end, count] in file order
+    with open(fastx_index_file(input), 'w') as outfile:
+        json.dump({'key': fastx_stats_key(input), 'samples': index}, outfile)
+
+def fastx_index(input):
+    '''
+    return OrderedDict of sample: (start, end, count) virtual offset ranges for a
+    FASTQ file written by sort_fastx_by_sample, or None if there is no valid index
+    '''
+    idx = fastx_index_file(input)
+    if not os.path.isfile(idx):
+        return None
+    try:
+        with open(idx, 'r') as infile:
+            result = json.load(infile)
+    except (IOError, ValueError):
+        return None
+    if result.get('key') != fastx_stats_key(input):
+        log.debug('{:} is out of date, ignoring it'.format(idx))
+        return None
+    return collections.OrderedDict((x[0], tuple(x[1:])) for x in result['samples'])
+
+def fastx_sample_counts(input):
+    #reads per sample, from the index if there is one otherwise counted by fastx_stats
+    index = fastx_index(input)
+    if index is not None:
+        return dict((k, v[2]) for k, v in index.items())
+    return fastx_stats(input)['samples']
+
+def write_sample_run(buckets, output):
+    #write in-memory sample buckets as a sorted run, returns (output, {sample: (start, end)})
+    ranges = {}
+    with open(output, 'wb') as outfile:
+        for sample in natsorted(buckets):
+            start = outfile.tell()
+            outfile.write(b''.join(buckets[sample]))
+            ranges[sample] = (start, outfile.tell())
+    return output, ranges
+
+def merge_sample_runs(runs, outfile, samples):
+    '''
+    k-way merge of sorted runs [(file, {sample: (start, end)})] into open outfile, each
+    sample (in samples order) gets its records from every run in turn. Runs hold the
+    samples in the same order, so each is read front to back with one handle.
+    Returns {sample: (start, end)} offsets in outfile
+    '''
+    handles = [open(x[0], 'rb') for x in runs]
+    result = {}
+    try:
+        for sample in samples:
+            outfile.flush()
+            start = outfile.tell()
+            for infile, (file, ranges) in zip(handles, runs):
+                if not sample in ranges:
+                    continue
+                begin, end = ranges[sample]
+                infile.seek(begin)
+                while begin < end:
+                    data = infile.read(min(1048576, end - begin))
+                    outfile.write(data)
+                    begin += len(data)
+            outfile.flush()
+            result[sample] = (start, outfile.tell())
+    finally:
+        for x in handles:
+            x.close()
+    return result
+
+def sort_fastx_by_sample(inputs, output, threads=1, tmpdir=None, buffersize=67108864, maxopen=MAX_OPEN_WRITERS):
+    '''
+    write FASTQ records from inputs to BGZF output grouped by sample (barcodelabel=),
+    samples in natural sort order, and save an index of each sample's virtual offset
+    range and read count next to it (see fastx_index). Records are bucketed in memory
+    and written as a run sorted by sample when buffersize is exceeded, the runs are
+    merged at the end, maxopen at a time
+    '''
+    if not tmpdir:
+        tmpdir = os.path.dirname(os.path.abspath(output))
+    spilldir = tempfile.mkdtemp(prefix='sort_', dir=tmpdir)
+    buckets = {}
+    runs = []
+    counts = collections.Counter()
+    buffered = 0
+    try:
+        for file in inputs:
+            for batch in iter_fastq_batches(file):
+                for title, seq, qual in batch:
+                    label = sample_label(title)
+                    sample = label.decode('utf-8') if label is not None else ''
+                    rec = b'@%s\n%s\n+\n%s\n' % (title, seq, qual)
+                    if not sample in buckets:
+                        buckets[sample] = []
+                    buckets[sample].append(rec)
+                    counts[sample] += 1
+                    buffered += len(rec)
+                if buffered > buffersize:
+                    runs.append(write_sample_run(buckets, os.path.join(spilldir, str(len(runs)))))
+                    buckets = {}
+                    buffered = 0
+        samples = natsorted(counts)
+        if runs and buckets:
+            runs.append(write_sample_run(buckets, os.path.join(spilldir, str(len(runs)))))
+            buckets = {}
+        #more runs than open files, merge them in groups (in order) first
+        level = 0
+        while len(runs) > maxopen:
+            level += 1
+            merged = []
+            for i in range(0, len(runs), maxopen):
+                file = os.path.join(spilldir, '{:}.{:}'.format(level, len(merged)))
+                with open(file, 'wb') as outfile:
+                    merged.append((file, merge_sample_runs(runs[i:i+maxopen], outfile, samples)))
+                for x in runs[i:i+maxopen]:
+                    os.remove(x[0])
+            runs = merged
+        index = []
+        with open_fastx_writer(output, mode='wb', threads=threads, compress=True) as outfile:
+            if runs:
+                ranges = merge_sample_runs(runs, outfile, samples)
+            else:
+                ranges = {}
+                for sample in samples:
+                    #BufferedWriter.tell adds pending bytes to the raw offset, so flush
+                    #first, the BGZF virtual offset is not linear in bytes written
+                    outfile.flush()
+                    start = outfile.tell()
+                    outfile.write(b''.join(buckets[sample]))
+                    outfile.flush()
+                    ranges[sample] = (start, outfile.tell())
+            for sample in samples:
+                index.append([sample, ranges[sample][0], ranges[sample][1], counts[sample]])
+        save_fastx_index(output, index)
+    finally:
+        shutil.rmtree(spilldir)
+    return index
+
+def write_fastx_samples(input, samples, output, threads=1):
+    '''
+    copy the records of samples (in index order) from a sample sorted file to output,
+    BGZF (.gz) output is indexed too. Returns number of reads written
+    '''
+    index = fastx_index(input)
+    newindex = []
+    total = 0
+    with open_fastx_writer(output, mode='wb', threads=threads) as outfile:
+        for sample, (start, end, count) in index.items():
+            if not sample in samples:
+                continue
+            outfile.flush()
+            begin = outfile.tell()
+            for offset, data in iter_fastx_blocks(input, start=start, end=end, format='bgzf'):
+                outfile.write(data)
+            outfile.flush()
+            newindex.append([sample, begin, outfile.tell(), count])
+            total += count
+    if fastx_format(output) == 'bgzf':
+        save_fastx_index(output, newindex)
+    return total
+
+def write_fastx_range(input, start, end, output):
+    #copy uncompressed data from a (start, end) range into output file
+    with open(output, 'wb') as outfile:
+        for offset, data in iter_fastx_blocks(input, start=start, end=end):
+            outfile.write(data)
+
 def split_fastq(input, numseqs, outputdir, chunks):
-    #get number of sequences and then number of sequences in each chunk
-    numlines = numseqs*4
-    n = numlines // chunks
-    #make sure n is divisible by 4 (number of lines in fastq)
-    if ( n % 4 ) != 0:
-        n = ((n // 4) + 1) * 4
-    splits = []
-    count = 0
-    for i in range(chunks):
-        start = count
-        end = count+n
-        if end > numlines:
-            end = numlines
-        splits.append((start, end))
-        count += n
-    #get line positions from file
-    linepos = scan_linepos(input)
-    #make sure output directory exists
+    #numseqs is kept for compatibility, chunks are found by sampling byte offsets
     if not os.path.isdir(outputdir):
         os.makedirs(outputdir)
-    #loop through the positions and write output
-    for i, x in enumerate(splits):
+    if not fastx_splittable(input):
+        #streams are read once, switching output at the record ranges
+        with open_fastx(input, mode='rb') as infile:
+            for i, x in enumerate(fastq_chunks(input, chunks)):
+                with open(os.path.join(outputdir, 'chunk_'+str(i+1)+'.fq'), 'wb') as outfile:
+                    outfile.writelines(itertools.islice(infile, (x[1] - x[0]) * 4))
+        return
+    for i, x in enumerate(fastq_chunks(input, chunks)):
         num = i+1
-        with open(os.path.join(outputdir, 'chunk_'+str(num)+'.fq'), 'w') as output:
-            lines = return_lines(input, linepos, x[0], x[1])
-            output.write('%s' % ''.join(lines))
+        write_fastx_range(input, x[0], x[1], os.path.join(outputdir, 'chunk_'+str(num)+'.fq'))
 
 def split_fastqPE(R1, R2, numseqs, outputdir, chunks):
-    #get number of sequences and then number of sequences in each chunk
-    numlines = numseqs*4
-    n = numlines // chunks
-    #make sure n is divisible by 4 (number of lines in fastq)
-    if ( n % 4 ) != 0:
-        n = ((n // 4) + 1) * 4
-    splits = []
-    count = 0
-    for i in range(chunks):
-        start = count
-        end = count+n
-        if end > numlines:
-            end = numlines
-        splits.append((start, end))
-        count += n
-    #get line positions from file
-    linepos = scan_linepos(R1)
-    #make sure output directory exists
     if not os.path.isdir(outputdir):
         os.makedirs(outputdir)
-    #loop through the positions and write output
-    for i, x in enumerate(splits):
+    for i, x in enumerate(fastq_chunksPE([R1, R2], chunks)):
         num = i+1
-        with open(os.path.join(outputdir, 'chunk_'+str(num)+'_R1.fq'), 'w') as output1:
-            with open(os.path.join(outputdir, 'chunk_'+str(num)+'_R2.fq'), 'w') as output2:
-                lines1 = return_lines(R1, linepos, x[0], x[1])
-                output1.write('%s' % ''.join(lines1))
-                lines2 = return_lines(R2, linepos, x[0], x[1])
-                output2.write('%s' % ''.join(lines2))
+        for file, read, r in zip([R1, R2], ['R1', 'R2'], x[1]):
+            write_fastx_range(file, r[0], r[1],
+                              os.path.join(outputdir, 'chunk_'+str(num)+'_'+read+'.fq'))
 
 def split_fastqPEandI(R1, R2, I1, numseqs, outputdir, chunks):
-    #get number of sequences and then number of sequences in each chunk
-    numlines = numseqs*4
-    n = numlines // chunks
-    #make sure n is divisible by 4 (number of lines in fastq)
-    if ( n % 4 ) != 0:
-        n = ((n // 4) + 1) * 4
-    splits = []
-    count = 0
-    for i in range(chunks):
-        start = count
-        end = count+n
-        if end > numlines:
-            end = numlines
-        splits.append((start, end))
-        count += n
-    #get line positions from file
-    linepos = scan_linepos(R1)
-    linepos2 = scan_linepos(I1)
-    #make sure output directory exists
     if not os.path.isdir(outputdir):
         os.makedirs(outputdir)
-    #loop through the positions and write output
-    for i, x in enumerate(splits):
+    for i, x in enumerate(fastq_chunksPE([R1, R2, I1], chunks)):
         num = i+1
-        with open(os.path.join(outputdir, 'chunk_'+str(num)+'_R1.fq'), 'w') as output1:
-            with open(os.path.join(outputdir, 'chunk_'+str(num)+'_R2.fq'), 'w') as output2:
-                with open(os.path.join(outputdir, 'chunk_'+str(num)+'_R3.fq'), 'w') as output3:
-                    lines1 = return_lines(R1, linepos, x[0], x[1])
-                    output1.write('%s' % ''.join(lines1))
-                    lines2 = return_lines(R2, linepos, x[0], x[1])
-                    output2.write('%s' % ''.join(lines2))
-                    lines3 = return_lines(I1, linepos2, x[0], x[1])
-                    output3.write('%s' % ''.join(lines3))
+        for file, read, r in zip([R1, R2, I1], ['R1', 'R2', 'R3'], x[1]):
+            write_fastx_range(file, r[0], r[1],
+                              os.path.join(outputdir, 'chunk_'+str(num)+'_'+read+'.fq'))
 
 
 def split_fasta(input, outputdir, chunks):
@@ -710,21 +2180,52 @@ def split_fasta(input, outputdir, chunks):
 
 
 def trim3prime(input, trimlen, output, removelist):
-    with open(output, 'w') as outfile:
-        for title, seq, qual in FastqGeneralIterator(gzopen(input)):
-            if not title.split(' ')[0] in removelist:
-                Seq = seq[:trimlen]
-                Qual = qual[:trimlen]
-                outfile.write("@%s\n%s\n+\n%s\n" % (title, Seq, Qual))
-
+    removelist = set(x.encode('utf-8') for x in removelist)
+    with FastqWriter(output) as outfile:
+        for batch in iter_fastq_batches(input):
+            if removelist:
+                batch = [x for x in batch if not x[0].split(b' ')[0] in removelist]
+            outfile.writebatch([(title, seq[:trimlen], qual[:trimlen]) for title, seq, qual in batch])
+
+def trim3primePE(R1, R2, trimlen, outR1, outR2, index=''):
+    '''
+    truncate paired reads to trimlen in one pass, if index is given pairs with a different
+    index sequence in either header (i.e. @M0:1:1 1:N:0:ACGTACGT) are dropped
+    returns number of pairs and number dropped
+    '''
+    Total = 0
+    Dropped = 0
+    screen = None
+    index = index.encode('utf-8')
+    with FastqWriter(outR1) as outfile1:
+        with FastqWriter(outR2) as outfile2:
+            for read1, read2 in zipPaired((R1, R2), iter_fastq(R1), iter_fastq(R2)):
+                Total += 1
+                if screen is None:
+                    #only headers ending in the index sequence, not the sample number, are screened
+                    screen = bool(index) and not read1[0].split(b' ')[-1].split(b':')[-1].isdigit()
+                if screen and (read1[0].split(b':')[-1] != index or read2[0].split(b':')[-1] != index):
+                    Dropped += 1
+                    continue
+                outfile1.write(read1[0], read1[1][:trimlen], read1[2][:trimlen])
+                outfile2.write(read2[0], read2[1][:trimlen], read2[2][:trimlen])
+    return Total, Dropped
 
-def PEsanitycheck(R1, R2):
-    R1count = line_count(R1)
-    R2count = line_count(R2)
-    if R1count != R2count:
-        return False
-    else:
-        return True
+def zipPaired(files, *iterators):
+    '''
+    zip the records of paired read files, logs and exits if one file has more reads,
+    so the pairing is checked in the same pass instead of counting each file first
+    '''
+    try:
+        from itertools import zip_longest
+    except ImportError:
+        from itertools import izip_longest as zip_longest
+    for records in zip_longest(*iterators):
+        if None in records:
+            names = [x[0] if isinstance(x, tuple) else x for x in files]
+            log.error("%s are not properly paired, exiting" % ' and '.join(names))
+            sys.exit(1)
+        yield records
 
 
 def PEandIndexCheck(R1, R2, R3):
@@ -756,148 +2257,118 @@ def mapIndex(seq, mapDict, bcmismatch):
     else:
         return (None,None)
 
-
-def DemuxIllumina(R1, R2, I1, mapDict, mismatch,
-                  fwdprimer, revprimer, primer_mismatch,
-                  outR1, outR2, trim_primers=True):
-    try:
-        from itertools import zip_longest
-    except ImportError:
-        from itertools import izip_longest as zip_longest
-    Total = 0
-    FPrimer = 0
-    RPrimer = 0
-    BCFound = 0
-    #function to loop through PE reads, renaming according to index
-    file1 = FastqGeneralIterator(gzopen(R1))
-    file2 = FastqGeneralIterator(gzopen(R2))
-    file3 = FastqGeneralIterator(gzopen(I1))
-    counter = 1
-    with open(outR1, 'w') as outfile1:
-        with open(outR2, 'w') as outfile2:
-            for read1, read2, index in zip(file1, file2, file3):
-                Total += 1
-                Name,Diffs = mapIndex(index[1], mapDict, mismatch)
-                if Name:
-                    BCFound += 1
-                    if trim_primers:
-                        #strip primers if found
-                        R1ForPos = trimForPrimer(fwdprimer, read1[1], primer_mismatch)
-                        R1RevPos = trimRevPrimer(revprimer, read1[1], primer_mismatch)
-                        R2ForPos = trimForPrimer(revprimer, read2[1], primer_mismatch)
-                        R2RevPos = trimRevPrimer(fwdprimer, read2[1], primer_mismatch)
-                        if R1ForPos > 0:
-                            FPrimer += 1
-                        if R1RevPos > 0:
-                            RPrimer += 1
-                        header = 'R_'+str(counter)+';barcodelabel='+Name+';bcseq='+index[1]+';bcdiffs='+str(Diffs)+';'
-                        outfile1.write('@%s\n%s\n+\n%s\n' % (header, read1[1][R1ForPos:R1RevPos], read1[2][R1ForPos:R1RevPos]))
-                        outfile2.write('@%s\n%s\n+\n%s\n' % (header, read2[1][R2ForPos:R2RevPos], read2[2][R2ForPos:R2RevPos]))
-                    else:
-                        header = 'R_'+str(counter)+';barcodelabel='+Name+';bcseq='+index[1]+';bcdiffs='+str(Diffs)+';'
-                        outfile1.write('@%s\n%s\n+\n%s\n' % (header, read1[1], read1[2]))
-                        outfile2.write('@%s\n%s\n+\n%s\n' % (header, read2[1], read2[2]))
-                    counter += 1
-    return Total, BCFound, FPrimer, RPrimer
-
-def DemuxIllumina4SRA(R1, R2, I1, mapDict, mismatch, outdir):
-    try:
-        from itertools import zip_longest
-    except ImportError:
-        from itertools import izip_longest as zip_longest
-    Total = 0
-    BCFound = 0
-    #function to loop through PE reads, renaming according to index
-    file1 = FastqGeneralIterator(gzopen(R1))
-    file2 = FastqGeneralIterator(gzopen(R2))
-    file3 = FastqGeneralIterator(gzopen(I1))
-    counter = 1
-    for read1, read2, index in zip(file1, file2, file3):
-        Total += 1
-        Name, Diffs = mapIndex(index[1], mapDict, mismatch)
-        if Name:
-            BCFound += 1
-            with open(os.path.join(outdir, Name+'_R1.fastq'), 'a') as outfile1:
-                with open(os.path.join(outdir, Name+'_R2.fastq'), 'a') as outfile2:
-                    #header = 'R_'+str(counter)+';barcodelabel='+Name+';bcseq='+index[1]+';bcdiffs='+str(Diffs)+';'
-                    outfile1.write('@%s\n%s\n+\n%s\n' % (read1[0], read1[1], read1[2]))
-                    outfile2.write('@%s\n%s\n+\n%s\n' % (read2[0], read2[1], read2[2]))
-                    counter += 1
-    return Total, BCFound
-
-def stripPrimersPE(R1, R2, RL, samplename, fwdprimer, revprimer, primer_mismatch, require_primer, full_length, outR1, outR2):
-    try:
-        from itertools import zip_longest
-    except ImportError:
-        from itertools import izip_longest as zip_longest
+
+def DemuxIllumina(R1, R2, I1, mapDict, mismatch,
+                  fwdprimer, revprimer, primer_mismatch,
+                  outR1, outR2, trim_primers=True, offset=0):
+    '''
+    relabel paired reads by the sample of their index read and cut the primers, inputs
+    are files or (file, start, end) ranges.  Returns (total, barcode found, forward
+    primer found, reverse primer found)
+    '''
+    #mapDict can be a dictionary or an IndexResolver shared by the caller
+    if not isinstance(mapDict, IndexResolver):
+        mapDict = IndexResolver(mapDict, mismatch)
+    stages = [IndexReadResolver(mapDict)]
+    if trim_primers:
+        stages.append(PairedPrimerTrimmer(PrimerSet(fwdprimer, revprimer, primer_mismatch)))
+    ranges = [x if isinstance(x, tuple) else (x, 0, None) for x in (R1, R2, I1)]
+    stats = DemuxEngine(stages).run(ranges, DemuxWriter(outR1, offset=offset, output2=outR2))
+    return stats['total'], stats['total'] - stats['no_barcode'], stats['fwd_primer'], stats['rev_primer']
+
+def DemuxIllumina4SRA(R1, R2, I1, mapDict, mismatch, outdir):
+    '''
+    split paired reads into per-sample R1/R2 files in outdir by the sample of their
+    index read, returns (total, barcode found)
+    '''
+    #mapDict can be a dictionary or an IndexResolver shared by the caller
+    if not isinstance(mapDict, IndexResolver):
+        mapDict = IndexResolver(mapDict, mismatch)
+    ranges = [(x, 0, None) for x in (R1, R2, I1)]
+    stats = DemuxEngine([IndexReadResolver(mapDict)]).run(ranges, SampleWriter(outdir, paired=True))
+    return stats['total'], stats['valid']
+
+def stripPrimersPE(R1, R2, RL, samplename, fwdprimer, revprimer, primer_mismatch, require_primer, full_length, outR1, outR2, primers=None, merger=None, rescue='on', first=1, phix=None):
+    '''
+    trim primers from read pairs to outR1/outR2, with a PairMerger the pairs are merged
+    as they are trimmed and written to outR1 (and R1 of pairs not merging if rescue),
+    dropping PhiX reads with a PhixScreen. R1/R2 can be (file, start, end) ranges,
+    reads are numbered from first
+    '''
     #can walk through dataset in pairs
-    file1 = FastqGeneralIterator(gzopen(R1))
-    file2 = FastqGeneralIterator(gzopen(R2))
-    counter = 1
+    file1, file2 = [iter_fastq(*x) if isinstance(x, tuple) else iter_fastq(x) for x in (R1, R2)]
+    counter = first
     Total = 0
     multihits = 0
     findForPrimer = 0
     findRevPrimer = 0
-    with open(outR1, 'w') as outfile1:
-        with open(outR2, 'w') as outfile2:
-            for read1, read2 in zip(file1, file2):
-                Total += 1
-                ffp = False
-                frp = False
-                R1Seq = read1[1][:RL]
-                R1Qual = read1[2][:RL]
-                R2Seq = read2[1][:RL]
-                R2Qual = read2[2][:RL]
-                ForTrim, RevTrim = (0,)*2
-                #look for forward primer in forward read
-                R1foralign = edlib.align(fwdprimer, R1Seq, mode="HW", k=primer_mismatch, additionalEqualities=degenNuc)
-                if R1foralign['editDistance'] < 0:
-                    if require_primer == 'on' or full_length: #not found
-                        continue
-                else:
-                    if len(R1foralign['locations']) > 1: #multiple hits
-                        multihits += 1
-                        continue
-                    try:
-                        ForTrim = R1foralign["locations"][0][1]+1
-                        findForPrimer += 1
-                        ffp = True
-                    except IndexError:
-                        pass
-                R1revalign = edlib.align(RevComp(revprimer), R1Seq, mode="HW", k=primer_mismatch, additionalEqualities=degenNuc)
-                if R1revalign['editDistance'] < 0:
-                    R1RevCut = RL
-                else:
-                    R1RevCut = R1revalign["locations"][0][0]
-                    findRevPrimer += 1
-                    frp = True
-                #look for reverse primer in reverse read
-                R2foralign = edlib.align(revprimer, R2Seq, mode="HW", k=primer_mismatch, additionalEqualities=degenNuc)
-                if R2foralign['editDistance'] < 0:
-                    if require_primer == 'on' or full_length: #not found
-                        continue
-                else:
-                    if len(R2foralign['locations']) > 1: #multiple hits
-                        multihits += 1
-                        continue
-                    try:
-                        RevTrim = R2foralign["locations"][0][1]+1
-                        if not frp:
-                            findRevPrimer += 1
-                    except IndexError:
-                        pass
-                R2revalign = edlib.align(RevComp(fwdprimer), R2Seq, mode="HW", k=primer_mismatch, additionalEqualities=degenNuc)
-                if R2revalign['editDistance'] < 0:
-                    R2RevCut = RL
-                else:
-                    R2RevCut = R2revalign["locations"][0][0]
-                    if not ffp:
-                        findForPrimer += 1
-                header = 'R_{:};barcodelabel={:};'.format(counter,samplename)
-                outfile1.write('@%s\n%s\n+\n%s\n' % (header, R1Seq[ForTrim:R1RevCut], R1Qual[ForTrim:R1RevCut]))
-                outfile2.write('@%s\n%s\n+\n%s\n' % (header, R2Seq[RevTrim:R2RevCut], R2Qual[RevTrim:R2RevCut]))
-                counter += 1
-    return Total, counter-1, multihits, findForPrimer, findRevPrimer
+    label = samplename.encode('utf-8')
+    #primers are expected at the read start, their reverse complements near the end
+    if primers is None:
+        primers = PrimerSet(fwdprimer, revprimer, primer_mismatch)
+    primers.reset()
+    if merger:
+        outfile = MergedPairWriter(outR1, merger, rescue=rescue, phix=phix)
+    else:
+        outfile = FastqPairWriter(outR1, outR2)
+    with outfile:
+        for read1, read2 in zipPaired((R1, R2), file1, file2):
+            Total += 1
+            ffp = False
+            frp = False
+            R1Seq = read1[1][:RL]
+            R1Qual = read1[2][:RL]
+            R2Seq = read2[1][:RL]
+            R2Qual = read2[2][:RL]
+            ForTrim, RevTrim = (0,)*2
+            #look for forward primer in forward read
+            R1foralign = primers.fwdStart(R1Seq)
+            if R1foralign['editDistance'] < 0:
+                if require_primer == 'on' or full_length: #not found
+                    continue
+            else:
+                if len(R1foralign['locations']) > 1: #multiple hits
+                    multihits += 1
+                    continue
+                try:
+                    ForTrim = R1foralign["locations"][0][1]+1
+                    findForPrimer += 1
+                    ffp = True
+                except IndexError:
+                    pass
+            #reverse complemented primers near the read ends are only counted, reads are
+            #cut at the primers at their starts
+            R1revalign = primers.revEnd(R1Seq)
+            if R1revalign['editDistance'] >= 0:
+                findRevPrimer += 1
+                frp = True
+            #look for reverse primer in reverse read
+            R2foralign = primers.revStart(R2Seq)
+            if R2foralign['editDistance'] < 0:
+                if require_primer == 'on' or full_length: #not found
+                    continue
+            else:
+                if len(R2foralign['locations']) > 1: #multiple hits
+                    multihits += 1
+                    continue
+                try:
+                    RevTrim = R2foralign["locations"][0][1]+1
+                    if not frp:
+                        findRevPrimer += 1
+                except IndexError:
+                    pass
+            R2revalign = primers.fwdEnd(R2Seq)
+            if R2revalign['editDistance'] >= 0:
+                if not ffp:
+                    findForPrimer += 1
+            header = b'R_%i;barcodelabel=%s;' % (counter, label)
+            if ForTrim > 0 and RevTrim > 0:
+                header += PRIMERS_TRIMMED_B
+            outfile.write(header, R1Seq[ForTrim:], R1Qual[ForTrim:], R2Seq[RevTrim:], R2Qual[RevTrim:])
+            counter += 1
+    for line in primers.summary():
+        log.debug('{:}: {:}'.format(samplename, line))
+    return Total, counter-first, multihits, findForPrimer, findRevPrimer
 
 def primerFound(primer, seq, mismatch):
     align = edlib.align(primer, seq, mode="HW", k=mismatch, additionalEqualities=degenNuc)
@@ -921,11 +2392,11 @@ def illuminaReorient(R1, R2, fwdprimer, revprimer, mismatch, ReadLength, outR1,
     Flipped = 0
     Dropped = 0
     #function to loop through PE reads, renaming according to index
-    file1 = FastqGeneralIterator(gzopen(R1))
-    file2 = FastqGeneralIterator(gzopen(R2))
-    with open(outR1, 'w') as outfile1:
-        with open(outR2, 'w') as outfile2:
-            for read1, read2 in zip(file1, file2):
+    file1 = FastqGeneralIterator(open_fastx(R1))
+    file2 = FastqGeneralIterator(open_fastx(R2))
+    with open_fastx_writer(outR1) as outfile1:
+        with open_fastx_writer(outR2) as outfile2:
+            for read1, read2 in zipPaired((R1, R2), file1, file2):
                 Total += 1
                 if primerFound(fwdprimer, read1[1], mismatch) and primerFound(revprimer, read2[1], mismatch):
                     Correct += 1
@@ -940,64 +2411,75 @@ def illuminaReorient(R1, R2, fwdprimer, revprimer, mismatch, ReadLength, outR1,
     return Total, Correct, Flipped, Dropped
 
 
-def demuxIlluminaPE(R1, R2, fwdprimer, revprimer, samples, forbarcodes, revbarcodes, barcode_mismatch, primer_mismatch, outR1, outR2, stats):
-    try:
-        from itertools import zip_longest
-    except ImportError:
-        from itertools import izip_longest as zip_longest
+def demuxIlluminaPE(R1, R2, fwdprimer, revprimer, samples, forbarcodes, revbarcodes, barcode_mismatch, primer_mismatch, outR1, outR2, stats, offset=0, primers=None, dual=None, tag=True):
+    #tag=True marks the pairs as primer trimmed for losslessTrim after merging
+    #barcodes can be dictionaries or a BarcodeIndex built once by the caller
+    if not isinstance(forbarcodes, BarcodeIndex):
+        forbarcodes = BarcodeIndex(forbarcodes, barcode_mismatch, mode='SHW')
+    if not isinstance(revbarcodes, BarcodeIndex):
+        revbarcodes = BarcodeIndex(revbarcodes, barcode_mismatch, mode='SHW')
+    if primers is None:
+        primers = PrimerSet(fwdprimer, revprimer, primer_mismatch, samples=samples)
+    if dual is None and len(samples) > 0:
+        dual = DualBarcodeIndex(samples, barcode_mismatch, revmode='SHW')
     #function to loop through PE reads, renaming according to index
-    file1 = FastqGeneralIterator(gzopen(R1))
-    file2 = FastqGeneralIterator(gzopen(R2))
-    counter = 1
+    file1 = FastqGeneralIterator(open_fastx(R1))
+    file2 = FastqGeneralIterator(open_fastx(R2))
+    counter = offset + 1
     Total = 0
     NoBarcode = 0
     NoRevBarcode = 0
     NoPrimer = 0
     NoRevPrimer = 0
     ValidSeqs = 0
-    with open(outR1, 'w') as outfile1:
-        with open(outR2, 'w') as outfile2:
-            for read1, read2 in zip(file1, file2):
+    with open_fastx_writer(outR1) as outfile1:
+        with open_fastx_writer(outR2) as outfile2:
+            for read1, read2 in zipPaired((R1, R2), file1, file2):
                 Total += 1
                 #look for valid barcode in forward read
                 if len(forbarcodes) > 0:
-                    BC, BCLabel = AlignBarcode(read1[1], forbarcodes, barcode_mismatch)
+                    BC, BCLabel = forbarcodes.align(read1[1])
                     if BC == '':
                         NoBarcode += 1
                         continue
                 if len(samples) > 0: #sample dictionary so enforce primers and barcodes from here
-                    FwdPrimer = samples[BCLabel]['ForPrimer']
-                    RevPrimer = samples[BCLabel]['RevPrimer']
-                    foralign = edlib.align(FwdPrimer, read1[1], mode="HW", k=primer_mismatch, additionalEqualities=degenNuc)
+                    samplePrimers = primers.sample(BCLabel)
+                    foralign = samplePrimers.fwdStart(read1[1])
                     if foralign['editDistance'] < 0: #not found
                         NoPrimer += 1
                         continue
-                    stringent = {}
-                    stringent[BCLabel] = samples[BCLabel]['RevBarcode']
-                    revBC, revBCLabel = AlignBarcode(read2[1], stringent, barcode_mismatch)
-                    if revBC == '':
+                    #sample from the forward and reverse barcode pair
+                    BCLabel = dual.resolve(BC, read2[1])
+                    if BCLabel is None:
                         NoRevBarcode += 1
                         continue
+                    revBCLabel = BCLabel
+                    if not primers.sample(BCLabel) is samplePrimers: #sample shares the barcode, not the primers
+                        samplePrimers = primers.sample(BCLabel)
+                        foralign = samplePrimers.fwdStart(read1[1])
+                        if foralign['editDistance'] < 0:
+                            NoPrimer += 1
+                            continue
                     #look for reverse primer in reverse read
-                    revalign = edlib.align(RevPrimer, read2[1], mode="HW", k=primer_mismatch, additionalEqualities=degenNuc)
+                    revalign = samplePrimers.revStart(read2[1])
                     if revalign['editDistance'] < 0: #not found
                         NoRevPrimer += 1
                         continue
                 else:
                     #look for forward primer
-                    foralign = edlib.align(fwdprimer, read1[1], mode="HW", k=primer_mismatch, additionalEqualities=degenNuc)
+                    foralign = primers.fwdStart(read1[1])
                     if foralign['editDistance'] < 0: #not found
                         NoPrimer += 1
                         continue
                     if len(revbarcodes) > 0:
                         #look for valid revbarcodes
                         if len(revbarcodes) > 0:
-                            revBC, revBCLabel = AlignBarcode(read2[1], revbarcodes, barcode_mismatch)
+                            revBC, revBCLabel = revbarcodes.align(read2[1])
                             if revBC == '':
                                 NoRevBarcode += 1
                                 continue
                     #look for reverse primer in reverse read
-                    revalign = edlib.align(revprimer, read2[1], mode="HW", k=primer_mismatch, additionalEqualities=degenNuc)
+                    revalign = primers.revStart(read2[1])
                     if revalign['editDistance'] < 0: #not found
                         NoRevPrimer += 1
                         continue
@@ -1008,32 +2490,37 @@ def demuxIlluminaPE(R1, R2, fwdprimer, revprimer, samples, forbarcodes, revbarco
                     label = BCLabel+':-:'+revBCLabel
                 ForTrim = foralign["locations"][0][1]+1
                 RevTrim = revalign["locations"][0][1]+1
-                header = 'R_{:};barcodelabel={:};'.format(counter,label)
+                header = 'R_{:};barcodelabel={:};{:}'.format(counter, label, PRIMERS_TRIMMED if tag else '')
                 outfile1.write('@%s\n%s\n+\n%s\n' % (header, read1[1][ForTrim:], read1[2][ForTrim:]))
                 outfile2.write('@%s\n%s\n+\n%s\n' % (header, read2[1][RevTrim:], read2[2][RevTrim:]))
                 counter += 1
                 ValidSeqs += 1
-    with open(stats, 'w') as statsout:
-        statsout.write('%i,%i,%i,%i,%i,%i\n' % (Total, NoBarcode, NoPrimer, NoRevBarcode, NoRevPrimer, ValidSeqs))
-
-def demuxIlluminaPE2(R1, R2, fwdprimer, revprimer, samples, forbarcodes, revbarcodes, barcode_mismatch, primer_mismatch, outR1, outR2, stats):
-    try:
-        from itertools import zip_longest
-    except ImportError:
-        from itertools import izip_longest as zip_longest
+    DemuxStats(total=Total, no_barcode=NoBarcode, no_primer=NoPrimer, no_rev_barcode=NoRevBarcode, no_rev_primer=NoRevPrimer, valid=ValidSeqs).dump(stats, PE_STATS)
+
+def demuxIlluminaPE2(R1, R2, fwdprimer, revprimer, samples, forbarcodes, revbarcodes, barcode_mismatch, primer_mismatch, outR1, outR2, stats, offset=0, primers=None, dual=None, tag=True):
+    #tag=True marks the pairs as primer trimmed for losslessTrim after merging
+    #barcodes can be dictionaries or a BarcodeIndex built once by the caller
+    if not isinstance(forbarcodes, BarcodeIndex):
+        forbarcodes = BarcodeIndex(forbarcodes, barcode_mismatch, mode='HW')
+    if not isinstance(revbarcodes, BarcodeIndex):
+        revbarcodes = BarcodeIndex(revbarcodes, barcode_mismatch, mode='HW')
+    if primers is None:
+        primers = PrimerSet(fwdprimer, revprimer, primer_mismatch, samples=samples)
+    if dual is None and len(samples) > 0:
+        dual = DualBarcodeIndex(samples, barcode_mismatch, revmode='HW')
     #function to loop through PE reads, renaming according to index
-    file1 = FastqGeneralIterator(gzopen(R1))
-    file2 = FastqGeneralIterator(gzopen(R2))
-    counter = 1
+    file1 = FastqGeneralIterator(open_fastx(R1))
+    file2 = FastqGeneralIterator(open_fastx(R2))
+    counter = offset + 1
     Total = 0
     NoBarcode = 0
     NoRevBarcode = 0
     NoPrimer = 0
     NoRevPrimer = 0
     ValidSeqs = 0
-    with open(outR1, 'w') as outfile1:
-        with open(outR2, 'w') as outfile2:
-            for read1, read2 in zip(file1, file2):
+    with open_fastx_writer(outR1) as outfile1:
+        with open_fastx_writer(outR2) as outfile2:
+            for read1, read2 in zipPaired((R1, R2), file1, file2):
                 Total += 1
                 #look for forward primer first, should all have primer and in correct orientation
                 R1ForTrim = trimForPrimer(fwdprimer, read1[1], primer_mismatch)
@@ -1041,25 +2528,31 @@ def demuxIlluminaPE2(R1, R2, fwdprimer, revprimer, samples, forbarcodes, revbarc
                     continue
                 if len(forbarcodes) > 0: #search for barcode match in seq upstream of primer
                     R1BCtrim = R1ForTrim - len(fwdprimer)
-                    BC, BCLabel = AlignBarcode2(read1[1][:R1BCtrim], forbarcodes, barcode_mismatch)
+                    BC, BCLabel = forbarcodes.align(read1[1][:R1BCtrim])
                     if BC == '':
                         NoBarcode += 1
                         continue
                 if len(samples) > 0: #sample dictionary so enforce primers and barcodes from here
-                    FwdPrimer = samples[BCLabel]['ForPrimer']
-                    RevPrimer = samples[BCLabel]['RevPrimer']
-                    stringent = {}
-                    stringent[BCLabel] = samples[BCLabel]['RevBarcode']
+                    samplePrimers = primers.sample(BCLabel)
+                    RevPrimer = samplePrimers.rev
                     #find rev primer in reverse read
                     R2ForTrim = trimForPrimer(RevPrimer, read2[1], primer_mismatch)
                     if R2ForTrim == 0:
                         continue
-                    #look for reverse barcode
+                    #look for reverse barcode, sample from the forward and reverse barcode pair
                     R2BCTrim = R2ForTrim - len(RevPrimer)
-                    revBC, revBCLabel = AlignBarcode2(read2[1][:R2BCTrim], stringent, barcode_mismatch)
-                    if revBC == '':
+                    BCLabel = dual.resolve(BC, read2[1][:R2BCTrim])
+                    if BCLabel is None:
                         NoRevBarcode += 1
                         continue
+                    revBCLabel = BCLabel
+                    if not primers.sample(BCLabel) is samplePrimers: #sample shares the barcode, not the primers
+                        samplePrimers = primers.sample(BCLabel)
+                        R2ForTrim = trimForPrimer(samplePrimers.rev, read2[1], primer_mismatch)
+                        if R2ForTrim == 0:
+                            continue
+                    FwdPrimer = samplePrimers.fwd
+                    RevPrimer = samplePrimers.rev
                     #okay, found both primers and barcodes, now 1 more cleanup step trip revcomped primers
                     R1RevTrim = trimRevPrimer(RevPrimer, read1[1], primer_mismatch)
                     R2RevTrim = trimRevPrimer(FwdPrimer, read2[1], primer_mismatch)
@@ -1071,7 +2564,7 @@ def demuxIlluminaPE2(R1, R2, fwdprimer, revprimer, samples, forbarcodes, revbarc
                     if len(revbarcodes) > 0:
                         #look for reverse barcode
                         R2BCTrim = R2ForTrim - len(revprimer)
-                        revBC, revBCLabel = AlignBarcode2(read2[1][:R2BCTrim], revbarcodes, barcode_mismatch)
+                        revBC, revBCLabel = revbarcodes.align(read2[1][:R2BCTrim])
                         if revBC == '':
                             NoRevBarcode += 1
                             continue
@@ -1084,17 +2577,381 @@ def demuxIlluminaPE2(R1, R2, fwdprimer, revprimer, samples, forbarcodes, revbarc
                     label = BCLabel
                 else:
                     label = BCLabel+':-:'+revBCLabel
-                header = 'R_{:};barcodelabel={:};'.format(counter,label)
+                header = 'R_{:};barcodelabel={:};{:}'.format(counter, label, PRIMERS_TRIMMED if tag else '')
                 outfile1.write('@%s\n%s\n+\n%s\n' % (header, read1[1][R1ForTrim:R1RevTrim], read1[2][R1ForTrim:R1RevTrim]))
                 outfile2.write('@%s\n%s\n+\n%s\n' % (header, read2[1][R2ForTrim:R2RevTrim], read2[2][R2ForTrim:R2RevTrim]))
                 counter += 1
                 ValidSeqs += 1
-    with open(stats, 'w') as statsout:
-        statsout.write('%i,%i,%i,%i,%i,%i\n' % (Total, NoBarcode, NoPrimer, NoRevBarcode, NoRevPrimer, ValidSeqs))
+    DemuxStats(total=Total, no_barcode=NoBarcode, no_primer=NoPrimer, no_rev_barcode=NoRevBarcode, no_rev_primer=NoRevPrimer, valid=ValidSeqs).dump(stats, PE_STATS)
+
+
+#read bases that edlib compares without degenerate equalities
+NOT_ACGT = re.compile('[^ACGT]')
+ACGT_DELETE = dict((ord(x), None) for x in 'ACGT')
+
+def nonACGT(seq):
+    '''characters of seq other than ACGT, empty for a plain read'''
+    if isinstance(seq, bytes):
+        return seq.translate(None, b'ACGT')
+    return seq.translate(ACGT_DELETE)
+
+#primer search window as a multiple of primer length after the read start, and the
+#number of bp at the read end searched for reverse primers, 0 aligns to the whole read
+PRIMER_WINDOW = float(os.environ.get('AMPTK_PRIMER_WINDOW', 2))
+PRIMER_TAIL = int(os.environ.get('AMPTK_PRIMER_TAIL', 100))
+#smallest list of reads worth aligning with the numpy BatchMatcher, and the number of
+#reads the per-read loops collect for one batch
+BATCH_MIN = int(os.environ.get('AMPTK_BATCH_MIN', 32))
+BATCH_SIZE = int(os.environ.get('AMPTK_BATCH_SIZE', 4096))
 
+class BatchMatcher(object):
+    '''
+    edlib HW alignment of one primer against a list of reads at once, Myers' bit-vector
+    algorithm with the reads as numpy uint64 lanes, one step per read position for the
+    whole batch.  Distances and the first best (start, end) are the same as edlib with
+    the same equalities, reads with several equally good ends are marked so the caller
+    can get all of them from edlib.  Primers up to 64 bp.
+    '''
+    def __init__(self, primer, mismatch, equalities=degenNuc):
+        self.primer = primer
+        self.m = len(primer)
+        self.mismatch = int(mismatch)
+        same = set(equalities) | set((y, x) for x, y in equalities)
+        #match masks for every byte value, byte 0 pads short reads and matches nothing
+        self.peq = np.zeros(256, dtype=np.uint64)
+        self.peqRev = np.zeros(256, dtype=np.uint64)
+        for c in range(1, 256):
+            for i, p in enumerate(primer):
+                if p == chr(c) or (p, chr(c)) in same:
+                    self.peq[c] |= np.uint64(1 << i)
+                    self.peqRev[c] |= np.uint64(1 << (self.m-1-i))
+
+    def _encode(self, seqs):
+        seqs = [x.encode('latin-1') if not isinstance(x, bytes) else x for x in seqs]
+        lengths = np.array([len(x) for x in seqs], dtype=np.int64)
+        width = max(int(lengths.max()), 1)
+        buf = b''.join([x.ljust(width, b'\0') for x in seqs])
+        codes = np.frombuffer(buf, dtype=np.uint8).reshape(len(seqs), width)
+        return np.ascontiguousarray(codes.T), lengths
+
+    def _scan(self, peq, codes, lengths, prefix=False):
+        '''
+        best score and its first end per read (HW), or its last end if prefix (SHW),
+        plus the number of ends with the best score
+        '''
+        width, n = codes.shape
+        one = np.uint64(1)
+        high = np.uint64(self.m-1)
+        Pv = np.full(n, ~np.uint64(0), dtype=np.uint64)
+        Mv = np.zeros(n, dtype=np.uint64)
+        score = np.full(n, self.m, dtype=np.int64)
+        scores = np.empty((width, n), dtype=np.int64)
+        for j in range(width):
+            Eq = peq[codes[j]]
+            Xv = Eq | Mv
+            Xh = (((Eq & Pv) + Pv) ^ Pv) | Eq
+            Ph = Mv | ~(Xh | Pv)
+            Mh = Pv & Xh
+            score += ((Ph >> high) & one).view(np.int64)
+            score -= ((Mh >> high) & one).view(np.int64)
+            scores[j] = score
+            Ph <<= one
+            if prefix:
+                Ph |= one
+            Mh <<= one
+            Pv = Mh | ~(Xv | Ph)
+            Mv = Ph & Xv
+        #positions past the end of a read are padding
+        scores[np.arange(width)[:, None] >= lengths[None, :]] = self.m + width + 1
+        best = scores.min(axis=0)
+        if prefix:
+            end = width - 1 - scores[::-1].argmin(axis=0)
+        else:
+            end = scores.argmin(axis=0)
+        ties = (scores == best).sum(axis=0)
+        empty = lengths == 0
+        best[empty], end[empty], ties[empty] = self.m + width + 1, -1, 0
+        return best, end, ties
+
+    def align(self, seqs, locations=False):
+        '''
+        returns lists of edit distance (-1 if more than mismatch), start (None unless
+        locations) and end of the first best hit, and whether a read has more best ends
+        '''
+        if not seqs:
+            return [], [], [], []
+        codes, lengths = self._encode(seqs)
+        best, end, ties = self._scan(self.peq, codes, lengths)
+        found = best <= self.mismatch
+        start = [None]*len(seqs)
+        if locations and found.any():
+            #like edlib, start of the longest best alignment ending there, the read up to
+            #the end position is reversed and aligned anchored at its first base
+            hits = np.nonzero(found)[0]
+            span = self.m + self.mismatch
+            ends = end[hits]
+            rev = [seqs[i][max(e+1-span, 0):e+1][::-1] for i, e in zip(hits.tolist(), ends.tolist())]
+            rcodes, rlengths = self._encode(rev)
+            rbest, rend, rties = self._scan(self.peqRev, rcodes, rlengths, prefix=True)
+            for i, s in zip(hits.tolist(), (ends - rend).tolist()):
+                start[i] = s
+        #edlib reports an empty read as the whole primer deleted, whatever the mismatch
+        empty = lengths == 0
+        dist = np.where(found, best, np.where(empty, self.m, -1)).tolist()
+        return dist, start, end.tolist(), (ties > 1).tolist()
+
+class PrimerLocator(object):
+    '''
+    edlib HW primer search limited to where the primer is expected, the first window bp
+    of the read (or the last window bp if end=True), the whole read is only searched
+    when the window has no hit.  A read is not aligned at all if none of the mismatch+1
+    primer pieces occurs exactly, one of them has to for a hit within mismatch edits.
+    A window hit within mismatch bp of the inner window edge can be a primer cut short
+    by the edge, these reads are searched whole.
+    Plain ACGT reads are aligned with only the equalities of the primer's degenerate
+    bases, building the full table costs edlib more than the alignment itself.
+    align() returns the edlib result with locations in read coordinates.
+    '''
+    def __init__(self, primer, mismatch, end=False, window=None, equalities=degenNuc):
+        self.primer = primer
+        self.mismatch = int(mismatch)
+        self.end = end
+        self.equalities = equalities
+        self.task = 'locations' if end else 'distance'
+        if window is None and end:
+            window = PRIMER_TAIL
+        elif window is None:
+            window = int(PRIMER_WINDOW*len(primer))
+            if window:
+                window += self.mismatch
+        self.window = window
+        self.searches = 0
+        self.fallback = 0
+        self.skipped = 0
+        self.matcher = None
+        self.pairs = [(x, y) for x, y in equalities if (x in primer and y in 'ACGT') or (y in primer and x in 'ACGT')]
+        #seeds are only searched in plain ACGT reads, so each piece is spelled out as the
+        #ACGT words it matches, a substring test is much faster than a regex search
+        codes = collections.defaultdict(set)
+        for x, y in equalities:
+            codes[x].add(y)
+            codes[y].add(x)
+        size = len(primer) // (self.mismatch+1)
+        self.seeds = None
+        self.seedWords = False
+        if size >= 4:
+            pieces = []
+            for i in range(self.mismatch+1):
+                piece = primer[i*size:] if i == self.mismatch else primer[i*size:(i+1)*size]
+                pieces.append([sorted(x for x in codes[c] | set([c]) if x in 'ACGT') for c in piece])
+            words = [''.join(x) for piece in pieces for x in itertools.product(*piece)]
+            if len(words) <= 256:
+                self.seedWords = True
+                self.seeds = (words, [x.encode('ascii') for x in words])
+            else:
+                pattern = '|'.join([''.join(['[{:}]'.format(''.join(x)) for x in piece]) for piece in pieces])
+                self.seeds = (re.compile(pattern), re.compile(pattern.encode('ascii')))
+
+    def _unseeded(self, seq):
+        #a plain read without any exact primer piece has no hit within mismatch edits
+        if self.seeds is None or nonACGT(seq):
+            return False
+        seeds = self.seeds[isinstance(seq, bytes)]
+        if self.seedWords:
+            found = any(x in seq for x in seeds)
+        else:
+            found = seeds.search(seq)
+        if found:
+            return False
+        self.skipped += 1
+        return True
+
+    def _align(self, seq):
+        if self._unseeded(seq):
+            return {'editDistance': -1, 'alphabetLength': 0, 'locations': [], 'cigar': None}
+        equalities = self.equalities if nonACGT(seq) else self.pairs
+        return edlib.align(self.primer, seq, mode='HW', task=self.task, k=self.mismatch, additionalEqualities=equalities)
+
+    def _shift(self, align, offset):
+        if offset and align['editDistance'] >= 0:
+            align['locations'] = [(None if s is None else s+offset, e+offset) for s, e in align['locations']]
+        return align
+
+    def edge(self, align, offset):
+        '''
+        True if a window hit reaches within mismatch bp of the inner window edge, i.e.
+        the start of the last window bp or the end of the first window bp
+        '''
+        if self.end:
+            return any(s is None or s - offset <= self.mismatch for s, e in align['locations'])
+        return any(e - offset >= self.window - 1 - self.mismatch for s, e in align['locations'])
+
+    def align(self, seq):
+        self.searches += 1
+        if not self.window or len(seq) <= self.window:
+            return self._align(seq)
+        offset = len(seq) - self.window if self.end else 0
+        align = self._shift(self._align(seq[offset:offset+self.window]), offset)
+        if align['editDistance'] >= 0:
+            if self.edge(align, offset):
+                self.fallback += 1
+                return self._align(seq)
+            return align
+        return self._rest(seq)
+
+    def _rest(self, seq):
+        #no hit in the window, the rest of the read overlaps it by a primer length
+        self.fallback += 1
+        overlap = len(self.primer) + self.mismatch
+        if self.end:
+            return self._align(seq[:len(seq)-self.window+overlap])
+        offset = max(self.window - overlap, 0)
+        return self._shift(self._align(seq[offset:]), offset)
+
+    def _batch(self, seqs, offsets):
+        #BatchMatcher results as edlib dicts, reads with several best hits go to edlib
+        if self.matcher is None:
+            self.matcher = BatchMatcher(self.primer, self.mismatch, self.equalities)
+        dist, start, end, multi = self.matcher.align(seqs, locations=self.end)
+        results = []
+        for i, offset in enumerate(offsets):
+            if multi[i]:
+                align = self._shift(self._align(seqs[i]), offset)
+            elif dist[i] < 0:
+                align = {'editDistance': -1, 'alphabetLength': 0, 'locations': [], 'cigar': None}
+            else:
+                align = {'editDistance': dist[i], 'alphabetLength': 0, 'cigar': None,
+                         'locations': [(None if start[i] is None else start[i]+offset, end[i]+offset)]}
+            results.append(align)
+        return results
+
+    def alignBatch(self, seqs):
+        '''align() for a list of reads, windows and then the reads without a hit as batches'''
+        if len(self.primer) > 64 or not self.window or len(seqs) < BATCH_MIN:
+            return [self.align(x) for x in seqs]
+        self.searches += len(seqs)
+        regions, offsets, rest = [], [], []
+        for i, seq in enumerate(seqs):
+            if not self.window or len(seq) <= self.window:
+                offset = 0
+                regions.append(seq)
+            else:
+                offset = len(seq) - self.window if self.end else 0
+                regions.append(seq[offset:offset+self.window])
+                rest.append(i)
+            offsets.append(offset)
+        results = self._batch(regions, offsets)
+        #reads without a hit in the window, one edlib call aligns a whole read faster,
+        #and reads with a hit at the window edge that may be a primer cut short
+        for i in rest:
+            if results[i]['editDistance'] < 0:
+                results[i] = self._rest(seqs[i])
+            elif self.edge(results[i], offsets[i]):
+                self.fallback += 1
+                results[i] = self._align(seqs[i])
+        return results
+
+    def summary(self):
+        return '{:,} searches for {:}, {:.1%} searched the rest of the read, {:,} alignments skipped by seed filter'.format(self.searches, self.primer, self.fallback / max(self.searches, 1), self.skipped)
+
+#locators for the primer trimming helpers, keyed by (primer, mismatch, end, revcomp)
+primerLocators = {}
+
+def getPrimerLocator(primer, mismatch, end=False, revcomp=False):
+    key = (primer, int(mismatch), end, revcomp)
+    if not key in primerLocators:
+        primerLocators[key] = PrimerLocator(RevComp(primer) if revcomp else primer, mismatch, end=end)
+    return primerLocators[key]
+
+def lookupPrimer(primer, direction='fwd'):
+    '''primer sequence for an AMPtk primer db name, anything else is taken as the sequence'''
+    if primer in primer_db:
+        log.info("{:} {:} primer found in AMPtk primer db, setting to: {:}".format(primer, direction, primer_db.get(primer)))
+        return primer_db.get(primer)
+    log.info("{:} {:} primer not found in AMPtk primer db, assuming it is actual primer sequence.".format(primer, direction))
+    return primer
+
+class PrimerSet(object):
+    '''
+    forward and reverse primers of a run with their reverse complements and a
+    PrimerLocator for each orientation, built once in main and inherited or pickled by
+    the workers.  samples is the parseMappingFileNEW sample dictionary, sample() returns
+    the set for a sample's own primers (samples with the same primers share one).
+    '''
+    def __init__(self, fwd, rev, mismatch, samples=None, internal=None):
+        self.fwd = fwd
+        self.rev = rev
+        self.fwdRC = RevComp(fwd)
+        self.revRC = RevComp(rev)
+        self.internal = internal
+        self.internalRC = RevComp(internal) if internal else None
+        self.mismatch = int(mismatch)
+        self.locators = {}
+        self.samples = {}
+        if samples:
+            shared = {(fwd, rev): self}
+            for name, data in samples.items():
+                key = (data['ForPrimer'], data['RevPrimer'])
+                if not key in shared:
+                    shared[key] = PrimerSet(key[0], key[1], mismatch)
+                self.samples[name] = shared[key]
+
+    def sample(self, name):
+        return self.samples.get(name, self)
+
+    def locator(self, primer, end=False, window=None):
+        key = (primer, end, window)
+        if not key in self.locators:
+            self.locators[key] = PrimerLocator(primer, self.mismatch, end=end, window=window)
+        return self.locators[key]
+
+    #the four orientations, primers near the read start and reverse complements near the end
+    def fwdStart(self, seq):
+        return self.locator(self.fwd).align(seq)
+
+    def revStart(self, seq):
+        return self.locator(self.rev).align(seq)
+
+    def fwdEnd(self, seq):
+        return self.locator(self.fwdRC, end=True).align(seq)
+
+    def revEnd(self, seq):
+        return self.locator(self.revRC, end=True).align(seq)
+
+    #same for a list of reads, see PrimerLocator.alignBatch
+    def fwdStartBatch(self, seqs):
+        return self.locator(self.fwd).alignBatch(seqs)
+
+    def revStartBatch(self, seqs):
+        return self.locator(self.rev).alignBatch(seqs)
+
+    def fwdEndBatch(self, seqs):
+        return self.locator(self.fwdRC, end=True).alignBatch(seqs)
+
+    def revEndBatch(self, seqs):
+        return self.locator(self.revRC, end=True).alignBatch(seqs)
+
+    def _all(self):
+        sets = [self]
+        for x in self.samples.values():
+            if not x in sets:
+                sets.append(x)
+        return [loc for x in sets for loc in x.locators.values()]
+
+    def reset(self):
+        for loc in self._all():
+            loc.searches, loc.fallback, loc.skipped = 0, 0, 0
+
+    def counts(self):
+        '''(searches, searches that needed the rest of the read)'''
+        locs = self._all()
+        return sum([x.searches for x in locs]), sum([x.fallback for x in locs])
+
+    def summary(self):
+        return [x.summary() for x in self._all() if x.searches]
 
 def trimForPrimer(primer, seq, primer_mismatch):
-    foralign = edlib.align(primer, seq, mode="HW", k=primer_mismatch, additionalEqualities=degenNuc)
+    foralign = getPrimerLocator(primer, primer_mismatch).align(seq)
     if foralign['editDistance'] < 0:
         return 0
     else:
@@ -1102,8 +2959,7 @@ def trimForPrimer(primer, seq, primer_mismatch):
         return CutPos
 
 def trimRevPrimer(primer, seq, primer_mismatch):
-    revprimer = RevComp(primer)
-    revalign = edlib.align(revprimer, seq, mode="HW", k=primer_mismatch, task="locations", additionalEqualities=degenNuc)
+    revalign = getPrimerLocator(primer, primer_mismatch, end=True, revcomp=True).align(seq)
     if revalign['editDistance'] < 0:
         return len(seq)
     else:
@@ -1113,48 +2969,40 @@ def trimRevPrimer(primer, seq, primer_mismatch):
 def losslessTrim(input, fwdprimer, revprimer, mismatch, trimLen, padding, minlength, output):
     '''
     function to trim primers if found from SE reads
-    and then trim/pad to a set length
+    and then trim/pad to a set length, reads tagged PRIMERS_TRIMMED
+    before merging are not searched again
+    returns number of reads and number that skipped the primer search
     '''
-    with open(output, 'w') as outfile:
-        for title, seq, qual in FastqGeneralIterator(gzopen(input)):
-            #sometimes primers sneek through the PE merging pipeline, check quickly again trim if found
-            ForTrim = trimForPrimer(fwdprimer, seq, mismatch)
-            RevTrim = trimRevPrimer(revprimer, seq, mismatch)
-            Seq = seq[ForTrim:RevTrim]
-            Qual = qual[ForTrim:RevTrim]
-            if len(Seq) < int(minlength): #need this check here or primer dimers will get through
-                continue
-            if len(Seq) < int(trimLen) and padding == 'on':
-                pad = int(trimLen) - len(Seq)
-                SeqF = Seq + pad*'N'
-                QualF = Qual + pad*'I'
-            else:
-                SeqF = Seq[:trimLen]
-                QualF = Qual[:trimLen]
-            outfile.write('@%s\n%s\n+\n%s\n' % (title, SeqF, QualF))
-
+    minlength = int(minlength)
+    trimLen = int(trimLen)
+    Total = 0
+    Skipped = 0
+    with FastqWriter(output) as outfile:
+        for batch in iter_fastq_batches(input):
+            for title, seq, qual in batch:
+                Total += 1
+                if PRIMERS_TRIMMED_B in title:
+                    title = title.replace(PRIMERS_TRIMMED_B, b'')
+                    ForTrim, RevTrim = 0, len(seq)
+                    Skipped += 1
+                else:
+                    #sometimes primers sneek through the PE merging pipeline, check quickly again trim if found
+                    ForTrim = trimForPrimer(fwdprimer, seq, mismatch)
+                    RevTrim = trimRevPrimer(revprimer, seq, mismatch)
+                Seq = seq[ForTrim:RevTrim]
+                Qual = qual[ForTrim:RevTrim]
+                if len(Seq) < minlength: #need this check here or primer dimers will get through
+                    continue
+                if len(Seq) < trimLen and padding == 'on':
+                    pad = trimLen - len(Seq)
+                    SeqF = Seq + pad*b'N'
+                    QualF = Qual + pad*b'I'
+                else:
+                    SeqF = Seq[:trimLen]
+                    QualF = Qual[:trimLen]
+                outfile.write(title, SeqF, QualF)
+    return Total, Skipped
 
-def checkBCinHeader(input):
-    #read first header
-    for title, seq, qual in FastqGeneralIterator(open(input)):
-        header = title.split(' ')
-        info = header[-1]
-        if info.split(':')[-1].isdigit():
-            return False
-        else:
-            return True
-        break
-
-def illuminaBCmismatch(R1, R2, index):
-    remove = []
-    for file in [R1,R2]:
-        for title, seq, qual in FastqGeneralIterator(open(file)):
-            ID = title.split(' ')[0]
-            BC = title.split(':')[-1]
-            if BC != index:
-                remove.append(ID)
-    remove = set(remove)
-    return remove
 
 def fasta2barcodes(input, revcomp):
     BC = {}
@@ -1256,6 +3104,1073 @@ def AlignBarcode2(Seq, BarcodeDict, mismatch):
     else:
         return "", ""
 
+def editNeighbors(seq):
+    '''all sequences one substitution, insertion or deletion away from seq'''
+    for i in range(len(seq)+1):
+        for base in 'ACGT':
+            yield seq[:i] + base + seq[i:]
+        if i < len(seq):
+            yield seq[:i] + seq[i+1:]
+            for base in 'ACGT':
+                if base != seq[i]:
+                    yield seq[:i] + base + seq[i+1:]
+
+#one edlib barcode alignment costs about as much as this many dict lookups
+EDLIB_LOOKUPS = 20
+#IUPAC nucleotides, mapping files write no_data for a missing barcode
+IUPAC_SEQ = re.compile('[ACGTRYSWKMBDHVN]+$')
+
+def barcodeLabels(barcodes, mode='SHW', strip=True):
+    '''
+    [(barcode, label, offset)] for a {label: barcode} dictionary, same N handling as the
+    Align functions, leading Ns shift the read and trailing Ns are dropped (mode rev)
+    '''
+    labels = []
+    for BL, B in barcodes.items():
+        if not strip:
+            offset = 0
+        elif mode == 'rev':
+            B = B.rstrip('N')
+            offset = 0
+        else:
+            offset = len(B) - len(B.lstrip('N'))
+            B = B[offset:]
+        labels.append((B, BL, offset))
+    return labels
+
+class BarcodeDistances(object):
+    '''
+    pairwise edit distances of a barcode set (fasta2barcodes or parseMappingFileNEW
+    dictionaries) computed once before demultiplexing.  Two barcodes at most 2*mismatch
+    edits apart can both be within mismatch edits of a read, safe is the largest
+    mismatch that keeps all barcode neighborhoods apart.  Distances follow the matching
+    mode, SHW compares barcodes to the start of each other, HW and rev anywhere.  Only
+    pairs up to the closest distance or 2*mismatch edits apart are aligned and kept.
+    '''
+    def __init__(self, barcodes, mode='SHW', strip=True, mismatch=0):
+        if isinstance(barcodes, dict):
+            barcodes = barcodeLabels(barcodes, mode=mode, strip=strip)
+        self.mode = mode
+        barcodes = [x for x in barcodes if IUPAC_SEQ.match(x[0])]
+        self.labels = [BL for B, BL, offset in barcodes]
+        #read position is fixed by the offset, N matches anything
+        seqs = ['N'*offset + B for B, BL, offset in barcodes]
+        plain = [not NOT_ACGT.search(x) for x in seqs]
+        self.pairs = []
+        closest = -1
+        for i, a in enumerate(seqs):
+            for j in range(i):
+                #degenerate equalities make edlib several times slower, only pass them if needed
+                equalities = [] if plain[i] and plain[j] else degenNuc
+                d = self._distance(seqs[j], a, max(closest, 2*mismatch) if closest >= 0 else -1, equalities)
+                if d < 0:
+                    continue
+                if closest < 0 or d < closest:
+                    closest = d
+                self.pairs.append((d, j, i))
+        self.pairs = sorted([x for x in self.pairs if x[0] <= max(closest, 2*mismatch)])
+        if self.pairs:
+            self.min = self.pairs[0][0]
+            self.safe = (self.min - 1) // 2
+        else:
+            self.min = None
+            self.safe = max([len(x) for x in seqs] + [0])
+
+    def _distance(self, a, b, k, equalities):
+        #edits between a and b, -1 if more than k
+        if self.mode == 'NW':
+            return edlib.align(a, b, mode='NW', k=k, additionalEqualities=equalities)['editDistance']
+        mode = 'SHW' if self.mode == 'SHW' else 'HW'
+        found = [x for x in (edlib.align(a, b, mode=mode, k=k, additionalEqualities=equalities)['editDistance'],
+                             edlib.align(b, a, mode=mode, k=k, additionalEqualities=equalities)['editDistance']) if x >= 0]
+        if found:
+            return min(found)
+        return -1
+
+    def collisions(self, mismatch):
+        '''returns [(edits, label, label)] of barcode pairs a read can be within mismatch edits of'''
+        result = []
+        for d, i, j in self.pairs:
+            if d > 2*mismatch:
+                break
+            result.append((d, self.labels[i], self.labels[j]))
+        return result
+
+    def report(self, mismatch, name='barcodes'):
+        if self.min is None:
+            return
+        d, i, j = self.pairs[0]
+        if self.min == 0:
+            log.info('Warning: {:} {:}/{:} are identical, a barcode mismatch of 0 can not tell them apart'.format(name, self.labels[i], self.labels[j]))
+        else:
+            log.info('Closest {:} are {:} edits apart ({:}/{:}), a barcode mismatch up to {:} keeps them distinct'.format(name, d, self.labels[i], self.labels[j], self.safe))
+        found = self.collisions(mismatch)
+        if found and self.min > 0:
+            log.info('Warning: barcode mismatch {:} lets reads match {:,} pairs of {:}, the closest barcode is used and reads as close to two of them are not assigned: {:}'.format(mismatch, len(found), name, ', '.join(['{:}/{:} ({:} edits)'.format(a, b, x) for x, a, b in found[:5]])))
+
+class BarcodeIndex(object):
+    '''
+    barcode lookup built once per run, hashes every sequence within mismatch edits of
+    each barcode so most reads are resolved with a few dict lookups.  Gives the same
+    answer as AlignBarcode (mode SHW), AlignBarcode2 (HW), AlignRevBarcode (rev) or
+    mapIndex (SHW, strip=False), except that reads as close to two different barcodes
+    are not assigned.  Reads with non-ACGT bases in the barcode region are aligned with edlib.  Mode NW matches the whole read without degenerate bases.
+    The barcode distances decide the strategy: hash when every read within mismatch edits
+    is in the table and no read can match two barcodes (exact hits return at once),
+    hash+edlib when reads without a hit may still be within mismatch, or scan to align
+    every read to every barcode when that costs less than the lookups.
+    '''
+    def __init__(self, barcodes, mismatch, mode='SHW', strip=True, maxvariants=1000000):
+        self.mismatch = int(mismatch)
+        self.mode = mode
+        self.labels = barcodeLabels(barcodes, mode=mode, strip=strip)
+        self.depth = 0
+        self.hashed = 0
+        self.fallback = 0
+        self.ambiguous = 0
+        edlib_only = []
+        hoods = []
+        for order, (B, BL, offset) in enumerate(self.labels):
+            if not B or NOT_ACGT.search(B):
+                edlib_only.append(order)
+            else:
+                hoods.append((order, {B: 0}, [B]))
+        self.edlib_only = edlib_only
+        #grow the neighborhoods one edit at a time, stop if the table would get too big
+        while self.depth < self.mismatch and hoods:
+            grown = []
+            total = 0
+            for order, hood, frontier in hoods:
+                added = {}
+                for v in frontier:
+                    for w in editNeighbors(v):
+                        if not w in hood and not w in added:
+                            added[w] = self.depth+1
+                total += len(hood) + len(added)
+                if total > maxvariants:
+                    break
+                grown.append(added)
+            if total > maxvariants:
+                break
+            for (order, hood, frontier), added in zip(hoods, grown):
+                hood.update(added)
+                frontier[:] = list(added)
+            self.depth += 1
+        #variant -> ((order, edits), ...) for each offset, flag variants reached at the same distance
+        self.tables = {}
+        self.size = 0
+        for order, hood, frontier in hoods:
+            offset = self.labels[order][2]
+            table = self.tables.setdefault(offset, {})
+            for v, d in hood.items():
+                if v in table:
+                    table[v] += ((order, d),)
+                else:
+                    table[v] = ((order, d),)
+                    self.size += 1
+        self.lengths = {}
+        for offset, table in self.tables.items():
+            self.lengths[offset] = sorted(set(len(v) for v in table))
+        #read region where a base could change an edlib result
+        self.span = max([len(B)+offset for B, BL, offset in self.labels] + [0]) + self.mismatch
+        #pick the matching strategy from the expected dict lookups and edlib alignments per read
+        self.distances = BarcodeDistances(self.labels, mode=mode, mismatch=self.mismatch)
+        self.lookups = sum([len(x) for x in self.lengths.values()])
+        if not mode in ('SHW', 'NW'):
+            self.lookups *= self.span
+        if not self.tables or len(self.labels) * EDLIB_LOOKUPS <= self.lookups:
+            self.strategy = 'scan'
+        elif self.depth == self.mismatch and not self.edlib_only and mode in ('SHW', 'NW') and self.distances.safe >= self.mismatch:
+            self.strategy = 'hash'
+        else:
+            self.strategy = 'hash+edlib'
+        #offset -> (barcode -> number, barcode lengths) for the exact match fast path
+        self.exact = {}
+        for order, (B, BL, offset) in enumerate(self.labels):
+            if not order in self.edlib_only:
+                self.exact.setdefault(offset, ({}, set()))[0].setdefault(B, order)
+                self.exact[offset][1].add(len(B))
+        for offset, (table, lengths) in self.exact.items():
+            self.exact[offset] = (table, sorted(lengths))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def report(self, name='barcodes'):
+        #log index size and barcodes that a read can match equally well
+        if not self.labels:
+            return
+        self.distances.report(self.mismatch, name)
+        if self.strategy == 'scan':
+            log.info('Matching {:} by edlib scan, {:,} alignments per read'.format(name, len(self.labels)))
+            return
+        log.info('Indexed {:,} {:} as {:,} sequences within {:} edits'.format(len(self.labels), name, self.size, self.depth))
+        if self.strategy == 'hash':
+            log.info('Matching {:} by hash lookup, up to {:,} dict lookups per read'.format(name, self.lookups))
+        else:
+            log.info('Matching {:} by hash lookup with edlib fallback, {:,} dict lookups per read and up to {:,} alignments for reads without a hit within {:} edits'.format(name, self.lookups, len(self.labels), self.depth))
+
+    def _edlib(self, Seq, orders):
+        hits = []
+        for order in orders:
+            B, BL, offset = self.labels[order]
+            if self.mode == 'NW':
+                align = edlib.align(B, Seq, mode='NW', k=self.mismatch)
+            else:
+                align = edlib.align(B, Seq[offset:], mode='HW' if self.mode == 'rev' else self.mode, k=self.mismatch, additionalEqualities=degenNuc)
+            if align['editDistance'] >= 0:
+                hits.append((align['editDistance'], order))
+        return hits
+
+    def _hashed(self, Seq):
+        #{barcode number: edits} of the barcodes within the hashed edits of the read
+        best = {}
+        for offset, table in self.tables.items():
+            s = Seq[offset:]
+            if self.mode == 'NW':
+                found = table.get(s)
+                if found:
+                    best.update((order, d) for order, d in found)
+                continue
+            if self.mode == 'SHW':
+                starts = [0]
+            else:
+                starts = range(len(s))
+            for i in starts:
+                for L in self.lengths[offset]:
+                    if i+L > len(s):
+                        break
+                    found = table.get(s[i:i+L])
+                    if found:
+                        for order, d in found:
+                            if d < best.get(order, d+1):
+                                best[order] = d
+        return best
+
+    def hits(self, Seq):
+        '''returns {barcode number: edits} for every barcode within mismatch edits'''
+        if isinstance(Seq, bytes):
+            Seq = Seq.decode('latin-1')
+        region = Seq[:self.span] if self.mode == 'SHW' else Seq
+        if NOT_ACGT.search(region):
+            return dict((order, d) for d, order in self._edlib(Seq, range(len(self.labels))))
+        best = self._hashed(Seq)
+        rest = [x for x in range(len(self.labels)) if not x in best]
+        if self.depth == self.mismatch:
+            rest = [x for x in rest if x in self.edlib_only]
+        best.update((order, d) for d, order in self._edlib(Seq, rest))
+        return best
+
+    def align(self, Seq):
+        '''returns (barcode, label) of the best hit or ("", "")'''
+        order, edits = self.lookup(Seq)
+        if order is None:
+            return "", ""
+        return self.labels[order][0], self.labels[order][1]
+
+    def lookup(self, Seq):
+        '''
+        returns (barcode number, edits) of the best hit, (None, None) if there is none
+        or (None, edits) if several barcodes are the closest
+        '''
+        if isinstance(Seq, bytes):
+            Seq = Seq.decode('latin-1')
+        if self.mode == 'SHW':
+            region = Seq[:self.span]
+        else:
+            region = Seq
+        if self.strategy == 'scan' or NOT_ACGT.search(region):
+            self.fallback += 1
+            hits = self._edlib(Seq, range(len(self.labels)))
+        else:
+            if self.strategy == 'hash':
+                #an exact barcode is the only barcode within mismatch of the read
+                for offset, (table, lengths) in self.exact.items():
+                    s = Seq[offset:]
+                    if self.mode == 'NW':
+                        order = table.get(s)
+                        if order is not None:
+                            self.hashed += 1
+                            return order, 0
+                        continue
+                    for L in lengths:
+                        order = table.get(s[:L])
+                        if order is not None:
+                            self.hashed += 1
+                            return order, 0
+            hits = [(d, order) for order, d in self._hashed(Seq).items()]
+            if hits or self.depth == self.mismatch:
+                self.hashed += 1
+            else:
+                #nothing within the hashed edits, closer barcodes may still be further out
+                self.fallback += 1
+                hits = self._edlib(Seq, [x for x in range(len(self.labels)) if not x in self.edlib_only])
+            if self.edlib_only:
+                hits += self._edlib(Seq, self.edlib_only)
+        if not hits:
+            return None, None
+        hits.sort()
+        d, order = hits[0]
+        #identical barcodes go to the first listed, different ones as close are a tie
+        if len(set(self.labels[x][0::2] for e, x in hits if e == d)) > 1:
+            self.ambiguous += 1
+            return None, d
+        return order, d
+
+class DualBarcodeIndex(object):
+    '''
+    (forward barcode, reverse barcode) -> sample table for mapping files with barcodes on
+    both ends, so samples sharing a forward barcode (combinatorial designs) are told apart
+    by the reverse barcode.  The reverse barcodes are hashed once as distinct sequences,
+    resolve() takes the forward barcode found in the read and costs two dict lookups
+    when the closest reverse barcode belongs to one of its samples.
+    '''
+    def __init__(self, samples, mismatch, revmode='SHW'):
+        #generated mapping files write no_data for a missing reverse barcode
+        revs = []
+        for name, data in samples.items():
+            if data['RevBarcode'] not in (None, '', 'no_data') and not data['RevBarcode'] in revs:
+                revs.append(data['RevBarcode'])
+        self.rev = BarcodeIndex(collections.OrderedDict((x, x) for x in revs), mismatch, mode=revmode)
+        revorder = dict((x, i) for i, x in enumerate(revs))
+        self.table = {}
+        self.partners = {}
+        for name, data in samples.items():
+            fwd = data['ForBarcode'].lstrip('N')
+            rev = revorder.get(data['RevBarcode'])
+            if (fwd, rev) in self.table:
+                log.info('Warning: {:} and {:} have the same barcodes, reads are assigned to {:}'.format(self.table[(fwd, rev)], name, self.table[(fwd, rev)]))
+                continue
+            self.table[(fwd, rev)] = name
+            self.partners.setdefault(fwd, []).append(rev)
+
+    def __len__(self):
+        return len(self.table)
+
+    def report(self):
+        shared = len([x for x in self.partners.values() if len(x) > 1])
+        log.info('{:,} samples from {:,} forward and {:,} reverse barcodes, {:,} forward barcodes are shared by several samples'.format(len(self.table), len(self.partners), len(self.rev), shared))
+
+    def resolve(self, fwd, Seq):
+        '''sample for the forward barcode sequence fwd and the reverse barcode read Seq, or None'''
+        fwd = fwd.lstrip('N')
+        partners = self.partners.get(fwd)
+        if not partners:
+            return None
+        if None in partners: #sample without a reverse barcode
+            return self.table[(fwd, None)]
+        order, d = self.rev.lookup(Seq)
+        if d is None:
+            return None
+        sample = self.table.get((fwd, order))
+        if sample is None and len(self.rev) > 1:
+            #closest reverse barcode is not used with this forward barcode (or is a tie), take
+            #the closest that is unless two partners are equally close
+            hits = self.rev.hits(Seq)
+            found = sorted((hits[x], x) for x in partners if x in hits)
+            if found and (len(found) == 1 or found[0][0] < found[1][0]):
+                sample = self.table[(fwd, found[0][1])]
+        return sample
+
+class IndexResolver(object):
+    '''
+    maps Illumina index reads to sample names with the same answers as mapIndex, each
+    distinct index sequence is looked up once and remembered, so the cost follows the
+    number of distinct indexes rather than the number of reads
+    '''
+    def __init__(self, mapDict, mismatch, maxmemo=1000000):
+        self.index = BarcodeIndex(mapDict, mismatch, strip=False)
+        self.memo = {}
+        self.maxmemo = maxmemo
+        self.reads = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def resolve(self, seq):
+        '''returns (sample name, diffs) or (None, None)'''
+        self.reads += 1
+        hit = self.memo.get(seq)
+        if hit is None:
+            order, diffs = self.index.lookup(seq)
+            if order is None:
+                hit = (None, None)
+            else:
+                hit = (self.index.labels[order][1], diffs)
+            if len(self.memo) < self.maxmemo:
+                self.memo[seq] = hit
+        return hit
+
+    def summary(self):
+        return '{:,} index reads from {:,} distinct index sequences'.format(self.reads, len(self.memo))
+
+class PrefixCache(object):
+    '''
+    bounded LRU cache of the barcode and forward primer decision keyed on the read
+    prefix, lookup() returns (barcode label, barcode length, forward trim position) with
+    label None if there is no barcode and trim position -1 if there is no primer.  The
+    prefix covers the barcode region and the primer search window after it, results that
+    needed the rest of the read are not cached.  strip=True searches the primer after
+    the barcode (trim position relative to that), otherwise in the whole read.
+    '''
+    def __init__(self, barcodes, primers, maxsize=100000, strip=True):
+        self.barcodes = barcodes
+        self.locator = primers.locator(primers.fwd)
+        self.maxsize = int(maxsize)
+        self.strip = strip
+        self.length = barcodes.span + self.locator.window
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        #barcodes matched anywhere in the read or an unbounded primer search depend on the whole read
+        self.enabled = self.maxsize > 0 and barcodes.mode == 'SHW' and self.locator.window > 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    def lookup(self, seq):
+        return self.lookupBatch([seq])[0]
+
+    def lookupBatch(self, seqs):
+        '''lookup() for a list of reads, the primer search of the misses runs as one batch'''
+        results = [None]*len(seqs)
+        keys = [None]*len(seqs)
+        pending = []
+        for i, seq in enumerate(seqs):
+            if self.enabled:
+                keys[i] = seq[:self.length]
+                hit = self.cache.get(keys[i])
+                if hit is not None:
+                    self.hits += 1
+                    self.cache.move_to_end(keys[i])
+                    results[i] = hit
+                    continue
+                self.misses += 1
+            Barcode, BarcodeLabel = self.barcodes.align(seq)
+            if Barcode == "":
+                results[i] = (None, 0, -1)
+                self._store(keys[i], results[i])
+                continue
+            pending.append((i, BarcodeLabel, len(Barcode)))
+        regions = [seqs[i][BL:] if self.strip else seqs[i] for i, label, BL in pending]
+        window = self.locator.window
+        for (i, label, BL), Seq, foralign in zip(pending, regions, self.locator.alignBatch(regions)):
+            #a hit ending in the window clear of its edge or a read shorter than it is decided
+            #by the prefix, other hits needed the rest of the read
+            if foralign['editDistance'] < 0:
+                results[i] = (label, BL, -1)
+                cacheable = len(Seq) <= window
+            else:
+                results[i] = (label, BL, foralign['locations'][0][1]+1)
+                cacheable = foralign['locations'][0][1] < window - 1 - self.locator.mismatch or len(Seq) <= window
+            if cacheable:
+                self._store(keys[i], results[i])
+        return results
+
+    def _store(self, key, hit):
+        if key is None:
+            return
+        self.cache[key] = hit
+        self.bytes += sys.getsizeof(key)
+        if len(self.cache) > self.maxsize:
+            old, value = self.cache.popitem(last=False)
+            self.bytes -= sys.getsizeof(old)
+
+    def reset(self):
+        self.hits, self.misses = 0, 0
+
+    def memory(self):
+        '''approximate bytes held by keys, entries and the table'''
+        return self.bytes + sys.getsizeof(self.cache) + 100*len(self.cache)
+
+    def summary(self):
+        total = self.hits + self.misses
+        return 'prefix cache: {:,} of {:,} reads ({:.1%}) from {:,} cached {:} bp prefixes, ~{:}'.format(self.hits, total, self.hits / max(total, 1), len(self.cache), self.length, convertSize(self.memory()))
+
+class DemuxRead(object):
+    '''
+    one read in the DemuxEngine, seq and qual lose the barcode and primers as the stages
+    find them.  Paired reads keep the R2 (title, seq, qual) record as mate and the I1
+    sequence as index
+    '''
+    __slots__ = ('title', 'seq', 'qual', 'mate', 'index', 'label', 'diffs', 'fortrim', 'rev', 'tail', 'trimmed')
+
+    def __init__(self, title, seq, qual, mate=None, index=None):
+        self.title = title
+        self.seq = seq
+        self.qual = qual
+        self.mate = mate
+        self.index = index
+        self.label = None
+        self.diffs = 0
+        self.fortrim = None
+        self.rev = False
+        self.tail = None
+        self.trimmed = False
+
+#column order of the per-chunk .stats CSV lines, the first columns are those written
+#before the DemuxEngine, its extra counts follow
+SE_STATS = ['total', 'no_barcode', 'no_primer', 'rev_primer', 'no_rev_barcode', 'too_short', 'valid',
+            'searches', 'fullread', 'cache_hits', 'cache_misses']
+PE_STATS = ['total', 'no_barcode', 'no_primer', 'no_rev_barcode', 'no_rev_primer', 'valid',
+            'merged', 'skipped', 'phix']
+RAW_STATS = ['total', 'valid', 'fwd_primer', 'rev_primer', 'too_short', 'output',
+             'merged', 'skipped', 'phix']
+
+class DemuxStats(collections.Counter):
+    '''
+    named read counts of a demux run, every stage of the DemuxEngine adds to the same
+    object.  Chunks dump() theirs to the tmp folder as a CSV line of fields and load()
+    adds a run back up
+    '''
+    def dump(self, output, fields):
+        with open(output, 'w') as outfile:
+            outfile.write(','.join([str(self[x]) for x in fields])+'\n')
+
+    @classmethod
+    def load(cls, files, fields):
+        stats = cls()
+        for file in files:
+            with open(file, 'r') as infile:
+                stats.update(dict(zip(fields, [int(x) for x in infile.readline().rstrip().split(',')])))
+        return stats
+
+def demuxReader(ranges):
+    '''
+    batches of DemuxRead from (file, start, end) ranges of R1, or of R1, R2 and I1 for
+    paired reads with an index file, end None reads to the end of the file
+    '''
+    if len(ranges) == 1:
+        for batch in iter_fastq_batches(ranges[0][0], start=ranges[0][1], end=ranges[0][2]):
+            yield [DemuxRead(*x) for x in batch]
+        return
+    files = [iter_fastq(x[0], start=x[1], end=x[2]) for x in ranges]
+    for batch in batch_iterator(zipPaired([x[0] for x in ranges], *files), BATCH_SIZE):
+        yield [DemuxRead(read1[0], read1[1], read1[2], mate=read2, index=index[1]) for read1, read2, index in batch]
+
+class BarcodeResolver(object):
+    '''
+    demux stage, finds the barcode (BarcodeIndex) at the read start and cuts it off,
+    reads without one are no_barcode.  With primers the forward primer is found in the
+    same step through a PrefixCache holding up to cache read prefixes (0 searches every
+    read), reads without it are no_primer
+    '''
+    def __init__(self, barcodes, primers=None, cache=0):
+        self.barcodes = barcodes
+        self.prefixes = None
+        if primers:
+            self.prefixes = PrefixCache(barcodes, primers, maxsize=cache)
+        self.hashed, self.fallback = 0, 0
+
+    def reset(self):
+        self.hashed, self.fallback = self.barcodes.hashed, self.barcodes.fallback
+        if self.prefixes:
+            self.prefixes.reset()
+
+    def run(self, batch, stats):
+        kept = []
+        if self.prefixes:
+            for read, (BarcodeLabel, BarcodeLength, ForTrim) in zip(batch, self.prefixes.lookupBatch([x.seq for x in batch])):
+                if BarcodeLabel is None:
+                    stats['no_barcode'] += 1
+                    continue
+                if ForTrim < 0:
+                    stats['no_primer'] += 1
+                    continue
+                read.label = BarcodeLabel
+                read.seq = read.seq[BarcodeLength:]
+                read.qual = read.qual[BarcodeLength:]
+                read.fortrim = ForTrim
+                kept.append(read)
+            return kept
+        for read in batch:
+            Barcode, BarcodeLabel = self.barcodes.align(read.seq)
+            if Barcode == "":
+                stats['no_barcode'] += 1
+                continue
+            read.label = BarcodeLabel
+            read.seq = read.seq[len(Barcode):]
+            read.qual = read.qual[len(Barcode):]
+            kept.append(read)
+        return kept
+
+    def finish(self, stats, name):
+        log.debug('{:}: {:,} barcode lookups from the index, {:,} aligned with edlib'.format(name, self.barcodes.hashed-self.hashed, self.barcodes.fallback-self.fallback))
+        if self.prefixes and self.prefixes.enabled:
+            stats['cache_hits'] += self.prefixes.hits
+            stats['cache_misses'] += self.prefixes.misses
+            log.debug('{:}: {:}'.format(name, self.prefixes.summary()))
+
+class IndexReadResolver(object):
+    '''
+    demux stage for paired reads with an index file, the IndexResolver sample of the
+    index read becomes the label, reads without one are no_barcode
+    '''
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    def reset(self):
+        pass
+
+    def run(self, batch, stats):
+        kept = []
+        for read in batch:
+            read.label, read.diffs = self.indexes.resolve(read.index)
+            if read.label is None:
+                stats['no_barcode'] += 1
+                continue
+            kept.append(read)
+        return kept
+
+    def finish(self, stats, name):
+        log.debug('{:}: {:}'.format(name, self.indexes.summary()))
+
+class PrimerTrimmer(object):
+    '''
+    demux stage, forward primer near the read start (unless found with the barcode)
+    and the reverse complemented reverse primer near the end, aligned for the whole
+    batch.  require is 'forward' to drop reads without the forward primer (no_primer),
+    'both' to also drop reads without the reverse primer (no_rev_primer) or 'off'.
+    read.rev tells if the reverse primer was found (rev_primer) and read.tail keeps the
+    sequence after it, trim cuts the primers off the read
+    '''
+    def __init__(self, primers, require='forward', reverse=True, trim=True):
+        self.primers = primers
+        self.require = require
+        self.reverse = reverse
+        self.trim = trim
+
+    def reset(self):
+        self.primers.reset()
+
+    def run(self, batch, stats):
+        if self.require != 'off':
+            search = [x for x in batch if x.fortrim is None]
+            for read, foralign in zip(search, self.primers.fwdStartBatch([x.seq for x in search])):
+                read.fortrim = foralign['locations'][0][1]+1 if foralign['editDistance'] >= 0 else -1
+            kept = [x for x in batch if x.fortrim >= 0]
+            stats['no_primer'] += len(batch) - len(kept)
+            batch = kept
+        if not self.reverse:
+            return batch
+        kept = []
+        for read, revalign in zip(batch, self.primers.revEndBatch([x.seq for x in batch])):
+            RevTrim = None
+            if revalign['editDistance'] >= 0:
+                stats['rev_primer'] += 1
+                RevTrim = revalign['locations'][0][0]
+                read.rev = True
+                read.tail = read.seq[revalign['locations'][0][1]:]
+            elif self.require == 'both':
+                stats['no_rev_primer'] += 1
+                continue
+            if self.trim:
+                ForTrim = read.fortrim or 0
+                read.seq = read.seq[ForTrim:RevTrim]
+                read.qual = read.qual[ForTrim:RevTrim]
+            kept.append(read)
+        return kept
+
+    def finish(self, stats, name):
+        searches, fullread = self.primers.counts()
+        stats['searches'] += searches
+        stats['fullread'] += fullread
+        for line in self.primers.summary():
+            log.debug('{:}: {:}'.format(name, line))
+
+class PairedPrimerTrimmer(PrimerTrimmer):
+    '''
+    demux stage for paired reads, cuts the forward primer and reverse complemented
+    reverse primer from R1, the reverse primer and reverse complemented forward primer
+    from R2.  Counts pairs with the forward primer at the R1 start (fwd_primer) and with
+    R1 bases left before the reverse primer cut (rev_primer), pairs with the primers at
+    both read starts are marked trimmed for losslessTrim
+    '''
+    def __init__(self, primers):
+        PrimerTrimmer.__init__(self, primers)
+
+    def run(self, batch, stats):
+        R1 = [x.seq for x in batch]
+        R2 = [x.mate[1] for x in batch]
+        found = zip(batch, self.primers.fwdStartBatch(R1), self.primers.revEndBatch(R1),
+                    self.primers.revStartBatch(R2), self.primers.fwdEndBatch(R2))
+        for read, R1For, R1Rev, R2For, R2Rev in found:
+            R1ForPos = R1For['locations'][0][1]+1 if R1For['editDistance'] >= 0 else 0
+            R1RevPos = R1Rev['locations'][0][0] if R1Rev['editDistance'] >= 0 else len(read.seq)
+            R2ForPos = R2For['locations'][0][1]+1 if R2For['editDistance'] >= 0 else 0
+            R2RevPos = R2Rev['locations'][0][0] if R2Rev['editDistance'] >= 0 else len(read.mate[1])
+            if R1ForPos > 0:
+                stats['fwd_primer'] += 1
+            if R1RevPos > 0:
+                stats['rev_primer'] += 1
+            read.trimmed = R1ForPos > 0 and R2ForPos > 0
+            read.seq = read.seq[R1ForPos:R1RevPos]
+            read.qual = read.qual[R1ForPos:R1RevPos]
+            title, seq, qual = read.mate
+            read.mate = (title, seq[R2ForPos:R2RevPos], qual[R2ForPos:R2RevPos])
+        return batch
+
+class RevBarcodeResolver(object):
+    '''
+    demux stage, reverse barcode after the reverse primer of reads where it was found.
+    dual (DualBarcodeIndex) resolves the forward/reverse pair to a sample, barcodes
+    being the forward barcode dictionary, otherwise the label becomes fwd:-:rev.
+    Reads without a match are no_rev_barcode
+    '''
+    def __init__(self, revbarcodes, dual=None, barcodes=None):
+        self.revbarcodes = revbarcodes
+        self.dual = dual
+        self.barcodes = barcodes
+
+    def reset(self):
+        pass
+
+    def run(self, batch, stats):
+        kept = []
+        for read in batch:
+            if read.rev:
+                if self.dual:
+                    BarcodeLabel = self.dual.resolve(self.barcodes[read.label], read.tail)
+                    if BarcodeLabel is None:
+                        stats['no_rev_barcode'] += 1
+                        continue
+                    read.label = BarcodeLabel
+                else:
+                    RevBarcode, RevBarcodeLabel = self.revbarcodes.align(read.tail)
+                    if RevBarcode == "":
+                        stats['no_rev_barcode'] += 1
+                        continue
+                    read.label = read.label+':-:'+RevBarcodeLabel
+            kept.append(read)
+        return kept
+
+    def finish(self, stats, name):
+        pass
+
+class LengthPolicy(object):
+    '''
+    demux stage, drops reads shorter than min_len (too_short).  With trim_len, reads
+    with the reverse primer are padded with N (pad on) or truncated to trim_len and
+    reads without it must be trim_len long and are truncated, full_length keeps only
+    reads with the reverse primer and leaves their length alone
+    '''
+    def __init__(self, min_len, trim_len=None, pad='off', full_length=False):
+        self.min_len = int(min_len)
+        self.trim_len = trim_len
+        self.pad = pad
+        self.full_length = full_length
+
+    def reset(self):
+        pass
+
+    def run(self, batch, stats):
+        kept = []
+        for read in batch:
+            Seq, Qual = read.seq, read.qual
+            if self.trim_len is None:
+                pass
+            elif read.rev:
+                if not self.full_length:
+                    #check minimum length here or primer dimer type sequences will get padded with Ns
+                    if len(Seq) < self.min_len:
+                        stats['too_short'] += 1
+                        continue
+                    if len(Seq) < self.trim_len and self.pad == 'on':
+                        pad = self.trim_len - len(Seq)
+                        Seq = Seq + pad*b'N'
+                        Qual = Qual + pad*b'I'
+                    else:
+                        Seq = Seq[:self.trim_len]
+                        Qual = Qual[:self.trim_len]
+            else:
+                if self.full_length:
+                    continue
+                #without the reverse primer the read must reach trim_len
+                if len(Seq) < self.trim_len:
+                    stats['too_short'] += 1
+                    continue
+                Seq = Seq[:self.trim_len]
+                Qual = Qual[:self.trim_len]
+            if len(Seq) < self.min_len:
+                stats['too_short'] += 1
+                continue
+            read.seq, read.qual = Seq, Qual
+            kept.append(read)
+        return kept
+
+    def finish(self, stats, name):
+        pass
+
+class DemuxWriter(object):
+    '''
+    demux output, reads are relabeled R_<n>;barcodelabel=<sample>; numbered from
+    offset+1 and counted as valid.  With output2 the mates of paired reads are written
+    there and the header also has the index read and its differences (bcseq, bcdiffs)
+    '''
+    def __init__(self, output, offset=0, output2=None):
+        self.counter = offset
+        self.outfile = FastqWriter(output)
+        self.outfile2 = FastqWriter(output2) if output2 else None
+
+    def write(self, batch, stats):
+        for read in batch:
+            self.counter += 1
+            label = read.label.encode('utf-8')
+            if self.outfile2 is None:
+                self.outfile.write(b'R_%i;barcodelabel=%s;' % (self.counter, label), read.seq, read.qual)
+                continue
+            header = b'R_%i;barcodelabel=%s;bcseq=%s;bcdiffs=%i;' % (self.counter, label, read.index, read.diffs)
+            if read.trimmed:
+                header += PRIMERS_TRIMMED_B
+            self.outfile.write(header, read.seq, read.qual)
+            self.outfile2.write(header, read.mate[1], read.mate[2])
+        stats['valid'] += len(batch)
+
+    def close(self):
+        self.outfile.close()
+        if self.outfile2:
+            self.outfile2.close()
+
+class DemuxPartWriter(DemuxWriter):
+    '''
+    DemuxWriter that moves on to the next of outputs, a list of (output, output2), every
+    reads input reads so the demuxed reads of a runQueue can be merged in parallel.
+    Read numbers continue across the parts, parts lists the outputs that were used
+    '''
+    def __init__(self, outputs, reads):
+        DemuxWriter.__init__(self, outputs[0][0], output2=outputs[0][1])
+        self.outputs = outputs
+        self.reads = reads
+        self.parts = [outputs[0]]
+        self.seen = 0
+
+    def write(self, batch, stats):
+        if self.seen >= len(self.parts) * self.reads and len(self.parts) < len(self.outputs):
+            DemuxWriter.close(self)
+            output, output2 = self.outputs[len(self.parts)]
+            self.outfile = FastqWriter(output)
+            self.outfile2 = FastqWriter(output2) if output2 else None
+            self.parts.append((output, output2))
+        DemuxWriter.write(self, batch, stats)
+        self.seen = stats['total']
+
+class SampleWriter(object):
+    '''
+    demux output to one compressed file per sample in folder (<sample>.fastq.gz, or
+    <sample>_R1.fastq.gz and <sample>_R2.fastq.gz if paired), headers are kept.  Files
+    are opened through a WriterCache, so only maxopen are open at once
+    '''
+    def __init__(self, folder, paired=False, maxopen=MAX_OPEN_WRITERS):
+        self.folder = folder
+        self.paired = paired
+        self.outfiles = WriterCache(functools.partial(FastqWriter, batchsize=256), maxopen=maxopen)
+
+    def write(self, batch, stats):
+        #one writer lookup per sample in the batch
+        samples = collections.defaultdict(list)
+        for read in batch:
+            samples[read.label].append(read)
+        for label, reads in samples.items():
+            if self.paired:
+                outfile = self.outfiles.get(os.path.join(self.folder, label+'_R1.fastq.gz'))
+                outfile2 = self.outfiles.get(os.path.join(self.folder, label+'_R2.fastq.gz'))
+                for read in reads:
+                    outfile.write(read.title, read.seq, read.qual)
+                    outfile2.write(*read.mate)
+            else:
+                outfile = self.outfiles.get(os.path.join(self.folder, label+'.fastq.gz'))
+                for read in reads:
+                    outfile.write(read.title, read.seq, read.qual)
+        stats['valid'] += len(batch)
+
+    def close(self):
+        self.outfiles.close()
+
+class DemuxEngine(object):
+    '''
+    streaming demultiplexer of process_ion, process_illumina2 (single end reads),
+    process_illumina_raw and fastq2sra.  Batches of DemuxRead from demuxReader go through
+    the stages in order (BarcodeResolver or IndexReadResolver, PrimerTrimmer,
+    RevBarcodeResolver, LengthPolicy), each drops reads and adds to one DemuxStats, the
+    writer gets what is left.  Stages have run(batch, stats), reset() and
+    finish(stats, name).  Built once in main, the workers of demuxChunks and runQueue
+    inherit it
+    '''
+    def __init__(self, stages):
+        self.stages = stages
+
+    def run(self, ranges, writer, name='demux'):
+        '''demultiplex (file, start, end) ranges of R1 or R1, R2, I1 to writer, returns DemuxStats'''
+        stats = DemuxStats()
+        for stage in self.stages:
+            stage.reset()
+        try:
+            for batch in demuxReader(ranges):
+                stats['total'] += len(batch)
+                for stage in self.stages:
+                    batch = stage.run(batch, stats)
+                writer.write(batch, stats)
+        finally:
+            writer.close()
+        for stage in self.stages:
+            stage.finish(stats, name)
+        return stats
+
+    def runQueue(self, inputs, writer, cpus, name='demux', slots=None):
+        '''
+        demultiplex whole R1 or R1, R2, I1 files to writer with cpus worker processes.
+        A reader process hands batches of raw FASTQ text to the workers through shared
+        memory slots, demuxed batches come back to the writer here in input order.
+        Nothing is split or uncompressed first and slow batches do not hold up the
+        other workers.  Returns DemuxStats
+        '''
+        ctx = multiprocessing.get_context('fork')
+        slots = slots or 3*cpus
+        #anonymous shared maps are inherited by the forked reader and workers
+        buffers = [mmap.mmap(-1, QUEUE_SLOTSIZE) for i in range(slots)]
+        free, tasks, results = ctx.Queue(), ctx.Queue(), ctx.Queue()
+        for i in range(slots):
+            free.put(i)
+        processes = [ctx.Process(target=demuxQueueReader, args=(inputs, buffers, free, tasks, results, cpus))]
+        for i in range(cpus):
+            processes.append(ctx.Process(target=demuxQueueWorker, args=(self, buffers, tasks, results, '{:}_{:}'.format(name, i+1))))
+        for p in processes:
+            p.start()
+        stats = DemuxStats()
+        pending = {}
+        nextbatch, batches, finished = 0, None, 0
+        try:
+            while batches is None or nextbatch < batches or finished < cpus:
+                kind, key, value = results.get()
+                if kind == 'error':
+                    log.error(value)
+                    sys.exit(1)
+                elif kind == 'batches':
+                    batches = key
+                elif kind == 'finish':
+                    stats.update(value)
+                    finished += 1
+                else:
+                    pending[key] = value
+                #write in input order, the slot is reused once its batch is written
+                while nextbatch in pending:
+                    slot, batch, counts = pending.pop(nextbatch)
+                    stats.update(counts)
+                    writer.write(batch, stats)
+                    free.put(slot)
+                    nextbatch += 1
+        finally:
+            writer.close()
+            for p in processes:
+                if p.is_alive() and (batches is None or nextbatch < batches):
+                    p.terminate()
+                p.join()
+        log.debug('{:}: {:,} batches of {:,} reads through {:} reader and {:} worker processes'.format(name, nextbatch, BATCH_SIZE, 1, cpus))
+        return stats
+
+QUEUE_SLOTSIZE = int(os.environ.get('AMPTK_QUEUE_SLOTSIZE', 8388608))
+
+def fastq_record_blocks(input, records, blocksize=1048576):
+    '''
+    raw FASTQ text of records reads at a time (fewer at the end of the file), yields
+    (number of reads, bytes).  Reads must be 4 lines per record, see fastq_blocks
+    '''
+    lines = []
+    pending = b''
+    with open_fastx(input, mode='rb') as infile:
+        while True:
+            block = infile.read(blocksize)
+            if not block:
+                break
+            lines.extend((pending + block).split(b'\n'))
+            pending = lines.pop()
+            n = len(lines) // (4*records)
+            for i in range(n):
+                yield records, b'\n'.join(lines[i*4*records:(i+1)*4*records]) + b'\n'
+            del lines[:n*4*records]
+    if pending.strip():
+        lines.append(pending)
+    while lines and not lines[-1].strip():
+        lines.pop()
+    if len(lines) % 4:
+        raise ValueError('%s: truncated FASTQ record at end of file' % input)
+    if lines:
+        yield len(lines) // 4, b'\n'.join(lines) + b'\n'
+
+def demuxQueueReader(inputs, buffers, free, tasks, results, cpus):
+    #producer of DemuxEngine.runQueue, batches of the same reads of every input go to one slot
+    try:
+        from itertools import zip_longest
+    except ImportError:
+        from itertools import izip_longest as zip_longest
+    try:
+        count = 0
+        for blocks in zip_longest(*[fastq_record_blocks(x, BATCH_SIZE) for x in inputs]):
+            if None in blocks or len(set(x[0] for x in blocks)) > 1:
+                raise ValueError('%s are not properly paired, exiting' % ', '.join(inputs))
+            sizes = [len(x[1]) for x in blocks]
+            data = b''.join(x[1] for x in blocks)
+            slot = free.get()
+            if len(data) <= QUEUE_SLOTSIZE:
+                buffers[slot][:len(data)] = data
+                data = None
+            #batches larger than a slot are pickled through the queue instead
+            tasks.put((count, slot, blocks[0][0], sizes, data))
+            count += 1
+        results.put(('batches', count, None))
+    except Exception as e:
+        results.put(('error', 0, str(e)))
+    finally:
+        for i in range(cpus):
+            tasks.put(None)
+
+def demuxQueueWorker(engine, buffers, tasks, results, name):
+    #consumer of DemuxEngine.runQueue, runs the stages on one batch at a time
+    stats = DemuxStats()
+    try:
+        for stage in engine.stages:
+            stage.reset()
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            count, slot, n, sizes, data = task
+            if data is None:
+                data = buffers[slot][:sum(sizes)]
+            records, start = [], 0
+            for size in sizes:
+                records.append(fastq_batch(data[start:start+size].split(b'\n'), 4*n))
+                start += size
+            if len(records) == 1:
+                batch = [DemuxRead(*x) for x in records[0]]
+            else:
+                batch = [DemuxRead(read1[0], read1[1], read1[2], mate=read2, index=index[1]) for read1, read2, index in zip(*records)]
+            counts = DemuxStats(total=len(batch))
+            for stage in engine.stages:
+                batch = stage.run(batch, counts)
+            results.put(('batch', count, (slot, batch, counts)))
+        for stage in engine.stages:
+            stage.finish(stats, name)
+        results.put(('finish', 0, stats))
+    except Exception as e:
+        results.put(('error', 0, '{:}: {:}'.format(name, e)))
+
+def demuxChunks(worker, inputs, cpus, perCPU=2, args=False):
+    '''
+    parallel driver of the demux commands, splits the inputs (R1, or R1/R2/I1) into
+    chunks holding the same reads and calls worker((chunk name, first read number,
+    [(file, start, end), ...]), args=args) for each one in cpus processes.
+    Returns the chunk list
+    '''
+    chunks = fastq_chunksPE(inputs, cpus*perCPU if cpus > 1 else 1)
+    file_list = [('chunk_'+str(i+1), rec, [(x,)+tuple(r) for x, r in zip(inputs, ranges)]) for i, (rec, ranges) in enumerate(chunks)]
+    if cpus > 1:
+        runMultiProgress(worker, file_list, cpus, args=args)
+    else:
+        worker(file_list[0], args=args)
+    return file_list
+
 def findFwdPrimer(primer, sequence, mismatch, equalities):
     #trim position
     TrimPos = None
@@ -1276,90 +4191,402 @@ def findRevPrimer(primer, sequence, mismatch, equalities):
     #return position will be None if not found
     return TrimPos
 
-def MergeReadsSimple(R1, R2, tmpdir, outname, minlen, usearch, rescue, method='vsearch'):
-    #check that num sequences is identical
-    if not PEsanitycheck(R1, R2):
-        log.error("%s and %s are not properly paired, exiting" % (R1, R2))
-        sys.exit(1)
+#read pair merging, 5-mer seeds as vsearch (merge_mindiagcount) and scores of an overlap
+MERGE_K = 5
+MERGE_MINDIAG = 4
+MERGE_MINSCORE = 16
+MERGE_MISMATCHMAX = -4
+MERGE_CODES = np.full(256, 5, dtype=np.uint8)
+MERGE_CODES[0] = 0
+for i, c in enumerate(b'ACGT'):
+    MERGE_CODES[c] = MERGE_CODES[c+32] = i+1
+MERGE_COMPLEMENT = bytes.maketrans(b'ACGTRYKMBVDHacgtrykmbvdh', b'TGCAYRMKVBHDtgcayrmkvbhd')
+
+class PairMerger(object):
+    '''
+    in-process alternative to vsearch --fastq_mergepairs for batches of read pairs, with
+    the vsearch defaults (--fastq_minovlen 10, --fastq_maxdiffs 10, --fastq_maxdiffpct
+    100) and staggered pairs merged with their overhangs cut (--fastq_allowmergestagger).
+    Overlaps are the diagonals with at least 4 shared 5-mers, found for the whole batch
+    at once with numpy, the best scoring one has to score 16.  Like vsearch the score is
+    quality aware, the log-odds of the two bases being the same or not given their
+    qualities, and a mismatch only counts as a difference if its score is -4 or lower,
+    so mismatches in low quality tails do not stop the merge.  Overlapping bases get
+    the posterior base and quality of Edgar & Flyvbjerg 2015, capped at qmaxout
+    '''
+    def __init__(self, minovlen=10, maxdiffs=10, maxdiffpct=100.0, minmergelen=1,
+                 maxmergelen=1000000, stagger=True, qmaxout=41, ascii=33):
+        self.minovlen = minovlen
+        self.maxdiffs = maxdiffs
+        self.maxdiffpct = maxdiffpct
+        self.minmergelen = minmergelen
+        self.maxmergelen = maxmergelen
+        self.stagger = stagger
+        self.qmaxout = qmaxout
+        self.ascii = ascii
+        self.cap = bytes(bytearray(min(c, ascii+qmaxout) for c in range(256)))
+        #posterior error of agreeing bases [q1, q2] and disagreeing ones [high q, low q]
+        p = 10.0 ** (-np.arange(94) / 10.0)
+        p1, p2 = p[:, None], p[None, :]
+        same = (p1*p2/3) / (1 - p1 - p2 + 4*p1*p2/3)
+        diff = p1*(1 - p2/3) / (p1 + p2 - 4*p1*p2/3)
+        self.qsame = np.clip(np.round(-10*np.log10(same)), 0, qmaxout).astype(np.uint8)
+        self.qdiff = np.clip(np.round(-10*np.log10(diff)), 0, qmaxout).astype(np.uint8)
+        #alignment score of a match and a mismatch of bases with qualities [q1, q2]
+        match = np.minimum((1 - p1)*(1 - p2) + p1*p2/3, 1 - 1e-12)
+        self.match_score = np.log2(match / 0.25)
+        self.mism_score = np.log2((1 - match) / 0.75)
+        self.counts = collections.Counter()
+
+    def reset(self):
+        self.counts = collections.Counter()
+
+    def _encode(self, seqs):
+        width = max(max(len(x) for x in seqs), MERGE_K)
+        buf = b''.join([x.ljust(width, b'\0') for x in seqs])
+        return np.frombuffer(buf, dtype=np.uint8).reshape(len(seqs), width), np.array([len(x) for x in seqs], dtype=np.int64)
+
+    def _kmers(self, codes):
+        #row, position and code of every 5-mer without N
+        n, width = codes.shape
+        m = width - MERGE_K + 1
+        valid = np.ones((n, m), dtype=bool)
+        kmer = np.zeros((n, m), dtype=np.int16)
+        for t in range(MERGE_K):
+            c = codes[:, t:t+m]
+            valid &= (c - 1) < 4
+            kmer = kmer*4 + (c - 1)
+        rows, cols = np.nonzero(valid)
+        return rows, cols, kmer[rows, cols]
+
+    def _diagonals(self, A, B):
+        '''
+        (pair, diagonal) with enough shared 5-mers, diagonal d puts R2 position j at R1
+        position j+d.  R1 5-mers are looked up in a table of their first and last
+        position in the read, so 5-mers seen more than twice only count twice
+        '''
+        n = A.shape[0]
+        r1, c1, k1 = self._kmers(A)
+        r2, c2, k2 = self._kmers(B)
+        last = np.full((n, 4**MERGE_K), -1, dtype=np.int32)
+        last[r1, k1] = c1
+        first = np.full((n, 4**MERGE_K), -1, dtype=np.int32)
+        first[r1[::-1], k1[::-1]] = c1[::-1]
+        width = A.shape[1] + B.shape[1]
+        i, j = last[r2, k2], first[r2, k2]
+        hit, repeat = i >= 0, (j >= 0) & (j != i)
+        key = np.concatenate(((r2*width + i - c2 + B.shape[1])[hit], (r2*width + j - c2 + B.shape[1])[repeat]))
+        key = np.nonzero(np.bincount(key, minlength=n*width) >= MERGE_MINDIAG)[0]
+        return key // width, key % width - B.shape[1]
+
+    def merge(self, pairs):
+        '''
+        merge a list of (seq1, qual1, seq2, qual2) bytes, R2 as sequenced, returns the
+        merged (seq, qual) of each pair or None if it does not merge
+        '''
+        results = [None]*len(pairs)
+        self.counts['pairs'] += len(pairs)
+        if not pairs:
+            return results
+        seq1 = [x[0] for x in pairs]
+        seq2 = [x[2][::-1].translate(MERGE_COMPLEMENT) for x in pairs]
+        qual2 = [x[3][::-1] for x in pairs]
+        S1, len1 = self._encode(seq1)
+        S2, len2 = self._encode(seq2)
+        A, B = MERGE_CODES[S1], MERGE_CODES[S2]
+        p, d = self._diagonals(A, B)
+        #mismatches of every candidate overlap, N matches nothing
+        a0 = np.maximum(d, 0)
+        a1 = np.minimum(len1[p], d + len2[p])
+        ovl = a1 - a0
+        t = np.arange(max(int(ovl.max()) if len(ovl) else 0, 1))
+        inside = t[None, :] < ovl[:, None]
+        pos1 = np.minimum(a0[:, None] + t, A.shape[1]-1)
+        pos2 = np.clip(pos1 - d[:, None], 0, B.shape[1]-1)
+        x, y = A[p[:, None], pos1], B[p[:, None], pos2]
+        called = inside & (x <= 4) & (y <= 4)
+        Q1, _ = self._encode([x[1] for x in pairs])
+        Q2, _ = self._encode(qual2)
+        q1 = np.clip(Q1[p[:, None], pos1].astype(np.int64) - self.ascii, 0, 93)
+        q2 = np.clip(Q2[p[:, None], pos2].astype(np.int64) - self.ascii, 0, 93)
+        same, mism = called & (x == y), called & (x != y)
+        score = np.where(same, self.match_score[q1, q2], 0).sum(axis=1) + np.where(mism, self.mism_score[q1, q2], 0).sum(axis=1)
+        diffs = (mism & (self.mism_score[q1, q2] <= MERGE_MISMATCHMAX)).sum(axis=1)
+        #best candidate of every pair, the longest overlap of equal scores
+        order = np.lexsort((-ovl, -score, p))
+        best = order[np.unique(p[order], return_index=True)[1]]
+        mergelen = d + len2[p]
+        staggered = (d < 0) | (mergelen < len1[p])
+        #reasons in the order vsearch checks them, the first failed one counts
+        reasons = [('no_alignment', score < MERGE_MINSCORE),
+                   ('overlap_too_short', ovl < self.minovlen),
+                   ('too_many_diffs', (diffs > self.maxdiffs) | (100.0*diffs > self.maxdiffpct*ovl)),
+                   ('staggered', staggered & (not self.stagger)),
+                   ('too_short', mergelen < self.minmergelen),
+                   ('too_long', mergelen > self.maxmergelen)]
+        ok = np.zeros(len(p), dtype=bool)
+        ok[best] = True
+        for reason, failed in reasons:
+            failed = ok & failed
+            self.counts[reason] += int(failed.sum())
+            ok &= ~failed
+        self.counts['no_alignment'] += len(pairs) - len(best)
+        rows = np.nonzero(ok)[0]
+        self.counts['merged'] += len(rows)
+        if not len(rows):
+            return results
+        #consensus of the overlaps, the base of the better quality read if they differ
+        x, y, called, q1, q2 = x[rows], y[rows], called[rows], q1[rows], q2[rows]
+        rp = p[rows]
+        b1, b2 = S1[rp[:, None], pos1[rows]], S2[rp[:, None], pos2[rows]]
+        use1 = (q1 >= q2) & (x <= 4) | (y > 4)
+        base = np.where(use1, b1, b2)
+        qual = np.where(use1, q1, q2)
+        qual = np.where(called & (x == y), self.qsame[q1, q2], qual)
+        qual = np.where(called & (x != y), self.qdiff[np.maximum(q1, q2), np.minimum(q1, q2)], qual)
+        qual = np.minimum(qual, self.qmaxout).astype(np.uint8) + np.uint8(self.ascii)
+        for lane, idx in enumerate(rows.tolist()):
+            i, start, end, o = int(p[idx]), int(a0[idx]), int(a1[idx]), int(ovl[idx])
+            tail = end - int(d[idx])
+            seq = seq1[i][:start] + base[lane, :o].tobytes() + seq2[i][tail:]
+            qual_ = (pairs[i][1][:start] + qual[lane, :o].tobytes() + qual2[i][tail:]).translate(self.cap)
+            results[i] = (seq, qual_)
+        return results
+
+    def summary(self):
+        pairs = self.counts['pairs']
+        return '{:,} of {:,} pairs merged ({:.1%}), not merged: {:}'.format(self.counts['merged'], pairs, self.counts['merged'] / max(pairs, 1),
+                ', '.join('{:} {:,}'.format(k, v) for k, v in sorted(self.counts.items()) if v and k not in ('pairs', 'merged')) or 'none')
+
+class MergedPairWriter(object):
+    '''
+    writer of read pairs that merges them with a PairMerger a batch at a time, merged
+    reads keep the R1 header.  Pairs that do not merge are written as their R1 if rescue
+    is on (vsearch --fastqout_notmerged_fwd), output is in input order.  With a
+    PhixScreen the PhiX reads are dropped in the same pass
+    '''
+    def __init__(self, output, merger, rescue='on', phix=None):
+        self.outfile = FastqWriter(output)
+        self.merger = merger
+        self.rescue = rescue == 'on'
+        self.phix = phix
+        self.batch = []
+        self.merged = 0
+        self.rescued = 0
+
+    def write(self, title, seq1, qual1, seq2, qual2):
+        self.batch.append((title, seq1, qual1, seq2, qual2))
+        if len(self.batch) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        records = []
+        for read, merged in zip(self.batch, self.merger.merge([x[1:] for x in self.batch])):
+            if merged:
+                records.append((read[0], merged[0], merged[1]))
+                self.merged += 1
+            elif self.rescue:
+                records.append((read[0], read[1], read[2]))
+                self.rescued += 1
+        if self.phix:
+            records = self.phix.filter(records)
+        self.outfile.writebatch(records)
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        self.outfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class FastqPairWriter(object):
+    '''R1 and R2 FastqWriter with the write() of MergedPairWriter'''
+    def __init__(self, outR1, outR2):
+        self.outfile1 = FastqWriter(outR1)
+        self.outfile2 = FastqWriter(outR2)
+
+    def write(self, title, seq1, qual1, seq2, qual2):
+        self.outfile1.write(title, seq1, qual1)
+        self.outfile2.write(title, seq2, qual2)
+
+    def close(self):
+        self.outfile1.close()
+        self.outfile2.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+#PhiX screen, reads sharing minhits 21-mers with PhiX174 (NC_001422.1) are removed
+PHIX_REFERENCE = os.path.join(parentdir, 'DB', 'phiX174.fa')
+PHIX_K = 21
+PHIX_MINHITS = 10
+PHIX_TABLEBITS = 22
+
+class PhixScreen(object):
+    '''
+    in-process PhiX filter (was usearch -filter_phix), the k-mers of both strands of the
+    (circular) PhiX genome are packed 2 bits per base in a sorted numpy array and the
+    k-mers of a batch of reads are looked up at once, through a table of their low bits
+    first so only the few candidates are searched.  Reads with at least minhits PhiX
+    k-mers are removed, counts of reads screened and removed are kept until reset()
+    '''
+    def __init__(self, reference=PHIX_REFERENCE, minhits=PHIX_MINHITS, k=PHIX_K):
+        self.minhits = minhits
+        self.k = k
+        kmers = []
+        for record in SeqIO.parse(reference, 'fasta'):
+            seq = str(record.seq).upper().encode('utf-8')
+            seq += seq[:k-1]
+            for x in (seq, RevComp(seq)):
+                packed, valid = self.kmers([x])
+                kmers.append(packed[valid])
+        self.reference = np.unique(np.concatenate(kmers))
+        self.mask = np.uint64((1 << PHIX_TABLEBITS) - 1)
+        self.table = np.zeros(1 << PHIX_TABLEBITS, dtype=bool)
+        self.table[self.reference & self.mask] = True
+        self.reset()
+
+    def reset(self):
+        self.screened = 0
+        self.removed = 0
+
+    def kmers(self, seqs):
+        #packed k-mer at every position of the reads and whether it is free of N
+        width = max(max(len(x) for x in seqs), self.k)
+        buf = b''.join([x.ljust(width, b'\0') for x in seqs])
+        codes = MERGE_CODES[np.frombuffer(buf, dtype=np.uint8).reshape(len(seqs), width)]
+        m = width - self.k + 1
+        bad = np.zeros((len(seqs), width+1), dtype=np.int32)
+        np.cumsum((codes - 1) >= 4, axis=1, out=bad[:, 1:])
+        #1, 2, 4, 8.. -mers by doubling, the k-mer joins those of the set bits of k
+        blocks = {1: ((codes - 1) & 3).astype(np.uint64)}
+        size = 1
+        while size*2 <= self.k:
+            x = blocks[size]
+            blocks[size*2] = (x[:, :-size] << np.uint64(2*size)) | x[:, size:]
+            size *= 2
+        packed, offset = None, 0
+        while size:
+            if self.k & size:
+                x = blocks[size][:, offset:offset+m]
+                packed = x if packed is None else (packed << np.uint64(2*size)) | x
+                offset += size
+            size //= 2
+        return packed, (bad[:, self.k:] - bad[:, :m]) == 0
+
+    def hits(self, seqs):
+        #number of PhiX k-mers in each read
+        packed, valid = self.kmers(seqs)
+        rows, cols = np.nonzero(self.table[packed & self.mask] & valid)
+        x = packed[rows, cols]
+        i = np.minimum(np.searchsorted(self.reference, x), len(self.reference)-1)
+        return np.bincount(rows[self.reference[i] == x], minlength=len(seqs))
+
+    def filter(self, records):
+        #(title, seq, qual) records that are not PhiX
+        if not records:
+            return records
+        self.screened += len(records)
+        keep = self.hits([x[1] for x in records]) < self.minhits
+        kept = [x for x, k in zip(records, keep) if k]
+        self.removed += len(records) - len(kept)
+        return kept
+
+def loadPhixScreen(minhits=PHIX_MINHITS, reference=PHIX_REFERENCE):
+    '''
+    PhixScreen for the processing scripts, None if minhits is 0 or the reference is
+    missing
+    '''
+    if minhits < 1:
+        return None
+    if not os.path.isfile(reference):
+        log.info('Warning: PhiX reference {:} not found, PhiX reads are not removed'.format(reference))
+        return None
+    return PhixScreen(reference, minhits=minhits)
+
+def filterPhix(inputs, output, phix):
+    #concatenate inputs to output without the PhiX reads, returns reads in and out
+    total, count = 0, 0
+    with FastqWriter(output) as outfile:
+        for input in inputs:
+            for batch in iter_fastq_batches(input):
+                kept = phix.filter(batch)
+                outfile.writebatch(kept)
+                total += len(batch)
+                count += len(kept)
+    return total, count
+
+def MergeReadsSimple(R1, R2, tmpdir, outname, minlen, usearch, rescue, method='vsearch', threads=1, phix=None):
+    '''
+    merge R1/R2 to tmpdir/outname, with a PhixScreen the PhiX reads are removed as the
+    merged reads are written. Returns the reads merged (and rescued) and the reads written
+    '''
+    #R1 and R2 are written in pairs by the demux functions, which check pairing with zipPaired
     #next run USEARCH/vsearch mergepe
     merge_out = os.path.join(tmpdir, outname + '.merged.fq')
     skip_for = os.path.join(tmpdir, outname + '.notmerged.R1.fq')
     report = os.path.join(tmpdir, outname +'.merge_report.txt')
+    final_out = os.path.join(tmpdir, outname)
     log.debug("Now merging PE reads")
+    if method == 'amptk':
+        #merge in process, merged and rescued R1 reads go straight to the final output
+        merger = PairMerger(minmergelen=minlen)
+        removed = phix.removed if phix else 0
+        with MergedPairWriter(final_out, merger, rescue=rescue, phix=phix) as outfile:
+            for read1, read2 in zipPaired((R1, R2), iter_fastq(R1), iter_fastq(R2)):
+                outfile.write(read1[0], read1[1], read1[2], read2[1], read2[2])
+        log.debug('{:}: {:}'.format(outname, merger.summary()))
+        count = countfastq(final_out)
+        if phix:
+            log.debug("Removed %i reads that were phiX" % (phix.removed - removed))
+            return count + phix.removed - removed, count
+        return count, count
     if method == 'usearch':
         cmd = [usearch, '-fastq_mergepairs', R1, '-reverse', R2,
                '-fastqout', merge_out, '-fastq_trunctail', '5',
                '-fastqout_notmerged_fwd', skip_for, '-minhsp', '12',
                '-fastq_maxdiffs', '8', '-report', report,
-               '-fastq_minmergelen', str(minlen), '-threads', '1']
+               '-fastq_minmergelen', str(minlen), '-threads', str(threads)]
     elif method == 'vsearch':
         log.debug('Merging PE reads using vsearch --fastq_mergepairs: {} {}'.format(os.path.basename(R1), os.path.basename(R2)))
         cmd = ['vsearch', '--fastq_mergepairs', R1, '--reverse', R2,
                '--fastqout', merge_out, '--fastqout_notmerged_fwd', skip_for,
-               '--fastq_minmergelen', str(minlen), '--fastq_allowmergestagger', '--threads', '1']
+               '--fastq_minmergelen', str(minlen), '--fastq_allowmergestagger', '--threads', str(threads)]
     runSubprocess(cmd, log)
     #now concatenate files for downstream pre-process_illumina.py script
-    final_out = os.path.join(tmpdir, outname)
-    tmp_merge = os.path.join(tmpdir, outname+'.tmp')
-    with open(tmp_merge, 'w') as cat_file:
-        shutil.copyfileobj(open(merge_out,'r'), cat_file)
-        if rescue == 'on':
-            shutil.copyfileobj(open(skip_for,'r'), cat_file)
-    phixsize = getSize(tmp_merge)
-    phixcount = countfastq(tmp_merge)
-    if method == 'usearch':
-        #run phix removal
-        #since most users have 32 bit usearch, check size of file, if > 3 GB, split into parts
-        log.debug("Removing phix from %s" % outname)
-        log.debug('File Size: %i bytes' % phixsize)
-        if phixsize > 3e9:
-            log.debug('FASTQ > 3 GB, splitting FASTQ file into chunks to avoid potential memory problems with 32 bit usearch')
-            phixdir = os.path.join(tmpdir, 'phix_'+str(os.getpid()))
-            os.makedirs(phixdir)
-            num = round(int((phixsize / 3e9))) + 1
-            split_fastq(tmp_merge, phixcount, phixdir, int(num))
-            for file in os.listdir(phixdir):
-                if file.endswith(".fq"):
-                    output = os.path.join(phixdir, file+'.phix')
-                    file = os.path.join(phixdir, file)
-                    cmd = [usearch, '-filter_phix', file, '-output', output, '-threads', '1']
-                    runSubprocess(cmd, log)
-            with open(final_out, 'w') as finalout:
-                for file in os.listdir(phixdir):
-                    if file.endswith('.phix'):
-                        with open(os.path.join(phixdir, file), 'r') as infile:
-                            shutil.copyfileobj(infile, finalout)
-            shutil.rmtree(phixdir)
-        else:
-            cmd = [usearch, '-filter_phix', tmp_merge, '-output', final_out, '-threads', '1']
-            runSubprocess(cmd, log)
+    catlist = [merge_out]
+    if rescue == 'on':
+        catlist.append(skip_for)
+    if phix:
+        #screen while concatenating, no extra pass over the merged reads
+        phixcount, finalcount = filterPhix(catlist, final_out, phix)
+        log.debug("Removed %i reads that were phiX" % (phixcount - finalcount))
     else:
-        os.rename(tmp_merge, final_out)
-    #count output
-    finalcount = countfastq(final_out)
+        #without phix filtering write straight to final output
+        cat_fastx(catlist, final_out)
+        phixcount = finalcount = countfastq(final_out)
     SafeRemove(merge_out)
     SafeRemove(skip_for)
-    SafeRemove(tmp_merge)
     return phixcount, finalcount
 
 
-def MergeReads(R1, R2, tmpdir, outname, read_length, minlen, usearch, rescue, method, index, mismatch):
-    removelist = []
-    if mismatch == 0 and index != '':
-        if checkBCinHeader(R1):
-            log.debug("Searching for index mismatches > 0: %s" % index)
-            removelist = illuminaBCmismatch(R1, R2, index)
-            log.debug("Removing %i reads with index mismatch > 0" % len(removelist))
+def MergeReads(R1, R2, tmpdir, outname, read_length, minlen, usearch, rescue, method, index, mismatch, phix=None):
     pretrim_R1 = os.path.join(tmpdir, outname + '.pretrim_R1.fq')
     pretrim_R2 = os.path.join(tmpdir, outname + '.pretrim_R2.fq')
     log.debug("Removing index 3prime bp 'A' from reads")
-    trim3prime(R1, read_length, pretrim_R1, removelist)
-    trim3prime(R2, read_length, pretrim_R2, removelist)
-
-    #check that num sequences is identical
-    if not PEsanitycheck(pretrim_R1, pretrim_R2):
-        log.error("%s and %s are not properly paired, exiting" % (R1, R2))
-        sys.exit(1)
+    if mismatch == 0 and index != '':
+        log.debug("Searching for index mismatches > 0: %s" % index)
+        origcount, removed = trim3primePE(R1, R2, read_length, pretrim_R1, pretrim_R2, index=index)
+        log.debug("Removed %i reads with index mismatch > 0" % removed)
+    else:
+        origcount, removed = trim3primePE(R1, R2, read_length, pretrim_R1, pretrim_R2)
 
     #next run USEARCH/vsearch mergepe
     merge_out = os.path.join(tmpdir, outname + '.merged.fq')
@@ -1373,55 +4600,29 @@ def MergeReads(R1, R2, tmpdir, outname, read_length, minlen, usearch, rescue, me
     runSubprocess(cmd, log)
     #now concatenate files for downstream pre-process_illumina.py script
     final_out = os.path.join(tmpdir, outname)
-    tmp_merge = os.path.join(tmpdir, outname+'.tmp')
-    with open(tmp_merge, 'w') as cat_file:
-        shutil.copyfileobj(open(merge_out,'r'), cat_file)
-        if rescue == 'on':
-            shutil.copyfileobj(open(skip_for,'r'), cat_file)
-    #run phix removal
-    #since most users have 32 bit usearch, check size of file, if > 3 GB, split into parts
-    log.debug("Removing phix from %s" % outname)
-    phixsize = getSize(tmp_merge)
-    phixcount = countfastq(tmp_merge)
-    log.debug('File Size: %i bytes' % phixsize)
-    if phixsize > 3e9:
-        log.debug('FASTQ > 3 GB, splitting FASTQ file into chunks to avoid potential memory problems with 32 bit usearch')
-        phixdir = os.path.join(tmpdir, 'phix_'+str(os.getpid()))
-        os.makedirs(phixdir)
-        num = round(int((phixsize / 3e9))) + 1
-        split_fastq(tmp_merge, phixcount, phixdir, int(num))
-        for file in os.listdir(phixdir):
-            if file.endswith(".fq"):
-                output = os.path.join(phixdir, file+'.phix')
-                file = os.path.join(phixdir, file)
-                cmd = [usearch, '-filter_phix', file, '-output', output]
-                runSubprocess(cmd, log)
-        with open(final_out, 'wb') as finalout:
-            for file in os.listdir(phixdir):
-                if file.endswith('.phix'):
-                    with open(os.path.join(phixdir, file), 'r') as infile:
-                        shutil.copyfileobj(infile, finalout)
-        shutil.rmtree(phixdir)
+    catlist = [merge_out]
+    if rescue == 'on':
+        catlist.append(skip_for)
+    if phix:
+        log.debug("Removing phix from %s" % outname)
+        filterPhix(catlist, final_out, phix)
     else:
-        cmd = [usearch, '-filter_phix', tmp_merge, '-output', final_out]
-        runSubprocess(cmd, log)
+        cat_fastx(catlist, final_out)
     #count output
-    origcount = countfastq(R1)
     finalcount = countfastq(final_out)
-    log.debug("Removed %i reads that were phiX" % (origcount - finalcount - len(removelist)))
+    log.debug("Removed %i reads that were phiX" % (origcount - finalcount - removed))
     pct_out = finalcount / float(origcount)
     #clean and close up intermediate files
-    os.remove(merge_out)
-    os.remove(pretrim_R1)
-    os.remove(pretrim_R2)
-    os.remove(skip_for)
-    os.remove(tmp_merge)
+    removefile(merge_out)
+    removefile(pretrim_R1)
+    removefile(pretrim_R2)
+    removefile(skip_for)
     return log.info('{0:,}'.format(finalcount) + ' reads passed ('+'{0:.1%}'.format(pct_out)+')')
 
 def validateorientation(tmp, reads, otus, output):
     orientcounts = os.path.join(tmp, 'orient.uc')
     cmd = ['vsearch', '--usearch_global', reads, '--db', otus, '--sizein', '--id', '0.97', '--strand', 'plus', '--uc', orientcounts]
-    runSubprocess(cmd, log)
+    runSubprocessCodec(cmd, log, inputs=[reads])
     OTUCounts = {}
     with open(orientcounts, 'r') as countdata:
         for line in countdata:
@@ -1715,45 +4916,45 @@ def utax2qiime(input, output):
 
 def barcodes2dict(input, mapDict, bcmismatch):
     #here expecting the index reads from illumina, create dictionary for naming?
+    #mapDict is barcode sequence: name, inexact reads are matched against the barcode
+    #neighborhoods and every distinct index sequence is only resolved once
+    index = BarcodeIndex(dict((k, k) for k in mapDict), bcmismatch, mode='NW', strip=False)
+    memo = {}
     Results = {}
     NoMatch = []
-    for title, seq, qual in FastqGeneralIterator(gzopen(input)):
-        hit = [None, None, None]
+    for title, seq, qual in FastqGeneralIterator(open_fastx(input)):
         titlesplit = title.split(' ')
         readID = titlesplit[0]
         orient = titlesplit[1]
         if orient.startswith('2:'):
             seq = RevComp(seq)
-        if seq in mapDict:
-            BC = mapDict.get(seq)
-            hit = [BC,seq, 0]
-        else:
-            for k,v in list(mapDict.items()):
-                alignment = edlib.align(k, seq, mode="NW", k=bcmismatch)
-                if alignment["editDistance"] < 0:
-                    continue
-                if hit[0]:
-                    oldhit = hit[2]
-                    if alignment["editDistance"] < oldhit:
-                        hit = [v, k, alignment["editDistance"]]
-                else:
-                    hit = [v, k, alignment["editDistance"]]
-
-            if not hit[0]: #no match, discard read
-                NoMatch.append(readID)
-                continue
+        hit = memo.get(seq)
+        if hit is None:
+            order, diffs = index.lookup(seq)
+            if order is None:
+                hit = ()
+            else:
+                BCseq = index.labels[order][1]
+                hit = (mapDict.get(BCseq), BCseq, diffs)
+            memo[seq] = hit
+        if not hit: #no match, discard read
+            NoMatch.append(readID)
+            continue
         if not readID in Results:
-            Results[readID] = (hit[0], hit[1], hit[2])
+            Results[readID] = hit
+    log.debug('Resolved {:,} distinct index sequences'.format(len(memo)))
     return Results, NoMatch
 
+#complement translation tables for RevComp, lower case input is upper cased
+rev_comp_lib = {'A':'T','C':'G','G':'C','T':'A','U':'A','M':'K','R':'Y','W':'W','S':'S','Y':'R','K':'M','V':'B','H':'D','D':'H','B':'V','X':'X','N':'N'}
+REVCOMP_TABLE = dict((ord(x), y) for x, y in rev_comp_lib.items())
+REVCOMP_TABLE.update(dict((ord(x.lower()), y) for x, y in rev_comp_lib.items()))
+REVCOMP_BYTES = bytes(bytearray(ord(REVCOMP_TABLE.get(x, chr(x))) for x in range(256)))
+
 def RevComp(s):
-    rev_comp_lib = {'A':'T','C':'G','G':'C','T':'A','U':'A','M':'K','R':'Y','W':'W','S':'S','Y':'R','K':'M','V':'B','H':'D','D':'H','B':'V','X':'X','N':'N'}
-    cseq = ''
-    n = len(s)
-    for i in range(0,n):
-        c = s[n-i-1]
-        cseq += rev_comp_lib[c.upper()]
-    return cseq
+    if isinstance(s, bytes):
+        return s.translate(REVCOMP_BYTES)[::-1]
+    return s.translate(REVCOMP_TABLE)[::-1]
 
 def mapping2dict(input):
     #parse a qiime mapping file pull out seqs and ID into dictionary
@@ -1797,6 +4998,87 @@ def runMultiProgress(function, inputList, cpus, args=False):
         time.sleep(1)
     p.close()
     p.join()
+    return [x.get() if x.successful() else None for x in results]
+
+#samples are split into parts once they are over their share of the input and this size
+SCHEDULE_MINSPLIT = int(os.environ.get('AMPTK_SCHEDULE_MINSPLIT', 268435456))
+
+class SampleScheduler(object):
+    '''
+    per-sample task list for runMultiProgress ordered by input size, largest first, so a
+    large sample does not start last and leave the other cpus idle.  Samples larger than
+    an even share of the input per cpu (and minsplit bytes) are split into parts holding
+    the same reads in each file (fastq_chunksPE), gzip input is streamed and each part
+    skips to its reads.  Tasks are (sample, part, first read, [(file, start, end), ...], size), workers
+    run them through runTask() and can take the cpus of finished tasks with threads()
+    '''
+    def __init__(self, cpus, minsplit=SCHEDULE_MINSPLIT):
+        self.cpus = cpus
+        self.minsplit = minsplit
+        self.samples = []
+        self.tasks = []
+        self.parts = {}
+        #tasks not finished yet, shared with the forked workers
+        self.remaining = multiprocessing.get_context('fork').Value('i', 0)
+
+    def add(self, name, inputs):
+        self.samples.append((name, inputs, sum(getSize(x) for x in inputs)))
+
+    def schedule(self):
+        total = sum(x[2] for x in self.samples)
+        share = max(total // self.cpus, self.minsplit)
+        self.tasks = []
+        for name, inputs, size in self.samples:
+            chunks = [(0, [(0, None)]*len(inputs))]
+            if self.cpus > 1 and size > share:
+                chunks = fastq_chunksPE(inputs, min(self.cpus, -(-size // share)))
+            if len(chunks) > 1:
+                self.parts[name] = ['{:}.part{:}'.format(name, i+1) for i in range(len(chunks))]
+                log.debug('{:}: {:} split into {:} parts'.format(name, convertSize(size), len(chunks)))
+            for i, (rec, ranges) in enumerate(chunks):
+                part = self.parts[name][i] if name in self.parts else name
+                self.tasks.append((name, part, rec, [(x,)+tuple(r) for x, r in zip(inputs, ranges)], size / len(chunks)))
+        self.tasks.sort(key=lambda x: x[4], reverse=True)
+        self.remaining.value = len(self.tasks)
+        return self.tasks
+
+    def threads(self):
+        #cpus per task still running or queued, all cpus go to the last one
+        return max(1, self.cpus // max(1, self.remaining.value))
+
+    def runTask(self, function, task, args=False):
+        start = time.time()
+        try:
+            function(task, args=args)
+        finally:
+            with self.remaining.get_lock():
+                self.remaining.value -= 1
+        return task[1], time.time() - start
+
+    def run(self, function, args=False):
+        '''
+        run function (calling runTask) on the tasks, logs expected and actual runtime of the
+        samples, expected runtimes are their share of the input at the mean speed of the run
+        '''
+        if not self.tasks:
+            self.schedule()
+        start = time.time()
+        results = runMultiProgress(function, self.tasks, self.cpus, args=args)
+        wall = time.time() - start
+        runtimes = dict(x for x in results if x)
+        if not runtimes:
+            return results
+        rate = sum(runtimes.values()) / max(1, sum(x[4] for x in self.tasks if x[1] in runtimes))
+        for name, inputs, size in self.samples:
+            parts = self.parts.get(name, [name])
+            actual = sum(runtimes.get(x, 0) for x in parts)
+            log.debug('{:}: {:} in {:} task(s), expected {:.1f}s, actual {:.1f}s'.format(name, convertSize(size), len(parts), size * rate, actual))
+        #expected wall time is the same task order on cpus workers, each taking the next task
+        workers = [0.0] * min(self.cpus, len(self.tasks))
+        for task in self.tasks:
+            heapq.heapreplace(workers, workers[0] + task[4] * rate)
+        log.debug('{:} tasks from {:} samples on {:} cpus, expected {:.1f}s, actual {:.1f}s'.format(len(self.tasks), len(self.samples), self.cpus, max(workers), wall))
+        return results
 
 
 def batch_iterator(iterator, batch_size):
@@ -1833,25 +5115,25 @@ def setupLogging(LOGNAME):
     fhnd.setFormatter(fileformat)
     log.addHandler(fhnd)
 
+#error probability for each byte of a phred+33 quality string
+QUAL_ERROR = [10**(float(-(i-33))/10) if 33 <= i <= 126 else 1.0 for i in range(256)]
+
 def FastMaxEEFilter(input, trunclen, maxee, output):
-    from Bio.SeqIO.QualityIO import FastqGeneralIterator
-    with open(output, 'w') as out:
-        with open(input, 'r') as file:
-            for title, seq, qual in FastqGeneralIterator(file):
-                trunclen = int(trunclen)
-                Seq = seq[:trunclen]
+    trunclen = int(trunclen)
+    maxee = float(maxee)
+    with FastqWriter(output) as out:
+        for batch in iter_fastq_batches(input):
+            passed = []
+            for title, seq, qual in batch:
                 Qual = qual[:trunclen]
-                ee = 0
-                for bp, Q in enumerate(Qual):
-                    q = int(ASCII.get(Q))
-                    P = 10**(float(-q)/10)
-                    ee += P
-                if ee <= float(maxee):
-                    out.write("@%s\n%s\n+\n%s\n" % (title, Seq, Qual))
+                ee = sum(map(QUAL_ERROR.__getitem__, Qual))
+                if ee <= maxee:
+                    passed.append((title, seq[:trunclen], Qual))
+            out.writebatch(passed)
 
 def MaxEEFilter(input, maxee):
     from Bio import SeqIO
-    with open(input, 'r') as f:
+    with open_fastx(input) as f:
         for rec in SeqIO.parse(f, "fastq"):
             ee = 0
             for bp, Q in enumerate(rec.letter_annotations["phred_quality"]):
@@ -1863,22 +5145,19 @@ def MaxEEFilter(input, maxee):
                 yield rec
 
 def dereplicate(input, output):
-    from Bio.SeqIO.QualityIO import FastqGeneralIterator
-    seqs = {}
-    with open(input, 'r') as file:
-        for title, sequence, qual in FastqGeneralIterator(file):
+    #sequence: [title of first read, count], output is FASTA in order of first occurrence
+    seqs = collections.OrderedDict()
+    for batch in iter_fastq_batches(input):
+        for title, sequence, qual in batch:
             if sequence not in seqs:
-                if title.endswith(';'):
-                    seqs[sequence]=title+'size=1;'
-                else:
-                    seqs[sequence]=title+';size=1;'
+                seqs[sequence] = [title, 1]
             else:
-                count = int(seqs[sequence].split('=')[-1].rstrip(';')) + 1
-                formated_string = seqs[sequence].rsplit('=', 1)[0]+'='+str(count)+';'
-                seqs[sequence] = formated_string
-    with open(output, 'w') as out:
-        for sequence in seqs:
-            out.write('>'+seqs[sequence]+'\n'+sequence+'\n')
+                seqs[sequence][1] += 1
+    with open_fastx_writer(output, mode='wb') as out:
+        for sequence, (title, count) in seqs.items():
+            if not title.endswith(b';'):
+                title += b';'
+            out.write(b'>%ssize=%i;\n%s\n' % (title, count, sequence))
 
 def convertSize(num, suffix='B'):
     for unit in ['','K','M','G','T','P','E','Z']:
@@ -1890,8 +5169,8 @@ def convertSize(num, suffix='B'):
 def faqual2fastq(fasta, qual, fastq):
     global skipCount
     from Bio.SeqIO.QualityIO import PairedFastaQualIterator
-    with open(fastq, 'w') as output:
-        records = PairedFastaQualIterator(open(fasta), open(qual))
+    with open_fastx_writer(fastq) as output:
+        records = PairedFastaQualIterator(open_fastx(fasta), open_fastx(qual))
         for rec in records:
             try:
                 SeqIO.write(rec, output, 'fastq')
@@ -1906,8 +5185,8 @@ def checkfastqsize(input):
 def fastqreindex(input, output):
     from Bio.SeqIO.QualityIO import FastqGeneralIterator
     count = 1
-    with open(output, 'w') as out:
-        with open(input, 'r') as fastq:
+    with open_fastx_writer(output) as out:
+        with open_fastx(input) as fastq:
             for title, sequence, qual in FastqGeneralIterator(fastq):
                 cols = title.split(';')
                 header = 'R_'+str(count)+';'+cols[1]+';'
@@ -1923,7 +5202,7 @@ def which(name):
             else:
                 subprocess.Popen([name, '--version'], stdout=devnull, stderr=devnull).communicate()
     except OSError as e:
-        if e.errno == os.errno.ENOENT:
+        if e.errno == errno.ENOENT:
             return False
     return True
 
@@ -1939,17 +5218,17 @@ def CheckDependencies(input):
 
 def fastarename(input, relabel, output):
     from Bio.SeqIO.FastaIO import FastaIterator
-    with open(output, 'w') as outfile:
+    with open_fastx_writer(output) as outfile:
         counter = 1
-        for record in FastaIterator(open(input)):
+        for record in FastaIterator(open_fastx(input)):
             newName = relabel+str(counter)
             outfile.write(">%s\n%s\n" % (newName, record.seq))
             counter += 1
 
 def fasta_strip_padding(file, output, stripsize=False):
     from Bio.SeqIO.FastaIO import FastaIterator
-    with open(output, 'w') as outputfile:
-        for record in FastaIterator(gzopen(file)):
+    with open_fastx_writer(output) as outputfile:
+        for record in FastaIterator(open_fastx(file)):
             Seq = record.seq.rstrip('N')
             if ';size=' in record.id:
                 record.id = record.id.split(';size=')[0]
@@ -1957,15 +5236,15 @@ def fasta_strip_padding(file, output, stripsize=False):
 
 def fastq_strip_padding(file, output):
     from Bio.SeqIO.QualityIO import FastqGeneralIterator
-    with open(output, 'w') as outputfile:
-        for title, seq, qual in FastqGeneralIterator(open(file)):
+    with open_fastx_writer(output) as outputfile:
+        for title, seq, qual in FastqGeneralIterator(open_fastx(file)):
             Seq = seq.rstrip('N')
             Qual = qual[:len(Seq)]
             assert len(Seq) == len(Qual)
             outputfile.write("@%s\n%s\n+\n%s\n" % (title, Seq, Qual))
 
 def ReverseComp(input, output):
-    with open(output, 'w') as revcomp:
+    with open_fastx_writer(output) as revcomp:
         with open(input, 'r') as fasta:
             for rec in SeqIO.parse(fasta, 'fasta'):
                 revcomp.write(">%s\n%s\n" % (rec.id, rec.seq.reverse_complement()))
@@ -2171,3 +5450,6 @@ def parseMappingFileIllumina(input):
 def removefile(input):
     if os.path.isfile(input):
         os.remove(input)
+        for sidecar in [fastx_stats_file(input), fastx_index_file(input)]:
+            if os.path.isfile(sidecar):
+                os.remove(sidecar)
@@ -8,9 +8,7 @@ import itertools
 import random
 import argparse
 import inspect
-import multiprocessing
 from natsort import natsorted
-from Bio import SeqIO
 from amptk import amptklib
 
 class MyFormatter(argparse.ArgumentDefaultsHelpFormatter):
@@ -19,17 +17,8 @@ class MyFormatter(argparse.ArgumentDefaultsHelpFormatter):
 
 def countBarcodes(file):
     global BarcodeCount
-    #now loop through data and find barcoded samples, counting each.....
-    BarcodeCount = {}
-    with open(file, 'r') as input:
-        header = itertools.islice(input, 0, None, 4)
-        for line in header:
-            ID = line.split("=")[-1].split(";")[0]
-            if ID not in BarcodeCount:
-                BarcodeCount[ID] = 1
-            else:
-                BarcodeCount[ID] += 1
-
+    #per-sample read counts, from the sample index or the sample labels
+    BarcodeCount = amptklib.fastx_sample_counts(file)
     #now let's count the barcodes found and count the number of times they are found.
     barcode_counts = "%20s:  %s" % ('Sample', 'Count')
     for k,v in natsorted(list(BarcodeCount.items()), key=lambda k_v: k_v[1], reverse=True):
@@ -37,16 +26,42 @@ def countBarcodes(file):
     print("Found %i barcoded samples\n%s" % (len(BarcodeCount), barcode_counts))
 
 def IndexSeqs(file):
+    #read IDs split up by barcodelabel, streamed so compressed input is fine
     global SeqIndex
-    SeqIndex = SeqIO.index(file, 'fastq')
+    SeqIndex = {}
+    with amptklib.open_fastx(file) as input:
+        header = itertools.islice(input, 0, None, 4)
+        for line in header:
+            rec = line[1:].rstrip().split(' ')[0]
+            ID = rec.split("=")[-1].split(";")[0]
+            if ID not in SeqIndex:
+                SeqIndex[ID] = []
+            SeqIndex[ID].append(rec)
 
 def filterSeqs(file, lst, out):
     from Bio.SeqIO.QualityIO import FastqGeneralIterator
     with open(out, 'w') as output:
-        for title, seq, qual in FastqGeneralIterator(open(file)):
-            if title in lst:
+        for title, seq, qual in FastqGeneralIterator(amptklib.open_fastx(file)):
+            if title.split(' ')[0] in lst:
                output.write("@%s\n%s\n+\n%s\n" % (title, seq, qual))
 
+def rarifySamples(file, index, num_reads, out):
+    #sample sorted input, pick reads by their position in each sample's range
+    newindex = []
+    with amptklib.FastqWriter(out) as output:
+        for sample, (start, end, count) in index.items():
+            keep = set(range(count))
+            if count > num_reads:
+                keep = set(random.sample(range(count), num_reads))
+            begin = output.tell()
+            for i, rec in enumerate(amptklib.iter_fastq(file, start=start, end=end)):
+                if i in keep:
+                    output.write(*rec)
+            newindex.append([sample, begin, output.tell(), len(keep)])
+    if amptklib.fastx_format(out) == 'bgzf':
+        amptklib.save_fastx_index(out, newindex)
+    return sum(x[3] for x in newindex)
+
 def main(args):
     parser=argparse.ArgumentParser(prog='amptk-barcode_rarify.py',
         description='''Script to sub-sample reads down to the same number for each sample (barcode)''',
@@ -57,29 +72,33 @@ def main(args):
     parser.add_argument('-o','--out', required=True, help='Output name')
     args=parser.parse_args(args)
 
-    #check if input compressed, incompress if it is
-    if args.input.endswith('.gz'):
-        SeqIn = args.input.replace('.gz', '')
-        amptklib.Funzip(args.input, SeqIn, multiprocessing.cpu_count())
-    else:
-        SeqIn = args.input
+    SeqIn = args.input
     if args.out.endswith('.gz'):
         outfile = args.out.replace('.gz', '')
     else:
         outfile = args.out
 
+    index = amptklib.fastx_index(SeqIn)
+    if index is not None:
+        #sample sorted input, no need to index the read names
+        countBarcodes(SeqIn)
+        print("----------------------------------")
+        print("Now sub-sampling reads down to a max of %s per sample" % args.num_reads)
+        total = rarifySamples(SeqIn, index, int(args.num_reads), args.out)
+        print("Finished randomly sampling reads, wrote %i sequences to %s" % (total, args.out))
+        print("----------------------------------")
+        countBarcodes(args.out)
+        print("----------------------------------")
+        print("Sub-sampling done: %s" % args.out)
+        return
+
     IndexSeqs(SeqIn)
     countBarcodes(SeqIn)
     print("----------------------------------")
     print("Now sub-sampling reads down to a max of %s per sample" % args.num_reads)
     Reads = []
     for key, value in list(BarcodeCount.items()):
-        sample = []
-        for rec in SeqIndex:
-            ID = rec.split("=")[-1].split(";")[0]
-            if key == ID:
-                sample.append(rec)
-        Reads.append(sample)
+        Reads.append(SeqIndex.get(key, []))
     print("Finished indexing reads, split up by barcodelabel")
     Subsample = []
     for line in Reads:
@@ -99,8 +118,6 @@ def main(args):
     #compress and clean
     if args.out.endswith('.gz'): #compress in place
         amptklib.Fzip_inplace(outfile)
-    if args.input.endswith('.gz'):
-        amptklib.removefile(SeqIn)
     print("----------------------------------")
     print("Sub-sampling done: %s" % args.out)
 
@@ -36,20 +36,27 @@ def folder2list(input, ending):
     return names
 
 def splitDemux2(input, outputdir, args=False):
-    for title, seq, qual in FastqGeneralIterator(open(input)):
-        sample = title.split('barcodelabel=')[1].split(';')[0]
-        sample = sample.replace(';', '')
-        if not args.length:
-            with open(os.path.join(outputdir, sample+'.fastq'), 'a') as output:
-                output.write("@%s\n%s\n+\n%s\n" % (title, seq, qual))
-        else:
-            if len(seq) >= int(args.length):
-                with open(os.path.join(outputdir, sample+'.fastq'), 'a') as output:
-                    output.write("@%s\n%s\n+\n%s\n" % (title, seq[:int(args.length):], qual[:int(args.length)]))
+    #per-sample writers, at most amptklib.MAX_OPEN_WRITERS open at once
+    outfiles = amptklib.WriterCache(amptklib.open_fastx_writer)
+    outnames = {}
+    try:
+        for title, seq, qual in FastqGeneralIterator(amptklib.open_fastx(input)):
+            sample = title.split('barcodelabel=')[1].split(';')[0]
+            sample = sample.replace(';', '')
+            if args.length:
+                if len(seq) < int(args.length):
+                    continue
+                seq = seq[:int(args.length)]
+                qual = qual[:int(args.length)]
+            if not sample in outnames:
+                outnames[sample] = os.path.join(outputdir, sample+'.fastq')
+            outfiles.get(outnames[sample]).write("@%s\n%s\n+\n%s\n" % (title, seq, qual))
+    finally:
+        outfiles.close()
 
 def getAvgLength(input):
     AvgLength = []
-    for title, seq, qual in FastqGeneralIterator(open(input)):
+    for title, seq, qual in FastqGeneralIterator(amptklib.open_fastx(input)):
         AvgLength.append(len(seq))
     Average = sum(AvgLength) / float(len(AvgLength))
     Min = min(AvgLength)
@@ -76,6 +83,7 @@ def main(args):
     parser.add_argument('--pool', action='store_true', help='Pool all sequences together for DADA2')
     parser.add_argument('--pseudopool', action='store_true', help='Use DADA2 pseudopooling')
     parser.add_argument('--debug', action='store_true', help='Keep all intermediate files')
+    parser.add_argument('--tmp_codec', default=amptklib.TMP_CODEC, choices=list(amptklib.CODEC_EXT), help='Compress intermediate files')
     parser.add_argument('-u','--usearch', dest="usearch", default='usearch9', help='USEARCH9 EXE')
     parser.add_argument('--cpus', type=int, help="Number of CPUs. Default: auto")
     args=parser.parse_args(args)
@@ -129,28 +137,27 @@ def main(args):
     amptklib.log.info("R v%s; DADA2 v%s" % (Rversions[0], Rversions[1]))
 
     #Count FASTQ records and remove 3' N's as dada2 can't handle them
+    #large intermediate files are compressed with --tmp_codec
+    amptklib.set_tmp_codec(args.tmp_codec)
     amptklib.log.info("Loading FASTQ Records")
-    no_ns = base+'.cleaned_input.fq'
-    if args.fastq.endswith('.gz'):
-        fastqInput = args.fastq.replace('.gz', '')
-        amptklib.Funzip(os.path.abspath(args.fastq), os.path.basename(fastqInput), CORES)
-    else:
-        fastqInput = os.path.abspath(args.fastq)
-    amptklib.fastq_strip_padding(os.path.basename(fastqInput), no_ns)
-    demuxtmp = base+'.original.fa'
-    cmd = ['vsearch', '--fastq_filter', os.path.abspath(no_ns),'--fastq_qmax', '55', '--fastaout', demuxtmp, '--threads', CORES]
-    amptklib.runSubprocess(cmd, amptklib.log)
-    orig_total = amptklib.countfasta(demuxtmp)
-    size = amptklib.checkfastqsize(no_ns)
+    no_ns = amptklib.tmpname(base+'.cleaned_input.fq')
+    stages = [(amptklib.fastq_strip_padding, [os.path.abspath(args.fastq)], [no_ns])]
+    demuxtmp = amptklib.tmpname(base+'.original.fa')
+    cmd = ['vsearch', '--fastq_filter', no_ns,'--fastq_qmax', '55', '--fastaout', demuxtmp, '--threads', CORES]
+    stages.append((cmd, [no_ns], [demuxtmp]))
+
+    #quality filter, runs at the same time with the cleaned reads passed through
+    #named pipes, these are only written to disk with --debug
+    derep = amptklib.tmpname(base+'.qual-filtered.fq')
+    filtercmd = ['vsearch', '--fastq_filter', no_ns, '--fastq_maxee', str(args.maxee), '--fastqout', derep, '--fastq_qmax', '55', '--fastq_maxns', '0', '--threads', CORES]
+    stages.append((filtercmd, [no_ns], [derep]))
+    totals = amptklib.runPipeline(stages, amptklib.log, keep=args.debug or [], counts=[demuxtmp, derep])
+    orig_total = totals[demuxtmp]
+    size = amptklib.checkfastqsize(args.fastq)
     readablesize = amptklib.convertSize(size)
     amptklib.log.info('{0:,}'.format(orig_total) + ' reads (' + readablesize + ')')
-
-    #quality filter
     amptklib.log.info("Quality Filtering, expected errors < %s" % args.maxee)
-    derep = base+'.qual-filtered.fq'
-    filtercmd = ['vsearch', '--fastq_filter', no_ns, '--fastq_maxee', str(args.maxee), '--fastqout', derep, '--fastq_qmax', '55', '--fastq_maxns', '0', '--threads', CORES]
-    amptklib.runSubprocess(filtercmd, amptklib.log)
-    total = amptklib.countfastq(derep)
+    total = totals[derep]
     amptklib.log.info('{0:,}'.format(total) + ' reads passed')
 
     #split into individual files
@@ -170,7 +177,7 @@ def main(args):
     if len(remove) > 0:
         amptklib.log.info("Dropping %s as fewer than %i reads" % (', '.join(remove), args.min_reads))
         for y in remove:
-            os.remove(os.path.join(filtfolder, y))
+            amptklib.removefile(os.path.join(filtfolder, y))
 
     #now run DADA2 on filtered folder
     #check pooling pseudopooling or notpooled, default is not pooled.
@@ -269,10 +276,10 @@ def main(args):
                 amptklib.removefile(fastaout)
 
     #setup output files
-    dadademux = base+'.dada2.map.uc'
+    dadademux = amptklib.tmpname(base+'.dada2.map.uc')
     bioSeqs = base+'.cluster.otus.fa'
     bioTable = base+'.cluster.otu_table.txt'
-    uctmp = base+'.map.uc'
+    uctmp = amptklib.tmpname(base+'.map.uc')
     ClusterComp = base+'.ASVs2clusters.txt'
 
     #Filter out ASVs in wrong orientation
@@ -285,7 +292,7 @@ def main(args):
     #map reads to DADA2 OTUs
     amptklib.log.info("Mapping reads to DADA2 ASVs")
     cmd = ['vsearch', '--usearch_global', demuxtmp, '--db', iSeqs, '--id', '0.97', '--uc', dadademux, '--strand', 'plus', '--otutabout', chimeraFreeTable, '--threads', CORES]
-    amptklib.runSubprocess(cmd, amptklib.log)
+    amptklib.runSubprocessCodec(cmd, amptklib.log, inputs=[demuxtmp], outputs=[dadademux])
     total = amptklib.line_count2(dadademux)
     amptklib.log.info('{0:,}'.format(total) + ' reads mapped to ASVs '+ '({0:.0f}%)'.format(total/float(orig_total)* 100))
 
@@ -319,7 +326,7 @@ def main(args):
     #create OTU table
     amptklib.log.info("Mapping reads to OTUs")
     cmd = ['vsearch', '--usearch_global', demuxtmp, '--db', bioSeqs, '--id', '0.97', '--uc', uctmp, '--strand', 'plus', '--otutabout', bioTable, '--threads', CORES]
-    amptklib.runSubprocess(cmd, amptklib.log)
+    amptklib.runSubprocessCodec(cmd, amptklib.log, inputs=[demuxtmp], outputs=[uctmp])
     total = amptklib.line_count2(uctmp)
     amptklib.log.info('{0:,}'.format(total) + ' reads mapped to OTUs '+ '({0:.0f}%)'.format(total/float(orig_total)* 100))
 
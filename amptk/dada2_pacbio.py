@@ -35,36 +35,53 @@ def folder2list(input, ending):
     return names
 
 def splitDemux2(input, outputdir, args=False):
-    for title, seq, qual in pyfastx.Fastq(input, build_index=False):
-        sample = title.split('barcodelabel=')[1].split(';')[0]
-        sample = sample.replace(';', '')
-        with open(os.path.join(outputdir, sample+'.fastq'), 'a') as output:
-            output.write("@%s\n%s\n+\n%s\n" % (title, seq, qual))
+    #per-sample writers, at most amptklib.MAX_OPEN_WRITERS open at once
+    outfiles = amptklib.WriterCache(amptklib.open_fastx_writer)
+    outnames = {}
+    try:
+        for title, seq, qual in pyfastx.Fastq(input, build_index=False):
+            sample = title.split('barcodelabel=')[1].split(';')[0]
+            sample = sample.replace(';', '')
+            if not sample in outnames:
+                outnames[sample] = os.path.join(outputdir, sample+'.fastq')
+            outfiles.get(outnames[sample]).write("@%s\n%s\n+\n%s\n" % (title, seq, qual))
+    finally:
+        outfiles.close()
 
 
 def pb_qualityfilter(input, output, min_rq=0.98, min_bq=80):
+    #input is a file or (file, start, end) range of a sample sorted file
     total = 0
     passed = 0
-    with open(output, 'w') as outfile:
-        for header, seq, qual in pyfastx.Fastq(input, build_index=False):
+    with amptklib.FastqWriter(output) as outfile:
+        for header, seq, qual in amptklib.iter_fastq(input):
             total += 1
             rq, bq = (None,)*2
-            if ';' in header:
-                tags = header.split(';')
+            if b';' in header:
+                tags = header.split(b';')
                 for x in tags:
-                    if x.startswith('rq='):
-                        rq = float(x.replace('rq=', ''))
-                    elif x.startswith('bq='):
-                        bq = int(x.replace('bq=', ''))
+                    if x.startswith(b'rq='):
+                        rq = float(x[3:])
+                    elif x.startswith(b'bq='):
+                        bq = int(x[3:])
                 if any(elem is None for elem in [rq, bq]):
                     continue
                 if rq >= min_rq and bq >= min_bq:
                     passed += 1
-                    outfile.write('@{:}\n{:}\n+\n{:}\n'.format(header,
-                                                                seq, qual))
+                    outfile.write(header, seq, qual)
     return total, passed
 
 
+def pb_filtersample(input, args=False):
+    #quality filter one sample of an indexed demux file into its own file
+    sample, start, end, output = input
+    total, passed = pb_qualityfilter((args.fastq, start, end), output,
+                                     min_rq=float(args.read_qual),
+                                     min_bq=args.barcode_qual)
+    if not passed:
+        amptklib.removefile(output)
+
+
 def main(args):
     parser=argparse.ArgumentParser(prog='amptk-dada2.py',
         description='''Script takes output from amptk pre-processing and runs pacbio DADA2''',
@@ -136,11 +153,24 @@ def main(args):
     amptklib.log.info("R v%s; DADA2 v%s" % (Rversions[0], Rversions[1]))
 
     #filter FASTQ data
-    amptklib.log.info("Loading FASTQ Records and quality filtering")
     derep = base+'.qual-filtered.fq'
-    totalReads, passedReads = pb_qualityfilter(args.fastq, derep,
-                                               min_rq=float(args.read_qual),
-                                               min_bq=args.barcode_qual)
+    filtfolder = base+'_filtered'
+    if os.path.isdir(filtfolder):
+        shutil.rmtree(filtfolder)
+    os.makedirs(filtfolder)
+    index = amptklib.fastx_index(args.fastq)
+    if index is not None:
+        #sample sorted input, filter each sample straight into its own file
+        amptklib.log.info("Loading FASTQ Records and quality filtering {:,} indexed samples".format(len(index)))
+        samples = [(k, v[0], v[1], os.path.join(filtfolder, k+'.fastq')) for k, v in index.items()]
+        amptklib.runMultiProgress(pb_filtersample, samples, int(CORES), args=args)
+        totalReads = sum(v[2] for v in index.values())
+        passedReads = sum(amptklib.countfastq(x[3]) for x in samples if os.path.isfile(x[3]))
+    else:
+        amptklib.log.info("Loading FASTQ Records and quality filtering")
+        totalReads, passedReads = pb_qualityfilter(args.fastq, derep,
+                                                   min_rq=float(args.read_qual),
+                                                   min_bq=args.barcode_qual)
     amptklib.log.info('{:,} total reads'.format(totalReads))
     pctPass = passedReads / totalReads
     amptklib.log.info(
@@ -148,12 +178,9 @@ def main(args):
             passedReads, pctPass, args.read_qual, args.barcode_qual))
 
     #split into individual files
-    amptklib.log.info("Splitting FASTQ file by Sample/Barcodes into individual files for DADA2")
-    filtfolder = base+'_filtered'
-    if os.path.isdir(filtfolder):
-        shutil.rmtree(filtfolder)
-    os.makedirs(filtfolder)
-    splitDemux2(derep, filtfolder, args=args)
+    if index is None:
+        amptklib.log.info("Splitting FASTQ file by Sample/Barcodes into individual files for DADA2")
+        splitDemux2(derep, filtfolder, args=args)
 
     #check for minimum number of reads in each sample
     remove = []
@@ -164,7 +191,7 @@ def main(args):
     if len(remove) > 0:
         amptklib.log.info("Dropping %s as fewer than %i reads" % (', '.join(remove), args.min_reads))
         for y in remove:
-            os.remove(os.path.join(filtfolder, y))
+            amptklib.removefile(os.path.join(filtfolder, y))
 
     #now run DADA2 on filtered folder
     #check pooling pseudopooling or notpooled, default is not pooled.
@@ -295,7 +295,7 @@ def stripPrimer(input, args=False):
     ErrorOut = os.path.join(folder, base+'.errors.fa')
     with open(StripOut, 'w') as outputfile:
         with open(ErrorOut, 'w') as errorfile:
-            for title, seq in pyfastx.Fasta(input, build_index=False, full_name=True):
+            for title, seq in lib.readahead_records(pyfastx.Fasta(input, build_index=False, full_name=True)):
                 orig_id = title
                 if len(seq) < args.min_len:
                     errorfile.write('>ERROR:LENGTH={}|{}\n{}\n'.format(len(seq), orig_id, seq))
@@ -7,9 +7,7 @@ import os
 import argparse
 import csv
 import shutil
-import edlib
-import multiprocessing
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
+from Bio import SeqIO
 from amptk import amptklib
 
 class MyFormatter(argparse.ArgumentDefaultsHelpFormatter):
@@ -79,7 +77,7 @@ def main(args):
             amptklib.log.error('For this method: --reads-forward, --reads-reverse, --reads-index, and --mapping_file is required')
             sys.exit(1)
     else:
-        if not args.input:
+        if not args.FASTQ:
             amptklib.log.error('For {} -i, --input is required'.format(args.platform))
             sys.exit(1)
 
@@ -129,19 +127,9 @@ def main(args):
     #parse primers here so doesn't conflict with mapping primers
     #look up primer db otherwise default to entry
     if FwdPrimer == '':
-        if args.F_primer in amptklib.primer_db:
-            FwdPrimer = amptklib.primer_db.get(args.F_primer)
-            amptklib.log.info("{:} fwd primer found in AMPtk primer db, setting to: {:}".format(args.F_primer, FwdPrimer))
-        else:
-            FwdPrimer = args.F_primer
-            amptklib.log.info("{:} fwd primer not found in AMPtk primer db, assuming it is actual primer sequence.".format(args.F_primer))
+        FwdPrimer = amptklib.lookupPrimer(args.F_primer, 'fwd')
     if RevPrimer == '':
-        if args.R_primer in amptklib.primer_db:
-            RevPrimer = amptklib.primer_db.get(args.R_primer)
-            amptklib.log.info("{:} rev primer found in AMPtk primer db, setting to: {:}".format(args.R_primer, RevPrimer))
-        else:
-            RevPrimer = args.R_primer
-            amptklib.log.info("{:} rev primer not found in AMPtk primer db, assuming it is actual primer sequence.".format(args.R_primer))
+        RevPrimer = amptklib.lookupPrimer(args.R_primer, 'rev')
 
 
     #then setup barcode dictionary
@@ -198,15 +186,13 @@ def main(args):
 
         # demux the data
         amptklib.log.info('Demulitiplexing reads by barcodes')
+        IndexMap = amptklib.IndexResolver(Barcodes, args.barcode_mismatch)
+        IndexMap.index.report('indexes')
         Total, BCFound = amptklib.DemuxIllumina4SRA(
-            args.reads_forward, args.reads_reverse, args.reads_index, Barcodes,
+            args.reads_forward, args.reads_reverse, args.reads_index, IndexMap,
             args.barcode_mismatch, base)
         amptklib.log.info('Found {:,} PE reads out of {:,} total reads'.format(BCFound, Total))
-        amptklib.log.info("Now Gzipping files")
-        for file in os.listdir(base):
-            if file.endswith(".fastq"):
-                file_path = os.path.join(base, file)
-                amptklib.Fzip_inplace(file_path)
+        amptklib.log.info('Mapped {:}'.format(IndexMap.summary()))
 
         #after all files demuxed into output folder, loop through and create SRA metadata file
         filelist = []
@@ -215,9 +201,6 @@ def main(args):
                 filelist.append(file)
 
     else:
-        #start here to process the reads, first reverse complement the reverse primer
-        ReverseCompRev = amptklib.RevComp(RevPrimer)
-
         #if --names given, load into dictonary
         if args.names:
             amptklib.log.info("Parsing names for output files via %s" % args.names)
@@ -229,17 +212,9 @@ def main(args):
                     if not cols[0] in namesDict:
                         namesDict[cols[0]] = cols[1]
 
-        #check for compressed input file
-        if args.FASTQ.endswith('.gz'):
-            amptklib.log.info("Gzipped input files detected, uncompressing")
-            FASTQ_IN = args.FASTQ.replace('.gz', '')
-            amptklib.Funzip(args.FASTQ, FASTQ_IN, multiprocessing.cpu_count())
-        else:
-            FASTQ_IN = args.FASTQ
-
-        #count FASTQ records in input
+        #count FASTQ records in input, compressed input is streamed
         amptklib.log.info("Loading FASTQ Records")
-        total = amptklib.countfastq(FASTQ_IN)
+        total = amptklib.countfastq(args.FASTQ)
         size = amptklib.checkfastqsize(args.FASTQ)
         readablesize = amptklib.convertSize(size)
         amptklib.log.info('{0:,}'.format(total) + ' reads (' + readablesize + ')')
@@ -252,35 +227,18 @@ def main(args):
         elif args.require_primer == 'both':
             amptklib.log.info("Looking for %i barcodes that must have FwdPrimer: %s and RevPrimer: %s" % (len(Barcodes), FwdPrimer, RevPrimer))
 
-        #this will loop through FASTQ file once, splitting those where barcodes are found, and primers trimmed
-        runningTotal = 0
-        with open(FASTQ_IN, 'r') as input:
-            for title, seq, qual in FastqGeneralIterator(input):
-                Barcode, BarcodeLabel = amptklib.AlignBarcode(seq, Barcodes, args.barcode_mismatch)
-                if Barcode == "":
-                    continue
-                #trim barcode from sequence
-                BarcodeLength = len(Barcode)
-                seq = seq[BarcodeLength:]
-                qual = qual[BarcodeLength:]
-                #look for forward primer
-                if args.require_primer != 'off': #means we only want ones with forward primer and or reverse, but don't remove them
-                    #now search for forward primer
-                    foralign = edlib.align(FwdPrimer, seq, mode="HW", k=args.primer_mismatch, additionalEqualities=amptklib.degenNuc)
-                    if foralign["editDistance"] < 0:
-                        continue
-                    if args.require_primer == 'both':
-                        #now search for reverse primer
-                        revalign = edlib.align(ReverseCompRev, seq, mode="HW", task="locations", k=args.primer_mismatch, additionalEqualities=amptklib.degenNuc)
-                        if revalign["editDistance"] < 0:  #reverse primer was not found
-                            continue
-                #check size
-                if len(seq) < args.min_len: #filter out sequences less than minimum length.
-                    continue
-                runningTotal += 1
-                fileout = os.path.join(base, BarcodeLabel+'.fastq')
-                with open(fileout, 'a') as output:
-                    output.write("@%s\n%s\n+\n%s\n" % (title, seq, qual))
+        #hash barcode neighborhoods once instead of aligning every barcode to every read
+        BarcodeIdx = amptklib.BarcodeIndex(Barcodes, args.barcode_mismatch)
+        BarcodeIdx.report('barcodes')
+        Primers = amptklib.PrimerSet(FwdPrimer, RevPrimer, args.primer_mismatch)
+
+        #this will loop through FASTQ file once, splitting those where barcodes are found
+        #primers are required but not removed, per-sample files are compressed as they are written
+        Demux = amptklib.DemuxEngine([amptklib.BarcodeResolver(BarcodeIdx),
+                                      amptklib.PrimerTrimmer(Primers, require=args.require_primer, reverse=args.require_primer == 'both', trim=False),
+                                      amptklib.LengthPolicy(args.min_len)])
+        stats = Demux.run([(args.FASTQ, 0, None)], amptklib.SampleWriter(base), name=args.FASTQ)
+        runningTotal = stats['valid']
 
         if args.require_primer == 'off':
             amptklib.log.info('{0:,}'.format(runningTotal) + ' total reads with valid barcode')
@@ -289,12 +247,6 @@ def main(args):
         elif args.require_primer == 'both':
             amptklib.log.info('{0:,}'.format(runningTotal) + ' total reads with valid barcode and both primers')
 
-        amptklib.log.info("Now Gzipping files")
-        for file in os.listdir(base):
-            if file.endswith(".fastq"):
-                file_path = os.path.join(base, file)
-                amptklib.Fzip_inplace(file_path)
-
         #after all files demuxed into output folder, loop through and create SRA metadata file
         filelist = []
         for file in os.listdir(base):
@@ -302,9 +254,6 @@ def main(args):
                 filelist.append(file)
 
     amptklib.log.info("Finished: output in %s" % base)
-    #clean up if gzipped
-    if args.FASTQ and args.FASTQ.endswith('.gz'):
-        amptklib.removefile(FASTQ_IN)
 
     #check for BioSample meta file
     if args.biosample:
@@ -4,7 +4,6 @@ from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 import sys
 import os
-import itertools
 import multiprocessing
 import glob
 import shutil
@@ -56,17 +55,8 @@ def worker(file):
 
 def countBarcodes(file):
     global BarcodeCount
-    #now loop through data and find barcoded samples, counting each.....
-    BarcodeCount = {}
-    with open(file, 'r') as input:
-        header = itertools.islice(input, 0, None, 4)
-        for line in header:
-            ID = line.split("=",1)[-1].split(";")[0]
-            if ID not in BarcodeCount:
-                BarcodeCount[ID] = 1
-            else:
-                BarcodeCount[ID] += 1
-
+    #per-sample read counts, from the sample index or the sample labels
+    BarcodeCount = amptklib.fastx_sample_counts(file)
 
     #now let's count the barcodes found and count the number of times they are found.
     barcode_counts = "%10s:  %s" % ('Sample', 'Count')
@@ -75,15 +65,8 @@ def countBarcodes(file):
     print("Found %i barcoded samples\n%s" % (len(BarcodeCount), barcode_counts))
 
 def getSeqLength(file):
-    seqlength = {}
-    with open(file, 'r') as input:
-        header = itertools.islice(input, 1, None, 4)
-        for line in header:
-            length = len(line) - 1
-            if not length in seqlength:
-                seqlength[length] = 1
-            else:
-                seqlength[length] += 1
+    #length histogram, counted with the sample labels
+    seqlength = amptklib.fastx_stats(file)['lengths']
     lengthlist = []
     countlist = []
     for k,v in natsorted(list(seqlength.items())):
@@ -98,7 +81,7 @@ def getSeqLength(file):
 
 
 def filterSeqs(file, lst):
-    with amptklib.gzopen(file, 'r') as input:
+    with amptklib.open_fastx(file) as input:
         SeqRecords = SeqIO.parse(input, 'fastq')
         for rec in SeqRecords:
             bc = rec.id.split("=")[-1].split(";")[0]
@@ -124,22 +107,18 @@ def main(args):
     #main start here
     cpus = multiprocessing.cpu_count()
     print("----------------------------------")
-    tmpinput = 'amptk_show.tmp'
-    if args.input.endswith('.gz'):
-        amptklib.Funzip(args.input, tmpinput, cpus)
-    else:
-        tmpinput = args.input
-    countBarcodes(tmpinput)
+    countBarcodes(args.input)
     print("----------------------------------")
-    getSeqLength(tmpinput)
+    getSeqLength(args.input)
     print("----------------------------------")
     if args.quality_trim:
         #split the input FASTQ file into chunks to process
         #split fastq file
-        SeqCount = amptklib.countfastq(tmpinput)
+        SeqCount = amptklib.countfastq(args.input)
         pid = os.getpid()
         folder = 'amptk_tmp_' + str(pid)
-        amptklib.split_fastq(tmpinput, SeqCount, folder, cpus*2)
+        os.makedirs(folder)
+        amptklib.split_fastq(args.input, SeqCount, folder, cpus*2)
         #now get file list from tmp folder
         file_list = []
         for file in os.listdir(folder):
@@ -170,9 +149,6 @@ def main(args):
         print("----------------------------------")
         print("Script finished, output in %s" % args.out)
 
-    if args.input.endswith('.gz'):
-        amptklib.removefile(tmpinput)
-
 
 if __name__ == "__main__":
     main(args)
@@ -13,20 +13,8 @@ class MyFormatter(argparse.ArgumentDefaultsHelpFormatter):
 
 
 def countBarcodes(file):
-    # now loop through data and find barcoded samples, counting each.....
-    BarcodeCount = {}
-    for title, seq, qual in pyfastx.Fastq(file, build_index=False):
-        if 'label=' in title:
-            ID = title.split("label=", 1)[-1].split(";")[0]
-        elif 'sample=' in title:
-            ID = title.split("sample=", 1)[-1].split(";")[0]
-        else:
-            ID = title.split("=", 1)[-1].split(";")[0]
-        if ID not in BarcodeCount:
-            BarcodeCount[ID] = 1
-        else:
-            BarcodeCount[ID] += 1
-    return BarcodeCount
+    # per-sample read counts, from the sample index or the sample labels
+    return amptklib.fastx_sample_counts(file)
 
 
 def filter_sample(file, keep_list, output, format='fastq'):
@@ -94,17 +82,23 @@ def main(args):
     keep_list = set(keepers)
     print("Keeping %i samples" % len(keep_list))
 
-    # rename to base
-    if args.out.endswith('.gz'):
-        outfile = args.out.replace('.gz', '')
+    index = amptklib.fastx_index(args.input)
+    if index is not None and args.format == 'fastq':
+        # sample sorted input, copy the ranges of the samples to keep
+        keep_count = amptklib.write_fastx_samples(args.input, keep_list, args.out)
+        total_count = sum(x[2] for x in index.values())
     else:
-        outfile = args.out
-    # run filtering
-    keep_count, total_count = filter_sample(args.input, keep_list, outfile,
-                                            format=args.format)
-    # compress and clean
-    if args.out.endswith('.gz'):  # compress in place
-        amptklib.Fzip_inplace(outfile)
+        # rename to base
+        if args.out.endswith('.gz'):
+            outfile = args.out.replace('.gz', '')
+        else:
+            outfile = args.out
+        # run filtering
+        keep_count, total_count = filter_sample(args.input, keep_list, outfile,
+                                                format=args.format)
+        # compress and clean
+        if args.out.endswith('.gz'):  # compress in place
+            amptklib.Fzip_inplace(outfile)
 
     print("Kept %i reads out of %i total reads" % (keep_count, total_count))
 
@@ -7,11 +7,7 @@ import os
 import argparse
 import shutil
 import multiprocessing
-import glob
-import itertools
 import re
-import edlib
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
 from natsort import natsorted
 from amptk import amptklib
 
@@ -24,9 +20,9 @@ class col(object):
     WARN = '\033[93m'
 
 def processReadsPE(input, args=False):
-    base = os.path.basename(input)
-    forward_reads = os.path.join(tmpdir, base+'_R1.fq')
-    reverse_reads = os.path.join(tmpdir, base+'_R2.fq')
+    #input is (chunk name, global index of first read, [R1 (file, start, end), R2 (file, start, end)])
+    base, offset, ranges = input
+    forward_reads, reverse_reads = ranges
     orientR1 = os.path.join(tmpdir, base+'_R1.oriented.fq')
     orientR2 = os.path.join(tmpdir, base+'_R2.oriented.fq')
     trim_forward = os.path.join(tmpdir, base+'_R1.trimmed.fq')
@@ -37,110 +33,34 @@ def processReadsPE(input, args=False):
     RL = amptklib.GuessRL(forward_reads)
     Total, Correct, Flip, Drop = amptklib.illuminaReorient(forward_reads, reverse_reads, FwdPrimer, RevPrimer, args.primer_mismatch, RL, orientR1, orientR2)
     amptklib.log.debug('Re-oriented PE reads for {:}: {:,} total, {:,} correct, {:,} flipped, {:,} dropped.'.format(base, Total, Correct, Flip, Drop))
+    #with --full_length the merged reads are the output, so they are not tagged for losslessTrim
     if args.barcode_not_anchored:
-        amptklib.demuxIlluminaPE2(orientR1, orientR2, FwdPrimer, RevPrimer, SampleData, Barcodes, RevBarcodes, args.barcode_mismatch, args.primer_mismatch, trim_forward, trim_reverse, StatsOut)
+        amptklib.demuxIlluminaPE2(orientR1, orientR2, FwdPrimer, RevPrimer, SampleData, BarcodeIdx, RevBarcodeIdx, args.barcode_mismatch, args.primer_mismatch, trim_forward, trim_reverse, StatsOut, offset=offset, primers=Primers, dual=DualIdx, tag=not args.full_length)
     else:
-        amptklib.demuxIlluminaPE(orientR1, orientR2, FwdPrimer, RevPrimer, SampleData, Barcodes, RevBarcodes, args.barcode_mismatch, args.primer_mismatch, trim_forward, trim_reverse, StatsOut)
+        amptklib.demuxIlluminaPE(orientR1, orientR2, FwdPrimer, RevPrimer, SampleData, BarcodeIdx, RevBarcodeIdx, args.barcode_mismatch, args.primer_mismatch, trim_forward, trim_reverse, StatsOut, offset=offset, primers=Primers, dual=DualIdx, tag=not args.full_length)
+    stats = amptklib.DemuxStats.load([StatsOut], amptklib.PE_STATS)
     if args.full_length:
-        amptklib.MergeReadsSimple(trim_forward, trim_reverse, '.', DemuxOut, args.min_len, usearch, 'off', args.merge_method)
+        PhixCount, MergeCount = amptklib.MergeReadsSimple(trim_forward, trim_reverse, '.', DemuxOut, args.min_len, usearch, 'off', args.merge_method, phix=Phix)
     else:
-        amptklib.MergeReadsSimple(trim_forward, trim_reverse, '.', merged_reads, args.min_len, usearch, 'on', args.merge_method)
-        amptklib.losslessTrim(merged_reads, FwdPrimer, RevPrimer, args.primer_mismatch, args.trim_len, args.pad, args.min_len, DemuxOut)
+        PhixCount, MergeCount = amptklib.MergeReadsSimple(trim_forward, trim_reverse, '.', merged_reads, args.min_len, usearch, 'on', args.merge_method, phix=Phix)
+        TrimCount, SkipSearch = amptklib.losslessTrim(merged_reads, FwdPrimer, RevPrimer, args.primer_mismatch, args.trim_len, args.pad, args.min_len, DemuxOut)
+        #add the primer search counts to the demux stats
+        stats.update(merged=TrimCount, skipped=SkipSearch)
+    stats.update(phix=PhixCount-MergeCount)
+    stats.dump(StatsOut, amptklib.PE_STATS)
     amptklib.SafeRemove(orientR1)
     amptklib.SafeRemove(orientR2)
-    amptklib.SafeRemove(forward_reads)
-    amptklib.SafeRemove(reverse_reads)
     amptklib.SafeRemove(merged_reads)
 
 def processRead(input, args=False):
-    base = os.path.basename(input).split('.')[0]
-    PL = len(FwdPrimer)
-    RL = len(RevPrimer)
+    #input is (chunk name, global index of first read, [(file, start, end)]) byte range of args.fastq
+    base, offset, ranges = input
     DemuxOut = os.path.join(tmpdir, base+'.demux.fq')
-    StatsOut = os.path.join(tmpdir, base+'.stats')
-    Total = 0
-    NoBarcode = 0
-    NoRevBarcode = 0
-    NoPrimer = 0
-    TooShort = 0
-    RevPrimerFound = 0
-    ValidSeqs = 0
-    RCrevPrimer = amptklib.RevComp(RevPrimer)
-    with open(StatsOut, 'w') as counts:
-        with open(DemuxOut, 'w') as out:
-            for title, seq, qual in FastqGeneralIterator(open(input)):
-                Total += 1
-                #look for barcode, trim it off
-                Barcode, BarcodeLabel = amptklib.AlignBarcode(seq, Barcodes, args.barcode_mismatch)
-                if Barcode == "":
-                    NoBarcode += 1
-                    continue
-                BarcodeLength = len(Barcode)
-                Seq = seq[BarcodeLength:]
-                Qual = qual[BarcodeLength:]
-                #now search for forward primer
-                foralign = edlib.align(FwdPrimer, Seq, mode="HW", k=args.primer_mismatch, additionalEqualities=amptklib.degenNuc)
-                if foralign["editDistance"] < 0:
-                    NoPrimer += 1
-                    continue
-                ForTrim = foralign["locations"][0][1]+1
-                #now search for reverse primer
-                revalign = edlib.align(RCrevPrimer, Seq, mode="HW", task="locations", k=args.primer_mismatch, additionalEqualities=amptklib.degenNuc)
-                if revalign["editDistance"] >= 0:  #reverse primer was found
-                    RevPrimerFound += 1
-                    #location to trim sequences
-                    RevTrim = revalign["locations"][0][0]
-                    #determine reverse barcode
-                    if args.reverse_barcode:
-                        RevBCdiffs = 0
-                        BCcut = revalign["locations"][0][1]
-                        CutSeq = Seq[BCcut:]
-                        RevBarcode, RevBarcodeLabel = amptklib.AlignRevBarcode(CutSeq, RevBarcodes, args.barcode_mismatch)
-                        if RevBarcode == "":
-                            NoRevBarcode += 1
-                            continue
-                        BarcodeLabel = BarcodeLabel+':-:'+RevBarcodeLabel
-                    #now trim record remove forward and reverse reads
-                    Seq = Seq[ForTrim:RevTrim]
-                    Qual = Qual[ForTrim:RevTrim]
-                    #since found reverse primer, now also need to pad/trim
-                    if not args.full_length:
-                        #check minimum length here or primer dimer type sequences will get padded with Ns
-                        if len(Seq) < int(args.min_len):
-                            TooShort += 1
-                            continue
-                        if len(Seq) < args.trim_len and args.pad == 'on':
-                            pad = args.trim_len - len(Seq)
-                            Seq = Seq + pad*'N'
-                            Qual = Qual +pad*'I'
-                        else: #len(Seq) > args.trim_len:
-                            Seq = Seq[:args.trim_len]
-                            Qual = Qual[:args.trim_len]
-                else:
-                    #trim record, did not find reverse primer
-                    if args.full_length: #if full length then move to next record
-                        continue
-                    #trim away forward primer
-                    Seq = Seq[ForTrim:]
-                    Qual = Qual[ForTrim:]
-                    #check length and trim, throw away if too short as it was bad read
-                    if len(Seq) < args.trim_len:
-                        TooShort += 1
-                        continue
-                    Seq = Seq[:args.trim_len]
-                    Qual = Qual[:args.trim_len]
-                #check minimum length
-                if len(Seq) < int(args.min_len):
-                    TooShort += 1
-                    continue
-                ValidSeqs += 1
-                #rename header
-                Name = 'R_'+str(ValidSeqs)+';barcodelabel='+BarcodeLabel+';'
-                out.write("@%s\n%s\n+\n%s\n" % (Name, Seq, Qual))
-            counts.write('%i,%i,%i,%i,%i,%i,%i\n' % (Total, NoBarcode, NoPrimer, RevPrimerFound, NoRevBarcode, TooShort, ValidSeqs))
+    stats = Demux.run(ranges, amptklib.DemuxWriter(DemuxOut, offset=offset), name=base)
+    stats.dump(os.path.join(tmpdir, base+'.stats'), amptklib.SE_STATS)
 
 def main(args):
-    global FwdPrimer, RevPrimer, SampleData, Barcodes, RevBarcodes, tmpdir, usearch
+    global FwdPrimer, RevPrimer, SampleData, BarcodeIdx, RevBarcodeIdx, DualIdx, Primers, Demux, Phix, tmpdir, usearch
     parser=argparse.ArgumentParser(prog='amptk-process_ion.py', usage="%(prog)s [options] -i file.fastq\n%(prog)s -h for help menu",
         description='''Script finds barcodes, strips forward and reverse primers, relabels, and then trim/pads reads to a set length''',
         epilog="""Written by Jon Palmer (2015) nextgenusfs@gmail.com""",
@@ -162,7 +82,9 @@ def main(args):
     parser.add_argument('-l','--trim_len', default=300, type=int, help='Trim length for reads')
     parser.add_argument('--full_length', action='store_true', help='Keep only full length reads (no trimming/padding)')
     parser.add_argument('--merge_method', default='vsearch', choices=['usearch', 'vsearch'], help='Software to use for PE read merging')
+    parser.add_argument('--phix_hits', default=amptklib.PHIX_MINHITS, type=int, help='Remove reads with this many PhiX k-mers, 0 keeps PhiX')
     parser.add_argument('--cpus', type=int, help="Number of CPUs. Default: auto")
+    parser.add_argument('--sort_samples', action='store_true', help='Group demux output by sample and write a per-sample index')
     parser.add_argument('-u','--usearch', dest="usearch", default='usearch9', help='USEARCH EXE')
     args=parser.parse_args(args)
 
@@ -182,6 +104,8 @@ def main(args):
     #Do a version check
     usearch = args.usearch
     amptklib.versionDependencyChecks(usearch, method=args.merge_method)
+    #PhiX reads are screened as the merged reads are written
+    Phix = amptklib.loadPhixScreen(args.phix_hits)
 
     #get number of CPUs to use
     if not args.cpus:
@@ -220,34 +144,8 @@ def main(args):
 
         #parse primers here so doesn't conflict with mapping primers
         #look up primer db otherwise default to entry
-        if args.F_primer in amptklib.primer_db:
-            FwdPrimer = amptklib.primer_db.get(args.F_primer)
-            amptklib.log.info("{:} fwd primer found in AMPtk primer db, setting to: {:}".format(args.F_primer, FwdPrimer))
-        else:
-            FwdPrimer = args.F_primer
-            amptklib.log.info("{:} fwd primer not found in AMPtk primer db, assuming it is actual primer sequence.".format(args.F_primer))
-        if args.R_primer in amptklib.primer_db:
-            RevPrimer = amptklib.primer_db.get(args.R_primer)
-            amptklib.log.info("{:} rev primer found in AMPtk primer db, setting to: {:}".format(args.R_primer, RevPrimer))
-        else:
-            RevPrimer = args.R_primer
-            amptklib.log.info("{:} rev primer not found in AMPtk primer db, assuming it is actual primer sequence.".format(args.R_primer))
-
-    #check if input is compressed
-    gzip_list = []
-    if args.fastq.endswith('.gz'):
-        gzip_list.append(os.path.abspath(args.fastq))
-    if args.reverse:
-        if args.reverse.endswith('.gz'):
-            gzip_list.append(os.path.abspath(args.reverse))
-    if gzip_list:
-        amptklib.log.info("Gzipped input files detected, uncompressing")
-        for file in gzip_list:
-            file_out = file.replace('.gz', '')
-            amptklib.Funzip(file, file_out, cpus)
-        args.fastq = args.fastq.replace('.gz', '')
-        if args.reverse:
-            args.reverse = args.reverse.replace('.gz', '')
+        FwdPrimer = amptklib.lookupPrimer(args.F_primer, 'fwd')
+        RevPrimer = amptklib.lookupPrimer(args.R_primer, 'rev')
 
     #Count FASTQ records
     amptklib.log.info("Loading FASTQ Records")
@@ -259,6 +157,31 @@ def main(args):
     #output barcodes/samples
     amptklib.log.info('Searching for {:} forward barcodes and {:} reverse barcodes'.format(len(Barcodes), len(RevBarcodes)))
 
+    #hash barcode neighborhoods once, forked workers share the index
+    if not args.reverse:
+        mode, revmode = 'SHW', 'rev'
+    elif args.barcode_not_anchored:
+        mode, revmode = 'HW', 'HW'
+    else:
+        mode, revmode = 'SHW', 'SHW'
+    BarcodeIdx = amptklib.BarcodeIndex(Barcodes, args.barcode_mismatch, mode=mode)
+    BarcodeIdx.report('forward barcodes')
+    RevBarcodeIdx = amptklib.BarcodeIndex(RevBarcodes, args.barcode_mismatch, mode=revmode)
+    RevBarcodeIdx.report('reverse barcodes')
+    Primers = amptklib.PrimerSet(FwdPrimer, RevPrimer, args.primer_mismatch, samples=SampleData)
+    #forward/reverse barcode pairs of the mapping file resolve straight to samples
+    DualIdx = None
+    if len(SampleData) > 0 and len(RevBarcodes) > 0:
+        DualIdx = amptklib.DualBarcodeIndex(SampleData, args.barcode_mismatch, revmode=revmode)
+        DualIdx.report()
+    #single end reads: barcode, forward primer, reverse primer, reverse barcode, then trim/pad
+    if not args.reverse:
+        stages = [amptklib.BarcodeResolver(BarcodeIdx), amptklib.PrimerTrimmer(Primers)]
+        if args.reverse_barcode:
+            stages.append(amptklib.RevBarcodeResolver(RevBarcodeIdx, dual=DualIdx, barcodes=Barcodes))
+        stages.append(amptklib.LengthPolicy(args.min_len, trim_len=args.trim_len, pad=args.pad, full_length=args.full_length))
+        Demux = amptklib.DemuxEngine(stages)
+
     #create tmpdir and split input into n cpus
     tmpdir = args.out.split('.')[0]+'_'+str(os.getpid())
     if not os.path.exists(tmpdir):
@@ -274,103 +197,46 @@ def main(args):
 
     amptklib.log.info('Dropping reads less than {:} bp and setting lossless trimming to {:} bp.'.format(args.min_len, args.trim_len))
 
-    if cpus > 1:
-        if args.reverse:
-            amptklib.split_fastqPE(args.fastq, args.reverse, orig_total, tmpdir, cpus*4)
-            file_list = []
-            for file in os.listdir(tmpdir):
-                if file.endswith('.fq'):
-                    filepart = os.path.join(tmpdir, file.split('_R')[0])
-                    if not filepart in file_list:
-                        file_list.append(filepart)
-            amptklib.runMultiProgress(processReadsPE, file_list, cpus, args=args)
-        else:
-            #split fastq file
-            amptklib.split_fastq(args.fastq, orig_total, tmpdir, cpus*4)
-            #now get file list from tmp folder
-            file_list = []
-            for file in os.listdir(tmpdir):
-                if file.endswith(".fq"):
-                    file = os.path.join(tmpdir, file)
-                    file_list.append(file)
-            #finally process reads over number of cpus
-            amptklib.runMultiProgress(processRead, file_list, cpus, args=args)
+    #workers read byte ranges of the input directly, no chunk files are written
+    if args.reverse:
+        file_list = amptklib.demuxChunks(processReadsPE, [args.fastq, args.reverse], cpus, perCPU=4, args=args)
     else:
-        if args.reverse:
-            shutil.copyfile(args.fastq, os.path.join(tmpdir, 'chunk_R1.fq'))
-            shutil.copyfile(args.reverse, os.path.join(tmpdir, 'chunk_R2.fq'))
-            processReadsPE(os.path.join(tmpdir, 'chunk'), args=args)
-        else:
-            shutil.copyfile(args.fastq, os.path.join(tmpdir, 'chunk.fq'))
-            processRead(os.path.join(tmpdir, 'chunk.fq'), args=args)
+        file_list = amptklib.demuxChunks(processRead, [args.fastq], cpus, perCPU=4, args=args)
 
     print("-------------------------------------------------------")
-    #Now concatenate all of the demuxed files together
+    #Now concatenate all of the demuxed files together, read names are already unique
     amptklib.log.info("Concatenating Demuxed Files")
-
-    tmpDemux = args.out + '.tmp.demux.fq'
-    with open(tmpDemux, 'w') as outfile:
-        for filename in glob.glob(os.path.join(tmpdir,'*.demux.fq')):
-            if filename == tmpDemux:
-                continue
-            with open(filename, 'r') as readfile:
-                shutil.copyfileobj(readfile, outfile)
+    FinalDemux = args.out+'.demux.fq.gz'
+    demuxfiles = [os.path.join(tmpdir, x[0]+'.demux.fq') for x in file_list]
+    if args.sort_samples:
+        amptklib.log.info("Grouping reads by sample and indexing: {}".format(amptklib.fastx_index_file(FinalDemux)))
+        amptklib.sort_fastx_by_sample(demuxfiles, FinalDemux, threads=cpus, tmpdir=tmpdir)
+    else:
+        amptklib.cat_fastx(demuxfiles, FinalDemux, threads=cpus)
+    #parse the stats
+    stats = amptklib.DemuxStats.load([os.path.join(tmpdir, x[0]+'.stats') for x in file_list], amptklib.PE_STATS if args.reverse else amptklib.SE_STATS)
+    amptklib.log.info('{0:,}'.format(stats['total'])+' total reads')
     if args.reverse:
-        #parse the stats
-        finalstats = [0,0,0,0,0,0]
-        for file in os.listdir(tmpdir):
-            if file.endswith('.stats'):
-                with open(os.path.join(tmpdir, file), 'r') as statsfile:
-                    line = statsfile.readline()
-                    line = line.rstrip()
-                    newstats = line.split(',')
-                    newstats = [int(i) for i in newstats]
-                    for x, num in enumerate(newstats):
-                        finalstats[x] += num
-
-        amptklib.log.info('{0:,}'.format(finalstats[0])+' total reads')
-        amptklib.log.info('{0:,}'.format(finalstats[0]-finalstats[1]-finalstats[3])+' valid Barcodes')
-        amptklib.log.info('{0:,}'.format(finalstats[5])+' valid output reads (Barcodes and Primers)')
+        amptklib.log.info('{0:,}'.format(stats['total']-stats['no_barcode']-stats['no_rev_barcode'])+' valid Barcodes')
+        amptklib.log.info('{0:,}'.format(stats['valid'])+' valid output reads (Barcodes and Primers)')
+        if Phix or stats['phix'] > 0:
+            amptklib.log.info('{0:,}'.format(stats['phix'])+' discarded PhiX')
+        if stats['merged'] > 0:
+            amptklib.log.info('{:,} of {:,} merged reads ({:.1%}) had primers removed before merging, skipped primer search'.format(stats['skipped'], stats['merged'], stats['skipped'] / float(stats['merged'])))
     else:
-        #parse the stats
-        finalstats = [0,0,0,0,0,0,0]
-        for file in os.listdir(tmpdir):
-            if file.endswith('.stats'):
-                with open(os.path.join(tmpdir, file), 'r') as statsfile:
-                    line = statsfile.readline()
-                    line = line.rstrip()
-                    newstats = line.split(',')
-                    newstats = [int(i) for i in newstats]
-                    for x, num in enumerate(newstats):
-                        finalstats[x] += num
-
-        amptklib.log.info('{0:,}'.format(finalstats[0])+' total reads')
         if args.reverse_barcode:
-            amptklib.log.info('{0:,}'.format(finalstats[0]-finalstats[1]-finalstats[2]-finalstats[4])+' valid Fwd and Rev Barcodes')
+            amptklib.log.info('{0:,}'.format(stats['total']-stats['no_barcode']-stats['no_primer']-stats['no_rev_barcode'])+' valid Fwd and Rev Barcodes')
         else:
-            amptklib.log.info('{0:,}'.format(finalstats[0]-finalstats[1])+' valid Barcode')
-            amptklib.log.info('{0:,}'.format(finalstats[0]-finalstats[1]-finalstats[2])+' Fwd Primer found, {0:,}'.format(finalstats[3])+ ' Rev Primer found')
-        amptklib.log.info('{0:,}'.format(finalstats[5])+' discarded too short (< %i bp)' % args.min_len)
-        amptklib.log.info('{0:,}'.format(finalstats[6])+' valid output reads')
-
+            amptklib.log.info('{0:,}'.format(stats['total']-stats['no_barcode'])+' valid Barcode')
+            amptklib.log.info('{0:,}'.format(stats['total']-stats['no_barcode']-stats['no_primer'])+' Fwd Primer found, {0:,}'.format(stats['rev_primer'])+ ' Rev Primer found')
+        amptklib.log.info('{0:,}'.format(stats['too_short'])+' discarded too short (< %i bp)' % args.min_len)
+        amptklib.log.info('{0:,}'.format(stats['valid'])+' valid output reads')
 
     #clean up tmp folder
     amptklib.SafeRemove(tmpdir)
 
-    #last thing is to re-number of reads as it is possible they could have same name from multitprocessor split
-    catDemux = args.out+'.demux.fq'
-    amptklib.fastqreindex(tmpDemux, catDemux)
-    amptklib.SafeRemove(tmpDemux)
-    #now loop through data and find barcoded samples, counting each.....
-    BarcodeCount = {}
-    with open(catDemux, 'r') as input:
-        header = itertools.islice(input, 0, None, 4)
-        for line in header:
-            ID = line.split("=",1)[-1].split(";")[0]
-            if ID not in BarcodeCount:
-                BarcodeCount[ID] = 1
-            else:
-                BarcodeCount[ID] += 1
+    #per-sample read counts of the sample labels
+    BarcodeCount = amptklib.fastx_stats(FinalDemux)['samples']
 
     #now let's count the barcodes found and count the number of times they are found.
     barcode_counts = "%22s:  %s" % ('Sample', 'Count')
@@ -384,15 +250,6 @@ def main(args):
         amptklib.CreateGenericMappingFile(Barcodes, RevBarcodes, FwdPrimer, RevPrimer, genericmapfile, BarcodeCount)
     else:
         amptklib.updateMappingFile(args.mapping_file, BarcodeCount, genericmapfile)
-    #compress the output to save space
-    FinalDemux = catDemux+'.gz'
-    amptklib.Fzip(catDemux, FinalDemux, cpus)
-    amptklib.removefile(catDemux)
-    if gzip_list:
-        for file in gzip_list:
-            file = file.replace('.gz', '')
-            amptklib.removefile(file)
-
     #get file size
     filesize = os.path.getsize(FinalDemux)
     readablesize = amptklib.convertSize(filesize)
@@ -8,10 +8,8 @@ import argparse
 import shutil
 import glob
 import multiprocessing
-import itertools
 import re
 from natsort import natsorted
-import edlib
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
 from amptk import amptklib
 
@@ -30,104 +28,132 @@ def processSEreads(input, args=False):
     RevPrimerFound = 0
     ValidSeqs = 0
     multiHits = 0
-    RCRevPrimer = amptklib.RevComp(RevPrimer)
+    Primers.reset()
     with open(StatsOut, 'w') as counts:
         with open(DemuxOut, 'w') as out:
-            for title, seq, qual in FastqGeneralIterator(open(inputPath)):
-                Total += 1
+            for batch in amptklib.batch_iterator(FastqGeneralIterator(amptklib.open_fastx(inputPath)), amptklib.BATCH_SIZE):
+                Total += len(batch)
                 #first thing is look for forward primer, if found trim it off
-                foralign = edlib.align(FwdPrimer, seq, mode="HW", k=args.primer_mismatch, additionalEqualities=amptklib.degenNuc)
-                #if require primer is on make finding primer in amplicon required if amplicon is larger than read length
-                #if less than read length, can't enforce primer because could have been trimmed via staggered trim in fastq_mergepairs
-                if len(foralign['locations']) > 1:
-                    multiHits += 1
-                    continue
-                if args.primer == 'on':
-                    if foralign["editDistance"] < 0:
-                        NoPrimer += 1
+                trimmed = []
+                for (title, seq, qual), foralign in zip(batch, Primers.fwdStartBatch([x[1] for x in batch])):
+                    #if require primer is on make finding primer in amplicon required if amplicon is larger than read length
+                    #if less than read length, can't enforce primer because could have been trimmed via staggered trim in fastq_mergepairs
+                    if len(foralign['locations']) > 1:
+                        multiHits += 1
                         continue
-                    ForCutPos = foralign["locations"][0][1]+1
-                    Seq = seq[ForCutPos:]
-                    Qual = qual[ForCutPos:]
-                else:
-                    if foralign["editDistance"] >= 0:
+                    if args.primer == 'on':
+                        if foralign["editDistance"] < 0:
+                            NoPrimer += 1
+                            continue
                         ForCutPos = foralign["locations"][0][1]+1
                         Seq = seq[ForCutPos:]
                         Qual = qual[ForCutPos:]
                     else:
-                        NoPrimer += 1
-                        Seq = seq
-                        Qual = qual
-                #now look for reverse primer
-                revalign = edlib.align(RCRevPrimer, Seq, mode="HW", task="locations", k=args.primer_mismatch, additionalEqualities=amptklib.degenNuc)
-                if revalign["editDistance"] >= 0:
-                    RevPrimerFound += 1
-                    RevCutPos = revalign["locations"][0][0]
-                    #location to trim sequences, trim seqs
-                    Seq = Seq[:RevCutPos]
-                    Qual = Qual[:RevCutPos]
-                else:
-                    if args.full_length:
-                        continue
-                #if full_length is passed, then only trim primers
-                if not args.full_length:
-                    #got here if primers were found they were trimmed
-                    #now check seq length, pad if too short, trim if too long
-                    if len(Seq) < args.min_len: #need this check here or primer dimers will get through
+                        if foralign["editDistance"] >= 0:
+                            ForCutPos = foralign["locations"][0][1]+1
+                            Seq = seq[ForCutPos:]
+                            Qual = qual[ForCutPos:]
+                        else:
+                            NoPrimer += 1
+                            Seq = seq
+                            Qual = qual
+                    trimmed.append((Seq, Qual))
+                #now look for reverse primer, aligned for the whole batch at once
+                for (Seq, Qual), revalign in zip(trimmed, Primers.revEndBatch([x[0] for x in trimmed])):
+                    if revalign["editDistance"] >= 0:
+                        RevPrimerFound += 1
+                        RevCutPos = revalign["locations"][0][0]
+                        #location to trim sequences, trim seqs
+                        Seq = Seq[:RevCutPos]
+                        Qual = Qual[:RevCutPos]
+                    else:
+                        if args.full_length:
+                            continue
+                    #if full_length is passed, then only trim primers
+                    if not args.full_length:
+                        #got here if primers were found they were trimmed
+                        #now check seq length, pad if too short, trim if too long
+                        if len(Seq) < args.min_len: #need this check here or primer dimers will get through
+                            TooShort += 1
+                            continue
+                        if len(Seq) < args.trim_len and args.pad == 'on':
+                            pad = args.trim_len - len(Seq)
+                            Seq = Seq + pad*'N'
+                            Qual = Qual + pad*'I'
+                        else: #len(Seq) > args.trim_len:
+                            Seq = Seq[:args.trim_len]
+                            Qual = Qual[:args.trim_len]
+                    #got here, reads are primers trimmed and trim/padded, check length
+                    if len(Seq) < args.min_len:
                         TooShort += 1
                         continue
-                    if len(Seq) < args.trim_len and args.pad == 'on':
-                        pad = args.trim_len - len(Seq)
-                        Seq = Seq + pad*'N'
-                        Qual = Qual + pad*'I'
-                    else: #len(Seq) > args.trim_len:
-                        Seq = Seq[:args.trim_len]
-                        Qual = Qual[:args.trim_len]
-                #got here, reads are primers trimmed and trim/padded, check length
-                if len(Seq) < args.min_len:
-                    TooShort += 1
-                    continue
-                ValidSeqs += 1
-                #now fix header
-                Title = 'R_'+str(ValidSeqs)+';barcodelabel='+Sample+';'
-                #now write to file
-                out.write("@%s\n%s\n+\n%s\n" % (Title, Seq, Qual))
+                    ValidSeqs += 1
+                    #now fix header
+                    Title = 'R_'+str(ValidSeqs)+';barcodelabel='+Sample+';'
+                    #now write to file
+                    out.write("@%s\n%s\n+\n%s\n" % (Title, Seq, Qual))
             ForPrimerFound = Total - NoPrimer - multiHits
             counts.write("%i,%i,%i,%i,%i,%i\n" % (Total, ForPrimerFound, RevPrimerFound, multiHits, TooShort, ValidSeqs))
+    for line in Primers.summary():
+        amptklib.log.debug('{:}: {:}'.format(Name, line))
 
 def processPEreads(input, args=False):
     '''
-    function for multiprocessing of the data, so take file list as input, need global forward/reverse list available
+    function for multiprocessing of the data, input is a SampleScheduler task (sample, part name,
+    first read, R1/R2 ranges, size), need global forward/reverse list available
     '''
-    for_reads, rev_reads = input
-    if '_' in os.path.basename(for_reads):
-        name = os.path.basename(for_reads).split("_")[0]
-    else:
-        name = os.path.basename(for_reads)
-    amptklib.log.debug('{:}: {:} {:}'.format(name, for_reads, rev_reads))
-    #for_reads = os.path.join(args.input, forwardRead)
-    #rev_reads = os.path.join(args.input, reverseRead)
+    sample, name, first, (for_reads, rev_reads), size = input
+    amptklib.log.debug('{:}: {:} {:}'.format(name, for_reads[0], rev_reads[0]))
     StatsOut = os.path.join(args.out, name+'.stats')
     #if read length explicity passed use it otherwise measure it
     if args.read_length:
         read_length = args.read_length
     else:
-        read_length = amptklib.GuessRL(for_reads)
+        read_length = amptklib.GuessRL(for_reads[0])
     trimR1 = os.path.join(args.out, name+'_R1.fq')
     trimR2 = os.path.join(args.out, name+'_R2.fq')
     mergedReads = os.path.join(args.out, name+'.merged.fq')
     demuxReads = os.path.join(args.out, name+'.demux.fq')
-    TotalCount, Written, DropMulti, FindForPrimer, FindRevPrimer = amptklib.stripPrimersPE(for_reads, rev_reads, read_length, name, FwdPrimer, RevPrimer, args.primer_mismatch, args.primer, args.full_length, trimR1, trimR2)
-    MergedCount, PhixCleanedCount = amptklib.MergeReadsSimple(trimR1, trimR2, args.out, name+'.merged.fq', args.min_len, usearch, args.rescue_forward, args.merge_method)
-    amptklib.losslessTrim(mergedReads, FwdPrimer, RevPrimer, args.primer_mismatch, args.trim_len, args.pad, args.min_len, demuxReads)
+    if Merger:
+        #merge the pairs as the primers are stripped, trimmed reads are not written
+        Merger.reset()
+        if Phix:
+            Phix.reset()
+        TotalCount, Written, DropMulti, FindForPrimer, FindRevPrimer = amptklib.stripPrimersPE(for_reads, rev_reads, read_length, sample, FwdPrimer, RevPrimer, args.primer_mismatch, args.primer, args.full_length, mergedReads, None, primers=Primers, merger=Merger, rescue=args.rescue_forward, first=first+1, phix=Phix)
+        amptklib.log.debug('{:}: {:}'.format(name, Merger.summary()))
+        PhixCleanedCount = amptklib.countfastq(mergedReads)
+        MergedCount = PhixCleanedCount + (Phix.removed if Phix else 0)
+    else:
+        TotalCount, Written, DropMulti, FindForPrimer, FindRevPrimer = amptklib.stripPrimersPE(for_reads, rev_reads, read_length, sample, FwdPrimer, RevPrimer, args.primer_mismatch, args.primer, args.full_length, trimR1, trimR2, primers=Primers, first=first+1)
+        #vsearch/usearch get the cpus left idle once fewer tasks than cpus remain
+        MergedCount, PhixCleanedCount = amptklib.MergeReadsSimple(trimR1, trimR2, args.out, name+'.merged.fq', args.min_len, usearch, args.rescue_forward, args.merge_method, threads=Scheduler.threads(), phix=Phix)
+    TrimCount, SkipSearch = amptklib.losslessTrim(mergedReads, FwdPrimer, RevPrimer, args.primer_mismatch, args.trim_len, args.pad, args.min_len, demuxReads)
     FinalCount = amptklib.countfastq(demuxReads)
     TooShort = PhixCleanedCount - FinalCount
     with open(StatsOut, 'w') as counts:
-        counts.write("%i,%i,%i,%i,%i,%i\n" % (TotalCount, FindForPrimer, FindRevPrimer, DropMulti, TooShort, FinalCount))
+        counts.write("%i,%i,%i,%i,%i,%i,%i,%i,%i\n" % (TotalCount, FindForPrimer, FindRevPrimer, DropMulti, TooShort, FinalCount, TrimCount, SkipSearch, MergedCount-PhixCleanedCount))
+
+def joinParts(sample, parts, args=False):
+    #concatenate the outputs of a sample split into parts, sum the stats
+    stats = [0,0,0,0,0,0,0,0,0]
+    for part in parts:
+        with open(os.path.join(args.out, part+'.stats'), 'r') as statsfile:
+            for x, num in enumerate(statsfile.readline().rstrip().split(',')):
+                stats[x] += int(num)
+    with open(os.path.join(args.out, sample+'.stats'), 'w') as counts:
+        counts.write(','.join([str(x) for x in stats])+'\n')
+    for ext in ['.merged.fq', '.demux.fq', '_R1.fq', '_R2.fq']:
+        files = [os.path.join(args.out, x+ext) for x in parts]
+        if all(os.path.isfile(x) for x in files):
+            amptklib.cat_fastx(files, os.path.join(args.out, sample+ext))
+        for x in files:
+            amptklib.SafeRemove(x)
+    for part in parts:
+        amptklib.SafeRemove(os.path.join(args.out, part+'.stats'))
 
 def safe_run(*args, **kwargs):
     """Call run(), catch exceptions."""
-    try: processPEreads(*args, **kwargs)
+    try: return Scheduler.runTask(processPEreads, *args, **kwargs)
     except Exception as e:
         print("error: %s run(*%r, **%r)" % (e, args, kwargs))
 
@@ -146,7 +172,7 @@ class col(object):
     WARN = '\033[93m'
 
 def main(args):
-    global FwdPrimer, RevPrimer, usearch
+    global FwdPrimer, RevPrimer, Primers, Merger, Phix, Scheduler, usearch
     parser=argparse.ArgumentParser(prog='amptk-process_illumina_folder.py', usage="%(prog)s [options] -i folder",
         description='''Script that takes De-mulitplexed Illumina data from a folder and processes it for amptk (merge PE reads, strip primers, trim/pad to set length.''',
         epilog="""Written by Jon Palmer (2015) nextgenusfs@gmail.com""",
@@ -165,8 +191,10 @@ def main(args):
     parser.add_argument('--rescue_forward', default='on', choices=['on', 'off'], help='Rescue Not-merged forward reads')
     parser.add_argument('--min_len', default=100, type=int, help='Minimum read length to keep')
     parser.add_argument('--merge_method', default='vsearch', choices=['usearch', 'vsearch'], help='Software to use for PE read merging')
+    parser.add_argument('--phix_hits', default=amptklib.PHIX_MINHITS, type=int, help='Remove reads with this many PhiX k-mers, 0 keeps PhiX')
     parser.add_argument('-l','--trim_len', default=300, type=int, help='Trim length for reads')
     parser.add_argument('--cpus', type=int, help="Number of CPUs. Default: auto")
+    parser.add_argument('--sort_samples', action='store_true', help='Group demux output by sample and write a per-sample index')
     parser.add_argument('--full_length', action='store_true', help='Keep only full length reads (no trimming/padding)')
     parser.add_argument('-p','--pad', default='off', choices=['on', 'off'], help='Pad with Ns to a set length')
     parser.add_argument('-u','--usearch', dest="usearch", default='usearch9', help='USEARCH executable')
@@ -202,19 +230,6 @@ def main(args):
     else:
         cpus = args.cpus
 
-    #check folder if files are gzipped, then gunzip them
-    #try to gunzip files
-    gzip_list = []
-    for file in os.listdir(args.input):
-        if file.endswith(".fastq.gz"):
-            gzip_list.append(file)
-    if gzip_list:
-        amptklib.log.info("Gzipped files detected, uncompressing")
-        for file in gzip_list:
-            amptklib.log.debug("Uncompressing %s" % file)
-            OutName = os.path.join(args.input, os.path.splitext(file)[0])
-            amptklib.Funzip(os.path.join(args.input, file), OutName, cpus)
-
     #check for mapping file, if exists, then use names from first column only for filenames
     SampleData = {}
     Barcodes = {}
@@ -233,7 +248,7 @@ def main(args):
         filenames = []
         for file in os.listdir(args.input):
             if file.startswith(tuple(sample_names)):
-                if file.endswith('.fastq'):
+                if file.endswith(('.fastq', '.fastq.gz')):
                     filenames.append(file)
 
         if len(filenames) < 1:
@@ -247,21 +262,11 @@ def main(args):
         #now get the FASTQ files and proceed
         filenames = []
         for file in os.listdir(args.input):
-            if file.endswith(".fastq"):
+            if file.endswith((".fastq", ".fastq.gz")):
                 filenames.append(file)
         #look up primer db otherwise default to entry
-        if args.F_primer in amptklib.primer_db:
-            FwdPrimer = amptklib.primer_db.get(args.F_primer)
-            amptklib.log.info("{:} fwd primer found in AMPtk primer db, setting to: {:}".format(args.F_primer, FwdPrimer))
-        else:
-            FwdPrimer = args.F_primer
-            amptklib.log.info("{:} fwd primer not found in AMPtk primer db, assuming it is actual primer sequence.".format(args.F_primer))
-        if args.R_primer in amptklib.primer_db:
-            RevPrimer = amptklib.primer_db.get(args.R_primer)
-            amptklib.log.info("{:} rev primer found in AMPtk primer db, setting to: {:}".format(args.R_primer, RevPrimer))
-        else:
-            RevPrimer = args.R_primer
-            amptklib.log.info("{:} rev primer not found in AMPtk primer db, assuming it is actual primer sequence.".format(args.R_primer))
+        FwdPrimer = amptklib.lookupPrimer(args.F_primer, 'fwd')
+        RevPrimer = amptklib.lookupPrimer(args.R_primer, 'rev')
 
     #if files are from SRA, then do something different as they are already merged
     if args.sra:
@@ -328,35 +333,48 @@ def main(args):
     #warn user that if require primers is on
     if args.primer == 'on':
         amptklib.log.info('Warning: --require_primer=on, ensure that your reads will contain --fwd_primer')
+    #primer locators are built once, forked workers reset their counts per sample
+    Primers = amptklib.PrimerSet(FwdPrimer, RevPrimer, args.primer_mismatch)
+    #built-in merger runs in the primer stripping worker
+    Merger = None
+    if args.merge_method == 'amptk':
+        Merger = amptklib.PairMerger(minmergelen=args.min_len)
+    #PhiX reads are screened as the merged reads are written
+    Phix = amptklib.loadPhixScreen(args.phix_hits)
     #zip read lists into a single list of tuples
     if args.reads == 'paired':
         amptklib.log.info("Strip Primers and Merge PE reads. FwdPrimer: {:} RevPrimer: {:}".format(FwdPrimer, RevPrimer))
-        readList = list(zip(fastq_for, fastq_rev))
-        amptklib.runMultiProgress(safe_run, readList, cpus, args=args)
+        #largest samples first, oversized samples are split into parts and joined after
+        Scheduler = amptklib.SampleScheduler(cpus)
+        for for_reads, rev_reads in zip(fastq_for, fastq_rev):
+            if '_' in os.path.basename(for_reads):
+                name = os.path.basename(for_reads).split("_")[0]
+            else:
+                name = os.path.basename(for_reads)
+            Scheduler.add(name, [for_reads, rev_reads])
+        Scheduler.run(safe_run, args=args)
+        for sample, parts in Scheduler.parts.items():
+            joinParts(sample, parts, args=args)
     else:
         amptklib.log.info("Strip Primers. FwdPrimer: {:} RevPrimer: {:}".format(FwdPrimer, RevPrimer))
+        fastq_for = sorted(fastq_for, key=amptklib.getSize, reverse=True)
         amptklib.runMultiProgress(safe_run2, fastq_for, cpus, args=args)
 
-    #cleanup to save space
-    if gzip_list:
-        for file in gzip_list:
-            file = file.replace('.gz', '')
-            amptklib.removefile(os.path.join(args.input, file))
     print("-------------------------------------------------------")
     #Now concatenate all of the demuxed files together
     amptklib.log.info("Concatenating Demuxed Files")
 
-    catDemux = args.out + '.demux.fq'
-    with open(catDemux, 'w') as outfile:
-        for filename in glob.glob(os.path.join(args.out,'*.demux.fq')):
-            if filename == catDemux:
-                continue
-            with open(filename, 'r') as readfile:
-                shutil.copyfileobj(readfile, outfile)
+    FinalDemux = args.out + '.demux.fq.gz'
+    demuxfiles = glob.glob(os.path.join(args.out,'*.demux.fq'))
+    if args.sort_samples:
+        amptklib.log.info("Grouping reads by sample and indexing: {}".format(amptklib.fastx_index_file(FinalDemux)))
+        amptklib.sort_fastx_by_sample(demuxfiles, FinalDemux, threads=cpus, tmpdir=args.out)
+    else:
+        amptklib.cat_fastx(demuxfiles, FinalDemux, threads=cpus)
 
     #parse the stats
-    #(Total, ForPrimerFound, RevPrimerFound, multiHits, TooShort, ValidSeqs))
-    finalstats = [0,0,0,0,0,0]
+    #(Total, ForPrimerFound, RevPrimerFound, multiHits, TooShort, ValidSeqs, MergedReads, SkippedSearch, PhiX))
+    finalstats = [0,0,0,0,0,0,0,0,0]
     for file in os.listdir(args.out):
         if file.endswith('.stats'):
             with open(os.path.join(args.out, file), 'r') as statsfile:
@@ -369,20 +387,16 @@ def main(args):
     amptklib.log.info('{0:,}'.format(finalstats[0])+' total reads')
     amptklib.log.info('{0:,}'.format(finalstats[1])+' Fwd Primer found, {0:,}'.format(finalstats[2])+ ' Rev Primer found')
     amptklib.log.info('{0:,}'.format(finalstats[3])+ ' discarded Primer incompatibility')
+    if Phix or finalstats[8] > 0:
+        amptklib.log.info('{0:,}'.format(finalstats[8])+' discarded PhiX')
     amptklib.log.info('{0:,}'.format(finalstats[4])+' discarded too short (< %i bp)' % args.min_len)
     amptklib.log.info('{0:,}'.format(finalstats[5])+' valid output reads')
+    if finalstats[6] > 0:
+        amptklib.log.info('{:,} of {:,} merged reads ({:.1%}) had primers removed before merging, skipped primer search'.format(finalstats[7], finalstats[6], finalstats[7] / float(finalstats[6])))
 
 
-    #now loop through data and find barcoded samples, counting each.....
-    BarcodeCount = {}
-    with open(catDemux, 'r') as input:
-        header = itertools.islice(input, 0, None, 4)
-        for line in header:
-            ID = line.split("=")[-1].split(";")[0]
-            if ID not in BarcodeCount:
-                BarcodeCount[ID] = 1
-            else:
-                BarcodeCount[ID] += 1
+    #per-sample read counts of the sample labels
+    BarcodeCount = amptklib.fastx_stats(FinalDemux)['samples']
 
     #now let's count the barcodes found and count the number of times they are found.
     barcode_counts = "%30s:  %s" % ('Sample', 'Count')
@@ -397,11 +411,6 @@ def main(args):
     else:
         amptklib.updateMappingFile(args.mapping_file, BarcodeCount, genericmapfile)
 
-    #compress the output to save space
-    FinalDemux = catDemux+'.gz'
-    amptklib.Fzip(catDemux, FinalDemux, cpus)
-    amptklib.removefile(catDemux)
-
     #get file size
     filesize = os.path.getsize(FinalDemux)
     readablesize = amptklib.convertSize(filesize)
@@ -7,8 +7,6 @@ import os
 import argparse
 import shutil
 import multiprocessing
-import glob
-import itertools
 import re
 from natsort import natsorted
 from amptk import amptklib
@@ -22,31 +20,34 @@ class col(object):
     WARN = '\033[93m'
 
 def processReadsPE(input, args=False):
-    base = os.path.basename(input)
-    forward_reads = os.path.join(tmpdir, base+'_R1.fq')
-    reverse_reads = os.path.join(tmpdir, base+'_R2.fq')
-    index_reads = os.path.join(tmpdir, base+'_R3.fq')
+    #input is (chunk name, global index of first read, [(file, start, end) of R1, R2, I1])
+    base, offset, ranges = input
+    trim_forward = os.path.join(tmpdir, base+'_R1.trimmed.fq')
+    trim_reverse = os.path.join(tmpdir, base+'_R2.trimmed.fq')
+    stats = Demux.run(ranges, amptklib.DemuxWriter(trim_forward, offset=offset, output2=trim_reverse), name=base)
+    stats.update(mergeReadsPE(base, args=args))
+    stats.dump(os.path.join(tmpdir, base+'.stats'), amptklib.RAW_STATS)
+
+def processPartPE(input, args=False):
+    #input is (part name,), demuxed by DemuxEngine.runQueue into <part>_R1/R2.trimmed.fq
+    base = input[0]
+    mergeReadsPE(base, args=args).dump(os.path.join(tmpdir, base+'.stats'), amptklib.RAW_STATS)
+
+def mergeReadsPE(base, args=False):
+    #merge the trimmed pairs of a chunk, then trim/pad, returns the counts
     trim_forward = os.path.join(tmpdir, base+'_R1.trimmed.fq')
     trim_reverse = os.path.join(tmpdir, base+'_R2.trimmed.fq')
     merged_reads = os.path.join(tmpdir, base+'.merged.fq')
     DemuxOut = os.path.join(tmpdir, base+'.demux.fq')
-    Total, BCFound, ForPrimerCount, RevPrimerCount = amptklib.DemuxIllumina(
-        forward_reads, reverse_reads, index_reads, Barcodes,
-        args.barcode_mismatch, FwdPrimer, RevPrimer,
-        args.primer_mismatch, trim_forward, trim_reverse,
-        trim_primers=args.no_primer_trim)
-    amptklib.MergeReadsSimple(trim_forward, trim_reverse, '.',
+    PhixCount, MergeCount = amptklib.MergeReadsSimple(trim_forward, trim_reverse, '.',
                               merged_reads, args.min_len, usearch,
-                              args.rescue_forward, args.merge_method)
-    MergeCount = amptklib.countfastq(merged_reads)
-    amptklib.losslessTrim(merged_reads, FwdPrimer, RevPrimer,
+                              args.rescue_forward, args.merge_method, phix=Phix)
+    TrimCount, SkipSearch = amptklib.losslessTrim(merged_reads, FwdPrimer, RevPrimer,
                           args.primer_mismatch, args.trim_len,
                           args.pad, args.min_len, DemuxOut)
     FinalCount = amptklib.countfastq(DemuxOut)
-    TooShort = MergeCount - FinalCount
-    stats = os.path.join(tmpdir, base+'.stats')
-    with open(stats, 'w') as counts:
-        counts.write("%i,%i,%i,%i,%i,%i\n" % (Total, BCFound, ForPrimerCount, RevPrimerCount, TooShort, FinalCount))
+    #valid are the demuxed pairs, output the reads left after merging and trimming
+    return amptklib.DemuxStats(too_short=MergeCount-FinalCount, output=FinalCount, merged=TrimCount, skipped=SkipSearch, phix=PhixCount-MergeCount)
 
 
 def safe_run(*args, **kwargs):
@@ -56,8 +57,15 @@ def safe_run(*args, **kwargs):
         print("error: %s run(*%r, **%r)" % (e, args, kwargs))
 
 
+def safe_merge(*args, **kwargs):
+    """Call processPartPE(), catch exceptions."""
+    try: processPartPE(*args, **kwargs)
+    except Exception as e:
+        print("error: %s run(*%r, **%r)" % (e, args, kwargs))
+
+
 def main(args):
-    global FwdPrimer, RevPrimer, Barcodes, tmpdir, usearch
+    global FwdPrimer, RevPrimer, Demux, Phix, tmpdir, usearch
     parser=argparse.ArgumentParser(prog='amptk-process_illumina_raw.py',
         usage="%(prog)s [options] -i file.fastq\n%(prog)s -h for help menu",
         description='''Script finds barcodes, strips forward and reverse primers, relabels, and then trim/pads reads to a set length''',
@@ -82,9 +90,12 @@ def main(args):
     parser.add_argument('-p', '--pad', default='off', choices=['on', 'off'], help='Pad with Ns to a set length')
     parser.add_argument('--no-primer-trim', dest='no_primer_trim', action='store_false', help='Do not trim primers')
     parser.add_argument('--cpus', type=int, help="Number of CPUs. Default: auto")
+    parser.add_argument('--demux_mode', default='queue', choices=['queue', 'chunks'], help='Multi-cpu demux, reader process feeding workers or byte range chunks of the input')
+    parser.add_argument('--sort_samples', action='store_true', help='Group demux output by sample and write a per-sample index')
     parser.add_argument('-u', '--usearch', dest="usearch", default='usearch9', help='USEARCH9 EXE')
     parser.add_argument('--cleanup', action='store_true', help='remove intermediate files')
     parser.add_argument('--merge_method', default='vsearch', choices=['usearch', 'vsearch'], help='Software to use for PE read merging')
+    parser.add_argument('--phix_hits', default=amptklib.PHIX_MINHITS, type=int, help='Remove reads with this many PhiX k-mers, 0 keeps PhiX')
     args=parser.parse_args(args)
 
     args.out = re.sub(r'\W+', '', args.out)
@@ -104,6 +115,8 @@ def main(args):
     # get version of amptk
     usearch = args.usearch
     amptklib.versionDependencyChecks(usearch, method=args.merge_method)
+    #PhiX reads are screened as the merged reads are written
+    Phix = amptklib.loadPhixScreen(args.phix_hits)
 
     # get number of CPUs to use
     if not args.cpus:
@@ -144,18 +157,8 @@ def main(args):
     if FwdPrimer == '' or RevPrimer == '':
         #parse primers here so doesn't conflict with mapping primers
         #look up primer db otherwise default to entry
-        if args.F_primer in amptklib.primer_db:
-            FwdPrimer = amptklib.primer_db.get(args.F_primer)
-            amptklib.log.info("{:} fwd primer found in AMPtk primer db, setting to: {:}".format(args.F_primer, FwdPrimer))
-        else:
-            FwdPrimer = args.F_primer
-            amptklib.log.info("{:} fwd primer not found in AMPtk primer db, assuming it is actual primer sequence.".format(args.F_primer))
-        if args.R_primer in amptklib.primer_db:
-            RevPrimer = amptklib.primer_db.get(args.R_primer)
-            amptklib.log.info("{:} rev primer found in AMPtk primer db, setting to: {:}".format(args.R_primer, RevPrimer))
-        else:
-            RevPrimer = args.R_primer
-            amptklib.log.info("{:} rev primer not found in AMPtk primer db, assuming it is actual primer sequence.".format(args.R_primer))
+        FwdPrimer = amptklib.lookupPrimer(args.F_primer, 'fwd')
+        RevPrimer = amptklib.lookupPrimer(args.R_primer, 'rev')
 
     #if still no primers set, then exit
     if FwdPrimer == '' or RevPrimer == '':
@@ -172,6 +175,14 @@ def main(args):
             Barcodes[k] = RCkey
 
     amptklib.log.info("Loading %i samples from mapping file" % len(Barcodes))
+    #index neighborhoods are built once, each worker remembers the index sequences it has seen
+    IndexMap = amptklib.IndexResolver(Barcodes, args.barcode_mismatch)
+    IndexMap.index.report('indexes')
+    #sample of the index read, then cut the primers from both reads
+    stages = [amptklib.IndexReadResolver(IndexMap)]
+    if args.no_primer_trim:
+        stages.append(amptklib.PairedPrimerTrimmer(amptklib.PrimerSet(FwdPrimer, RevPrimer, args.primer_mismatch)))
+    Demux = amptklib.DemuxEngine(stages)
     amptklib.log.info('FwdPrimer: {:}  RevPrimer: {:}'.format(FwdPrimer, RevPrimer))
     amptklib.log.info('Dropping reads less than {:} bp and setting lossless trimming to {:} bp.'.format(args.min_len, args.trim_len))
 
@@ -180,72 +191,51 @@ def main(args):
         amptklib.log.error("FASTQ input malformed, read numbers do not match")
         sys.exit(1)
     amptklib.log.info("Loading FASTQ Records")
-    NumSeqs = amptklib.countfastq(args.fastq)
-    if cpus > 1:
-        amptklib.log.info("Splitting FASTQ files over {:} cpus".format(cpus))
-        amptklib.split_fastqPEandI(args.fastq, args.reverse, args.index[0], NumSeqs, tmpdir, cpus*2)
-        file_list = []
-        for file in os.listdir(tmpdir):
-            if file.endswith('.fq'):
-                filepart = os.path.join(tmpdir, file.split('_R')[0])
-                if not filepart in file_list:
-                    file_list.append(filepart)
-
-        amptklib.log.info("Mapping indexes to reads and renaming PE reads")
-        amptklib.runMultiProgress(safe_run, file_list, cpus, args=args)
+    amptklib.log.info("Mapping indexes to reads and renaming PE reads")
+    if cpus > 1 and args.demux_mode == 'queue':
+        #one reader feeds the workers as it goes, the demuxed pairs are merged in cpus parts
+        amptklib.log.info("Demuxing with 1 reader and {:} worker processes".format(cpus))
+        parts = [(os.path.join(tmpdir, 'part_%i_R1.trimmed.fq' % (i+1)), os.path.join(tmpdir, 'part_%i_R2.trimmed.fq' % (i+1))) for i in range(cpus)]
+        writer = amptklib.DemuxPartWriter(parts, reads=-(-amptklib.countfastq(args.fastq) // cpus))
+        demuxstats = Demux.runQueue([args.fastq, args.reverse, args.index[0]], writer, cpus)
+        file_list = [('part_'+str(i+1),) for i in range(len(writer.parts))]
+        amptklib.log.info("Merging PE reads in {:} parts".format(len(file_list)))
+        amptklib.runMultiProgress(safe_merge, file_list, cpus, args=args)
     else:
-        amptklib.log.info("Mapping indexes to reads and renaming PE reads")
-        shutil.copyfile(args.fastq, os.path.join(tmpdir, 'chunk_R1.fq'))
-        shutil.copyfile(args.reverse, os.path.join(tmpdir, 'chunk_R2.fq'))
-        shutil.copyfile(args.index[0], os.path.join(tmpdir, 'chunk_R3.fq'))
-        processReadsPE(os.path.join(tmpdir, 'chunk'), args=args)
+        #workers read matching byte ranges of R1/R2/I1 directly, no chunk files are written
+        if cpus > 1:
+            amptklib.log.info("Splitting FASTQ files over {:} cpus".format(cpus))
+        demuxstats = amptklib.DemuxStats()
+        worker = safe_run if cpus > 1 else processReadsPE
+        file_list = amptklib.demuxChunks(worker, [args.fastq, args.reverse, args.index[0]], cpus, perCPU=2, args=args)
 
     print("-------------------------------------------------------")
-    #Now concatenate all of the demuxed files together
+    #Now concatenate all of the demuxed files together, read names are already unique
     amptklib.log.info("Concatenating Demuxed Files")
-
-    tmpDemux = os.path.join(tmpdir, args.out + '.demux.fq')
-    with open(tmpDemux, 'wb') as outfile:
-        for filename in glob.glob(os.path.join(tmpdir,'*.demux.fq')):
-            if filename == tmpDemux:
-                continue
-            with open(filename, 'r') as readfile:
-                shutil.copyfileobj(readfile, outfile)
+    FinalDemux = args.out + '.demux.fq.gz'
+    demuxfiles = [os.path.join(tmpdir, x[0]+'.demux.fq') for x in file_list]
+    if args.sort_samples:
+        amptklib.log.info("Grouping reads by sample and indexing: {}".format(amptklib.fastx_index_file(FinalDemux)))
+        amptklib.sort_fastx_by_sample(demuxfiles, FinalDemux, threads=cpus, tmpdir=tmpdir)
+    else:
+        amptklib.cat_fastx(demuxfiles, FinalDemux, threads=cpus)
     #parse the stats
-    finalstats = [0,0,0,0,0,0]
-    for file in os.listdir(tmpdir):
-        if file.endswith('.stats'):
-            with open(os.path.join(tmpdir, file), 'r') as statsfile:
-                line = statsfile.readline()
-                line = line.replace('\n', '')
-                newstats = line.split(',')
-                newstats = [int(i) for i in newstats]
-                for x, num in enumerate(newstats):
-                    finalstats[x] += num
-
-    #finally reindex output
-    #last thing is to re-number of reads as it is possible they could have same name from multitprocessor split
-    Demux = args.out + '.demux.fq'
-    amptklib.fastqreindex(tmpDemux, Demux)
-    amptklib.SafeRemove(tmpDemux)
+    stats = amptklib.DemuxStats.load([os.path.join(tmpdir, x[0]+'.stats') for x in file_list], amptklib.RAW_STATS)
+    stats.update(demuxstats)
 
     #output stats of the run
-    amptklib.log.info('{0:,}'.format(finalstats[0])+' total reads')
-    amptklib.log.info('{0:,}'.format(finalstats[0] - finalstats[1])+' discarded no index match')
-    amptklib.log.info('{0:,}'.format(finalstats[2])+' Fwd Primer found, {0:,}'.format(finalstats[3])+ ' Rev Primer found')
-    amptklib.log.info('{0:,}'.format(finalstats[4])+' discarded too short (< %i bp)' % args.min_len)
-    amptklib.log.info('{0:,}'.format(finalstats[5])+' valid output reads')
-
-    #now loop through data and find barcoded samples, counting each.....
-    BarcodeCount = {}
-    with open(Demux, 'r') as input:
-        header = itertools.islice(input, 0, None, 4)
-        for line in header:
-            ID = line.split("=",1)[-1].split(";")[0]
-            if ID not in BarcodeCount:
-                BarcodeCount[ID] = 1
-            else:
-                BarcodeCount[ID] += 1
+    amptklib.log.info('{0:,}'.format(stats['total'])+' total reads')
+    amptklib.log.info('{0:,}'.format(stats['total']-stats['valid'])+' discarded no index match')
+    amptklib.log.info('{0:,}'.format(stats['fwd_primer'])+' Fwd Primer found, {0:,}'.format(stats['rev_primer'])+ ' Rev Primer found')
+    if Phix or stats['phix'] > 0:
+        amptklib.log.info('{0:,}'.format(stats['phix'])+' discarded PhiX')
+    amptklib.log.info('{0:,}'.format(stats['too_short'])+' discarded too short (< %i bp)' % args.min_len)
+    amptklib.log.info('{0:,}'.format(stats['output'])+' valid output reads')
+    if stats['merged'] > 0:
+        amptklib.log.info('{:,} of {:,} merged reads ({:.1%}) had primers removed before merging, skipped primer search'.format(stats['skipped'], stats['merged'], stats['skipped'] / float(stats['merged'])))
+
+    #per-sample read counts of the sample labels
+    BarcodeCount = amptklib.fastx_stats(FinalDemux)['samples']
 
     #now let's count the barcodes found and count the number of times they are found.
     barcode_counts = "%30s:  %s" % ('Sample', 'Count')
@@ -257,11 +247,6 @@ def main(args):
     genericmapfile = args.out + '.mapping_file.txt'
     amptklib.CreateGenericMappingFile(Barcodes, {}, FwdPrimer, RevPrimer, genericmapfile, BarcodeCount)
 
-    #compress the output to save space
-    FinalDemux = Demux+'.gz'
-    amptklib.Fzip(Demux, FinalDemux, cpus)
-    amptklib.removefile(Demux)
-
     if args.cleanup:
         amptklib.SafeRemove(tmpdir)
 
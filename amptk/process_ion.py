@@ -7,12 +7,8 @@ import os
 import argparse
 import shutil
 import multiprocessing
-import glob
-import itertools
 import re
-import edlib
 from Bio import SeqIO
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
 from natsort import natsorted
 from amptk import amptklib
 
@@ -26,99 +22,14 @@ class col(object):
     WARN = '\033[93m'
 
 def processRead(input, args=False):
-    base = os.path.basename(input).split('.')[0]
-    ''''
-    FwdPrimer = dictOptions['FwdPrimer']
-    RevPrimer = dictOptions['RevPrimer']
-    Barcodes = dictOptions['Barcodes']
-    args = dictOptions['args']
-    '''
-    PL = len(FwdPrimer)
-    RL = len(RevPrimer)
+    #input is (chunk name, global index of first read, [(file, start, end)]) byte range of SeqIn
+    base, offset, ranges = input
     DemuxOut = os.path.join(tmpdir, base+'.demux.fq')
-    StatsOut = os.path.join(tmpdir, base+'.stats')
-    Total = 0
-    NoBarcode = 0
-    NoRevBarcode = 0
-    NoPrimer = 0
-    TooShort = 0
-    RevPrimerFound = 0
-    ValidSeqs = 0
-    with open(StatsOut, 'w') as counts:
-        with open(DemuxOut, 'w') as out:
-            for title, seq, qual in FastqGeneralIterator(open(input)):
-                Total += 1
-                #look for barcode, trim it off
-                Barcode, BarcodeLabel = amptklib.AlignBarcode(seq, Barcodes, args.barcode_mismatch)
-                if Barcode == "":
-                    NoBarcode += 1
-                    continue
-                BarcodeLength = len(Barcode)
-                Seq = seq[BarcodeLength:]
-                Qual = qual[BarcodeLength:]
-                #now search for forward primer
-                foralign = edlib.align(FwdPrimer, Seq, mode="HW", k=args.primer_mismatch, additionalEqualities=amptklib.degenNuc)
-                if foralign["editDistance"] < 0:
-                    NoPrimer += 1
-                    continue
-                ForTrim = foralign["locations"][0][1]+1
-                #now search for reverse primer
-                revalign = edlib.align(RevPrimer, Seq, mode="HW", task="locations", k=args.primer_mismatch, additionalEqualities=amptklib.degenNuc)
-                if revalign["editDistance"] >= 0:  #reverse primer was found
-                    RevPrimerFound += 1
-                    #location to trim sequences
-                    RevTrim = revalign["locations"][0][0]
-                    #determine reverse barcode
-                    if args.reverse_barcode:
-                        RevBCdiffs = 0
-                        BCcut = revalign["locations"][0][1]
-                        CutSeq = Seq[BCcut:]
-                        RevBarcode, RevBarcodeLabel = amptklib.AlignRevBarcode(CutSeq, RevBarcodes, args.barcode_mismatch)
-                        if RevBarcode == "":
-                            NoRevBarcode += 1
-                            continue
-                        BarcodeLabel = BarcodeLabel+':-:'+RevBarcodeLabel
-                    #now trim record remove forward and reverse reads
-                    Seq = Seq[ForTrim:RevTrim]
-                    Qual = Qual[ForTrim:RevTrim]
-                    #since found reverse primer, now also need to pad/trim
-                    if not args.full_length:
-                        #check minimum length here or primer dimer type sequences will get padded with Ns
-                        if len(Seq) < int(args.min_len):
-                            TooShort += 1
-                            continue
-                        if len(Seq) < args.trim_len and args.pad == 'on':
-                            pad = args.trim_len - len(Seq)
-                            Seq = Seq + pad*'N'
-                            Qual = Qual +pad*'I'
-                        else: #len(Seq) > args.trim_len:
-                            Seq = Seq[:args.trim_len]
-                            Qual = Qual[:args.trim_len]
-                else:
-                    #trim record, did not find reverse primer
-                    if args.full_length: #if full length then move to next record
-                        continue
-                    #trim away forward primer
-                    Seq = Seq[ForTrim:]
-                    Qual = Qual[ForTrim:]
-                    #check length and trim, throw away if too short as it was bad read
-                    if len(Seq) < args.trim_len:
-                        TooShort += 1
-                        continue
-                    Seq = Seq[:args.trim_len]
-                    Qual = Qual[:args.trim_len]
-                #check minimum length
-                if len(Seq) < int(args.min_len):
-                    TooShort += 1
-                    continue
-                ValidSeqs += 1
-                #rename header
-                Name = 'R_'+str(ValidSeqs)+';barcodelabel='+BarcodeLabel+';'
-                out.write("@%s\n%s\n+\n%s\n" % (Name, Seq, Qual))
-            counts.write('%i,%i,%i,%i,%i,%i,%i\n' % (Total, NoBarcode, NoPrimer, RevPrimerFound, NoRevBarcode, TooShort, ValidSeqs))
+    stats = Demux.run(ranges, amptklib.DemuxWriter(DemuxOut, offset=offset), name=base)
+    stats.dump(os.path.join(tmpdir, base+'.stats'), amptklib.SE_STATS)
 
 def main(args):
-    global FwdPrimer, RevPrimer, Barcodes, tmpdir
+    global Demux, tmpdir
     parser=argparse.ArgumentParser(prog='amptk-process_ion.py', usage="%(prog)s [options] -i file.fastq\n%(prog)s -h for help menu",
         description='''Script finds barcodes, strips forward and reverse primers, relabels, and then trim/pads reads to a set length''',
         epilog="""Written by Jon Palmer (2015) nextgenusfs@gmail.com""",
@@ -143,6 +54,8 @@ def main(args):
     parser.add_argument('--ion', action='store_true', help='Input data is Ion Torrent')
     parser.add_argument('--454', action='store_true', help='Input data is 454')
     parser.add_argument('--cpus', type=int, help="Number of CPUs. Default: auto")
+    parser.add_argument('--prefix_cache', default=0, type=int, help='Remember barcode/primer results for up to N distinct read prefixes (0 is off)')
+    parser.add_argument('--sort_samples', action='store_true', help='Group demux output by sample and write a per-sample index')
     args=parser.parse_args(args)
 
 
@@ -238,40 +151,25 @@ def main(args):
 
         #parse primers here so doesn't conflict with mapping primers
         #look up primer db otherwise default to entry
-        if args.F_primer in amptklib.primer_db:
-            FwdPrimer = amptklib.primer_db.get(args.F_primer)
-            amptklib.log.info("{:} fwd primer found in AMPtk primer db, setting to: {:}".format(args.F_primer, FwdPrimer))
-        else:
-            FwdPrimer = args.F_primer
-            amptklib.log.info("{:} fwd primer not found in AMPtk primer db, assuming it is actual primer sequence.".format(args.F_primer))
-        if args.R_primer in amptklib.primer_db:
-            RevPrimer = amptklib.primer_db.get(args.R_primer)
-            amptklib.log.info("{:} rev primer found in AMPtk primer db, setting to: {:}".format(args.R_primer, RevPrimer))
-        else:
-            RevPrimer = args.R_primer
-            amptklib.log.info("{:} rev primer not found in AMPtk primer db, assuming it is actual primer sequence.".format(args.R_primer))
-
-    #check if input is compressed
-    gzip_list = []
-    if args.fastq.endswith('.gz'):
-        gzip_list.append(os.path.abspath(args.fastq))
-    if gzip_list:
-        amptklib.log.info("Gzipped input files detected, uncompressing")
-        for file in gzip_list:
-            file_out = file.replace('.gz', '')
-            amptklib.Funzip(file, file_out, cpus)
-        args.fastq = args.fastq.replace('.gz', '')
+        FwdPrimer = amptklib.lookupPrimer(args.F_primer, 'fwd')
+        RevPrimer = amptklib.lookupPrimer(args.R_primer, 'rev')
+
+    #compressed input is read as a stream, the extension only tells the file type
+    inputName = args.fastq
+    if inputName.endswith('.gz'):
+        inputName = inputName[:-3]
 
     #if SFF file passed, convert to FASTQ with biopython
-    if args.fastq.endswith(".sff"):
+    if inputName.endswith(".sff"):
         if args.barcode_fasta == 'ionxpress':
             if not args.mapping_file:
                 amptklib.log.error("You did not specify a --barcode_fasta or --mapping_file, one is required for 454 data")
                 sys.exit(1)
         amptklib.log.info("SFF input detected, converting to FASTQ")
         SeqIn = args.out + '.sff.extract.fastq'
-        SeqIO.convert(args.fastq, "sff-trim", SeqIn, "fastq")
-    elif args.fastq.endswith(".fas") or args.fastq.endswith(".fasta") or args.fastq.endswith(".fa"):
+        with amptklib.open_fastx(args.fastq, mode='rb') as sffin:
+            SeqIO.convert(sffin, "sff-trim", SeqIn, "fastq")
+    elif inputName.endswith(".fas") or inputName.endswith(".fasta") or inputName.endswith(".fa"):
         if not args.qual:
             amptklib.log.error("FASTA input detected, however no QUAL file was given.  You must have FASTA + QUAL files")
             sys.exit(1)
@@ -283,7 +181,7 @@ def main(args):
             SeqIn = args.out + '.fastq'
             amptklib.log.info("FASTA + QUAL detected, converting to FASTQ")
             amptklib.faqual2fastq(args.fastq, args.qual, SeqIn)
-    elif args.fastq.endswith('.bam'):
+    elif inputName.endswith('.bam'):
         #so we can convert natively with pybam, however it is 10X slower than bedtools/samtools
         #since samtools is fastest, lets use that if exists, if not then bedtools, else default to pybam
         amptklib.log.info("Converting Ion Torrent BAM file to FASTQ")
@@ -305,6 +203,8 @@ def main(args):
     origRevPrimer = RevPrimer
     RevPrimer = amptklib.RevComp(RevPrimer)
     amptklib.log.info("Foward primer: %s,  Rev comp'd rev primer: %s" % (FwdPrimer, RevPrimer))
+    #primers are searched near the read start (after the barcode) and near the read end first
+    Primers = amptklib.PrimerSet(FwdPrimer, origRevPrimer, args.primer_mismatch)
 
     #then setup barcode dictionary
     if len(Barcodes) < 1:
@@ -318,6 +218,26 @@ def main(args):
         shutil.copyfile(args.reverse_barcode, rev_barcode_file)
         RevBarcodes = amptklib.fasta2barcodes(rev_barcode_file, True)
 
+    #hash barcode neighborhoods once, forked workers share the index
+    BarcodeIdx = amptklib.BarcodeIndex(Barcodes, args.barcode_mismatch)
+    BarcodeIdx.report('barcodes')
+    RevBarcodeIdx = amptklib.BarcodeIndex(RevBarcodes, args.barcode_mismatch, mode='rev')
+    RevBarcodeIdx.report('reverse barcodes')
+    #forward/reverse barcode pairs of the mapping file resolve straight to samples
+    DualIdx = None
+    if args.reverse_barcode and len(SampleData) > 0 and len(RevBarcodes) > 0:
+        DualIdx = amptklib.DualBarcodeIndex(SampleData, args.barcode_mismatch, revmode='rev')
+        DualIdx.report()
+    #barcode and forward primer, reverse primer, reverse barcode, then trim/pad
+    Resolver = amptklib.BarcodeResolver(BarcodeIdx, primers=Primers, cache=args.prefix_cache)
+    if args.prefix_cache > 0:
+        amptklib.log.info('Caching barcode/primer results for up to {:,} read prefixes of {:} bp'.format(args.prefix_cache, Resolver.prefixes.length))
+    stages = [Resolver, amptklib.PrimerTrimmer(Primers)]
+    if args.reverse_barcode:
+        stages.append(amptklib.RevBarcodeResolver(RevBarcodeIdx, dual=DualIdx, barcodes=Barcodes))
+    stages.append(amptklib.LengthPolicy(args.min_len, trim_len=args.trim_len, pad=args.pad, full_length=args.full_length))
+    Demux = amptklib.DemuxEngine(stages)
+
     #Count FASTQ records
     amptklib.log.info("Loading FASTQ Records")
     orig_total = amptklib.countfastq(SeqIn)
@@ -332,71 +252,42 @@ def main(args):
 
     amptklib.log.info('Dropping reads less than {:} bp and setting lossless trimming to {:} bp.'.format(args.min_len, args.trim_len))
 
+    #workers read byte ranges of the input directly, no chunk files are written
     if cpus > 1:
-        #split fastq file
         amptklib.log.info("Splitting FASTQ files over {:} cpus".format(cpus))
-        amptklib.split_fastq(SeqIn, orig_total, tmpdir, cpus*2)
-        #now get file list from tmp folder
-        file_list = []
-        for file in os.listdir(tmpdir):
-            if file.endswith(".fq"):
-                file = os.path.join(tmpdir, file)
-                file_list.append(file)
-        #finally process reads over number of cpus
-        amptklib.runMultiProgress(processRead, file_list, cpus, args=args)
-    else:
-        shutil.copyfile(SeqIn, os.path.join(tmpdir, 'chunk.fq'))
-        processRead(os.path.join(tmpdir, 'chunk.fq'), args=args)
+    file_list = amptklib.demuxChunks(processRead, [SeqIn], cpus, perCPU=2, args=args)
 
     print("-------------------------------------------------------")
-    #Now concatenate all of the demuxed files together
+    #Now concatenate all of the demuxed files together, read names are already unique
     amptklib.log.info("Concatenating Demuxed Files")
-
-    tmpDemux = args.out + '.tmp.demux.fq'
-    with open(tmpDemux, 'w') as outfile:
-        for filename in glob.glob(os.path.join(tmpdir,'*.demux.fq')):
-            if filename == tmpDemux:
-                continue
-            with open(filename, 'r') as readfile:
-                shutil.copyfileobj(readfile, outfile)
+    FinalDemux = catDemux+'.gz'
+    demuxfiles = [os.path.join(tmpdir, x[0]+'.demux.fq') for x in file_list]
+    if args.sort_samples:
+        amptklib.log.info("Grouping reads by sample and indexing: {}".format(amptklib.fastx_index_file(FinalDemux)))
+        amptklib.sort_fastx_by_sample(demuxfiles, FinalDemux, threads=cpus, tmpdir=tmpdir)
+    else:
+        amptklib.cat_fastx(demuxfiles, FinalDemux, threads=cpus)
     #parse the stats
-    finalstats = [0,0,0,0,0,0,0]
-    for file in os.listdir(tmpdir):
-        if file.endswith('.stats'):
-            with open(os.path.join(tmpdir, file), 'r') as statsfile:
-                line = statsfile.readline()
-                line = line.rstrip()
-                newstats = line.split(',')
-                newstats = [int(i) for i in newstats]
-                for x, num in enumerate(newstats):
-                    finalstats[x] += num
+    stats = amptklib.DemuxStats.load([os.path.join(tmpdir, x[0]+'.stats') for x in file_list], amptklib.SE_STATS)
 
     #clean up tmp folder
     shutil.rmtree(tmpdir)
 
-    #last thing is to re-number of reads as it is possible they could have same name from multitprocessor split
-    amptklib.fastqreindex(tmpDemux, catDemux)
-    os.remove(tmpDemux)
-
-    amptklib.log.info('{0:,}'.format(finalstats[0])+' total reads')
+    amptklib.log.info('{0:,}'.format(stats['total'])+' total reads')
     if args.reverse_barcode:
-        amptklib.log.info('{0:,}'.format(finalstats[0]-finalstats[1]-finalstats[2]-finalstats[4])+' valid Fwd and Rev Barcodes')
+        amptklib.log.info('{0:,}'.format(stats['total']-stats['no_barcode']-stats['no_primer']-stats['no_rev_barcode'])+' valid Fwd and Rev Barcodes')
     else:
-        amptklib.log.info('{0:,}'.format(finalstats[0]-finalstats[1])+' valid Barcode')
-        amptklib.log.info('{0:,}'.format(finalstats[0]-finalstats[1]-finalstats[2])+' Fwd Primer found, {0:,}'.format(finalstats[3])+ ' Rev Primer found')
-    amptklib.log.info('{0:,}'.format(finalstats[5])+' discarded too short (< %i bp)' % args.min_len)
-    amptklib.log.info('{0:,}'.format(finalstats[6])+' valid output reads')
-
-    #now loop through data and find barcoded samples, counting each.....
-    BarcodeCount = {}
-    with open(catDemux, 'r') as input:
-        header = itertools.islice(input, 0, None, 4)
-        for line in header:
-            ID = line.split("=",1)[-1].split(";")[0]
-            if ID not in BarcodeCount:
-                BarcodeCount[ID] = 1
-            else:
-                BarcodeCount[ID] += 1
+        amptklib.log.info('{0:,}'.format(stats['total']-stats['no_barcode'])+' valid Barcode')
+        amptklib.log.info('{0:,}'.format(stats['total']-stats['no_barcode']-stats['no_primer'])+' Fwd Primer found, {0:,}'.format(stats['rev_primer'])+ ' Rev Primer found')
+    amptklib.log.info('{0:,}'.format(stats['too_short'])+' discarded too short (< %i bp)' % args.min_len)
+    amptklib.log.info('{0:,}'.format(stats['valid'])+' valid output reads')
+    amptklib.log.debug('{:,} primer searches, {:.1%} not found near the read ends and searched the whole read'.format(stats['searches'], stats['fullread'] / max(stats['searches'], 1)))
+    if args.prefix_cache > 0:
+        lookups = stats['cache_hits'] + stats['cache_misses']
+        amptklib.log.info('Prefix cache answered {:,} of {:,} barcode/primer searches ({:.1%})'.format(stats['cache_hits'], lookups, stats['cache_hits'] / max(lookups, 1)))
+
+    #per-sample read counts of the sample labels
+    BarcodeCount = amptklib.fastx_stats(FinalDemux)['samples']
 
     #now let's count the barcodes found and count the number of times they are found.
     barcode_counts = "%22s:  %s" % ('Sample', 'Count')
@@ -411,15 +302,6 @@ def main(args):
     else:
         amptklib.updateMappingFile(args.mapping_file, BarcodeCount, genericmapfile)
 
-    #compress the output to save space
-    FinalDemux = catDemux+'.gz'
-    amptklib.Fzip(catDemux, FinalDemux, cpus)
-    amptklib.removefile(catDemux)
-    if gzip_list:
-        for file in gzip_list:
-            file = file.replace('.gz', '')
-            amptklib.removefile(file)
-
     #get file size
     filesize = os.path.getsize(FinalDemux)
     readablesize = amptklib.convertSize(filesize)
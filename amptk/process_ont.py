@@ -123,6 +123,9 @@ def orient(input, output, fwdprimer='TCCGTAGGTGAACCTGCGG',
     tooshort = 0
     lowquality = 0
     total = 0
+    # primer reverse complements are computed once, not per read
+    primers = lib.PrimerSet(fwdprimer, revprimer, mismatch,
+                            internal=internalprimer)
 
     def _reverse_string(s):
         return s[::-1]
@@ -175,15 +178,15 @@ def orient(input, output, fwdprimer='TCCGTAGGTGAACCTGCGG',
             if internalprimer:
                 ifPos = findRevPrimer(internalprimer, seq,
                                       mismatch, lib.degenNuc)
-                irPos = findRevPrimer(lib.RevComp(internalprimer), seq,
+                irPos = findRevPrimer(primers.internalRC, seq,
                                       mismatch, lib.degenNuc)
             else:
                 ifPos = (False, False)
                 irPos = (False, False)
             ffPos = findFwdPrimer(fwdprimer, seq, mismatch, lib.degenNuc)
-            frPos = findRevPrimer(lib.RevComp(fwdprimer),
+            frPos = findRevPrimer(primers.fwdRC,
                                   seq, mismatch, lib.degenNuc)
-            rfPos = findRevPrimer(lib.RevComp(revprimer),
+            rfPos = findRevPrimer(primers.revRC,
                                   seq, mismatch, lib.degenNuc)
             rrPos = findFwdPrimer(revprimer, seq, mismatch, lib.degenNuc)
             orientation, primerMatch = calcOrientation((ifPos,
@@ -5,7 +5,6 @@ import os
 import shutil
 import glob
 import argparse
-import itertools
 import edlib
 import pyfastx
 import multiprocessing
@@ -119,6 +118,9 @@ def processBAM(bam, args=False):
                 intPrimer = args.int_primer
     else:
         intPrimer = False
+    # primer reverse complements are computed once, not per read
+    primers = lib.PrimerSet(args.fwd_primer, args.rev_primer, args.mismatch,
+                            internal=intPrimer)
     Total = 0
     NoPrimer = 0
     TooShort = 0
@@ -165,16 +167,16 @@ def processBAM(bam, args=False):
                 if intPrimer:
                     ifPos = findRevPrimer(intPrimer, seq,
                                           args.mismatch, lib.degenNuc)
-                    irPos = findRevPrimer(lib.RevComp(intPrimer), seq,
+                    irPos = findRevPrimer(primers.internalRC, seq,
                                           args.mismatch, lib.degenNuc)
                 else:
                     ifPos = (False, False)
                     irPos = (False, False)
                 ffPos = findFwdPrimer(args.fwd_primer, seq, args.mismatch,
                                       lib.degenNuc)
-                frPos = findRevPrimer(lib.RevComp(args.fwd_primer),
+                frPos = findRevPrimer(primers.fwdRC,
                                       seq, args.mismatch, lib.degenNuc)
-                rfPos = findRevPrimer(lib.RevComp(args.rev_primer),
+                rfPos = findRevPrimer(primers.revRC,
                                       seq, args.mismatch, lib.degenNuc)
                 rrPos = findFwdPrimer(args.rev_primer, seq, args.mismatch,
                                       lib.degenNuc)
@@ -237,6 +239,8 @@ def main(args):
                         help='Minimum read length to keep')
     parser.add_argument('--cpus', type=int,
                         help="Number of CPUs. Default: auto")
+    parser.add_argument('--sort_samples', action='store_true',
+                        help='Group demux output by sample and write a per-sample index')
     args = parser.parse_args(args)
 
     if not args.cpus:
@@ -306,24 +310,16 @@ def main(args):
     lib.log.info('{:,} valid output reads'.format(finalstats[4]))
 
     # now combine the results of properfied data
-    catDemux = args.out + '.demux.fq'
-    with open(catDemux, 'w') as outfile:
-        for filename in glob.glob(os.path.join(args.out, '*.oriented.fq')):
-            if filename == catDemux:
-                continue
-            with open(filename, 'r') as readfile:
-                shutil.copyfileobj(readfile, outfile)
+    FinalDemux = args.out + '.demux.fq.gz'
+    demuxfiles = glob.glob(os.path.join(args.out, '*.oriented.fq'))
+    if args.sort_samples:
+        lib.log.info("Grouping reads by sample and indexing: {}".format(lib.fastx_index_file(FinalDemux)))
+        lib.sort_fastx_by_sample(demuxfiles, FinalDemux, threads=args.cpus, tmpdir=args.out)
+    else:
+        lib.cat_fastx(demuxfiles, FinalDemux, threads=args.cpus)
 
-    #now loop through data and find barcoded samples, counting each.....
-    BarcodeCount = {}
-    with open(catDemux, 'r') as input:
-        header = itertools.islice(input, 0, None, 4)
-        for line in header:
-            ID = line.split("label=", 1)[-1].split(";")[0]
-            if ID not in BarcodeCount:
-                BarcodeCount[ID] = 1
-            else:
-                BarcodeCount[ID] += 1
+    #per-sample read counts of the sample labels
+    BarcodeCount = lib.fastx_stats(FinalDemux)['samples']
 
     #now let's count the barcodes found and count the number of times they are found.
     barcode_counts = "%22s:  %s" % ('Sample', 'Count')
@@ -331,10 +327,7 @@ def main(args):
         barcode_counts += "\n%22s:  %s" % (k, str(BarcodeCount[k]))
     lib.log.info("Found %i barcoded samples\n%s" % (len(BarcodeCount), barcode_counts))
 
-    # gzip final and clean up
-    FinalDemux = catDemux+'.gz'
-    lib.Fzip(catDemux, FinalDemux, args.cpus)
-    lib.removefile(catDemux)
+    # clean up
     shutil.rmtree(args.out)
     #get file size
     filesize = os.path.getsize(FinalDemux)
@@ -65,6 +65,12 @@ def main(args):
     parser.add_argument(
         "--debug", action="store_true", help="Remove Intermediate Files"
     )
+    parser.add_argument(
+        "--tmp_codec",
+        default=amptklib.TMP_CODEC,
+        choices=list(amptklib.CODEC_EXT),
+        help="Compress intermediate files in tmp folder",
+    )
     parser.add_argument("--cpus", type=int, help="Number of CPUs. Default: auto")
     args = parser.parse_args(args)
 
@@ -104,7 +110,8 @@ def main(args):
     else:
         cpus = amptklib.getCPUS()
 
-    # make tmp folder
+    # make tmp folder, large intermediate files are compressed with --tmp_codec
+    amptklib.set_tmp_codec(args.tmp_codec)
     tmp = base + "_tmp"
     if not os.path.exists(tmp):
         os.makedirs(tmp)
@@ -112,7 +119,7 @@ def main(args):
     # Count FASTQ records
     amptklib.log.info("Loading FASTQ Records")
     # convert to FASTA for mapping
-    orig_fasta = os.path.join(tmp, base + ".orig.fa")
+    orig_fasta = amptklib.tmpname(os.path.join(tmp, base + ".orig.fa"))
     cmd = [
         "vsearch",
         "--fastq_filter",
@@ -124,15 +131,21 @@ def main(args):
         "--threads",
         str(cpus),
     ]
-    amptklib.runSubprocess(cmd, amptklib.log)
+    amptklib.runSubprocessCodec(
+        cmd, amptklib.log, inputs=[args.FASTQ], outputs=[orig_fasta]
+    )
     orig_total = amptklib.countfasta(orig_fasta)
     size = amptklib.checkfastqsize(args.FASTQ)
     readablesize = amptklib.convertSize(size)
     amptklib.log.info("{0:,}".format(orig_total) + " reads (" + readablesize + ")")
 
     # Expected Errors filtering step
-    filter_out = os.path.join(tmp, base + ".EE" + args.maxee + ".filter.fq")
-    filter_fasta = os.path.join(tmp, base + ".EE" + args.maxee + ".filter.fa")
+    filter_out = amptklib.tmpname(
+        os.path.join(tmp, base + ".EE" + args.maxee + ".filter.fq")
+    )
+    filter_fasta = amptklib.tmpname(
+        os.path.join(tmp, base + ".EE" + args.maxee + ".filter.fa")
+    )
     amptklib.log.info("Quality Filtering, expected errors < %s" % args.maxee)
     cmd = [
         "vsearch",
@@ -149,12 +162,16 @@ def main(args):
         "--threads",
         str(cpus),
     ]
-    amptklib.runSubprocess(cmd, amptklib.log)
+    amptklib.runSubprocessCodec(
+        cmd, amptklib.log, inputs=[args.FASTQ], outputs=[filter_out, filter_fasta]
+    )
     total = amptklib.countfastq(filter_out)
     amptklib.log.info("{0:,}".format(total) + " reads passed")
 
     # now run full length dereplication
-    derep_out = os.path.join(tmp, base + ".EE" + args.maxee + ".derep.fa")
+    derep_out = amptklib.tmpname(
+        os.path.join(tmp, base + ".EE" + args.maxee + ".derep.fa")
+    )
     amptklib.log.info("De-replication (remove duplicate reads)")
     if LooseVersion(amptklib.get_vsearch_version()) >= LooseVersion("2.20.0"):
         cmd = [
@@ -180,7 +197,9 @@ def main(args):
             "--threads",
             str(cpus),
         ]
-    amptklib.runSubprocess(cmd, amptklib.log)
+    amptklib.runSubprocessCodec(
+        cmd, amptklib.log, inputs=[filter_out], outputs=[derep_out]
+    )
     total = amptklib.countfasta(derep_out)
     amptklib.log.info("{0:,}".format(total) + " reads passed")
 
@@ -188,10 +207,11 @@ def main(args):
     unoise_out = os.path.join(tmp, base + ".EE" + args.maxee + ".unoise.fa")
     if args.method == "usearch":
         amptklib.log.info("Denoising reads with UNOISE3")
+        unoise_in = derep_out
         cmd = [
             usearch,
             "-unoise3",
-            derep_out,
+            unoise_in,
             "-zotus",
             unoise_out,
             "-minsize",
@@ -203,15 +223,20 @@ def main(args):
     else:
         amptklib.log.info("Denoising reads with VSEARCH --cluster_unoise")
         # need to sort here first
-        sorted_out = os.path.join(tmp, base + ".EE" + args.maxee + ".sorted.fa")
+        sorted_out = amptklib.tmpname(
+            os.path.join(tmp, base + ".EE" + args.maxee + ".sorted.fa")
+        )
         cmd = ["vsearch", "--sortbysize", derep_out, "--output", sorted_out]
         # vsearch --sortbysize zotus_chim.fa --output zotus_sorted.fa
-        amptklib.runSubprocess(cmd, amptklib.log)
+        amptklib.runSubprocessCodec(
+            cmd, amptklib.log, inputs=[derep_out], outputs=[sorted_out]
+        )
         # now run unoise3
+        unoise_in = sorted_out
         cmd = [
             "vsearch",
             "--cluster_unoise",
-            sorted_out,
+            unoise_in,
             "--minsize",
             args.minsize,
             "--sizein",
@@ -221,7 +246,7 @@ def main(args):
             "--centroids",
             unoise_out,
         ]
-    amptklib.runSubprocess(cmd, amptklib.log)
+    amptklib.runSubprocessCodec(cmd, amptklib.log, inputs=[unoise_in])
     # total = amptklib.countfasta(unoise_out)
     # amptklib.log.info('{0:,}'.format(total) + ' denoised sequences')
 
@@ -319,7 +344,9 @@ def main(args):
     amptklib.log.info("{:,} ASVs validated ({:,} dropped)".format(numKept, numDropped))
 
     # build OTU table with iSeqs
-    uc_iSeq_out = os.path.join(tmp, base + ".EE" + args.maxee + ".mapping.uc")
+    uc_iSeq_out = amptklib.tmpname(
+        os.path.join(tmp, base + ".EE" + args.maxee + ".mapping.uc")
+    )
     iSeq_otu_table = base + ".otu_table.txt"
     # setup reads to map
     if args.map_filtered:
@@ -344,7 +371,9 @@ def main(args):
         "--threads",
         str(cpus),
     ]
-    amptklib.runSubprocess(cmd, amptklib.log)
+    amptklib.runSubprocessCodec(
+        cmd, amptklib.log, inputs=[reads], outputs=[uc_iSeq_out]
+    )
 
     # count reads mapped
     total = amptklib.line_count2(uc_iSeq_out)
@@ -418,7 +447,9 @@ def main(args):
             clusters.write("%s\t%s\n" % (k, ", ".join(v)))
 
     # now map reads back to OTUs and build OTU table
-    uc_out = os.path.join(tmp, base + ".EE" + args.maxee + ".cluster.mapping.uc")
+    uc_out = amptklib.tmpname(
+        os.path.join(tmp, base + ".EE" + args.maxee + ".cluster.mapping.uc")
+    )
     otu_table = os.path.join(tmp, base + ".EE" + args.maxee + ".cluster.otu_table.txt")
     # setup reads to map
     if args.map_filtered:
@@ -443,7 +474,7 @@ def main(args):
         "--threads",
         str(cpus),
     ]
-    amptklib.runSubprocess(cmd, amptklib.log)
+    amptklib.runSubprocessCodec(cmd, amptklib.log, inputs=[reads], outputs=[uc_out])
 
     # count reads mapped
     total = amptklib.line_count2(uc_out)
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import sys
+import os
+import argparse
+import logging
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+import edlib
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+from amptk import amptklib
+
+#the demux functions log per-chunk details at debug level
+amptklib.log = logging.getLogger('amptk')
+
+
+class MyFormatter(argparse.ArgumentDefaultsHelpFormatter):
+    def __init__(self, prog):
+        super(MyFormatter, self).__init__(prog, max_help_position=50)
+
+
+def simulateFastq(output, numseqs, length=300, seed=1):
+    #write random reads, quality lines can start with @ so resyncing is tested
+    random.seed(seed)
+    with open(output, 'w') as outfile:
+        for i in range(numseqs):
+            seq = ''.join(random.choice('ACGT') for x in range(length))
+            qual = ''.join(random.choice('@ABCDEFGHI') for x in range(length))
+            outfile.write('@R_%i;barcodelabel=sample%i;\n%s\n+\n%s\n' % (i+1, i % 96, seq, qual))
+
+
+def legacy_split_fastq(input, numseqs, outputdir, chunks):
+    #the original line-offset splitter, kept here as the reference
+    numlines = numseqs*4
+    n = numlines // chunks
+    if (n % 4) != 0:
+        n = ((n // 4) + 1) * 4
+    splits = []
+    count = 0
+    for i in range(chunks):
+        end = count+n
+        if end > numlines:
+            end = numlines
+        splits.append((count, end))
+        count += n
+    linepos = amptklib.scan_linepos(input)
+    if not os.path.isdir(outputdir):
+        os.makedirs(outputdir)
+    for i, x in enumerate(splits):
+        with open(os.path.join(outputdir, 'chunk_'+str(i+1)+'.fq'), 'w') as output:
+            lines = amptklib.return_lines(input, linepos, x[0], x[1])
+            output.write('%s' % ''.join(lines))
+
+
+def timeit(function, *args, **kwargs):
+    #tracemalloc slows down allocation heavy loops, skip it for throughput numbers
+    memory = kwargs.get('memory', True)
+    if memory:
+        tracemalloc.start()
+    start = time.time()
+    function(*args)
+    elapsed = time.time() - start
+    peak = 0
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def benchSplit(args, tmpdir):
+    print('%10s  %8s  %12s  %12s  %12s  %12s' % ('Reads', 'Chunks', 'legacy (s)', 'legacy mem', 'ranges (s)', 'ranges mem'))
+    for num in args.reads:
+        fastq = os.path.join(tmpdir, 'bench_%i.fq' % num)
+        simulateFastq(fastq, num, length=args.length)
+        legacy = timeit(legacy_split_fastq, fastq, num, os.path.join(tmpdir, 'legacy_%i' % num), args.chunks)
+        ranges = timeit(amptklib.split_fastq, fastq, num, os.path.join(tmpdir, 'ranges_%i' % num), args.chunks)
+        print('%10i  %8i  %12.2f  %12s  %12.2f  %12s' % (num, args.chunks, legacy[0], amptklib.convertSize(legacy[1]),
+                                                       ranges[0], amptklib.convertSize(ranges[1])))
+        for x in [fastq, os.path.join(tmpdir, 'legacy_%i' % num), os.path.join(tmpdir, 'ranges_%i' % num)]:
+            amptklib.SafeRemove(x)
+
+
+def simulatePE(base, numseqs, length=250, seed=1):
+    #R1 starts with fITS7, R2 with ITS4, I1 is one of 8 index reads
+    random.seed(seed)
+    fwd, rev = amptklib.primer_db['fITS7'], amptklib.primer_db['ITS4']
+    indexes = dict(('sample%i' % i, ''.join(random.choice('ACGT') for x in range(8))) for i in range(8))
+    files = [base+'_R1.fq', base+'_R2.fq', base+'_I1.fq']
+    handles = [open(x, 'w') for x in files]
+    for i in range(numseqs):
+        r1 = fwd.replace('R', 'A') + ''.join(random.choice('ACGT') for x in range(length-len(fwd)))
+        r2 = rev + ''.join(random.choice('ACGT') for x in range(length-len(rev)))
+        idx = indexes['sample%i' % (i % 8)]
+        for h, seq in zip(handles, [r1, r2, idx]):
+            qual = ''.join(random.choice('5?ABCDEFGHI') for x in range(len(seq)))
+            h.write('@M0:1:FC:1:1:%i:1 1:N:0:1;barcodelabel=sample%i;\n%s\n+\n%s\n' % (i+1, i % 8, seq, qual))
+    for h in handles:
+        h.close()
+    return files, indexes
+
+
+#the str based FastqGeneralIterator versions, kept here as the reference
+def legacy_parse(input):
+    for title, seq, qual in FastqGeneralIterator(amptklib.open_fastx(input)):
+        pass
+
+def legacy_write(input, output):
+    with amptklib.open_fastx_writer(output) as outfile:
+        for title, seq, qual in FastqGeneralIterator(amptklib.open_fastx(input)):
+            outfile.write('@%s\n%s\n+\n%s\n' % (title, seq, qual))
+
+def legacy_trim3prime(input, trimlen, output, removelist):
+    with amptklib.open_fastx_writer(output) as outfile:
+        for title, seq, qual in FastqGeneralIterator(amptklib.open_fastx(input)):
+            if not title.split(' ')[0] in removelist:
+                outfile.write('@%s\n%s\n+\n%s\n' % (title, seq[:trimlen], qual[:trimlen]))
+
+def legacy_losslessTrim(input, fwdprimer, revprimer, mismatch, trimLen, padding, minlength, output):
+    with amptklib.open_fastx_writer(output) as outfile:
+        for title, seq, qual in FastqGeneralIterator(amptklib.open_fastx(input)):
+            ForTrim = amptklib.trimForPrimer(fwdprimer, seq, mismatch)
+            RevTrim = amptklib.trimRevPrimer(revprimer, seq, mismatch)
+            Seq = seq[ForTrim:RevTrim]
+            Qual = qual[ForTrim:RevTrim]
+            if len(Seq) < int(minlength):
+                continue
+            if len(Seq) < int(trimLen) and padding == 'on':
+                pad = int(trimLen) - len(Seq)
+                SeqF = Seq + pad*'N'
+                QualF = Qual + pad*'I'
+            else:
+                SeqF = Seq[:trimLen]
+                QualF = Qual[:trimLen]
+            outfile.write('@%s\n%s\n+\n%s\n' % (title, SeqF, QualF))
+
+def legacy_FastMaxEEFilter(input, trunclen, maxee, output):
+    with amptklib.open_fastx_writer(output) as out:
+        for title, seq, qual in FastqGeneralIterator(amptklib.open_fastx(input)):
+            trunclen = int(trunclen)
+            Seq = seq[:trunclen]
+            Qual = qual[:trunclen]
+            ee = 0
+            for bp, Q in enumerate(Qual):
+                q = int(amptklib.ASCII.get(Q))
+                P = 10**(float(-q)/10)
+                ee += P
+            if ee <= float(maxee):
+                out.write("@%s\n%s\n+\n%s\n" % (title, Seq, Qual))
+
+def legacy_dereplicate(input, output):
+    seqs = {}
+    for title, sequence, qual in FastqGeneralIterator(amptklib.open_fastx(input)):
+        if sequence not in seqs:
+            if title.endswith(';'):
+                seqs[sequence] = title+'size=1;'
+            else:
+                seqs[sequence] = title+';size=1;'
+        else:
+            count = int(seqs[sequence].split('=')[-1].rstrip(';')) + 1
+            seqs[sequence] = seqs[sequence].rsplit('=', 1)[0]+'='+str(count)+';'
+    with amptklib.open_fastx_writer(output) as out:
+        for sequence in seqs:
+            out.write('>'+seqs[sequence]+'\n'+sequence+'\n')
+
+def legacy_stripPrimersPE(R1, R2, RL, samplename, fwdprimer, revprimer, primer_mismatch, outR1, outR2):
+    #require_primer off, not full length
+    file1 = FastqGeneralIterator(amptklib.open_fastx(R1))
+    file2 = FastqGeneralIterator(amptklib.open_fastx(R2))
+    counter = 1
+    with amptklib.open_fastx_writer(outR1) as outfile1:
+        with amptklib.open_fastx_writer(outR2) as outfile2:
+            for read1, read2 in zip(file1, file2):
+                R1Seq, R1Qual = read1[1][:RL], read1[2][:RL]
+                R2Seq, R2Qual = read2[1][:RL], read2[2][:RL]
+                ForTrim, RevTrim = (0,)*2
+                R1foralign = edlib.align(fwdprimer, R1Seq, mode="HW", k=primer_mismatch, additionalEqualities=amptklib.degenNuc)
+                if R1foralign['editDistance'] >= 0:
+                    if len(R1foralign['locations']) > 1:
+                        continue
+                    ForTrim = R1foralign["locations"][0][1]+1
+                R1revalign = edlib.align(amptklib.RevComp(revprimer), R1Seq, mode="HW", k=primer_mismatch, additionalEqualities=amptklib.degenNuc)
+                R1RevCut = RL if R1revalign['editDistance'] < 0 else R1revalign["locations"][0][0]
+                R2foralign = edlib.align(revprimer, R2Seq, mode="HW", k=primer_mismatch, additionalEqualities=amptklib.degenNuc)
+                if R2foralign['editDistance'] >= 0:
+                    if len(R2foralign['locations']) > 1:
+                        continue
+                    RevTrim = R2foralign["locations"][0][1]+1
+                R2revalign = edlib.align(amptklib.RevComp(fwdprimer), R2Seq, mode="HW", k=primer_mismatch, additionalEqualities=amptklib.degenNuc)
+                R2RevCut = RL if R2revalign['editDistance'] < 0 else R2revalign["locations"][0][0]
+                header = 'R_{:};barcodelabel={:};'.format(counter, samplename)
+                outfile1.write('@%s\n%s\n+\n%s\n' % (header, R1Seq[ForTrim:R1RevCut], R1Qual[ForTrim:R1RevCut]))
+                outfile2.write('@%s\n%s\n+\n%s\n' % (header, R2Seq[RevTrim:R2RevCut], R2Qual[RevTrim:R2RevCut]))
+                counter += 1
+
+def legacy_DemuxIllumina(R1, R2, I1, mapDict, mismatch, fwdprimer, revprimer, primer_mismatch, outR1, outR2):
+    file1 = FastqGeneralIterator(amptklib.open_fastx(R1))
+    file2 = FastqGeneralIterator(amptklib.open_fastx(R2))
+    file3 = FastqGeneralIterator(amptklib.open_fastx(I1))
+    counter = 1
+    with amptklib.open_fastx_writer(outR1) as outfile1:
+        with amptklib.open_fastx_writer(outR2) as outfile2:
+            for read1, read2, index in zip(file1, file2, file3):
+                Name, Diffs = amptklib.mapIndex(index[1], mapDict, mismatch)
+                if Name:
+                    R1ForPos = amptklib.trimForPrimer(fwdprimer, read1[1], primer_mismatch)
+                    R1RevPos = amptklib.trimRevPrimer(revprimer, read1[1], primer_mismatch)
+                    R2ForPos = amptklib.trimForPrimer(revprimer, read2[1], primer_mismatch)
+                    R2RevPos = amptklib.trimRevPrimer(fwdprimer, read2[1], primer_mismatch)
+                    header = 'R_'+str(counter)+';barcodelabel='+Name+';bcseq='+index[1]+';bcdiffs='+str(Diffs)+';'
+                    outfile1.write('@%s\n%s\n+\n%s\n' % (header, read1[1][R1ForPos:R1RevPos], read1[2][R1ForPos:R1RevPos]))
+                    outfile2.write('@%s\n%s\n+\n%s\n' % (header, read2[1][R2ForPos:R2RevPos], read2[2][R2ForPos:R2RevPos]))
+                    counter += 1
+
+
+def batch_parse(input):
+    for batch in amptklib.iter_fastq_batches(input):
+        pass
+
+def batch_write(input, output):
+    with amptklib.FastqWriter(output) as outfile:
+        for batch in amptklib.iter_fastq_batches(input):
+            outfile.writebatch(batch)
+
+def benchParse(args, tmpdir):
+    fwd, rev = amptklib.primer_db['fITS7'], amptklib.primer_db['ITS4']
+    (R1, R2, I1), indexes = simulatePE(os.path.join(tmpdir, 'bench'), args.reads, length=args.length)
+    out1, out2 = os.path.join(tmpdir, 'out_R1.fq'), os.path.join(tmpdir, 'out_R2.fq')
+    tests = [('parse', legacy_parse, batch_parse, (R1,)),
+             ('write', legacy_write, batch_write, (R1, out1)),
+             ('trim3prime', legacy_trim3prime, amptklib.trim3prime, (R1, 200, out1, set())),
+             ('losslessTrim', legacy_losslessTrim, amptklib.losslessTrim, (R1, fwd, rev, 2, 200, 'on', 100, out1)),
+             ('FastMaxEEFilter', legacy_FastMaxEEFilter, amptklib.FastMaxEEFilter, (R1, 200, 1.0, out1)),
+             ('dereplicate', legacy_dereplicate, amptklib.dereplicate, (R1, out1)),
+             ('stripPrimersPE', legacy_stripPrimersPE, amptklib.stripPrimersPE,
+              ((R1, R2, 250, 'sample1', fwd, rev, 2, out1, out2), (R1, R2, 250, 'sample1', fwd, rev, 2, 'off', False, out1, out2))),
+             ('DemuxIllumina', legacy_DemuxIllumina, amptklib.DemuxIllumina,
+              (R1, R2, I1, indexes, 1, fwd, rev, 2, out1, out2))]
+    print('%16s  %14s  %14s  %8s' % ('Function', 'str (reads/s)', 'batch (reads/s)', 'Speedup'))
+    for name, legacy, batched, fargs in tests:
+        if isinstance(fargs[0], tuple):
+            largs, bargs = fargs
+        else:
+            largs = bargs = fargs
+        before = timeit(legacy, *largs, memory=False)[0]
+        after = timeit(batched, *bargs, memory=False)[0]
+        print('%16s  %14i  %14i  %7.1fx' % (name, args.reads / before, args.reads / after, before / after))
+
+def readahead_loop(input, depth, primer, work):
+    #per-read primer search like processRead, work=False only parses
+    count = 0
+    for batch in amptklib.iter_fastq_batches(input, depth=depth):
+        if work:
+            for title, seq, qual in batch:
+                edlib.align(primer, seq[:60], mode='HW', k=2, additionalEqualities=amptklib.degenNuc)
+        count += len(batch)
+    return count
+
+def benchReadahead(args, tmpdir):
+    #put --tmpdir on the file system to test, i.e. an NFS mount vs local SSD
+    primer = amptklib.primer_db['fITS7']
+    fastq = os.path.join(tmpdir, 'bench.fq')
+    simulateFastq(fastq, args.reads, length=args.length)
+    files = []
+    if 'plain' in args.format:
+        files.append(('plain', fastq))
+    if 'gz' in args.format:
+        amptklib.cat_fastx([fastq], fastq+'.gz')
+        files.append(('bgzf', fastq+'.gz'))
+    print('%8s  %6s  %16s  %16s' % ('Format', 'Depth', 'parse (reads/s)', 'primer (reads/s)'))
+    for name, file in files:
+        for depth in args.depth:
+            parse = timeit(readahead_loop, file, depth, primer, False, memory=False)[0]
+            work = timeit(readahead_loop, file, depth, primer, True, memory=False)[0]
+            print('%8s  %6i  %16i  %16i' % (name, depth, args.reads / parse, args.reads / work))
+
+def main(args):
+    parser = argparse.ArgumentParser(prog='amptk_benchmark.py',
+                                     description='''Micro-benchmarks for AMPtk FASTQ processing on simulated data''',
+                                     formatter_class=MyFormatter)
+    subparsers = parser.add_subparsers(dest='bench')
+    split = subparsers.add_parser('split', help='split_fastq scaling, byte ranges vs line offsets',
+                                  formatter_class=MyFormatter)
+    split.add_argument('-n', '--reads', nargs='+', type=int, default=[100000, 500000, 1000000],
+                       help='Number of reads to simulate')
+    split.add_argument('-c', '--chunks', type=int, default=16, help='Number of chunks')
+    split.add_argument('-l', '--length', type=int, default=300, help='Read length')
+    parse = subparsers.add_parser('parse', help='reads/sec of per-read loops, str vs batched bytes parser',
+                                  formatter_class=MyFormatter)
+    parse.add_argument('-n', '--reads', type=int, default=100000, help='Number of read pairs to simulate')
+    parse.add_argument('-l', '--length', type=int, default=250, help='Read length')
+    readahead = subparsers.add_parser('readahead', help='reads/sec of the FASTQ reader by read-ahead depth',
+                                      formatter_class=MyFormatter)
+    readahead.add_argument('-n', '--reads', type=int, default=500000, help='Number of reads to simulate')
+    readahead.add_argument('-l', '--length', type=int, default=250, help='Read length')
+    readahead.add_argument('-d', '--depth', nargs='+', type=int, default=[0, 1, 2, 4, 8],
+                           help='Read-ahead depths to test, 0 is no reader thread')
+    readahead.add_argument('-f', '--format', nargs='+', default=['plain', 'gz'], choices=['plain', 'gz'],
+                           help='Input compression to test')
+    parser.add_argument('--tmpdir', help='Folder for simulated data, i.e. on NFS or local SSD')
+    args = parser.parse_args(args)
+
+    if not args.bench:
+        parser.print_help()
+        sys.exit(1)
+    tmpdir = tempfile.mkdtemp(dir=args.tmpdir)
+    try:
+        if args.bench == 'split':
+            benchSplit(args, tmpdir)
+        elif args.bench == 'parse':
+            benchParse(args, tmpdir)
+        elif args.bench == 'readahead':
+            benchReadahead(args, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
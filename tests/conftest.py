@@ -0,0 +1,18 @@
+import os
+import logging
+import pytest
+from amptk import amptklib
+
+TESTDATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_data')
+
+
+@pytest.fixture(autouse=True)
+def amptk_log():
+    # the processing scripts set this up with amptklib.setupLogging
+    amptklib.log = logging.getLogger('amptk-test')
+    yield
+
+
+@pytest.fixture
+def illumina_folder():
+    return os.path.join(TESTDATA, 'illumina_test_data')
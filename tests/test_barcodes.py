@@ -0,0 +1,147 @@
+import random
+import collections
+import edlib
+import pytest
+from amptk import amptklib
+
+
+def random_seq(rng, length):
+    return ''.join(rng.choice('ACGT') for i in range(length))
+
+
+def mutate(rng, seq, edits):
+    seq = list(seq)
+    for i in range(edits):
+        pos = rng.randrange(len(seq))
+        kind = rng.choice(['sub', 'ins', 'del'])
+        if kind == 'sub':
+            seq[pos] = rng.choice('ACGT')
+        elif kind == 'ins':
+            seq.insert(pos, rng.choice('ACGT'))
+        elif len(seq) > 1:
+            del seq[pos]
+    return ''.join(seq)
+
+
+def edlib_lookup(barcodes, seq, mismatch, mode):
+    # closest barcode by edlib, None if there is none or two different barcodes are as close
+    hits = []
+    for order, B in enumerate(barcodes.values()):
+        align = edlib.align(B, seq, mode=mode, k=mismatch)
+        if align['editDistance'] >= 0:
+            hits.append((align['editDistance'], order))
+    if not hits:
+        return None, None
+    hits.sort()
+    d = hits[0][0]
+    if len(set(list(barcodes.values())[x] for e, x in hits if e == d)) > 1:
+        return None, d
+    return hits[0][1], d
+
+
+def barcode_set(rng, count, length, close=0):
+    # random barcodes, close of them one or two edits from another one
+    barcodes = collections.OrderedDict()
+    for i in range(count):
+        barcodes['BC%i' % i] = random_seq(rng, length)
+    for i in range(close):
+        barcodes['close%i' % i] = mutate(rng, barcodes['BC%i' % i], 1 + i % 2)
+    return barcodes
+
+
+@pytest.mark.parametrize('mode,count,close', [('SHW', 24, 0), ('SHW', 24, 4), ('SHW', 2, 0), ('rev', 24, 4), ('rev', 1, 0)])
+@pytest.mark.parametrize('mismatch', [0, 1, 2])
+def test_BarcodeIndex_matches_edlib(mode, count, close, mismatch):
+    rng = random.Random(count * 10 + close + mismatch)
+    barcodes = barcode_set(rng, count, 10, close)
+    index = amptklib.BarcodeIndex(barcodes, mismatch, mode=mode)
+    labels = list(barcodes)
+    for i in range(1500):
+        B = rng.choice(list(barcodes.values()))
+        read = mutate(rng, B, rng.randrange(mismatch + 2)) + random_seq(rng, 30)
+        if mode == 'rev':
+            read = random_seq(rng, 30) + read
+        if i % 10 == 0:
+            read = random_seq(rng, 40)
+        expected = edlib_lookup(barcodes, read, mismatch, 'HW' if mode == 'rev' else 'SHW')
+        assert index.lookup(read) == expected, (read, index.strategy)
+        label = index.align(read)[1]
+        assert label == (labels[expected[0]] if expected[0] is not None else '')
+
+
+def test_BarcodeIndex_strategies():
+    rng = random.Random(1)
+    apart = barcode_set(rng, 24, 12)
+    assert amptklib.BarcodeIndex(apart, 1).strategy == 'hash'
+    # neighborhoods of barcodes 2 edits apart overlap at mismatch 1, the hash alone is not safe
+    close = barcode_set(rng, 24, 12, close=2)
+    index = amptklib.BarcodeIndex(close, 1)
+    assert index.distances.collisions(1)
+    assert index.strategy != 'hash'
+    # a barcode searched anywhere in the read costs fewer alignments than lookups
+    assert amptklib.BarcodeIndex(barcode_set(rng, 1, 12), 1, mode='rev').strategy == 'scan'
+
+
+def test_BarcodeIndex_rejects_ties():
+    barcodes = collections.OrderedDict([('A', 'ACGTACGTAA'), ('B', 'ACGTACGTCC'), ('C', 'TTTTGGGGCC')])
+    index = amptklib.BarcodeIndex(barcodes, 1)
+    # one substitution from both A and B
+    assert index.lookup('ACGTACGTACGGATTACA') == (None, 1)
+    assert index.align('ACGTACGTACGGATTACA') == ('', '')
+    assert index.ambiguous == 2
+    assert index.lookup('ACGTACGTAAGGATTACA') == (0, 0)
+    assert index.lookup('TTTTGGGGCAGGATTACA') == (2, 1)
+    # the same barcode listed twice is not a tie, the first sample is used
+    same = amptklib.BarcodeIndex(collections.OrderedDict([('A', 'ACGTACGTAA'), ('B', 'ACGTACGTAA')]), 1)
+    assert same.lookup('ACGTACGTATGGATTACA') == (0, 1)
+
+
+def test_IndexResolver_matches_edlib():
+    rng = random.Random(7)
+    barcodes = barcode_set(rng, 12, 8, close=3)
+    resolver = amptklib.IndexResolver(barcodes, 1)
+    labels = list(barcodes)
+    seqs = [mutate(rng, rng.choice(list(barcodes.values())), rng.randrange(3)) for i in range(300)]
+    for seq in seqs + seqs:
+        order, d = edlib_lookup(barcodes, seq, 1, 'SHW')
+        expected = (labels[order], d) if order is not None else (None, None)
+        assert resolver.resolve(seq) == expected
+    # every distinct index sequence is looked up once
+    assert resolver.reads == 600
+    assert len(resolver.memo) == len(set(seqs))
+
+
+def dual_samples():
+    # S1/S2 share a forward barcode, S4 has no reverse barcode, X and Y are 2 edits apart
+    X, Y = 'GATTACAGAT', 'GATTACAGCC'
+    rows = [('S1', 'AAAACCCCGG', X), ('S2', 'AAAACCCCGG', Y), ('S3', 'CCCCGGGGTT', X), ('S4', 'GGGGTTTTAA', 'no_data')]
+    samples = collections.OrderedDict()
+    for name, fwd, rev in rows:
+        samples[name] = {'ForBarcode': fwd, 'ForPrimer': '', 'RevBarcode': rev, 'RevPrimer': ''}
+    return samples, X, Y
+
+
+def test_DualBarcodeIndex_resolves_pairs():
+    samples, X, Y = dual_samples()
+    dual = amptklib.DualBarcodeIndex(samples, 2)
+    assert len(dual) == 4
+    assert dual.resolve('AAAACCCCGG', X+'TTTT') == 'S1'
+    assert dual.resolve('AAAACCCCGG', Y+'TTTT') == 'S2'
+    assert dual.resolve('CCCCGGGGTT', X+'TTTT') == 'S3'
+    # Y is closest but not used with this forward barcode, X is within 2 edits
+    assert dual.resolve('CCCCGGGGTT', Y+'TTTT') == 'S3'
+    # samples without a reverse barcode need none
+    assert dual.resolve('GGGGTTTTAA', 'CCCCCCCCCCCC') == 'S4'
+
+
+def test_DualBarcodeIndex_one_sided_miss_and_ties():
+    samples, X, Y = dual_samples()
+    dual = amptklib.DualBarcodeIndex(samples, 1)
+    # forward barcode not in the mapping file
+    assert dual.resolve('TTTTTTTTTT', X+'TTTT') is None
+    # reverse barcode read matches none of the reverse barcodes
+    assert dual.resolve('AAAACCCCGG', 'CCCCCCCCCCCC') is None
+    # one edit from both X and Y: a tie for S1/S2, only X is used with S3
+    between = 'GATTACAGAC' + 'TTTT'
+    assert dual.resolve('AAAACCCCGG', between) is None
+    assert dual.resolve('CCCCGGGGTT', between) == 'S3'
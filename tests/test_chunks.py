@@ -0,0 +1,108 @@
+import gzip
+import random
+import pytest
+from amptk import amptklib
+
+
+def write_fastq(output, count, seed=1, tag=b'', bgzf=False, prefix=b'r', lengths=(50, 300)):
+    rng = random.Random(seed)
+    records = []
+    for i in range(count):
+        seq = bytes(rng.choice(b'ACGT') for _ in range(rng.randrange(*lengths)))
+        records.append(b'@%s%i%s\n%s\n+\n%s\n' % (prefix, i, tag, seq, b'I'*len(seq)))
+    data = b''.join(records)
+    if bgzf:
+        with amptklib.open_fastx_writer(output, mode='wb') as outfile:
+            outfile.write(data)
+    elif output.endswith('.gz'):
+        with gzip.open(output, 'wb') as outfile:
+            outfile.write(data)
+    else:
+        with open(output, 'wb') as outfile:
+            outfile.write(data)
+    return records
+
+
+def read_range(input, start, end):
+    with amptklib.open_fastx((input, start, end), mode='rb') as infile:
+        return infile.read()
+
+
+@pytest.mark.parametrize('name', ['reads.fq', 'reads.fq.gz'])
+def test_fastq_chunks_cover_the_file(tmp_path, name):
+    input = str(tmp_path / name)
+    records = write_fastq(input, 3000)
+    for chunks in [1, 2, 7]:
+        ranges = amptklib.fastq_chunks(input, chunks)
+        assert len(ranges) == chunks
+        data = [read_range(input, start, end) for start, end in ranges]
+        assert b''.join(data) == b''.join(records)
+        assert all(x.startswith(b'@r') for x in data)
+
+
+def test_gzip_is_split_without_a_copy(tmp_path):
+    input = str(tmp_path / 'reads.fq.gz')
+    records = write_fastq(input, 1000)
+    # gzip ranges are record numbers, each part streams and skips to its reads
+    assert amptklib.fastq_chunks(input, 4) == [(0, 250), (250, 500), (500, 750), (750, 1000)]
+    assert read_range(input, 250, 500) == b''.join(records[250:500])
+    assert sorted(x.name for x in tmp_path.iterdir()) == ['reads.fq.gz']
+
+
+def test_fastq_chunksPE_mixed_formats(tmp_path):
+    R1 = str(tmp_path / 'R1.fq.gz')
+    R2 = str(tmp_path / 'R2.fq')
+    write_fastq(R1, 2000, seed=1, tag=b' 1')
+    write_fastq(R2, 2000, seed=2, tag=b' 2')
+    chunks = amptklib.fastq_chunksPE([R1, R2], 5)
+    assert len(chunks) == 5
+    total = 0
+    for first, ranges in chunks:
+        names = [[x[0].split(b' ')[0] for x in amptklib.iter_fastq(f, start=r[0], end=r[1])]
+                 for f, r in zip([R1, R2], ranges)]
+        assert names[0] == names[1]
+        assert names[0][0] == b'r%i' % first
+        total += len(names[0])
+    assert total == 2000
+
+
+def chunk_names(inputs, chunks):
+    return [[[x[0].split(b' ')[0].split(b'/')[0] for x in amptklib.iter_fastq(f, start=r[0], end=r[1])]
+             for f, r in zip(inputs, ranges)] for first, ranges in chunks]
+
+
+def test_fastq_chunksPE_finds_mates_by_name(tmp_path, monkeypatch):
+    # R1 is short reads, the mates are long (BGZF) or index (gzip) reads, so a read is at
+    # a different fraction of each file and mates are found by name, not by counting
+    R1, R2, I1 = str(tmp_path / 'R1.fq'), str(tmp_path / 'R2.fq.gz'), str(tmp_path / 'I1.fq.gz')
+    write_fastq(R1, 6000, seed=1, tag=b'/1', lengths=(20, 400))
+    write_fastq(R2, 6000, seed=2, tag=b'/2', bgzf=True, lengths=(250, 300))
+    write_fastq(I1, 6000, seed=3, tag=b' 3:N:0', lengths=(8, 9))
+    assert [amptklib.fastx_format(x) for x in (R1, R2, I1)] == ['plain', 'bgzf', 'gzip']
+    for func in ['fastq_count_lines', 'fastq_line_offsets']:
+        monkeypatch.setattr(amptklib, func, None)
+    for inputs in [[R1, R2, I1], [R2, R1]]:
+        chunks = amptklib.fastq_chunksPE(inputs, 7)
+        assert len(chunks) == 7
+        names = chunk_names(inputs, chunks)
+        assert all(x == part[0] for part in names for x in part)
+        assert [x for part in names for x in part[0]] == [b'r%i' % i for i in range(6000)]
+        # reads are numbered from the R1 offset of their chunk
+        assert [x[0] for x in chunks] == [x[1][0][0] for x in chunks]
+        assert chunks[0][0] == 0
+    # a window far from the read grows until it is found
+    for input, format in [(R1, 'plain'), (R2, 'bgzf')]:
+        offsets = dict((amptklib.fastq_read_name(t), o) for o, t in amptklib.fastq_titles(input, 0, None, format))
+        assert amptklib.fastq_find_mate(input, b'r4500', 0.05, format, window=1000) == offsets[b'r4500']
+        assert amptklib.fastq_find_mate(input, b'missing', 0.5, format, window=1000) is None
+
+
+def test_fastq_chunksPE_mates_named_differently(tmp_path):
+    R1, R2 = str(tmp_path / 'R1.fq'), str(tmp_path / 'R2.fq')
+    write_fastq(R1, 2000, seed=1, prefix=b'a')
+    write_fastq(R2, 2000, seed=2, prefix=b'b')
+    chunks = amptklib.fastq_chunksPE([R1, R2], 4)
+    names = chunk_names([R1, R2], chunks)
+    # paired by position as before
+    assert [[x[1:] for x in part[0]] for part in names] == [[x[1:] for x in part[1]] for part in names]
+    assert sum(len(part[0]) for part in names) == 2000
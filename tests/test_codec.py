@@ -0,0 +1,93 @@
+import os
+import sys
+import glob
+import logging
+import tempfile
+import pytest
+from amptk import amptklib
+
+CODECS = list(amptklib.CODEC_EXT)
+FORMATS = {'none': 'plain', 'gzip': 'bgzf', 'zstd': 'zstd', 'lz4': 'lz4'}
+
+
+def fastq_data(count=2000):
+    return b''.join(b'@R_%i;barcodelabel=S%i;\n%s\n+\n%s\n' % (i, i % 4, b'ACGTTGCA' * 20, b'I' * 160) for i in range(count))
+
+
+def read_all(input):
+    with amptklib.open_fastx(input, mode='rb') as infile:
+        return infile.read()
+
+
+@pytest.fixture
+def no_tools(monkeypatch):
+    # neither the compression commands nor the python modules are installed
+    monkeypatch.setattr(amptklib, 'which_path', lambda x: None)
+    for module in ['zstandard', 'lz4', 'lz4.frame', 'isal']:
+        monkeypatch.setitem(sys.modules, module, None)
+
+
+def needs(codec):
+    if not amptklib.codec_available(codec):
+        pytest.skip('no {:} command or python module'.format(codec))
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_open_fastx_writer_round_trip(tmp_path, codec):
+    needs(codec)
+    output = str(tmp_path / ('reads.fq' + amptklib.CODEC_EXT[codec]))
+    data = fastq_data()
+    with amptklib.open_fastx_writer(output, mode='wb') as outfile:
+        outfile.write(data)
+    # appending adds a member that is read on after the first one
+    with amptklib.open_fastx_writer(output, mode='wb', append=True) as outfile:
+        outfile.write(data[:500])
+    assert amptklib.fastx_format(output) == FORMATS[codec]
+    assert read_all(output) == data + data[:500]
+    assert amptklib.fastx_stats(output)['records'] == 2000 + data[:500].count(b'\n') // 4
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_runSubprocessCodec_round_trip(tmp_path, monkeypatch, codec):
+    needs(codec)
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    monkeypatch.setattr(amptklib, 'TMP_CODEC', codec)
+    input, output = amptklib.tmpname(str(tmp_path / 'in.fq')), amptklib.tmpname(str(tmp_path / 'out.fq'))
+    data = fastq_data()
+    with amptklib.open_fastx_writer(input, mode='wb') as outfile:
+        outfile.write(data)
+    # cp only reads and writes plain files, the codec is handled through named pipes
+    amptklib.runSubprocessCodec(['cp', input, output], logging.getLogger('amptk-test'), inputs=[input], outputs=[output])
+    assert amptklib.fastx_format(output) == FORMATS[codec]
+    assert read_all(output) == data
+    assert not glob.glob(str(tmp_path / 'amptk_fifo_*'))
+
+
+def test_gzip_without_tools(tmp_path, no_tools):
+    # gzip is written and read in-process
+    output = str(tmp_path / 'reads.fq.gz')
+    with amptklib.open_fastx_writer(output, mode='wb') as outfile:
+        outfile.write(fastq_data())
+    assert amptklib.decompress_command(output, 'gzip') is None
+    assert read_all(output) == fastq_data()
+
+
+@pytest.mark.parametrize('codec', ['zstd', 'lz4'])
+def test_tmp_codec_without_tools(tmp_path, monkeypatch, no_tools, codec):
+    monkeypatch.setattr(amptklib, 'TMP_CODEC', 'none')
+    assert not amptklib.codec_available(codec)
+    # --tmp_codec falls back to plain intermediate files
+    assert amptklib.set_tmp_codec(codec) == 'none'
+    assert amptklib.tmpname('tmp.fq') == 'tmp.fq'
+    assert amptklib.set_tmp_codec('gzip') == 'gzip'
+    # an explicit output with the codec extension is an error, not a truncated file
+    output = str(tmp_path / ('reads.fq' + amptklib.CODEC_EXT[codec]))
+    with pytest.raises(IOError, match='python module'):
+        amptklib.open_fastx_writer(output, mode='wb')
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    input = str(tmp_path / 'in.fq')
+    with open(input, 'wb') as outfile:
+        outfile.write(fastq_data())
+    with pytest.raises(SystemExit):
+        amptklib.runSubprocessCodec(['cp', input, output], logging.getLogger('amptk-test'), inputs=[input], outputs=[output])
+    assert not glob.glob(str(tmp_path / 'amptk_fifo_*'))
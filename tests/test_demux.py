@@ -0,0 +1,160 @@
+import os
+import glob
+import gzip
+import random
+import shutil
+import hashlib
+import collections
+import pytest
+from amptk import amptklib
+
+TESTDATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_data')
+ION = os.path.join(TESTDATA, 'ion.test.fastq')
+IONXPRESS = os.path.join(os.path.dirname(amptklib.__file__), 'DB', 'ionxpress_barcodes.fa')
+needs_vsearch = pytest.mark.skipif(not shutil.which('vsearch'), reason='vsearch is not installed')
+
+# per-sample read counts and md5 of the sorted sample/sequence lines written by the
+# code before the DemuxEngine, for the same inputs and options
+ION_SAMPLES = {'BC.10': 71, 'BC.11': 66, 'BC.12': 60, 'BC.14': 65, 'BC.15': 72, 'BC.16': 72,
+               'BC.17': 90, 'BC.18': 77, 'BC.19': 53, 'BC.20': 82, 'BC.21': 72, 'BC.22': 68,
+               'BC.23': 90, 'BC.24': 62, 'BC.27': 95, 'BC.28': 88, 'BC.5': 44, 'BC.73': 80,
+               'BC.9': 65}
+ION_DIGEST = '28434ed4b261f705706b52d88b507069'
+
+
+def read_records(input):
+    opener = gzip.open if input.endswith('.gz') else open
+    with opener(input, 'rt') as infile:
+        lines = infile.read().splitlines()
+    for i in range(0, len(lines), 4):
+        yield lines[i][1:], lines[i+1]
+
+
+def digest(files, label=None):
+    # sample of each read from its barcodelabel, or label(file) for per-sample files
+    counts = collections.Counter()
+    lines = []
+    for file in files:
+        for title, seq in read_records(file):
+            sample = label(file) if label else title.split('barcodelabel=')[1].split(';')[0]
+            counts[sample] += 1
+            lines.append(sample+'\t'+seq)
+    return dict(counts), hashlib.md5('\n'.join(sorted(lines)).encode('utf-8')).hexdigest()
+
+
+def index_reads(folder, output):
+    # R1/R2 of the illumina test samples with an index read file of their dual index,
+    # every 5th index read has a mismatch and every 11th is not a sample
+    rng = random.Random(5)
+    barcodes = {}
+    files = [output+'_R1.fq', output+'_R2.fq', output+'_I1.fq']
+    outfiles = [open(x, 'w') for x in files]
+    n = 0
+    for r1 in sorted(glob.glob(os.path.join(folder, '*_R1_*.fastq.gz'))):
+        sample, index = os.path.basename(r1).split('_')[:2]
+        barcodes[sample] = index.replace('-', '')
+        for read1, read2 in zip(read_records(r1), read_records(r1.replace('_R1_', '_R2_'))):
+            index = barcodes[sample]
+            if n % 11 == 3:
+                index = ''.join(rng.choice('ACGT') for i in range(len(index)))
+            elif n % 5 == 1:
+                pos = rng.randrange(len(index))
+                index = index[:pos] + {'A': 'C', 'C': 'G', 'G': 'T', 'T': 'A'}[index[pos]] + index[pos+1:]
+            name = read1[0].split(' ')[0]
+            for outfile, (title, seq) in zip(outfiles, [read1, read2, (name+' 3:N:0', index)]):
+                outfile.write('@%s\n%s\n+\n%s\n' % (title, seq, 'I'*len(seq)))
+            n += 1
+    for outfile in outfiles:
+        outfile.close()
+    return files, barcodes
+
+
+@pytest.fixture
+def run_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    monkeypatch.setattr(amptklib, 'get_version', lambda: 'test')
+    return tmp_path
+
+
+@pytest.mark.parametrize('cpus', ['1', '2'])
+def test_process_ion_matches_baseline(run_dir, cpus):
+    from amptk import process_ion
+    process_ion.main(['-i', ION, '-o', 'ion', '--cpus', cpus])
+    assert digest(['ion.demux.fq.gz']) == (ION_SAMPLES, ION_DIGEST)
+
+
+def test_process_ion_mismatch_pad_matches_baseline(run_dir):
+    from amptk import process_ion
+    process_ion.main(['-i', ION, '-o', 'ion', '--cpus', '1', '--barcode_mismatch', '1', '--pad', 'on', '-l', '200'])
+    samples = {'BC.10': 83, 'BC.11': 75, 'BC.12': 62, 'BC.13': 1, 'BC.14': 74, 'BC.15': 86, 'BC.16': 92,
+               'BC.17': 110, 'BC.18': 85, 'BC.19': 61, 'BC.20': 98, 'BC.21': 83, 'BC.22': 73, 'BC.23': 96,
+               'BC.24': 72, 'BC.27': 106, 'BC.28': 100, 'BC.35': 1, 'BC.42': 1, 'BC.5': 53, 'BC.61': 2,
+               'BC.73': 103, 'BC.9': 76}
+    assert digest(['ion.demux.fq.gz']) == (samples, 'f35d4eec278f46c17a8622b6d2e59a15')
+
+
+def test_fastq2sra_ion_matches_baseline(run_dir):
+    from amptk import fastq2sra
+    with open('map.txt', 'w') as mapping:
+        mapping.write('#SampleID\tBarcodeSequence\tLinkerPrimerSequence\tRevBarcodeSequence\tReversePrimer\tphinchID\tTreatment\n')
+        for name, seq in amptklib.fasta2barcodes(IONXPRESS, False).items():
+            mapping.write('%s\t%s\tGTGARTCATCGAATCTTTG\t\tTCCTCCGCTTATTGATATGC\t%s\tno_data\n' % (name, seq, name))
+    fastq2sra.main(['-i', ION, '-o', 'sra', '-m', 'map.txt'])
+    files = glob.glob(os.path.join('sra', '*.fastq.gz'))
+    samples = {'BC.10': 71, 'BC.11': 67, 'BC.12': 61, 'BC.14': 66, 'BC.15': 74, 'BC.16': 74, 'BC.17': 92,
+               'BC.18': 82, 'BC.19': 53, 'BC.20': 85, 'BC.21': 73, 'BC.22': 69, 'BC.23': 92, 'BC.24': 63,
+               'BC.27': 95, 'BC.28': 92, 'BC.5': 44, 'BC.73': 89, 'BC.9': 66}
+    # untrimmed reads in one file per sample
+    assert digest(files, label=lambda x: os.path.basename(x).split('.fastq')[0]) == (samples, 'f7a979eef49dadffded11d2dd29b5ba8')
+
+
+@needs_vsearch
+def test_process_illumina2_matches_baseline(run_dir):
+    from amptk import process_illumina2
+    process_illumina2.main(['-i', ION, '-o', 'i2', '--barcode_fasta', IONXPRESS, '-f', 'fITS7-ion', '-r', 'ITS4', '--cpus', '2'])
+    assert digest(['i2.demux.fq.gz']) == (ION_SAMPLES, ION_DIGEST)
+
+
+def test_DemuxIllumina_matches_baseline(tmp_path, illumina_folder):
+    (R1, R2, I1), barcodes = index_reads(illumina_folder, str(tmp_path / 'raw'))
+    outR1, outR2 = str(tmp_path / 'out_R1.fq'), str(tmp_path / 'out_R2.fq')
+    counts = amptklib.DemuxIllumina(R1, R2, I1, barcodes, 1, amptklib.primer_db['fITS7'], amptklib.primer_db['ITS4'], 2, outR1, outR2)
+    samples = {'301-1': 91, '301-2': 91, 'spike': 363}
+    assert counts == (600, 545, 545, 545)
+    assert digest([outR1]) == (samples, '3592ff8b0ce72126bb59444ca7eb36c7')
+    assert digest([outR2]) == (samples, '84861fc6de52416531a3c6fd9efb3321')
+
+
+def test_runQueue_matches_run(tmp_path, illumina_folder, monkeypatch):
+    # small batches, so the workers hand them back out of order
+    monkeypatch.setattr(amptklib, 'BATCH_SIZE', 50)
+    (R1, R2, I1), barcodes = index_reads(illumina_folder, str(tmp_path / 'raw'))
+    engine = amptklib.DemuxEngine([amptklib.IndexReadResolver(amptklib.IndexResolver(barcodes, 1)),
+                                   amptklib.PairedPrimerTrimmer(amptklib.PrimerSet(amptklib.primer_db['fITS7'], amptklib.primer_db['ITS4'], 2))])
+    single = [str(tmp_path / 'run_R1.fq'), str(tmp_path / 'run_R2.fq')]
+    stats = engine.run([(x, 0, None) for x in (R1, R2, I1)], amptklib.DemuxWriter(single[0], output2=single[1]))
+    parts = [(str(tmp_path / ('part%i_R1.fq' % i)), str(tmp_path / ('part%i_R2.fq' % i))) for i in range(3)]
+    writer = amptklib.DemuxPartWriter(parts, reads=200)
+    queued = engine.runQueue([R1, R2, I1], writer, 2, slots=3)
+    assert len(writer.parts) == 3
+    assert queued == stats
+    # read numbers continue across the parts, so the reads are the same in the same order
+    for i in range(2):
+        expected = list(read_records(single[i]))
+        assert [x for part in writer.parts for x in read_records(part[i])] == expected
+
+
+@needs_vsearch
+def test_process_illumina_raw_queue_matches_chunks(run_dir, illumina_folder):
+    from amptk import process_illumina_raw
+    (R1, R2, I1), barcodes = index_reads(illumina_folder, 'raw')
+    with open('barcodes.fa', 'w') as fasta:
+        for name, seq in barcodes.items():
+            fasta.write('>%s\n%s\n' % (name, seq))
+    results = []
+    for mode in ['queue', 'chunks']:
+        process_illumina_raw.main(['-f', R1, '-r', R2, '-i', I1, '--barcode_fasta', 'barcodes.fa', '--barcode_mismatch', '1',
+                                   '--fwd_primer', 'fITS7', '--rev_primer', 'ITS4', '--cpus', '2', '--demux_mode', mode, '-o', mode])
+        results.append(digest([mode+'.demux.fq.gz']))
+    assert results[0] == results[1]
+    assert set(results[0][0]) == set(barcodes)
@@ -0,0 +1,150 @@
+import random
+import edlib
+import pytest
+from amptk import amptklib
+
+PRIMERS = [amptklib.primer_db['fITS7'], amptklib.primer_db['ITS4'], amptklib.primer_db['515FB'],
+           amptklib.RevComp(amptklib.primer_db['806RB'])]
+
+
+def mutate(rng, seq, edits):
+    seq = list(seq)
+    for i in range(edits):
+        pos = rng.randrange(len(seq))
+        kind = rng.choice(['sub', 'ins', 'del'])
+        if kind == 'sub':
+            seq[pos] = rng.choice('ACGT')
+        elif kind == 'ins':
+            seq.insert(pos, rng.choice('ACGT'))
+        elif len(seq) > 1:
+            del seq[pos]
+    return ''.join(seq)
+
+
+def concrete(rng, primer):
+    # a read copy of a degenerate primer
+    codes = {}
+    for x, y in amptklib.degenNuc:
+        codes.setdefault(x, []).append(y)
+    return ''.join(rng.choice(codes[x]) if x in codes else x for x in primer)
+
+
+def random_reads(rng, primer, mismatch, count):
+    reads = []
+    for i in range(count):
+        length = rng.choice([0, 5, 60, 150, 300])
+        read = ''.join(rng.choice('ACGT') for x in range(length))
+        if length and i % 4:
+            pos = rng.randrange(length)
+            read = read[:pos] + mutate(rng, concrete(rng, primer), rng.randrange(mismatch+2)) + read[pos:]
+        if i % 7 == 0 and read:
+            pos = rng.randrange(len(read))
+            read = read[:pos] + 'N' + read[pos+1:]
+        reads.append(read)
+    return reads
+
+
+def edlib_hw(primer, seq, mismatch, task='locations'):
+    return edlib.align(primer, seq, mode='HW', task=task, k=mismatch, additionalEqualities=amptklib.degenNuc)
+
+
+@pytest.mark.parametrize('mismatch', [0, 1, 2, 3])
+def test_BatchMatcher_matches_edlib(mismatch):
+    rng = random.Random(mismatch)
+    for primer in PRIMERS:
+        reads = random_reads(rng, primer, mismatch, 400)
+        matcher = amptklib.BatchMatcher(primer, mismatch)
+        dist, start, end, multi = matcher.align(reads, locations=True)
+        for i, read in enumerate(reads):
+            align = edlib_hw(primer, read, mismatch)
+            assert dist[i] == align['editDistance']
+            if align['editDistance'] < 0 or not read:
+                continue
+            ends = set(e for s, e in align['locations'])
+            assert multi[i] == (len(ends) > 1)
+            if not multi[i]:
+                assert (start[i], end[i]) == align['locations'][0]
+
+
+def reference_locate(primer, seq, mismatch, end, window):
+    # the PrimerLocator search spelled out with whole edlib calls: the window, then the
+    # rest of the read (overlapping the window by a primer length) if it has no hit, or
+    # the whole read if the hit is at the inner window edge.  Returns (result, fallback)
+    task = 'locations' if end else 'distance'
+    if len(seq) <= window:
+        return edlib_hw(primer, seq, mismatch, task), 0
+    offset = len(seq) - window if end else 0
+    align = edlib_hw(primer, seq[offset:offset+window], mismatch, task)
+    if align['editDistance'] >= 0:
+        locations = [(None if s is None else s+offset, e+offset) for s, e in align['locations']]
+        if end:
+            edge = any(s is None or s - offset <= mismatch for s, e in locations)
+        else:
+            edge = any(e - offset >= window - 1 - mismatch for s, e in locations)
+        if edge:
+            return edlib_hw(primer, seq, mismatch, task), 1
+        align['locations'] = locations
+        return align, 0
+    overlap = len(primer) + mismatch
+    if end:
+        return edlib_hw(primer, seq[:len(seq)-window+overlap], mismatch, task), 1
+    offset = max(window - overlap, 0)
+    align = edlib_hw(primer, seq[offset:], mismatch, task)
+    if align['editDistance'] >= 0:
+        align['locations'] = [(None if s is None else s+offset, e+offset) for s, e in align['locations']]
+    return align, 1
+
+
+def first_hit(align):
+    if align['editDistance'] < 0:
+        return -1, None
+    return align['editDistance'], align['locations'][0]
+
+
+@pytest.mark.parametrize('end', [False, True])
+@pytest.mark.parametrize('mismatch', [0, 2])
+def test_PrimerLocator_matches_edlib(end, mismatch):
+    rng = random.Random(10 + mismatch)
+    for primer in PRIMERS:
+        reads = [x for x in random_reads(rng, primer, mismatch, 300) if x]
+        single = amptklib.PrimerLocator(primer, mismatch, end=end)
+        batch = amptklib.PrimerLocator(primer, mismatch, end=end)
+        results = batch.alignBatch(reads)
+        fallback = 0
+        for read, result in zip(reads, results):
+            expected, fell = reference_locate(primer, read, mismatch, end, single.window)
+            fallback += fell
+            assert first_hit(single.align(read)) == first_hit(expected)
+            assert first_hit(result) == first_hit(expected)
+            # the window search never finds a hit edlib does not, and never a better one
+            whole = edlib_hw(primer, read, mismatch)
+            if whole['editDistance'] < 0:
+                assert expected['editDistance'] < 0
+            else:
+                assert expected['editDistance'] >= whole['editDistance']
+        assert single.searches == batch.searches == len(reads)
+        assert single.fallback == batch.fallback == fallback
+
+
+def test_PrimerLocator_fallback_counts():
+    rng = random.Random(3)
+    primer = amptklib.primer_db['fITS7']
+    seq = concrete(rng, primer)
+    body = lambda n: ''.join(rng.choice('ACGT') for x in range(n))
+    locator = amptklib.PrimerLocator(primer, 2)
+    # primer at the read start is found in the window
+    assert locator.align(seq + body(200))['editDistance'] == 0
+    assert locator.fallback == 0
+    # primer after the window needs the rest of the read
+    align = locator.align(body(150) + seq + body(100))
+    assert align['editDistance'] == 0 and align['locations'][0][1] == 150 + len(seq) - 1
+    assert locator.fallback == 1
+    # a hit ending at the window edge may be cut short, the whole read is searched
+    cut = locator.window - len(seq) + 1
+    locator.align(body(cut) + seq + body(100))
+    assert locator.fallback == 2
+    # no primer piece in the window or the rest of the read, edlib is not called
+    skipped = locator.skipped
+    assert locator.align('A' * 300)['editDistance'] == -1
+    assert locator.skipped == skipped + 2 and locator.fallback == 3
+    assert locator.searches == 4
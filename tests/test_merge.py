@@ -0,0 +1,60 @@
+import os
+import glob
+import random
+from amptk import amptklib
+
+
+def read_pairs(r1):
+    r2 = r1.replace('_R1_', '_R2_')
+    return [(a[1], a[2], b[1], b[2]) for a, b in zip(amptklib.iter_fastq(r1), amptklib.iter_fastq(r2))]
+
+
+def test_merge_illumina_test_data(illumina_folder):
+    # pairs that do not merge have no overlap, the ITS amplicon is longer than both reads
+    expected = {'301-1': 98, '301-2': 98, 'spike': 389}
+    for r1 in sorted(glob.glob(os.path.join(illumina_folder, '*_R1_*.fastq.gz'))):
+        pairs = read_pairs(r1)
+        merger = amptklib.PairMerger()
+        merged = merger.merge(pairs)
+        assert merger.counts['merged'] == expected[os.path.basename(r1).split('_')[0]]
+        assert merger.counts['too_many_diffs'] == 0
+        for (seq1, qual1, seq2, qual2), result in zip(pairs, merged):
+            if result is None:
+                continue
+            seq, qual = result
+            assert len(seq) == len(qual)
+            # R1 start and R2 start (reverse complemented) end up at the two ends,
+            # staggered pairs have their overhangs cut
+            if len(seq) >= len(seq1):
+                assert seq.startswith(seq1[:20])
+            if len(seq) >= len(seq2):
+                assert seq.endswith(amptklib.RevComp(seq2.decode('utf-8'))[-20:].encode('utf-8'))
+
+
+def overlap_pair(rng, tail_qual, errors):
+    # 300 bp amplicon read 2x250, errors put in the R2 copy of the 200 bp overlap
+    amplicon = ''.join(rng.choice('ACGT') for _ in range(300))
+    seq1 = amplicon[:250]
+    seq2 = list(amptklib.RevComp(amplicon[50:]))
+    qual2 = [tail_qual if 180 <= i < 250 else 'I' for i in range(250)]
+    for i in rng.sample(range(180, 250), errors):
+        seq2[i] = {'A': 'C', 'C': 'G', 'G': 'T', 'T': 'A'}[seq2[i]]
+    return amplicon, (seq1.encode('utf-8'), b'I'*250, ''.join(seq2).encode('utf-8'), ''.join(qual2).encode('utf-8'))
+
+
+def test_merge_quality_aware_diffs():
+    rng = random.Random(1)
+    # mismatches in a Q2 tail are not differences, the high quality base wins
+    amplicon, pair = overlap_pair(rng, '#', 20)
+    merger = amptklib.PairMerger()
+    merged = merger.merge([pair])[0]
+    assert merged is not None
+    assert merged[0] == amplicon.encode('utf-8')
+    # the same mismatches with good qualities are too many differences
+    amplicon, pair = overlap_pair(rng, 'I', 12)
+    merger = amptklib.PairMerger()
+    assert merger.merge([pair]) == [None]
+    assert merger.counts['too_many_diffs'] == 1
+    # up to --fastq_maxdiffs good quality mismatches merge
+    amplicon, pair = overlap_pair(rng, 'I', 10)
+    assert amptklib.PairMerger().merge([pair])[0] is not None
@@ -0,0 +1,60 @@
+import random
+from amptk import amptklib
+
+
+def phix_genome():
+    with open(amptklib.PHIX_REFERENCE) as infile:
+        return ''.join(x.strip() for x in infile if not x.startswith('>'))
+
+
+def amplicon_reads(folder):
+    name = folder + '/301-1_TCCGGAGA-CCTATCCT_L001_R1_001.fastq.gz'
+    return list(amptklib.iter_fastq(name))
+
+
+def phix_reads(rng, genome, count=100, length=250):
+    # reads of both strands, some across the origin of the circular genome, with a few errors
+    circular = genome + genome[:length]
+    reads = []
+    for i in range(count):
+        start = rng.randrange(len(genome))
+        seq = list(circular[start:start+length])
+        for pos in rng.sample(range(length), 3):
+            seq[pos] = rng.choice('ACGT')
+        seq = ''.join(seq)
+        if i % 2:
+            seq = amptklib.RevComp(seq)
+        reads.append((b'phix_%i' % i, seq.encode('utf-8'), b'I'*length))
+    return reads
+
+
+def test_phix_reference_bundled():
+    genome = phix_genome()
+    assert len(genome) == 5386
+    assert set(genome) == set('ACGT')
+
+
+def test_phix_screen_drops_phix_keeps_amplicons(tmp_path, illumina_folder):
+    rng = random.Random(42)
+    screen = amptklib.loadPhixScreen()
+    assert screen is not None
+    amplicons = amplicon_reads(illumina_folder)
+    phix = phix_reads(rng, phix_genome())
+    mixed = amplicons + phix
+    rng.shuffle(mixed)
+    fastq = str(tmp_path / 'mixed.fq')
+    with open(fastq, 'wb') as outfile:
+        for title, seq, qual in mixed:
+            outfile.write(b'@%s\n%s\n+\n%s\n' % (title, seq, qual))
+    output = str(tmp_path / 'screened.fq')
+    total, kept = amptklib.filterPhix([fastq], output, screen)
+    assert total == len(mixed)
+    assert kept == len(amplicons)
+    assert set(x[0] for x in amptklib.iter_fastq(output)) == set(x[0] for x in amplicons)
+    assert screen.screened == len(mixed)
+    assert screen.removed == len(phix)
+
+
+def test_phix_screen_off(tmp_path):
+    assert amptklib.loadPhixScreen(0) is None
+    assert amptklib.loadPhixScreen(10, reference=str(tmp_path / 'missing.fa')) is None
@@ -0,0 +1,58 @@
+import os
+import glob
+import logging
+import tempfile
+import threading
+import pytest
+from amptk import amptklib
+
+
+def children():
+    # child processes of this process, zombies included
+    pids = []
+    for task in glob.glob('/proc/self/task/*/children'):
+        with open(task) as infile:
+            pids += infile.read().split()
+    return pids
+
+
+def write_fasta(output, count=1000):
+    with open(output, 'w') as outfile:
+        for i in range(count):
+            outfile.write('>R_%i;barcodelabel=S%i;\n%s\n' % (i, i % 3, 'ACGT' * 30))
+
+
+@pytest.fixture
+def pipe_dir(tmp_path, monkeypatch):
+    # the named pipes go in a folder under tmp_path
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    before = (children(), threading.active_count())
+    yield tmp_path
+    assert not glob.glob(str(tmp_path / 'amptk_fifo_*'))
+    assert children() == before[0]
+    assert threading.active_count() == before[1]
+
+
+def test_runPipeline_pipes_and_counts(pipe_dir):
+    fasta, copy, out1, out2 = [str(pipe_dir / x) for x in ('in.fa', 'copy.fa', 'out1.fa', 'out2.fa')]
+    stages = [(write_fasta, [], [fasta]),
+              (['cp', fasta, copy], [fasta], [copy]),
+              (['cp', copy, out1], [copy], [out1]),
+              (['cp', copy, out2], [copy], [out2])]
+    totals = amptklib.runPipeline(stages, logging.getLogger('amptk-test'), counts=[copy, out1])
+    assert totals == {copy: 1000, out1: 1000}
+    # the piped file is never written
+    assert not os.path.exists(copy)
+    with open(out1) as a, open(out2) as b:
+        assert a.read() == b.read()
+
+
+@pytest.mark.parametrize('middle', [['sh', '-c', 'exit 3'], ['amptk-no-such-command']])
+def test_runPipeline_failing_middle_stage(pipe_dir, middle):
+    # the middle stage never opens its pipes, the other stages must not be left blocked
+    fasta, mid, out = [str(pipe_dir / x) for x in ('in.fa', 'mid.fa', 'out.fa')]
+    stages = [(write_fasta, [], [fasta]),
+              (middle + [fasta, mid], [fasta], [mid]),
+              (['cp', mid, out], [mid], [out])]
+    with pytest.raises(SystemExit):
+        amptklib.runPipeline(stages, logging.getLogger('amptk-test'))
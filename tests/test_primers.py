@@ -0,0 +1,40 @@
+import os
+import glob
+import edlib
+from amptk import amptklib
+
+
+FWD = amptklib.primer_db['fITS7']
+REV = amptklib.primer_db['ITS4']
+
+
+def edlib_strip(pairs, fwd, rev, mismatch, require_primer, length):
+    # whole read HW search of the primers at the read starts, reads are cut after them
+    results = []
+    for seq1, qual1, seq2, qual2 in pairs:
+        seq1, seq2 = seq1[:length], seq2[:length]
+        cut = []
+        for primer, seq in [(fwd, seq1), (rev, seq2)]:
+            align = edlib.align(primer, seq, mode='HW', k=mismatch, additionalEqualities=amptklib.degenNuc)
+            if align['editDistance'] < 0:
+                cut.append(None if require_primer == 'on' else 0)
+            elif len(align['locations']) > 1:
+                cut.append(None)
+            else:
+                cut.append(align['locations'][0][1]+1)
+        if None in cut:
+            continue
+        results.append((seq1[cut[0]:], seq2[cut[1]:]))
+    return results
+
+
+def test_stripPrimersPE_matches_edlib(tmp_path, illumina_folder):
+    for r1 in sorted(glob.glob(os.path.join(illumina_folder, '*_R1_*.fastq.gz'))):
+        r2 = r1.replace('_R1_', '_R2_')
+        pairs = [(a[1].decode(), a[2].decode(), b[1].decode(), b[2].decode())
+                 for a, b in zip(amptklib.iter_fastq(r1), amptklib.iter_fastq(r2))]
+        for mismatch, require_primer in [(0, 'on'), (2, 'off')]:
+            out1, out2 = str(tmp_path / 'R1.fq'), str(tmp_path / 'R2.fq')
+            amptklib.stripPrimersPE(r1, r2, 300, 'x', FWD, REV, mismatch, require_primer, False, out1, out2)
+            result = [(a[1].decode(), b[1].decode()) for a, b in zip(amptklib.iter_fastq(out1), amptklib.iter_fastq(out2))]
+            assert result == edlib_strip(pairs, FWD, REV, mismatch, require_primer, 300)
@@ -0,0 +1,37 @@
+import os
+import random
+import pytest
+from amptk import amptklib
+
+
+def write_demux(output, count, seed):
+    # demuxed reads of samples S1..S12 in random order, some reads have no label
+    rng = random.Random(seed)
+    records = []
+    with open(output, 'wb') as outfile:
+        for i in range(count):
+            sample = b'S%i' % rng.randrange(1, 13)
+            title = b'R_%i;barcodelabel=%s;' % (i, sample) if i % 50 else b'R_%i' % i
+            seq = bytes(rng.choice(b'ACGT') for x in range(rng.randrange(20, 120)))
+            outfile.write(b'@%s\n%s\n+\n%s\n' % (title, seq, b'I'*len(seq)))
+            records.append((sample.decode() if i % 50 else '', (title, seq, b'I'*len(seq))))
+    return records
+
+
+@pytest.mark.parametrize('buffersize,maxopen', [(67108864, 128), (4000, 128), (4000, 3)])
+def test_sort_fastx_by_sample(tmp_path, buffersize, maxopen):
+    inputs = [str(tmp_path / ('in%i.fq' % i)) for i in range(3)]
+    records = [x for i, input in enumerate(inputs) for x in write_demux(input, 700, i)]
+    output = str(tmp_path / 'sorted.fq.gz')
+    amptklib.sort_fastx_by_sample(inputs, output, tmpdir=str(tmp_path), buffersize=buffersize, maxopen=maxopen)
+    # the spill runs are removed
+    assert sorted(os.listdir(str(tmp_path))) == ['in0.fq', 'in1.fq', 'in2.fq', 'sorted.fq.gz', 'sorted.fq.gz.idx']
+    index = amptklib.fastx_index(output)
+    samples = amptklib.natsorted(set(x[0] for x in records))
+    assert list(index) == samples
+    # each sample's reads in input order, found at its index range
+    for sample, (start, end, count) in index.items():
+        expected = [x[1] for x in records if x[0] == sample]
+        assert list(amptklib.iter_fastq(output, start=start, end=end)) == expected
+        assert count == len(expected)
+    assert sum(1 for x in amptklib.iter_fastq(output)) == len(records)
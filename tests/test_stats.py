@@ -0,0 +1,36 @@
+import os
+from amptk import amptklib
+
+
+def write_reads(output, samples):
+    with amptklib.FastqWriter(output) as outfile:
+        for sample, count in samples:
+            for i in range(count):
+                outfile.write(b'r%i;barcodelabel=%s;' % (i, sample), b'ACGT'*(i+1), b'I'*4*(i+1))
+
+
+def test_fastx_stats_counts_without_sidecar(tmp_path):
+    output = str(tmp_path / 'demux.fq.gz')
+    write_reads(output, [(b'A', 3), (b'B', 2)])
+    # nothing is counted or saved while writing
+    assert os.listdir(str(tmp_path)) == ['demux.fq.gz']
+    stats = amptklib.fastx_stats(output)
+    assert stats['records'] == 5
+    assert stats['bases'] == 4*(1+2+3) + 4*(1+2)
+    assert stats['samples'] == {'A': 3, 'B': 2}
+    assert stats['lengths'] == {4: 2, 8: 2, 12: 1}
+    assert os.listdir(str(tmp_path)) == ['demux.fq.gz']
+
+
+def test_fastx_stats_sidecar_opt_in(tmp_path, monkeypatch):
+    monkeypatch.setattr(amptklib, 'STATS_SIDECAR', True)
+    output = str(tmp_path / 'demux.fq')
+    write_reads(output, [(b'A', 2)])
+    assert amptklib.countfastq(output) == 2
+    assert os.path.isfile(amptklib.fastx_stats_file(output))
+    # a new process reads the sidecar, a rewritten file is counted again
+    amptklib.FASTX_STATS.clear()
+    assert amptklib.fastx_stats(output)['samples'] == {'A': 2}
+    write_reads(output, [(b'A', 2), (b'C', 5)])
+    os.utime(output, (0, 0))
+    assert amptklib.fastx_stats(output)['samples'] == {'A': 2, 'C': 5}